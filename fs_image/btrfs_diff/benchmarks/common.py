@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+'Helpers shared by the `btrfs_diff` benchmarks.'
+import struct
+import time
+import tracemalloc
+
+from typing import Any, Callable
+
+from ..parse_send_stream import BTRFS_SEND_STREAM_MAGIC
+
+_STREAM_HEADER_SIZE = len(BTRFS_SEND_STREAM_MAGIC) + 4  # magic & version
+_END_SIZE = struct.calcsize('<IHI')  # END has no attributes
+
+
+def best_of(fn: Callable[[], Any], *, repeat: int) -> float:
+    '''
+    Returns the fastest wall-clock time, in seconds, of `repeat` calls to
+    `fn`.  The minimum is the least noisy estimate of what `fn` costs.
+    '''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def peak_memory(fn: Callable[[], Any]) -> int:
+    '''
+    Returns the peak number of bytes that Python allocated during `fn()`,
+    as seen by `tracemalloc`.  Tracing slows `fn` down, so do not combine
+    this with timing.
+    '''
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def repeat_send_stream_commands(sendstream: bytes, copies: int) -> bytes:
+    '''
+    Makes a bigger send-stream by repeating all the commands of `sendstream`
+    (except END) `copies` times.  The result parses fine, but of course it
+    cannot be applied to a `Subvolume`.
+    '''
+    return b''.join([
+        sendstream[:_STREAM_HEADER_SIZE],
+        sendstream[_STREAM_HEADER_SIZE:-_END_SIZE] * copies,
+        sendstream[-_END_SIZE:],
+    ])
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+'''
+Usage:
+
+    python3 -m btrfs_diff.benchmarks.extent_writes \\
+        [--writes N] [--write-size BYTES] [--clone-every N]
+
+Applies N small writes to one file's `Extent`, once at sequential offsets,
+and once at random offsets, and reports the time per write, the time to
+list the file's trimmed leaves, the tree height, and the peak memory.
+With `--clone-every`, every that many writes, we also clone a random
+range of the file back into itself.
+
+Each operation should cost O(log N), so the time per write should grow
+only slightly with N, and the height should stay below 1.45 * log2(N).
+'''
+import argparse
+import math
+import random
+import sys
+import time
+
+from ..extent import Extent
+
+from .common import peak_memory
+
+
+def _apply_writes(offsets, write_size, clone_every, rand):
+    e = Extent.empty()
+    for i, offset in enumerate(offsets):
+        e = e.write(offset=offset, length=write_size)
+        if clone_every and i % clone_every == clone_every - 1:
+            length = rand.randrange(1, e.length // 2 + 1)
+            e = e.clone(
+                to_offset=rand.randrange(e.length),
+                from_extent=e,
+                from_offset=rand.randrange(e.length - length + 1),
+                length=length,
+            )
+    return e
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--writes', type=int, default=100000)
+    parser.add_argument('--write-size', type=int, default=4096)
+    parser.add_argument('--clone-every', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv[1:])
+
+    rand = random.Random(args.seed)
+    for name, offsets in [
+        ('sequential', [i * args.write_size for i in range(args.writes)]),
+        ('random', [
+            rand.randrange(args.writes * args.write_size)
+                for _ in range(args.writes)
+        ]),
+    ]:
+        start = time.perf_counter()
+        e = _apply_writes(offsets, args.write_size, args.clone_every, rand)
+        write_sec = time.perf_counter() - start
+
+        start = time.perf_counter()
+        num_leaves = sum(1 for _ in e.gen_trimmed_leaves())
+        leaves_sec = time.perf_counter() - start
+
+        mb = peak_memory(lambda: _apply_writes(
+            offsets, args.write_size, args.clone_every, rand,
+        )) / 1e6
+        print(
+            f'{args.writes} {name} writes: '
+            f'{1e6 * write_sec / args.writes:.1f}us/write, '
+            f'{num_leaves} leaves listed in {leaves_sec:.3f}s, '
+            f'height {e.height} (log2 {math.log2(num_leaves + 1):.1f}), '
+            f'{mb:.1f}MB peak'
+        )
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
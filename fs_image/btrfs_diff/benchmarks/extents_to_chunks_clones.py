@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+'''
+Usage:
+
+    python3 -m btrfs_diff.benchmarks.extents_to_chunks_clones \\
+        [--clones N1 N2 ...] [--max-quadratic-clones N]
+
+Clones one DATA extent into N files, and measures the time & peak memory
+of `extents_to_chunks_with_clones` with both clone representations.  With
+`shared_extents=True`, both should grow linearly in N.  The default
+`ChunkClone` representation grows quadratically, so it is skipped above
+`--max-quadratic-clones`.
+'''
+import argparse
+import sys
+
+from ..extent import Extent
+from ..extents_to_chunks import extents_to_chunks_with_clones
+from ..inode_id import InodeIDMap
+
+from .common import best_of, peak_memory
+
+
+def _make_ids_and_extents(num_clones):
+    id_map = InodeIDMap.new()
+    source = Extent.empty().write(offset=0, length=4096)
+    return [
+        (
+            id_map.add_file(id_map.next(), b'f%d' % i),
+            Extent.empty().clone(
+                to_offset=0, from_extent=source, from_offset=0, length=4096,
+            ),
+        ) for i in range(num_clones)
+    ]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        '--clones', type=int, nargs='+', default=[250, 500, 1000, 2000, 4000],
+    )
+    parser.add_argument('--max-quadratic-clones', type=int, default=1000)
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='Report the best of this many runs.',
+    )
+    args = parser.parse_args(argv[1:])
+
+    for num_clones in args.clones:
+        ids_and_extents = _make_ids_and_extents(num_clones)
+        for shared_extents in [True, False]:
+            if not shared_extents and num_clones > args.max_quadratic_clones:
+                continue
+
+            def run():
+                for _ in extents_to_chunks_with_clones(
+                    ids_and_extents, shared_extents=shared_extents,
+                ):
+                    pass
+
+            sec = best_of(run, repeat=args.repeat)
+            mb = peak_memory(run) / 1e6
+            print(
+                f'{num_clones} clones, shared_extents={shared_extents}: '
+                f'{sec:.3f}s, {mb:.1f}MB peak'
+            )
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+'''
+Usage:
+
+    python3 -m btrfs_diff.benchmarks.inode_id_renames \\
+        [--files N] [--depth N] [--files-per-dir N] [--repeat N]
+
+`btrfs send` first creates every inode at the root of the subvolume
+under a temporary name like `o257-2433-0`, and only then renames it into
+place.  This replays that pattern on an `InodeIDMap`: it makes a chain of
+`--depth` nested directories, and then leaf directories under it with N
+files in total.  Then, it looks up the ID of every file by path, and
+makes the paths of every file from its ID.
+
+Reports the best time per operation for each phase.  With an O(depth)
+index, these should grow linearly with `--depth`, or not at all for
+`get_paths`, since directory paths are cached.
+'''
+import argparse
+import sys
+
+from ..inode_id import InodeIDMap
+
+from .common import best_of
+
+
+def _temp_name(ino_id):
+    return b'o%d-2433-0' % ino_id.id
+
+
+def _add_renamed(id_map, add, path):
+    ino_id = id_map.next()
+    temp = _temp_name(ino_id)
+    add(ino_id, temp)
+    id_map.rename_path(temp, path)
+    return ino_id
+
+
+def _make_map(args):
+    id_map = InodeIDMap.new()
+    parent = b'.'
+    for d in range(args.depth):
+        parent = b'd%d' % d if parent == b'.' else parent + b'/d%d' % d
+        _add_renamed(id_map, id_map.add_dir, parent)
+    file_paths = []
+    for i in range(args.files):
+        leaf = parent + b'/leaf%d' % (i // args.files_per_dir)
+        if i % args.files_per_dir == 0:
+            _add_renamed(id_map, id_map.add_dir, leaf)
+        file_paths.append(leaf + b'/f%d' % i)
+        _add_renamed(id_map, id_map.add_file, file_paths[-1])
+    return id_map, file_paths
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--depth', type=int, default=20)
+    parser.add_argument('--files-per-dir', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv[1:])
+
+    id_map, file_paths = _make_map(args)
+    ino_ids = [id_map.get_id(p) for p in file_paths]
+    num_inodes = args.depth + args.files + (
+        args.files + args.files_per_dir - 1
+    ) // args.files_per_dir
+
+    for desc, count, fn in [
+        ('add & rename', num_inodes, lambda: _make_map(args)),
+        ('get_id', args.files, lambda: [id_map.get_id(p) for p in file_paths]),
+        ('get_paths', args.files, lambda: [
+            id_map.get_paths(i) for i in ino_ids
+        ]),
+    ]:
+        sec = best_of(fn, repeat=args.repeat)
+        print(f'{desc}: {1e6 * sec / count:.2f}us per inode')
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+'''
+Usage:
+
+    python3 -m btrfs_diff.benchmarks.large_scale \\
+        [--files N] [--snapshots N] [--changes-per-snapshot N] \\
+        [--files-per-dir N] [--depth N] [--clone-every N] [--xattrs N] \\
+        [--block-size N] [--max-blocks N] [--seed N] [--repeat N] \\
+        [--no-memory]
+
+Runs the main stages of `btrfs_diff` on a chain of synthetic send-streams
+from `synthetic.py`, which are much bigger than the gold demo streams:
+ - `parse_send_stream` of each stream, as written by `write_send_stream`,
+ - `Subvolume.apply_item` of all the items, via `SubvolumeSetMutator`,
+ - `SubvolumeSet.freeze`, starting from an empty `CloneIndex`,
+ - `extents_to_chunks_with_clones` of all the inodes, with and without
+   `shared_extents` -- this is the bulk of `freeze`.
+
+Reports the best time of each stage, and its peak memory.  Everything
+happens in memory, so this needs neither privileges nor a network.  The
+streams are deterministic, so results are comparable across commits.
+'''
+import argparse
+import io
+import itertools
+import sys
+
+from ..extents_to_chunks import CloneIndex, extents_to_chunks_with_clones
+from ..freeze import freeze
+from ..parse_send_stream import parse_send_stream
+from ..subvolume_set import SubvolumeSet, SubvolumeSetMutator
+from ..write_send_stream import write_send_stream
+
+from .common import best_of, peak_memory
+from .synthetic import gen_synthetic_send_streams
+
+
+def _encode(items):
+    out = io.BytesIO()
+    write_send_stream(items, out)
+    return out.getvalue()
+
+
+def _parse(sendstreams):
+    for sendstream in sendstreams:
+        for _ in parse_send_stream(io.BytesIO(sendstream)):
+            pass
+
+
+def _apply(streams):
+    subvols = SubvolumeSet.new()
+    for items in streams:
+        mutator = SubvolumeSetMutator.new(subvols, items[0])
+        for item in items[1:]:
+            mutator.apply_item(item)
+    return subvols
+
+
+def _extents_to_chunks(ids_and_extents, shared_extents):
+    for _ in extents_to_chunks_with_clones(
+        ids_and_extents, shared_extents=shared_extents,
+    ):
+        pass
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--files', type=int, default=20000)
+    parser.add_argument('--snapshots', type=int, default=2)
+    parser.add_argument('--changes-per-snapshot', type=int, default=1000)
+    parser.add_argument('--files-per-dir', type=int, default=50)
+    parser.add_argument('--depth', type=int, default=8)
+    parser.add_argument('--clone-every', type=int, default=3)
+    parser.add_argument('--xattrs', type=int, default=2)
+    parser.add_argument('--block-size', type=int, default=1024)
+    parser.add_argument('--max-blocks', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--repeat', type=int, default=1,
+        help='Report the best of this many runs. At this scale, one run is '
+            'not very noisy.',
+    )
+    parser.add_argument(
+        '--no-memory', action='store_true',
+        help='Skip measuring peak memory, which runs each stage again.',
+    )
+    args = parser.parse_args(argv[1:])
+
+    streams = gen_synthetic_send_streams(
+        files=args.files,
+        snapshots=args.snapshots,
+        changes_per_snapshot=args.changes_per_snapshot,
+        files_per_dir=args.files_per_dir,
+        depth=args.depth,
+        clone_every=args.clone_every,
+        xattrs=args.xattrs,
+        block_size=args.block_size,
+        max_blocks=args.max_blocks,
+        seed=args.seed,
+    )
+    sendstreams = [_encode(items) for items in streams]
+    subvols = _apply(streams)
+    ids_and_extents = list(itertools.chain.from_iterable(
+        subvol._inode_ids_and_extents()
+            for subvol in subvols.uuid_to_subvolume.values()
+    ))
+    print(
+        f'{len(streams)} streams, '
+        f'{sum(len(items) for items in streams)} items, '
+        f'{sum(len(s) for s in sendstreams) / 1e6:.1f}MB, '
+        f'{len(ids_and_extents)} files'
+    )
+
+    for desc, fn in [
+        ('parse_send_stream', lambda: _parse(sendstreams)),
+        ('apply_item', lambda: _apply(streams)),
+        ('SubvolumeSet.freeze', lambda: freeze(
+            subvols._replace(clone_index=CloneIndex()),
+        )),
+        ('extents_to_chunks_with_clones', lambda: _extents_to_chunks(
+            ids_and_extents, shared_extents=False,
+        )),
+        ('extents_to_chunks_with_clones, shared_extents', lambda:
+            _extents_to_chunks(ids_and_extents, shared_extents=True)),
+    ]:
+        sec = best_of(fn, repeat=args.repeat)
+        mem = '' if args.no_memory \
+            else f', peak {peak_memory(fn) / 1e6:.1f} MB'
+        print(f'{desc}: {sec:.2f}s{mem}')
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
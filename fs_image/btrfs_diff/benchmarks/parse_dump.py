@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+'''
+Usage:
+
+    python3 -m btrfs_diff.benchmarks.parse_dump \\
+        [--copies N] [--jobs J1 J2 ...] [--repeat N]
+
+Makes a big `btrfs receive --dump` output by repeating the lines of the
+gold `create_ops` demo dump (except its first, `subvol` line) `--copies`
+times, and reports the time per line of:
+ - `parse_btrfs_dump`,
+ - `parallel_parse.parse_btrfs_dump_parallel` with each `--jobs` count,
+ - `parse_send_stream` of the equivalent send-stream, for comparison.
+'''
+import argparse
+import io
+import os
+import sys
+
+from ..parallel_parse import parse_btrfs_dump_parallel
+from ..parse_dump import parse_btrfs_dump
+from ..parse_send_stream import parse_send_stream
+from ..tests.demo_sendstreams import gold_demo_sendstreams
+
+from .common import best_of, repeat_send_stream_commands
+
+
+def _consume(items) -> int:
+    count = 0
+    for _ in items:
+        count += 1
+    return count
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--copies', type=int, default=1000)
+    parser.add_argument(
+        '--jobs', type=int, nargs='+',
+        default=sorted({2, os.cpu_count() or 1}),
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='Report the best of this many runs.',
+    )
+    args = parser.parse_args(argv[1:])
+
+    gold = gold_demo_sendstreams()['create_ops']
+    first, *rest = [l + b'\n' for l in gold['dump'] if l]
+    dump = first + b''.join(rest) * args.copies
+    sendstream = repeat_send_stream_commands(gold['sendstream'], args.copies)
+    num_lines = 1 + len(rest) * args.copies
+    print(f'{num_lines} lines, {len(dump) / 1e6:.1f}MB')
+
+    fns = [
+        ('parse_btrfs_dump', lambda: _consume(
+            parse_btrfs_dump(io.BytesIO(dump))
+        )),
+        *((f'parse_btrfs_dump_parallel, {jobs} jobs', lambda jobs=jobs:
+            _consume(parse_btrfs_dump_parallel(
+                io.BytesIO(dump), max_workers=jobs,
+            ))) for jobs in args.jobs),
+        ('parse_send_stream', lambda: _consume(
+            parse_send_stream(io.BytesIO(sendstream))
+        )),
+    ]
+    for desc, fn in fns:
+        sec = best_of(fn, repeat=args.repeat)
+        print(f'{desc}: {sec:.3f}s ({1e6 * sec / num_lines:.2f}us/line)')
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+'''
+Usage:
+
+    python3 -m btrfs_diff.benchmarks.parse_send_stream_crc [--copies N]
+
+Compares send-stream parse throughput with and without `verify_crc=True`,
+for both parsers, on the gold demo send-streams from `btrfs_diff/tests/`.
+
+The demo streams are small enough to be verified in-process, so by default
+each stream's commands are repeated `--copies` times (as a single stream,
+with a single END) to also exercise the pipelined worker-process path.
+'''
+import argparse
+import io
+import sys
+
+from ..parse_send_stream import parse_send_stream, parse_send_stream_buffer
+from ..tests.demo_sendstreams import gold_demo_sendstreams
+
+from .common import best_of, repeat_send_stream_commands
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        '--copies', type=int, default=50,
+        help='Repeat the commands of each demo stream this many times.',
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='Report the best of this many runs.',
+    )
+    args = parser.parse_args(argv[1:])
+
+    for name, d in sorted(gold_demo_sendstreams().items()):
+        sendstream = repeat_send_stream_commands(
+            d['sendstream'], args.copies,
+        )
+        mb = len(sendstream) / 1e6
+        for parser_name, parse in [
+            ('file', lambda **kw: parse_send_stream(
+                io.BytesIO(sendstream), **kw,
+            )),
+            ('buffer', lambda **kw: parse_send_stream_buffer(
+                sendstream, **kw,
+            )),
+        ]:
+            for verify_crc in [False, True]:
+                sec = best_of(
+                    lambda: list(parse(verify_crc=verify_crc)),
+                    repeat=args.repeat,
+                )
+                print(
+                    f'{name} ({mb:.1f}MB): {parser_name} parser, '
+                    f'verify_crc={verify_crc}: {mb / sec:.1f}MB/s'
+                )
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
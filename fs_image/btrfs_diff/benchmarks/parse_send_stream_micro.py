@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+'''
+Usage:
+
+    python3 -m btrfs_diff.benchmarks.parse_send_stream_micro [--repeat N]
+
+Micro-benchmark of per-command decoding cost on the gold demo send-streams
+from `btrfs_diff/tests/`.  For each stream, prints the time per command of
+the file-based `parse_send_stream`, and of `parse_send_stream_buffer`.
+
+The gold streams are tiny, so each measurement parses a stream many times
+and reports the best of several runs.
+'''
+import argparse
+import io
+import sys
+
+from ..parse_send_stream import parse_send_stream, parse_send_stream_buffer
+from ..tests.demo_sendstreams import gold_demo_sendstreams
+
+from .common import best_of
+
+
+def _consume(items) -> int:
+    count = 0
+    for _ in items:
+        count += 1
+    return count
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=5,
+        help='Report the best of this many runs.',
+    )
+    parser.add_argument(
+        '--parses-per-run', type=int, default=100,
+        help='How many times to parse each stream in one run.',
+    )
+    args = parser.parse_args(argv[1:])
+
+    for name, d in sorted(gold_demo_sendstreams().items()):
+        sendstream = d['sendstream']
+        num_cmds = _consume(parse_send_stream_buffer(sendstream))
+        for parser_name, parse in [
+            ('file', lambda: parse_send_stream(io.BytesIO(sendstream))),
+            ('buffer', lambda: parse_send_stream_buffer(sendstream)),
+        ]:
+            sec = best_of(
+                lambda: [
+                    _consume(parse()) for _ in range(args.parses_per_run)
+                ],
+                repeat=args.repeat,
+            )
+            usec = 1e6 * sec / (num_cmds * args.parses_per_run)
+            print(
+                f'{name}: {parser_name} parser: {usec:.2f} usec/command '
+                f'({num_cmds} commands)'
+            )
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+'''
+Usage:
+
+    python3 -m btrfs_diff.benchmarks.parse_send_streams_parallel \\
+        [--streams N] [--copies N] [--jobs J1 J2 ...]
+
+Writes a corpus of send-stream files to a temporary directory -- each is
+the gold `create_ops` demo stream with its commands repeated `--copies`
+times -- and times parsing all of them:
+ - serially in this process, as the `examples/` tools used to, and
+ - via `parallel_parse.parse_send_stream_files` with each `--jobs` count.
+
+The wall-clock time of the latter should scale with the number of cores.
+'''
+import argparse
+import mmap
+import os
+import sys
+import tempfile
+
+from ..parallel_parse import parse_send_stream_files
+from ..parse_send_stream import parse_send_stream_buffer
+from ..tests.demo_sendstreams import gold_demo_sendstreams
+
+from .common import best_of, repeat_send_stream_commands
+
+
+def _parse_serially(paths):
+    for path in paths:
+        with open(path, 'rb') as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ,
+        ) as m:
+            list(parse_send_stream_buffer(m))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--streams', type=int, default=16)
+    parser.add_argument('--copies', type=int, default=20)
+    parser.add_argument(
+        '--jobs', type=int, nargs='+',
+        default=sorted({1, 2, os.cpu_count() or 1}),
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='Report the best of this many runs.',
+    )
+    args = parser.parse_args(argv[1:])
+
+    sendstream = repeat_send_stream_commands(
+        gold_demo_sendstreams()['create_ops']['sendstream'], args.copies,
+    )
+    with tempfile.TemporaryDirectory() as td:
+        paths = []
+        for i in range(args.streams):
+            paths.append(os.path.join(td, str(i)).encode())
+            with open(paths[-1], 'wb') as f:
+                f.write(sendstream)
+        mb = args.streams * len(sendstream) / 1e6
+        print(f'{args.streams} streams, {mb:.1f}MB total')
+
+        sec = best_of(lambda: _parse_serially(paths), repeat=args.repeat)
+        print(f'serial: {sec:.3f}s')
+        for jobs in args.jobs:
+            sec = best_of(
+                lambda: list(parse_send_stream_files(
+                    paths, max_workers=jobs,
+                )),
+                repeat=args.repeat,
+            )
+            print(f'parse_send_stream_files, {jobs} jobs: {sec:.3f}s')
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+'''
+Usage:
+
+    python3 -m btrfs_diff.benchmarks.reflinked_files \\
+        [--files N] [--sources N] [--source-blocks N] [--max-blocks N] \\
+        [--seed N] [--repeat N]
+
+Models a heavily deduplicated image: each of `--files` files consists of
+up to `--max-blocks` runs of blocks, each reflinked from a random offset
+of one of `--sources` written extents, so that every source extent is
+shared by many files, in overlapping ranges.  Reports the time of:
+ - `extents_to_chunks_with_clones`, with `ChunkClone`s -- this is the
+   interval sweep, whose output is quadratic in the sharing of each block,
+ - `extents_to_chunks_with_clones` with `shared_extents`,
+ - `CloneIndex.update` from scratch, which runs the same sweep.
+'''
+import argparse
+import random
+import sys
+
+from ..extent import Extent
+from ..extents_to_chunks import CloneIndex, extents_to_chunks_with_clones
+from ..inode_id import InodeIDMap
+
+from .common import best_of
+
+
+def _make_ids_and_extents(
+    *, files, sources, source_blocks, max_blocks, seed,
+):
+    rand = random.Random(seed)
+    id_map = InodeIDMap.new()
+    source_extents = [
+        Extent.empty().write(offset=0, length=source_blocks)
+            for _ in range(sources)
+    ]
+    ids_and_extents = []
+    for i in range(files):
+        extent = Extent.empty()
+        offset = 0
+        for _ in range(rand.randint(1, max_blocks)):
+            length = rand.randint(1, source_blocks // 2)
+            extent = extent.clone(
+                to_offset=offset,
+                from_extent=rand.choice(source_extents),
+                from_offset=rand.randrange(source_blocks - length + 1),
+                length=length,
+            )
+            offset += length
+        ids_and_extents.append(
+            (id_map.add_file(id_map.next(), b'f%d' % i), extent)
+        )
+    return ids_and_extents
+
+
+def _consume(ids_and_chunks):
+    num_chunk_clones = 0
+    for _, chunks in ids_and_chunks:
+        num_chunk_clones += sum(len(c.chunk_clones) for c in chunks)
+    return num_chunk_clones
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--files', type=int, default=20000)
+    parser.add_argument('--sources', type=int, default=2000)
+    parser.add_argument('--source-blocks', type=int, default=16)
+    parser.add_argument('--max-blocks', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='Report the best of this many runs.',
+    )
+    args = parser.parse_args(argv[1:])
+
+    ids_and_extents = _make_ids_and_extents(
+        files=args.files,
+        sources=args.sources,
+        source_blocks=args.source_blocks,
+        max_blocks=args.max_blocks,
+        seed=args.seed,
+    )
+    print(
+        f'{len(ids_and_extents)} files, '
+        f'{_consume(extents_to_chunks_with_clones(ids_and_extents))} '
+        'ChunkClones'
+    )
+    for desc, fn in [
+        ('extents_to_chunks_with_clones', lambda: _consume(
+            extents_to_chunks_with_clones(ids_and_extents),
+        )),
+        ('extents_to_chunks_with_clones, shared_extents', lambda: _consume(
+            extents_to_chunks_with_clones(
+                ids_and_extents, shared_extents=True,
+            ),
+        )),
+        ('CloneIndex.update', lambda: CloneIndex().update(ids_and_extents)),
+    ]:
+        print(f'{desc}: {best_of(fn, repeat=args.repeat):.3f}s')
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
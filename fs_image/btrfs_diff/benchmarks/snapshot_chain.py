@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+'''
+Usage:
+
+    python3 -m btrfs_diff.benchmarks.snapshot_chain \\
+        [--files N] [--snapshots N] [--edits-per-snapshot N]
+
+Makes a subvolume with N files, and then a chain of snapshots, each of
+which edits a few random files of its parent.  Reports the time & peak
+memory of the chain with `Subvolume.snapshot`, and with the `deepcopy` that
+`SubvolumeSetMutator` used to make snapshots.
+
+`snapshot` is O(1), and each edit copies O(log N) map nodes, so the time
+per snapshot should not depend on N.  A `deepcopy` costs O(N).
+'''
+import argparse
+import copy
+import random
+import sys
+
+from ..inode_id import InodeIDMap
+from ..send_stream import SendStreamItems
+from ..subvolume import Subvolume
+
+from .common import best_of, peak_memory
+
+
+def _make_subvolume(num_files):
+    si = SendStreamItems
+    subvol = Subvolume.new(id_map=InodeIDMap.new(description='0'))
+    for d in range(num_files // 100 + 1):
+        subvol.apply_item(si.mkdir(path=b'd%d' % d))
+    for i in range(num_files):
+        path = b'd%d/f%d' % (i // 100, i)
+        subvol.apply_item(si.mkfile(path=path))
+        subvol.apply_item(si.write(path=path, offset=0, data=b'x' * 10))
+    return subvol
+
+
+def _deepcopy_snapshot(subvol, description):
+    return copy.deepcopy(subvol, memo={
+        id(subvol.id_map.inner.description): description,
+    })
+
+
+def _make_chain(subvol, num_files, num_snapshots, edits, snapshot_fn):
+    si = SendStreamItems
+    rand = random.Random(0)
+    chain = [subvol]
+    for s in range(num_snapshots):
+        subvol = snapshot_fn(chain[-1], str(s + 1))
+        for _ in range(edits):
+            i = rand.randrange(num_files)
+            path = b'd%d/f%d' % (i // 100, i)
+            subvol.apply_item(si.chmod(path=path, mode=0o600))
+            subvol.apply_item(si.write(path=path, offset=5, data=b'y'))
+        chain.append(subvol)
+    return chain
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--files', type=int, default=20000)
+    parser.add_argument('--snapshots', type=int, default=50)
+    parser.add_argument('--edits-per-snapshot', type=int, default=10)
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='Report the best of this many runs.',
+    )
+    args = parser.parse_args(argv[1:])
+
+    subvol = _make_subvolume(args.files)
+    for name, snapshot_fn in [
+        ('snapshot', lambda sv, desc: sv.snapshot(description=desc)),
+        ('deepcopy', _deepcopy_snapshot),
+    ]:
+
+        def run():
+            _make_chain(
+                subvol, args.files, args.snapshots, args.edits_per_snapshot,
+                snapshot_fn,
+            )
+
+        sec = best_of(run, repeat=args.repeat)
+        mb = peak_memory(run) / 1e6
+        print(
+            f'{name}: {args.snapshots} snapshots of {args.files} files in '
+            f'{sec:.3f}s ({1e3 * sec / args.snapshots:.2f}ms each), '
+            f'{mb:.1f}MB peak'
+        )
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+'''
+Usage:
+
+    python3 -m btrfs_diff.benchmarks.streaming_render \\
+        [--files N] [--files-per-dir N] [--hardlink-every N] [--repeat N]
+
+Makes a frozen subvolume with N files, each with a little data, and with
+every `--hardlink-every`-th file linked from a second directory.  Writes
+its JSON to `/dev/null`:
+ - via `Subvolume.render` and `json.dumps`, as we did before
+   `streaming_render.py`,
+ - via `gen_rendered_json`.
+
+Reports the best time, and the peak memory of each, on top of the memory
+of the subvolume itself.
+'''
+import argparse
+import json
+import os
+import sys
+
+from ..freeze import freeze
+from ..inode_id import InodeIDMap
+from ..rendered_tree import emit_non_unique_traversal_ids
+from ..send_stream import SendStreamItems
+from ..streaming_render import gen_rendered_json
+from ..subvolume import Subvolume
+
+from .common import best_of, peak_memory
+
+
+def _make_subvol(num_files, files_per_dir, hardlink_every):
+    si = SendStreamItems
+    subvol = Subvolume.new(id_map=InodeIDMap.new())
+    subvol.apply_item(si.mkdir(path=b'links'))
+    for d in range((num_files + files_per_dir - 1) // files_per_dir):
+        subvol.apply_item(si.mkdir(path=b'd%d' % d))
+    for i in range(num_files):
+        path = b'd%d/f%d' % (i // files_per_dir, i)
+        subvol.apply_item(si.mkfile(path=path))
+        subvol.apply_item(si.write(path=path, offset=0, data=b'x' * 10))
+        if i % hardlink_every == 0:
+            subvol.apply_item(si.link(path=b'links/f%d' % i, dest=path))
+    return freeze(subvol)
+
+
+def _render_and_dump(subvol, out):
+    out.write(json.dumps(
+        emit_non_unique_traversal_ids(subvol.render()),
+        sort_keys=True,
+        indent=2,
+    ))
+
+
+def _stream(subvol, out):
+    out.writelines(gen_rendered_json(subvol, indent=2))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--files-per-dir', type=int, default=100)
+    parser.add_argument('--hardlink-every', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv[1:])
+
+    subvol = _make_subvol(args.files, args.files_per_dir, args.hardlink_every)
+    with open(os.devnull, 'w') as out:
+        for desc, fn in [
+            ('render & json.dumps', lambda: _render_and_dump(subvol, out)),
+            ('gen_rendered_json', lambda: _stream(subvol, out)),
+        ]:
+            sec = best_of(fn, repeat=args.repeat)
+            mb = peak_memory(fn) / 1e6
+            print(f'{desc}: {sec:.2f}s, peak {mb:.1f} MB')
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
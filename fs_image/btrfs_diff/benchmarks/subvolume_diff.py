@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+'''
+Usage:
+
+    python3 -m btrfs_diff.benchmarks.subvolume_diff \\
+        [--files N] [--files-per-dir N] [--changes N] [--repeat N]
+
+Makes a frozen "layer" with N files, and a frozen snapshot of it that
+`chmod`s `--changes` files spread over the tree.  Compares the two layers
+by:
+ - rendering both, and comparing the `RenderedTree`s, which is what we
+   had to do before `subvolume_diff.py`,
+ - `diff_subvolumes`, including computing the digests of both layers,
+ - `diff_subvolumes` with the digests of both layers already computed,
+   as when comparing consecutive pairs in a chain of layers.
+'''
+import argparse
+import sys
+
+from ..freeze import freeze
+from ..inode_id import InodeIDMap
+from ..rendered_tree import emit_all_traversal_ids
+from ..send_stream import SendStreamItems
+from ..subvolume import Subvolume
+from ..subvolume_diff import diff_subvolumes, subtree_digests
+
+from .common import best_of
+
+
+def _make_layers(num_files, files_per_dir, num_changes):
+    si = SendStreamItems
+    subvol = Subvolume.new(id_map=InodeIDMap.new())
+    num_dirs = (num_files + files_per_dir - 1) // files_per_dir
+    for d in range(num_dirs):
+        subvol.apply_item(si.mkdir(path=b'd%d' % d))
+    paths = [b'd%d/f%d' % (i // files_per_dir, i) for i in range(num_files)]
+    for path in paths:
+        subvol.apply_item(si.mkfile(path=path))
+        subvol.apply_item(si.write(path=path, offset=0, data=b'x' * 10))
+        subvol.apply_item(si.chmod(path=path, mode=0o644))
+    child = subvol.snapshot()
+    for path in paths[::max(1, num_files // num_changes)][:num_changes]:
+        child.apply_item(si.chmod(path=path, mode=0o755))
+    return freeze(subvol), freeze(child)
+
+
+def _render_and_compare(old, new):
+    return emit_all_traversal_ids(old.render()) == \
+        emit_all_traversal_ids(new.render())
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--files-per-dir', type=int, default=100)
+    parser.add_argument('--changes', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv[1:])
+
+    old, new = _make_layers(args.files, args.files_per_dir, args.changes)
+    old_digests, new_digests = subtree_digests(old), subtree_digests(new)
+    num_diffs = len(list(diff_subvolumes(
+        old, new, old_digests=old_digests, new_digests=new_digests,
+    )))
+    print(f'{num_diffs} differences in {args.files} files')
+    for desc, fn in [
+        ('render & compare', lambda: _render_and_compare(old, new)),
+        ('diff_subvolumes', lambda: list(diff_subvolumes(old, new))),
+        ('diff_subvolumes, digests reused', lambda: list(diff_subvolumes(
+            old, new, old_digests=old_digests, new_digests=new_digests,
+        ))),
+    ]:
+        print(f'{desc}: {best_of(fn, repeat=args.repeat):.4f}s')
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
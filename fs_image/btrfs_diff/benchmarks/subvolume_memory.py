@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+'''
+Usage:
+
+    python3 -m btrfs_diff.benchmarks.subvolume_memory \\
+        [--files N] [--files-per-dir N] [--xattr-every N]
+
+Applies a synthetic send-stream that makes N small files to a fresh
+`Subvolume`, and reports the time, the peak Python memory per file, and
+the peak RSS of the process.  The items are generated on the fly, so the
+memory is that of the `Subvolume` model.
+
+Each file gets the items that `btrfs send` emits for it: `mkfile`,
+`write`, `chown`, `chmod`, and `utimes`.  With `--xattr-every`, every
+that many files also get an xattr.
+'''
+import argparse
+import resource
+import sys
+import time
+
+from ..inode_id import InodeIDMap
+from ..send_stream import SendStreamItems
+from ..subvolume import Subvolume
+
+from .common import peak_memory
+
+
+def _gen_items(num_files, files_per_dir, xattr_every):
+    si = SendStreamItems
+    for d in range((num_files + files_per_dir - 1) // files_per_dir):
+        yield si.mkdir(path=b'd%d' % d)
+    for i in range(num_files):
+        path = b'd%d/f%d' % (i // files_per_dir, i)
+        yield si.mkfile(path=path)
+        yield si.write(path=path, offset=0, data=b'x' * 10)
+        yield si.chown(path=path, uid=0, gid=0)
+        yield si.chmod(path=path, mode=0o644)
+        yield si.utimes(
+            path=path, ctime=(i, 0), mtime=(i, 0), atime=(i, 0),
+        )
+        if xattr_every and i % xattr_every == 0:
+            yield si.set_xattr(
+                path=path, name=b'security.selinux', data=b'system_u:obj',
+            )
+
+
+def _make_subvolume(args):
+    subvol = Subvolume.new(id_map=InodeIDMap.new())
+    for item in _gen_items(args.files, args.files_per_dir, args.xattr_every):
+        subvol.apply_item(item)
+    return subvol
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--files', type=int, default=1000000)
+    parser.add_argument('--files-per-dir', type=int, default=100)
+    parser.add_argument('--xattr-every', type=int, default=0)
+    args = parser.parse_args(argv[1:])
+
+    start = time.perf_counter()
+    _make_subvolume(args)
+    sec = time.perf_counter() - start
+    # Linux reports `ru_maxrss` in KiB.
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+    mem = peak_memory(lambda: _make_subvolume(args))
+    print(
+        f'{args.files} files in {sec:.2f}s ({1e6 * sec / args.files:.1f}us '
+        f'each), {mem / args.files:.0f} bytes per file, {rss_mb:.0f}MB '
+        'peak RSS'
+    )
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
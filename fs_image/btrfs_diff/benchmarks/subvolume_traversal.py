@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+'''
+Usage:
+
+    python3 -m btrfs_diff.benchmarks.subvolume_traversal \\
+        [--files N] [--files-per-dir N] [--depth N] [--repeat N]
+
+Times `Subvolume.gather_bottom_up` and `Subvolume.render` on two synthetic
+frozen subvolumes with N files each:
+ - "wide" has the files in flat directories of `--files-per-dir` each,
+ - "deep" puts them at the bottom of a chain of `--depth` directories,
+   with `--files-per-dir` files in each level.
+
+A recursive traversal must pass every `yield` through one generator per
+level, so its cost per inode grows with the depth of the tree.
+'''
+import argparse
+import sys
+
+from ..coroutine_utils import while_not_exited
+from ..freeze import freeze
+from ..inode_id import InodeIDMap
+from ..send_stream import SendStreamItems
+from ..subvolume import Subvolume
+
+from .common import best_of
+
+
+def _make_wide(num_files, files_per_dir):
+    si = SendStreamItems
+    subvol = Subvolume.new(id_map=InodeIDMap.new())
+    for d in range((num_files + files_per_dir - 1) // files_per_dir):
+        subvol.apply_item(si.mkdir(path=b'd%d' % d))
+    for i in range(num_files):
+        subvol.apply_item(si.mkfile(path=b'd%d/f%d' % (i // files_per_dir, i)))
+    return subvol
+
+
+def _make_deep(num_files, files_per_dir, depth):
+    si = SendStreamItems
+    subvol = Subvolume.new(id_map=InodeIDMap.new())
+    dirs = []
+    path = b'.'
+    for d in range(depth):
+        path = b'd%d' % d if path == b'.' else path + b'/d%d' % d
+        subvol.apply_item(si.mkdir(path=path))
+        dirs.append(path)
+    for i in range(num_files):
+        parent = dirs[(i // files_per_dir) % len(dirs)]
+        subvol.apply_item(si.mkfile(path=parent + b'/f%d' % i))
+    return subvol
+
+
+def _count_inodes(subvol):
+    with while_not_exited(subvol.gather_bottom_up()) as ctx:
+        result = None
+        while True:
+            _path, _ino, child_results = ctx.send(result)
+            result = 1 if child_results is None \
+                else 1 + sum(child_results.values())
+    return ctx.result
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--files-per-dir', type=int, default=100)
+    # Keep this under ~500 to compare with a recursive traversal, which
+    # would hit the default recursion limit.
+    parser.add_argument('--depth', type=int, default=400)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv[1:])
+
+    for desc, subvol in [
+        ('wide', freeze(_make_wide(args.files, args.files_per_dir))),
+        ('deep', freeze(_make_deep(
+            args.files, args.files_per_dir, args.depth,
+        ))),
+    ]:
+        num_inodes = _count_inodes(subvol)
+        for fn_desc, fn in [
+            ('gather_bottom_up', lambda: _count_inodes(subvol)),
+            ('render', subvol.render),
+        ]:
+            sec = best_of(fn, repeat=args.repeat)
+            print(
+                f'{desc} {fn_desc}: {sec:.2f}s for {num_inodes} inodes '
+                f'({1e6 * sec / num_inodes:.2f}us each)'
+            )
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+'''
+Deterministic, synthetic send-streams for benchmarks at scale.
+
+`gen_synthetic_send_streams` returns the items of a chain of send-streams:
+a full send of a subvolume, followed by incremental sends of snapshots.
+The same arguments always give the same items.
+
+The base subvolume has chains of `depth` nested directories, with
+`files_per_dir` files in each directory.  Like `btrfs send`, we create
+every inode under a temporary `oINO-GEN-0` name, and then rename it into
+place.  Each file has a SELinux label, `xattrs` more xattrs, metadata, and
+up to `max_blocks` blocks of data.  Every `clone_every`-th file clones its
+blocks from random blocks of the earlier files, rather than writing them.
+
+Each snapshot modifies `changes_per_snapshot` random files: it rewrites
+them, clones into them from its parent subvolume, renames, or deletes them.
+'''
+import random
+import uuid
+
+from typing import List
+
+from ..send_stream import SendStreamItem, SendStreamItems
+
+_SELINUX_XATTR = b'security.selinux'
+_SELINUX_LABEL = b'system_u:object_r:usr_t:s0\0'
+
+
+class _Generator:
+    '''
+    Tracks what the streams made so far contain, so that the next items
+    refer only to paths & data that exist.
+    '''
+
+    def __init__(
+        self, *, files_per_dir, depth, clone_every, xattrs, block_size,
+        max_blocks, seed,
+    ):
+        self.files_per_dir = files_per_dir
+        self.depth = depth
+        self.clone_every = clone_every
+        self.xattrs = xattrs
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.rand = random.Random(seed)
+        self.next_ino = 257  # The first free inode number in btrfs
+        self.transid = 0
+        self.renames = 0
+        self.dirs = []
+        self.files = []  # [path, number of blocks], as in the latest stream
+        self.len_to_data = {}  # Reuse `bytes`, to keep the items small
+
+    def data(self, length):
+        data = self.len_to_data.get(length)
+        if data is None:
+            data = self.len_to_data[length] = bytes(
+                i % 251 for i in range(length)
+            )
+        return data
+
+    def new_uuid(self):
+        return str(uuid.UUID(int=self.rand.getrandbits(128))).encode()
+
+    def new_inode(self, make_item, path, **kwargs):
+        temp_path = b'o%d-%d-0' % (self.next_ino, self.transid)
+        self.next_ino += 1
+        yield make_item(path=temp_path, **kwargs)
+        yield SendStreamItems.rename(path=temp_path, dest=path)
+
+    def metadata(self, path, mode):
+        si = SendStreamItems
+        t = (1500000000 + self.transid, self.rand.randrange(10 ** 9))
+        yield si.chown(path=path, uid=0, gid=0)
+        yield si.chmod(path=path, mode=mode)
+        yield si.utimes(path=path, atime=t, mtime=t, ctime=t)
+
+    def file_data(self, path, num_blocks, clone_from=None, from_id=None):
+        '''
+        Writes, or clones from the `(path, num_blocks)` in `clone_from`,
+        which are in the subvolume with the `(uuid, transid)` of `from_id`.
+        '''
+        si = SendStreamItems
+        bs = self.block_size
+        for block in range(num_blocks):
+            if clone_from:
+                from_path, from_blocks = self.rand.choice(clone_from)
+                yield si.clone(
+                    path=path, offset=block * bs, len=bs,
+                    from_uuid=from_id[0], from_transid=from_id[1],
+                    from_path=from_path,
+                    clone_offset=self.rand.randrange(from_blocks) * bs,
+                )
+            else:
+                yield si.write(
+                    path=path, offset=block * bs, data=self.data(bs),
+                )
+
+    def gen_subvol(self, num_files, path):
+        si = SendStreamItems
+        self.transid += 1
+        subvol_id = (self.new_uuid(), self.transid)
+        yield si.subvol(path=path, uuid=subvol_id[0], transid=subvol_id[1])
+        yield from self.metadata(b'.', 0o755)
+        num_dirs = (num_files + self.files_per_dir - 1) // self.files_per_dir
+        for d in range(num_dirs):
+            parent = b'.' if d % self.depth == 0 else self.dirs[-1]
+            dir_path = b'd%d' % d if parent == b'.' else parent + b'/d%d' % d
+            self.dirs.append(dir_path)
+            yield from self.new_inode(si.mkdir, dir_path)
+            yield from self.metadata(dir_path, 0o755)
+        for i in range(num_files):
+            file_path = self.dirs[i // self.files_per_dir] + b'/f%d' % i
+            num_blocks = self.rand.randint(1, self.max_blocks)
+            yield from self.new_inode(si.mkfile, file_path)
+            yield from self.xattr_items(file_path)
+            yield from self.file_data(
+                file_path, num_blocks,
+                self.files if self.clone_every and self.files
+                    and i % self.clone_every == 0 else None,
+                subvol_id,
+            )
+            yield from self.metadata(file_path, 0o644)
+            self.files.append([file_path, num_blocks])
+
+    def xattr_items(self, path):
+        yield SendStreamItems.set_xattr(
+            path=path, name=_SELINUX_XATTR, data=_SELINUX_LABEL,
+        )
+        for x in range(self.xattrs):
+            yield SendStreamItems.set_xattr(
+                path=path, name=b'user.synthetic%d' % x,
+                data=b'%d' % self.rand.randrange(1000),
+            )
+
+    def gen_snapshot(self, num_changes, path, parent_id):
+        si = SendStreamItems
+        self.transid += 1
+        yield si.snapshot(
+            path=path, uuid=self.new_uuid(), transid=self.transid,
+            parent_uuid=parent_id[0], parent_transid=parent_id[1],
+        )
+        parent_files = [list(f) for f in self.files]
+        touched_dirs = set()
+        for _ in range(num_changes):
+            if not self.files:
+                break
+            idx = self.rand.randrange(len(self.files))
+            file_path, num_blocks = self.files[idx]
+            touched_dirs.add(file_path.rsplit(b'/', 1)[0])
+            action = self.rand.randrange(4)
+            if action == 0:  # Rewrite, and maybe resize
+                new_blocks = self.rand.randint(1, self.max_blocks)
+                yield from self.file_data(file_path, new_blocks)
+                if new_blocks < num_blocks:
+                    yield si.truncate(
+                        path=file_path, size=new_blocks * self.block_size,
+                    )
+                self.files[idx][1] = new_blocks
+            elif action == 1:  # Clone from the parent
+                yield from self.file_data(
+                    file_path, num_blocks, parent_files, parent_id,
+                )
+            elif action == 2:  # Move to a random directory
+                new_dir = self.rand.choice(self.dirs)
+                self.renames += 1
+                new_path = new_dir + b'/r%d' % self.renames
+                yield si.rename(path=file_path, dest=new_path)
+                touched_dirs.add(new_dir)
+                self.files[idx][0] = new_path
+                continue  # Renames do not change the file's metadata
+            else:
+                yield si.unlink(path=file_path)
+                self.files[idx] = self.files[-1]
+                self.files.pop()
+                continue
+            yield from self.xattr_items(file_path)
+            yield from self.metadata(file_path, 0o644)
+        for dir_path in sorted(touched_dirs):
+            yield from self.metadata(dir_path, 0o755)
+
+
+def gen_synthetic_send_streams(
+    *,
+    files: int,
+    snapshots: int = 2,
+    changes_per_snapshot: int = 1000,
+    files_per_dir: int = 50,
+    depth: int = 8,
+    clone_every: int = 3,
+    xattrs: int = 2,
+    block_size: int = 1024,
+    max_blocks: int = 4,
+    seed: int = 0,
+) -> List[List[SendStreamItem]]:
+    'Returns the items of each stream in the chain, see the docblock.'
+    gen = _Generator(
+        files_per_dir=files_per_dir,
+        depth=depth,
+        clone_every=clone_every,
+        xattrs=xattrs,
+        block_size=block_size,
+        max_blocks=max_blocks,
+        seed=seed,
+    )
+    streams = [list(gen.gen_subvol(files, b'synthetic'))]
+    for i in range(snapshots):
+        parent = streams[-1][0]
+        streams.append(list(gen.gen_snapshot(
+            changes_per_snapshot,
+            b'synthetic-%d' % (i + 1),
+            (parent.uuid, parent.transid),
+        )))
+    return streams
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+'''
+`compact_send_stream` rewrites a full (non-incremental) send-stream as a
+shorter one that `btrfs receive` turns into the same subvolume.  We apply
+the items to a `Subvolume`, and emit its final state:
+
+ - Each inode is made at its final path, so the renames through `btrfs
+   send` temporaries like `o257-2433-0` go away.  Hardlinks become
+   `link`s.
+ - Each file gets just the data it ends up with.  Overwritten writes and
+   redundant `truncate`s go away, and adjacent writes are coalesced.
+   Bytes that were cloned keep being cloned, from wherever we first
+   wrote them, unless the clone would be unaligned.
+ - Each inode gets one `chown`, `chmod`, and `utimes`, and its final
+   xattrs.
+
+The data comes along via the `Extent`s of `IncompleteFile`: each `write`
+makes a new DATA leaf, which we map to the written bytes.  Leaves made by
+`update_extent` have no bytes, so `--no-data` streams compact into
+`update_extent`s.  Our output is meant for `write_send_stream`, which
+splits big writes into several commands.
+
+Incremental streams are not supported, since the compacted stream would
+have to express the changes relative to the parent.  Nor are clones from
+other subvolumes, nor `encoded_write`s, whose data we would have to
+decode.
+'''
+from typing import Iterable, Iterator, List, Mapping, Optional, Tuple
+
+from .coroutine_utils import while_not_exited
+from .extent import Extent
+from .incomplete_inode import (
+    IncompleteDevice, IncompleteDir, IncompleteFifo, IncompleteFile,
+    IncompleteInode, IncompleteSocket, IncompleteSymlink,
+)
+from .inode_id import InodeIDMap
+from .send_stream import SendStreamItem, SendStreamItems
+from .subvolume import Subvolume
+
+# `btrfs receive` fails to clone ranges that are not aligned to the
+# filesystem's sector size, which is usually 4KiB.
+CLONE_ALIGNMENT = 4096
+
+_INODE_CLASS_TO_ITEM = {
+    IncompleteDir: SendStreamItems.mkdir,
+    IncompleteFile: SendStreamItems.mkfile,
+    IncompleteSocket: SendStreamItems.mksock,
+    IncompleteFifo: SendStreamItems.mkfifo,
+}
+
+
+def _gen_make_inode(path: bytes, ino: IncompleteInode):
+    if isinstance(ino, IncompleteDevice):
+        yield SendStreamItems.mknod(
+            path=path, mode=ino.file_type | (ino.mode or 0), dev=ino.dev,
+        )
+    elif isinstance(ino, IncompleteSymlink):
+        yield SendStreamItems.symlink(path=path, dest=ino.dest)
+    else:
+        yield _INODE_CLASS_TO_ITEM[type(ino)](path=path)
+
+
+def _gen_metadata(path: bytes, ino: IncompleteInode):
+    'Except `utimes`, which must follow all changes to the inode.'
+    # `chown` clears the setuid & setgid bits, so it goes before `chmod`.
+    if ino.owner is not None:
+        yield SendStreamItems.chown(
+            path=path, uid=ino.owner.uid, gid=ino.owner.gid,
+        )
+    if ino.mode is not None and not isinstance(ino, IncompleteSymlink):
+        yield SendStreamItems.chmod(path=path, mode=ino.mode)
+    # Writes & `chown` clear `security.capability`, so xattrs go last.
+    for name, data in ino.xattrs.items():
+        yield SendStreamItems.set_xattr(path=path, name=name, data=data)
+
+
+class _DataWriter:
+    '''
+    Emits the data of each file in turn.  Remembers where each DATA leaf
+    was written, so that later files can clone from there.
+    '''
+
+    def __init__(
+        self, *, leaf_to_data: Mapping[int, bytes], uuid: bytes, transid: int,
+    ):
+        self._leaf_to_data = leaf_to_data  # `id(leaf)` -> written bytes
+        self._uuid = uuid
+        self._transid = transid
+        # `id(leaf)` -> `(leaf_offset, length, path, file_offset, file_size)`
+        # for each place that we wrote it.
+        self._leaf_to_places = {}
+
+    def _find_clone_source(
+        self, leaf: Extent, offset: int, length: int, file_offset: int,
+    ) -> Optional[Tuple[bytes, int]]:
+        if file_offset % CLONE_ALIGNMENT:
+            return None
+        for leaf_offset, place_length, path, place_offset, file_size in (
+            self._leaf_to_places.get(id(leaf), ())
+        ):
+            if not (
+                leaf_offset <= offset and
+                offset + length <= leaf_offset + place_length
+            ):
+                continue
+            clone_offset = place_offset + offset - leaf_offset
+            if clone_offset % CLONE_ALIGNMENT:
+                continue
+            # Only a clone to the end of its source may be unaligned.
+            if length % CLONE_ALIGNMENT and clone_offset + length != file_size:
+                continue
+            return path, clone_offset
+        return None
+
+    def data_items(self, path: bytes, extent: Extent) -> List[SendStreamItem]:
+        si = SendStreamItems
+        out = []
+        # The run of adjacent pieces that will become one item: its start,
+        # and its data, or None for an `update_extent`.
+        run_offset = 0
+        run_data: Optional[List[bytes]] = None
+        run_length = 0
+        places = []
+
+        def flush():
+            nonlocal run_length
+            if not run_length:
+                return
+            out.append(si.update_extent(
+                path=path, offset=run_offset, len=run_length,
+            ) if run_data is None else si.write(
+                path=path, offset=run_offset, data=b''.join(run_data),
+            ))
+            run_length = 0
+
+        file_offset = 0
+        data_end = 0
+        for offset, length, leaf in extent.gen_trimmed_leaves():
+            if leaf.content == Extent.Kind.HOLE:
+                file_offset += length
+                continue
+            data_end = file_offset + length
+            source = self._find_clone_source(leaf, offset, length, file_offset)
+            if source is not None:
+                flush()
+                from_path, clone_offset = source
+                prev = out[-1] if out else None
+                # Merge with the previous clone if it continues it.
+                if isinstance(prev, si.clone) and prev.from_path == from_path \
+                        and prev.offset + prev.len == file_offset \
+                        and prev.clone_offset + prev.len == clone_offset:
+                    out[-1] = prev._replace(len=prev.len + length)
+                else:
+                    out.append(si.clone(
+                        path=path, offset=file_offset, len=length,
+                        from_uuid=self._uuid, from_transid=self._transid,
+                        from_path=from_path, clone_offset=clone_offset,
+                    ))
+                file_offset += length
+                continue
+            data = self._leaf_to_data.get(id(leaf))
+            if data is not None:
+                data = data[offset:offset + length]
+            if run_length and (
+                run_offset + run_length != file_offset
+                or (run_data is None) != (data is None)
+            ):
+                flush()
+            if not run_length:
+                run_offset = file_offset
+                run_data = None if data is None else []
+            if data is not None:
+                run_data.append(data)
+            run_length += length
+            # We learn the file's size once we are done with it.
+            places.append((id(leaf), (offset, length, path, file_offset)))
+            file_offset += length
+        flush()
+        if data_end < extent.length:  # A trailing hole
+            out.append(si.truncate(path=path, size=extent.length))
+        for leaf_id, place in places:
+            self._leaf_to_places.setdefault(leaf_id, []).append(
+                (*place, extent.length),
+            )
+        return out
+
+
+def compact_send_stream(
+    items: Iterable[SendStreamItem],
+) -> Iterator[SendStreamItem]:
+    '''
+    Yields the compacted form of the full send-stream `items`, see the
+    module docblock.  The `write`s in `items` must have `bytes` data.
+    '''
+    items = iter(items)
+    subvol_item = next(items)
+    if not isinstance(subvol_item, SendStreamItems.subvol):
+        raise RuntimeError(
+            f'Can only compact full send-streams, not {subvol_item}'
+        )
+    subvol = Subvolume.new(id_map=InodeIDMap.new())
+    leaf_to_data = {}  # `id(leaf)` -> `(leaf, data)`, keeping leaves alive
+    for item in items:
+        if isinstance(item, SendStreamItems.clone):
+            if item.from_uuid != subvol_item.uuid:
+                raise RuntimeError(f'Cannot compact {item} from another subvol')
+            subvol.apply_clone(item, subvol)
+            continue
+        if isinstance(item, SendStreamItems.encoded_write):
+            raise RuntimeError(f'Cannot compact {item}, it needs decoding')
+        is_write = isinstance(item, SendStreamItems.write)
+        if is_write and not isinstance(item.data, bytes):
+            raise RuntimeError(
+                f'Cannot compact {item}, parse without lazy_data'
+            )
+        subvol.apply_item(item)
+        if is_write and item.data:
+            (_, _, leaf), = subvol.inode_at_path(
+                item.path
+            ).extent.gen_trimmed_leaves(
+                offset=item.offset, length=len(item.data),
+            )
+            leaf_to_data[id(leaf)] = (leaf, item.data)
+
+    yield subvol_item
+    paths_and_inodes = []
+    with while_not_exited(subvol.gather_bottom_up()) as ctx:
+        while True:
+            path, ino, _ = ctx.send(None)
+            paths_and_inodes.append((path, ino))
+    writer = _DataWriter(
+        leaf_to_data={k: data for k, (_, data) in leaf_to_data.items()},
+        uuid=subvol_item.uuid,
+        transid=subvol_item.transid,
+    )
+    # Parents sort before their children, so this makes each directory
+    # before its entries.
+    paths_and_inodes.sort(key=lambda p: () if p[0] == b'.' else tuple(
+        p[0].split(b'/')
+    ))
+    id_to_first_path = {}
+    with_utimes = []
+    for path, ino in paths_and_inodes:
+        first_path = id_to_first_path.get(id(ino))
+        if first_path is not None:
+            yield SendStreamItems.link(path=path, dest=first_path)
+            continue
+        id_to_first_path[id(ino)] = path
+        if path != b'.':
+            yield from _gen_make_inode(path, ino)
+        if isinstance(ino, IncompleteFile):
+            yield from writer.data_items(path, ino.extent)
+        yield from _gen_metadata(path, ino)
+        if ino.utimes is not None:
+            with_utimes.append((path, ino))
+    # Making entries, and linking, changes the times of inodes.
+    for path, ino in with_utimes:
+        yield SendStreamItems.utimes(
+            path=path,
+            atime=ino.utimes.atime,
+            mtime=ino.utimes.mtime,
+            ctime=ino.utimes.ctime,
+        )
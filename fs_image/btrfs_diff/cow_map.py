@@ -0,0 +1,787 @@
+#!/usr/bin/env python3
+'''
+`CowMap` is a mutable mapping whose `copy()` is O(1).  This is what lets
+`SubvolumeSetMutator` make a snapshot without copying every inode and
+path of the parent subvolume.
+
+A `CowMap` is a hash array mapped trie (HAMT), whose nodes are shared
+between the map and its copies.  Each node records which map was editing
+it when it was made, and each map has a fresh "edit token" after every
+`copy()`.  A map mutates a node in place only when it holds the node's
+edit token, and otherwise replaces the node -- and its ancestors -- with
+copies.  So, an update costs O(log N) the first time that it touches a
+shared node, and is in-place after that.
+
+A `Subvolume` keeps several entries per file in these maps, so they are
+compact: each key gets a small slotted leaf, and an interior node only
+stores its non-empty children, which a bitmap marks.  `CowIntMap` is a
+cheaper and faster variant for maps keyed by small non-negative `int`s,
+like inode numbers, which stores the values directly in its nodes.
+
+The values need the same treatment if they are mutable: a value that was
+stored before a `copy()` is shared by both maps.  `get_mut` returns a
+value that is safe to mutate, calling `copy_value` on shared values.
+Immutable values are simplest -- just store a new one via `[]=`.
+
+Even a compact map costs an object per value, and more for the values'
+own fields.  `CowIntTable` stores rows of fields without any per-row
+objects: the rows are grouped into chunks, each of which packs its rows'
+`int` fields into one `bytearray`.
+
+IMPORTANT: Keep this `deepcopy`able.  A `deepcopy` duplicates the shared
+nodes & values once per `deepcopy` call, so maps copied together stay
+consistent.
+'''
+import copy
+import functools
+import struct
+
+from types import MappingProxyType
+from typing import (
+    Any, Callable, Hashable, Iterable, Iterator, MutableMapping, Sequence,
+)
+
+from .freeze import freeze
+
+_BITS = 5  # Each trie level consumes this many bits of the key hash
+_WIDTH = 1 << _BITS
+_MASK = _WIDTH - 1
+_HASH_MASK = (1 << 64) - 1  # Negative hashes become positive
+
+
+if hasattr(int, 'bit_count'):  # Python 3.10+
+    _popcount = int.bit_count
+else:  # pragma: no cover
+    def _popcount(n: int) -> int:
+        return bin(n).count('1')
+
+
+class _EditToken:
+    'Identifies the map that may mutate a node in place.'
+    __slots__ = ()
+
+
+class _Node:
+    # Bit `i` of `bitmap` is set iff there is a child for hash bits `i`.
+    # `children` holds just those, each a `_Node`, `_Leaf`, or `_Collision`.
+    # It is a `tuple`, since that is smaller than a `list`, and its copies
+    # can be shared.
+    __slots__ = ('edit', 'bitmap', 'children')
+
+    def __init__(self, edit, bitmap, children):
+        self.edit = edit
+        self.bitmap = bitmap
+        self.children = children
+
+
+class _Leaf:
+    # The value belongs to the map that owns the leaf, since only that map
+    # may store into the leaf.  To save memory, the hash is not stored --
+    # `hash()` of `int`s is trivial, and `bytes` cache their hash.
+    __slots__ = ('edit', 'key', 'value')
+
+    def __init__(self, edit, key, value):
+        self.edit = edit
+        self.key = key
+        self.value = value
+
+
+def _hash(key) -> int:
+    return hash(key) & _HASH_MASK
+
+
+def _node_hash(node) -> int:
+    'The full key hash of a `_Leaf` or `_Collision`.'
+    return _hash(node.key) if node.__class__ is _Leaf else node.hash
+
+
+class _Collision:
+    'Holds the `_Leaf`s of several keys with the same hash.'
+    __slots__ = ('edit', 'hash', 'leaves')
+
+    def __init__(self, edit, hash, leaves):
+        self.edit = edit
+        self.hash = hash
+        self.leaves = leaves
+
+
+def _leaf_index(node: _Collision, key) -> int:
+    for i, leaf in enumerate(node.leaves):
+        if leaf.key is key or leaf.key == key:
+            return i
+    raise KeyError(key)
+
+
+class CowMap(MutableMapping):
+    __slots__ = ('_root', '_len', '_edit')
+
+    def __init__(self, items=()):
+        self._root = None
+        self._len = 0
+        self._edit = _EditToken()
+        self.update(items)
+
+    def copy(self) -> 'CowMap':
+        'O(1).  Afterwards, neither map may mutate the shared nodes.'
+        new = CowMap.__new__(CowMap)
+        new._root = self._root
+        new._len = self._len
+        new._edit = _EditToken()
+        self._edit = _EditToken()
+        return new
+
+    def _find(self, key) -> _Leaf:
+        'Raises `KeyError` if `key` is missing.'
+        h = _hash(key)
+        node = self._root
+        shift = 0
+        while node.__class__ is _Node:
+            bit = 1 << ((h >> shift) & _MASK)
+            if not node.bitmap & bit:
+                raise KeyError(key)
+            node = node.children[_popcount(node.bitmap & (bit - 1))]
+            shift += _BITS
+        if node.__class__ is _Leaf:
+            if node.key is key or node.key == key:
+                return node
+        elif node is not None and node.hash == h:
+            return node.leaves[_leaf_index(node, key)]
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        return self._find(key).value
+
+    def get(self, key, default=None):
+        try:
+            return self._find(key).value
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self._find(key)
+        except KeyError:
+            return False
+        return True
+
+    def get_mut(self, key, copy_value: Callable[[Any], Any]):
+        '''
+        Returns the value at `key`.  If it may be shared with another map,
+        first replaces it by `copy_value(value)`.
+        '''
+        leaf = self._find(key)
+        if leaf.edit is self._edit:
+            return leaf.value
+        value = copy_value(leaf.value)
+        self[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._root = self._assoc(
+            self._root, 0, _hash(key), key, value,
+        )
+
+    def _own(self, node):
+        'Returns `node`, or a copy of it if we may not mutate it.'
+        if node.edit is self._edit:
+            return node
+        if node.__class__ is _Node:
+            return _Node(self._edit, node.bitmap, node.children)
+        return _Collision(self._edit, node.hash, list(node.leaves))
+
+    def _assoc(self, node, shift: int, h: int, key, value):
+        edit = self._edit
+        if node is None:
+            self._len += 1
+            return _Leaf(edit, key, value)
+        if node.__class__ is not _Node:
+            node_hash = _node_hash(node)
+            if node_hash == h:
+                leaf = _Leaf(edit, key, value)
+                if node.__class__ is _Leaf:
+                    if node.key is key or node.key == key:
+                        if node.edit is edit:
+                            node.value = value
+                            return node
+                        return leaf
+                    self._len += 1
+                    return _Collision(edit, h, [node, leaf])
+                node = self._own(node)
+                try:
+                    node.leaves[_leaf_index(node, key)] = leaf
+                except KeyError:
+                    self._len += 1
+                    node.leaves.append(leaf)
+                return node
+            # Push the old leaf down a level, and retry.  The hashes
+            # differ, so they will part ways before running out of bits.
+            node = _Node(edit, 1 << ((node_hash >> shift) & _MASK), (node,))
+        bit = 1 << ((h >> shift) & _MASK)
+        idx = _popcount(node.bitmap & (bit - 1))
+        children = node.children
+        if node.bitmap & bit:
+            child = self._assoc(children[idx], shift + _BITS, h, key, value)
+            if child is children[idx]:  # Updated in place
+                return node
+            node = self._own(node)
+            node.children = children[:idx] + (child,) + children[idx + 1:]
+        else:
+            self._len += 1
+            node = self._own(node)
+            node.bitmap |= bit
+            node.children = \
+                children[:idx] + (_Leaf(edit, key, value),) + children[idx:]
+        return node
+
+    def __delitem__(self, key):
+        self._root = self._dissoc(self._root, 0, _hash(key), key)
+        self._len -= 1
+
+    def _dissoc(self, node, shift: int, h: int, key):
+        'Returns the replacement for `node`, raises if `key` is missing.'
+        if node is None:
+            raise KeyError(key)
+        if node.__class__ is _Leaf:
+            if not (node.key is key or node.key == key):
+                raise KeyError(key)
+            return None
+        if node.__class__ is _Collision:
+            if node.hash != h:
+                raise KeyError(key)
+            idx = _leaf_index(node, key)
+            if len(node.leaves) == 2:
+                return node.leaves[1 - idx]
+            node = self._own(node)
+            del node.leaves[idx]
+            return node
+        bit = 1 << ((h >> shift) & _MASK)
+        if not node.bitmap & bit:
+            raise KeyError(key)
+        idx = _popcount(node.bitmap & (bit - 1))
+        child = self._dissoc(node.children[idx], shift + _BITS, h, key)
+        # Collapse nodes that are left with a single leaf -- lookups check
+        # the full hash of a leaf, so it may live at any depth.
+        if child is None:
+            if node.bitmap == bit:
+                return None
+            if len(node.children) == 2:
+                other = node.children[1 - idx]
+                if other.__class__ is not _Node:
+                    return other
+        elif node.bitmap == bit and child.__class__ is not _Node:
+            return child
+        node = self._own(node)
+        children = node.children
+        if child is None:
+            node.bitmap &= ~bit
+            node.children = children[:idx] + children[idx + 1:]
+        else:
+            node.children = children[:idx] + (child,) + children[idx + 1:]
+        return node
+
+    def _gen_leaves(self) -> Iterator[_Leaf]:
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            if node.__class__ is _Leaf:
+                yield node
+            elif node.__class__ is _Collision:
+                yield from node.leaves
+            else:
+                # Reversed, so that we visit the children in hash order.
+                stack.extend(reversed(node.children))
+
+    def __iter__(self) -> Iterator[Hashable]:
+        for leaf in self._gen_leaves():
+            yield leaf.key
+
+    def items(self):
+        for leaf in self._gen_leaves():
+            yield leaf.key, leaf.value
+
+    def values(self):
+        for leaf in self._gen_leaves():
+            yield leaf.value
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __repr__(self):
+        return f'CowMap({dict(self.items())})'
+
+    def freeze(self, *, _memo):
+        'Like `freeze` on a `dict`.'
+        return MappingProxyType({
+            freeze(k, _memo=_memo): freeze(v, _memo=_memo)
+                for k, v in self.items()
+        })
+
+
+class _Missing:
+    'Marks the empty slots of `_IntNode`s at the bottom of the trie.'
+    __slots__ = ()
+
+    def __reduce__(self):  # `deepcopy` and `pickle` must keep the singleton
+        return '_MISSING'
+
+
+_MISSING = _Missing()
+
+
+class _IntNode:
+    # `slots` is a list of `_WIDTH` children, or of values at the bottom
+    # level.  At the bottom, bit `i` of `owned` is set iff `edit`'s map
+    # stored value `i` -- the other values may be shared.
+    __slots__ = ('edit', 'owned', 'slots')
+
+    def __init__(self, edit, owned, slots):
+        self.edit = edit
+        self.owned = owned
+        self.slots = slots
+
+
+class CowIntMap(MutableMapping):
+    '''
+    Like `CowMap`, but only takes `int` keys >= 0, and is best suited to
+    keys that are densely packed near 0.  It is a radix trie on the bits
+    of the key, growing taller as bigger keys get added.
+    '''
+    __slots__ = ('_root', '_shift', '_len', '_edit')
+
+    def __init__(self, items=()):
+        self._root = None
+        self._shift = 0  # The bit offset of the top level of the trie
+        self._len = 0
+        self._edit = _EditToken()
+        self.update(items)
+
+    def copy(self) -> 'CowIntMap':
+        'O(1).  Afterwards, neither map may mutate the shared nodes.'
+        new = CowIntMap.__new__(CowIntMap)
+        new._root = self._root
+        new._shift = self._shift
+        new._len = self._len
+        new._edit = _EditToken()
+        self._edit = _EditToken()
+        return new
+
+    def _find(self, key):
+        'Returns `(bottom node, slot index)`, or raises `KeyError`.'
+        if (
+            self._root is None or key.__class__ is not int or key < 0 or
+            key >> (self._shift + _BITS)
+        ):
+            raise KeyError(key)
+        node = self._root
+        shift = self._shift
+        while shift:
+            node = node.slots[(key >> shift) & _MASK]
+            if node is None:
+                raise KeyError(key)
+            shift -= _BITS
+        idx = key & _MASK
+        if node.slots[idx] is _MISSING:
+            raise KeyError(key)
+        return node, idx
+
+    def __getitem__(self, key):
+        node, idx = self._find(key)
+        return node.slots[idx]
+
+    def get(self, key, default=None):
+        'Faster than `Mapping.get`, which handles a `KeyError` on misses.'
+        node = self._root
+        if (
+            node is None or key.__class__ is not int or key < 0 or
+            key >> (self._shift + _BITS)
+        ):
+            return default
+        shift = self._shift
+        while shift:
+            node = node.slots[(key >> shift) & _MASK]
+            if node is None:
+                return default
+            shift -= _BITS
+        value = node.slots[key & _MASK]
+        return default if value is _MISSING else value
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get_mut(self, key, copy_value: Callable[[Any], Any]):
+        'See `CowMap.get_mut`.'
+        node, idx = self._find(key)
+        value = node.slots[idx]
+        if node.edit is self._edit and node.owned & (1 << idx):
+            return value
+        value = copy_value(value)
+        self[key] = value
+        return value
+
+    def _own(self, node: _IntNode) -> _IntNode:
+        'Returns `node`, or a copy of it if we may not mutate it.'
+        if node.edit is self._edit:
+            return node
+        return _IntNode(self._edit, 0, list(node.slots))
+
+    def _bottom_node_for_write(self, key: int) -> _IntNode:
+        edit = self._edit
+        if self._root is None:
+            self._root = _IntNode(edit, 0, [_MISSING] * _WIDTH)
+        while key >> (self._shift + _BITS):  # Add levels on top
+            self._root = _IntNode(
+                edit, 0, [self._root] + [None] * (_WIDTH - 1),
+            )
+            self._shift += _BITS
+        node = self._root = self._own(self._root)
+        shift = self._shift
+        while shift:
+            idx = (key >> shift) & _MASK
+            child = node.slots[idx]
+            if child is None:
+                child = _IntNode(edit, 0, (
+                    [None] if shift > _BITS else [_MISSING]
+                ) * _WIDTH)
+            else:
+                child = self._own(child)
+            node.slots[idx] = node = child
+            shift -= _BITS
+        return node
+
+    def __setitem__(self, key, value):
+        if key.__class__ is not int or key < 0:
+            raise TypeError(f'CowIntMap keys are ints >= 0, not {key!r}')
+        node = self._bottom_node_for_write(key)
+        idx = key & _MASK
+        if node.slots[idx] is _MISSING:
+            self._len += 1
+        node.slots[idx] = value
+        node.owned |= 1 << idx
+
+    def __delitem__(self, key):
+        self._find(key)
+        # Nodes are not pruned, since the keys are supposed to be dense.
+        node = self._bottom_node_for_write(key)
+        node.slots[key & _MASK] = _MISSING
+        self._len -= 1
+
+    def items(self):
+        if self._root is None:
+            return
+        stack = [(self._root, self._shift, 0)]
+        while stack:
+            node, shift, prefix = stack.pop()
+            if shift:
+                # Reversed, so that we yield the keys in increasing order.
+                for i in reversed(range(len(node.slots))):
+                    if node.slots[i] is not None:
+                        stack.append((
+                            node.slots[i], shift - _BITS,
+                            prefix | (i << shift),
+                        ))
+            else:
+                for i, value in enumerate(node.slots):
+                    if value is not _MISSING:
+                        yield prefix | i, value
+
+    def __iter__(self) -> Iterator[int]:
+        for key, _ in self.items():
+            yield key
+
+    def values(self):
+        for _, value in self.items():
+            yield value
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __repr__(self):
+        return f'CowIntMap({dict(self.items())})'
+
+    def freeze(self, *, _memo):
+        'Like `freeze` on a `dict`.'
+        return MappingProxyType({
+            k: freeze(v, _memo=_memo) for k, v in self.items()
+        })
+
+
+class _TableField:
+    'How a `CowIntTable` stores one field of its rows.'
+    __slots__ = ('code', 'offset', 'struct', 'min', 'max')
+
+    def __init__(self, code: str, offset: int):
+        self.code = code
+        # The byte offset of an `int` field in its row, or the index of an
+        # object field among the object fields.
+        self.offset = offset
+        if code in 'OC':
+            self.struct = None
+        else:
+            self.struct = struct.Struct('=' + code)
+            bits = 8 * self.struct.size
+            self.min = -(1 << (bits - 1))  # Marks unpacked values
+            self.max = (1 << (bits - 1)) - 1
+
+
+class _TableChunk:
+    '''
+    Rows `i * _WIDTH` through `i * _WIDTH + _WIDTH - 1` of a `CowIntTable`.
+    Bit `j` of `present` is set iff row `j` exists.  The `int` fields of
+    row `j` are packed at `j * table._row_size` in `ints`, and its object
+    fields are at `j * table._num_objects` in `objects`.  `overflow` maps
+    `(j, field)` to the values of `int` fields that could not be packed.
+    '''
+    __slots__ = ('present', 'ints', 'objects', 'overflow', 'caches')
+
+    def __init__(self, present, ints, objects, overflow, caches):
+        self.present = present
+        self.ints = ints
+        self.objects = objects
+        self.overflow = overflow
+        # The indexes in `objects` of the `C` fields, shared by all chunks
+        # of the table.
+        self.caches = caches
+
+    def copy(self) -> '_TableChunk':
+        return _TableChunk(
+            self.present, bytearray(self.ints), list(self.objects),
+            None if self.overflow is None else dict(self.overflow),
+            self.caches,
+        )
+
+    def __deepcopy__(self, memo):
+        'Caches are not copied, see `CowIntTable`.'
+        objects = list(self.objects)
+        if self.caches:
+            num_objects = len(objects) // _WIDTH
+            for i in range(0, len(objects), num_objects):
+                for j in self.caches:
+                    objects[i + j] = None
+        new = _TableChunk(
+            self.present, bytearray(self.ints),
+            copy.deepcopy(objects, memo),
+            copy.deepcopy(self.overflow, memo), self.caches,
+        )
+        memo[id(self)] = new
+        return new
+
+
+@functools.lru_cache(maxsize=None)
+def _table_layout(fields: str):
+    '''
+    Returns `(fields, row_struct, num_objects, caches)` for the `fields` of
+    a `CowIntTable`, see its docstring.  Parsing this is slow next to the
+    rest of making a table, and there are few distinct `fields`.
+    '''
+    table_fields = []
+    row_codes = '='
+    num_objects = 0
+    caches = []
+    for code in fields:
+        if code in 'OC':
+            if code == 'C':
+                caches.append(num_objects)
+            table_fields.append(_TableField(code, num_objects))
+            num_objects += 1
+        elif code in 'bhiq':
+            table_fields.append(_TableField(code, struct.calcsize(row_codes)))
+            row_codes += code
+        else:
+            raise ValueError(f'Bad CowIntTable field type {code!r}')
+    return (
+        tuple(table_fields), struct.Struct(row_codes), num_objects,
+        tuple(caches),
+    )
+
+
+class CowIntTable:
+    '''
+    A copy-on-write table of rows, keyed by `int`s >= 0, which is best
+    suited to keys that are densely packed near 0.  Every row has the same
+    fields, whose types are the characters of `fields`:
+     - `b`, `h`, `i`, `q`: an `int` of the `struct` format, packed into
+       the row's chunk.  Any other value, like `None`, or an `int` that
+       does not fit, is kept in a `dict` of the chunk.  This keeps rare
+       outliers correct without making every row bigger.
+     - `O`: any object.
+     - `C`: any object, which is a cache of the row's other fields.
+       `set_cache` stores it even in a chunk that is shared with copies,
+       since they share the rest of the row, too, and `deepcopy` leaves
+       it empty.  So, the cached value must be checked before use.
+
+    The chunks of `_WIDTH` rows are the values of a `CowIntMap`, so
+    `copy()` is O(1), and a write copies a shared chunk at its first
+    touch.
+    '''
+    __slots__ = (
+        '_chunks', '_len', '_fields', '_row_struct', '_row_size',
+        '_num_objects', '_caches',
+    )
+
+    def __init__(self, fields: str):
+        self._chunks = CowIntMap()
+        self._len = 0
+        # `_row_struct` packs all the `int` fields of a row at once.
+        self._fields, self._row_struct, self._num_objects, self._caches = \
+            _table_layout(fields)
+        self._row_size = self._row_struct.size
+
+    def copy(self) -> 'CowIntTable':
+        'O(1).  Afterwards, neither table may mutate the shared chunks.'
+        new = copy.copy(self)
+        new._chunks = self._chunks.copy()
+        return new
+
+    def __deepcopy__(self, memo):
+        'Shares the layout, which is immutable, and cannot be copied.'
+        new = copy.copy(self)
+        memo[id(self)] = new
+        new._chunks = copy.deepcopy(self._chunks, memo)
+        return new
+
+    def _chunk(self, key: int) -> _TableChunk:
+        'Returns the chunk holding `key`, or raises `KeyError`.'
+        chunk = None
+        if key.__class__ is int and key >= 0:
+            chunk = self._chunks.get(key >> _BITS)
+        if chunk is None or not (chunk.present >> (key & _MASK)) & 1:
+            raise KeyError(key)
+        return chunk
+
+    def _get(self, chunk: _TableChunk, row: int, field: int):
+        f = self._fields[field]
+        if f.struct is None:
+            return chunk.objects[row * self._num_objects + f.offset]
+        value, = f.struct.unpack_from(
+            chunk.ints, row * self._row_size + f.offset,
+        )
+        if value == f.min:
+            return None if chunk.overflow is None \
+                else chunk.overflow.get((row, field))
+        return value
+
+    def get(self, key: int, field: int):
+        'Returns field number `field` of row `key`.'
+        return self._get(self._chunk(key), key & _MASK, field)
+
+    def get_row(self, key: int) -> Sequence[Any]:
+        'Returns a `list` of all the fields of row `key`.'
+        chunk = self._chunk(key)
+        row = key & _MASK
+        ints = iter(self._row_struct.unpack_from(
+            chunk.ints, row * self._row_size,
+        ))
+        objects = chunk.objects
+        start = row * self._num_objects
+        values = []
+        for field, f in enumerate(self._fields):
+            if f.struct is None:
+                values.append(objects[start + f.offset])
+                continue
+            value = next(ints)
+            if value == f.min:
+                value = None if chunk.overflow is None \
+                    else chunk.overflow.get((row, field))
+            values.append(value)
+        return values
+
+    def _to_packed(
+        self, chunk: _TableChunk, row: int, field: int, value,
+    ) -> int:
+        'Returns what to pack for `value`, and updates the overflow.'
+        f = self._fields[field]
+        overflow = chunk.overflow
+        if value.__class__ is int and f.min < value <= f.max:
+            if overflow is not None:
+                overflow.pop((row, field), None)
+            return value
+        if value is not None:
+            if overflow is None:
+                overflow = chunk.overflow = {}
+            overflow[(row, field)] = value
+        elif overflow is not None:
+            overflow.pop((row, field), None)
+        return f.min
+
+    def _set(self, chunk: _TableChunk, row: int, field: int, value) -> None:
+        f = self._fields[field]
+        if f.struct is None:
+            chunk.objects[row * self._num_objects + f.offset] = value
+        else:
+            f.struct.pack_into(
+                chunk.ints, row * self._row_size + f.offset,
+                self._to_packed(chunk, row, field, value),
+            )
+
+    def _chunk_for_write(self, key: int) -> _TableChunk:
+        self._chunk(key)
+        return self._chunks.get_mut(key >> _BITS, _TableChunk.copy)
+
+    def set(self, key: int, field: int, value) -> None:
+        'Sets field number `field` of the existing row `key`.'
+        self._set(self._chunk_for_write(key), key & _MASK, field, value)
+
+    def set_cache(self, key: int, field: int, value) -> None:
+        'Sets a `C` field in place, even if the chunk is shared.'
+        assert self._fields[field].code == 'C'
+        self._set(self._chunk(key), key & _MASK, field, value)
+
+    def set_row(self, key: int, values: Iterable[Any]) -> None:
+        'Adds or replaces row `key`, whose fields are `values`.'
+        if key.__class__ is not int or key < 0:
+            raise TypeError(f'CowIntTable keys are ints >= 0, not {key!r}')
+        idx = key >> _BITS
+        chunk = self._chunks.get(idx)
+        if chunk is None:
+            chunk = self._chunks[idx] = _TableChunk(
+                0, bytearray(_WIDTH * self._row_size),
+                [None] * (_WIDTH * self._num_objects), None, self._caches,
+            )
+        else:
+            chunk = self._chunks.get_mut(idx, _TableChunk.copy)
+        row = key & _MASK
+        values = tuple(values)
+        if len(values) != len(self._fields):
+            raise ValueError(f'{len(self._fields)} fields, got {values}')
+        objects = chunk.objects
+        start = row * self._num_objects
+        ints = []
+        for field, (f, value) in enumerate(zip(self._fields, values)):
+            if f.struct is None:
+                objects[start + f.offset] = value
+            else:
+                ints.append(self._to_packed(chunk, row, field, value))
+        self._row_struct.pack_into(chunk.ints, row * self._row_size, *ints)
+        if not (chunk.present >> row) & 1:
+            chunk.present |= 1 << row
+            self._len += 1
+
+    def __delitem__(self, key: int) -> None:
+        chunk = self._chunk_for_write(key)
+        row = key & _MASK
+        chunk.present &= ~(1 << row)
+        self._len -= 1
+        # Release the objects, and the overflow, of the row.
+        for field in range(len(self._fields)):
+            self._set(chunk, row, field, None)
+
+    def __contains__(self, key) -> bool:
+        try:
+            self._chunk(key)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self) -> Iterator[int]:
+        'Yields the keys in increasing order.'
+        for idx, chunk in self._chunks.items():
+            present = chunk.present
+            row = 0
+            while present:
+                if present & 1:
+                    yield (idx << _BITS) | row
+                present >>= 1
+                row += 1
+
+    def __len__(self) -> int:
+        return self._len
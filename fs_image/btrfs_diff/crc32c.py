@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+'''
+Pure-Python CRC32C (Castagnoli), as used by the btrfs send-stream.
+
+`crc32c(data)` is the "raw" CRC that btrfs computes: it starts from the
+given `crc` (0 by default) and applies no final inversion.  To get the
+usual (iSCSI / `crc32c` module) value, start from 0xffffffff and xor the
+result with 0xffffffff.
+
+Python makes per-byte loops expensive, so this uses "slicing-by-8": eight
+256-entry tables let each loop iteration consume 8 bytes, unpacked as two
+32-bit words by `struct.iter_unpack`.  Only the trailing `len % 8` bytes
+take the classic one-table path.  That is ~1.5x faster than the
+byte-at-a-time loop, but still only ~10MB/s, so `parse_send_stream.py`
+verifies CRCs on worker processes, in parallel with parsing.
+'''
+import struct
+
+from typing import List
+
+_POLY = 0x82F63B78  # Castagnoli, bit-reversed
+_TWO_WORDS = struct.Struct('<II')
+
+
+def _make_tables() -> List[List[int]]:
+    t0 = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ (_POLY if crc & 1 else 0)
+        t0.append(crc)
+    tables = [t0]
+    for _ in range(7):
+        prev = tables[-1]
+        tables.append([(c >> 8) ^ t0[c & 0xff] for c in prev])
+    return tables
+
+
+_TABLES = _make_tables()
+
+
+def crc32c(data, crc: int = 0) -> int:
+    'Takes any bytes-like `data`.'
+    t0, t1, t2, t3, t4, t5, t6, t7 = _TABLES
+    with memoryview(data) as view:
+        view = view.cast('B')
+        split = len(view) - len(view) % _TWO_WORDS.size
+        for lo, hi in _TWO_WORDS.iter_unpack(view[:split]):
+            lo ^= crc
+            crc = (
+                t7[lo & 0xff] ^ t6[(lo >> 8) & 0xff] ^
+                t5[(lo >> 16) & 0xff] ^ t4[lo >> 24] ^
+                t3[hi & 0xff] ^ t2[(hi >> 8) & 0xff] ^
+                t1[(hi >> 16) & 0xff] ^ t0[hi >> 24]
+            )
+        for b in view[split:]:
+            crc = t0[(crc ^ b) & 0xff] ^ (crc >> 8)
+    return crc
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+'''
+Usage:
+
+    alias demo_sendstream='python3 -m btrfs_diff.tests.gold_demo_sendstreams'
+    demo_sendstream create_ops |
+        python3 -m btrfs_diff.examples.compact_sendstream |
+        python3 -m btrfs_diff.examples.dump_sendstream
+
+Reads a full send-stream from stdin, and writes to stdout a version 1
+send-stream that makes the same subvolume with fewer commands: no
+temporary names, one coalesced `write` per run of data, and one `chown`,
+`chmod` & `utimes` per inode.  See `compact_send_stream.py` for the
+details and limitations.
+'''
+import sys
+
+from ..compact_send_stream import compact_send_stream
+from ..parse_send_stream import parse_send_stream
+from ..write_send_stream import write_send_stream
+
+
+def main(argv):
+    if len(argv) != 1:
+        print(__doc__, file=sys.stderr)
+        return 1
+
+    write_send_stream(
+        compact_send_stream(parse_send_stream(sys.stdin.buffer)),
+        sys.stdout.buffer,
+    )
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -13,7 +13,7 @@ Returns 2 if no loops exist, 1 on usage or data errors.
 import os
 import sys
 
-from ..parse_send_stream import parse_send_stream
+from ..parse_send_stream import CommandKind, scan_send_stream
 from ..send_stream import SendStreamItems
 
 
@@ -21,10 +21,10 @@ def main(argv):
     if len(argv) != 1:
         print(__doc__, file=sys.stderr)
         return 1
-    for item in parse_send_stream(sys.stdin.buffer):
-        if isinstance(item, SendStreamItems.mknod) and (
-            os.major(item.dev) == 7 or item.dev == os.makedev(10, 237)
-        ):
+    # Only `mknod` commands get decoded, the rest are skipped.
+    for item in scan_send_stream(sys.stdin.buffer, {CommandKind.MKNOD}):
+        assert isinstance(item, SendStreamItems.mknod), item
+        if os.major(item.dev) == 7 or item.dev == os.makedev(10, 237):
             # Not printing the path here since it'd be `o123-78-456` or some
             # similarly meaningless temporary emitted by `btrfs send`.
             #
@@ -39,13 +39,9 @@ def main(argv):
             #  -  Roll some special logic for resolving what names
             #     send-stream temporaries ultimately map to.  Probably not
             #     worth it.
-            #  -  Add the capability to `Subvolume` to apply items even when
-            #     the dependency is not there, and instead to record some
-            #     kind of placeholder / dependency object in the tree.  The
-            #     semantics would take some thought to get right, but the
-            #     upside is significant, since we would then be able to
-            #     handle filesystem diffs almost as easily as full
-            #     filesystems.
+            #  -  Apply just this send-stream, with `allow_unknown_parent`
+            #     in `SubvolumeSetMutator`, which records placeholders for
+            #     the parent's inodes.  This still costs a full parse.
             print(os.major(item.dev), os.minor(item.dev))
             return 0
     return 2  # Python would return 1 on raised parse exceptions :)
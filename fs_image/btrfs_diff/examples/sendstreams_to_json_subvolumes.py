@@ -33,6 +33,7 @@ A few things to try:
 # to encourage interactive play with send-streams.
 import argparse
 import json
+import os
 import sys
 
 from ..freeze import freeze
@@ -41,11 +42,23 @@ from ..inode_utils import (
     erase_mode_and_owner, erase_selinux_xattr, erase_utimes_in_range,
     SELinuxXAttrStats,
 )
+from ..parallel_parse import parse_send_stream_files
 from ..parse_send_stream import parse_send_stream
-from ..rendered_tree import emit_non_unique_traversal_ids
+from ..rendered_tree import TraversalIDMaker
+from ..streaming_render import gen_rendered_json
 from ..subvolume_set import SubvolumeSet, SubvolumeSetMutator
 
 
+def _parse_files(paths):
+    'Parses the files in turn, keeping one open at a time.'
+    for path in paths:
+        if path == '-':
+            yield parse_send_stream(sys.stdin.buffer)
+            continue
+        with open(path, 'rb') as infile:
+            yield parse_send_stream(infile)
+
+
 def main(argv):
     parser = argparse.ArgumentParser(
         description=__doc__,
@@ -100,17 +113,56 @@ def main(argv):
             'doubt, first look at the output without `--show-only`.'
     )
     parser.add_argument(
-        'sendstream', type=argparse.FileType('br'), nargs='+',
-        help='A file containing the output of `btrfs send`. Note that '
-            'send-stream order matters, since we will try to apply them '
-            'to our in-memory filesystem from left to right.',
+        '--shared-extents', action='store_true',
+        help='Instead of listing, for each cloned chunk, every other place '
+            'that clones it (quadratic in the number of clones), label '
+            'each shared extent with an ID like `e3`, and list the extents '
+            'backing each chunk. Use this for long chains of snapshots.',
+    )
+    parser.add_argument(
+        '--allow-unknown-parent', action='store_true',
+        help='Apply an incremental send-stream even if the stream of its '
+            'parent is not given, modeling the parent by placeholders: '
+            'the paths that the stream refers to, with no metadata, and '
+            'with the type `Unknown` unless the stream reveals it. Since '
+            'placeholders are incomplete, combine with '
+            '--no-check-complete.',
+    )
+    parser.add_argument(
+        '--parse-jobs', type=int, default=1,
+        help='Parse up to this many send-streams at once, in separate '
+            'processes. The items are still applied in order by the main '
+            'process.',
+    )
+    parser.add_argument(
+        'sendstream', nargs='+',
+        help='A file containing the output of `btrfs send`, or `-` for '
+            'stdin. Note that send-stream order matters, since we will try '
+            'to apply them to our in-memory filesystem from left to right.',
     )
     args = parser.parse_args(argv[1:])
 
+    if args.parse_jobs > 1:
+        if '-' in args.sendstream:
+            parser.error(
+                'Cannot read `-` with --parse-jobs > 1, since the workers '
+                'open the send-streams by path'
+            )
+        # The workers open the files by name, e.g. `/dev/fd/N` for pipes.
+        parsed_streams = parse_send_stream_files(
+            [os.fsencode(p) for p in args.sendstream],
+            max_workers=args.parse_jobs,
+        )
+    else:
+        parsed_streams = _parse_files(args.sendstream)
+
     subvols = SubvolumeSet.new()
-    for sendstream_in in args.sendstream:
-        parsed = parse_send_stream(sendstream_in)
-        mutator = SubvolumeSetMutator.new(subvols, next(parsed))
+    for parsed in parsed_streams:
+        parsed = iter(parsed)
+        mutator = SubvolumeSetMutator.new(
+            subvols, next(parsed),
+            allow_unknown_parent=args.allow_unknown_parent,
+        )
         for i in parsed:
             mutator.apply_item(i)
 
@@ -143,7 +195,7 @@ def main(argv):
             ))
 
     if args.show_only:
-        result = {}
+        name_to_subvol = {}
         # This hides cross-subvolume clone annotations, see `--show-only`.
         for which_subvol in args.show_only:
             subvol = subvols.get_by_rendered_id(which_subvol)
@@ -151,15 +203,33 @@ def main(argv):
                 raise RuntimeError(
                     f'Unknown subvol {which_subvol}, try without --show-only'
                 )
-            result[which_subvol] = emit_non_unique_traversal_ids(
-                freeze(subvol).render()
+            name_to_subvol[which_subvol] = freeze(
+                subvol, shared_extents=args.shared_extents,
             )
     else:
-        result = freeze(subvols).map(
-            lambda sv: emit_non_unique_traversal_ids(sv.render())
+        name_to_subvol = freeze(
+            subvols, shared_extents=args.shared_extents,
+        ).map(lambda subvol: subvol)
+
+    # Stream the JSON, since the rendered subvolumes can take many times
+    # the memory of the frozen ones.  This prints the same thing as
+    # `json.dumps(..., sort_keys=True, indent=2)` of the rendered
+    # subvolumes, see `streaming_render.py`.
+    #
+    # Number shared extents consistently across all the output subvolumes.
+    extent_id_maker = TraversalIDMaker()
+    sys.stdout.write('{')
+    for i, name in enumerate(sorted(name_to_subvol)):
+        sys.stdout.write(
+            (',' if i else '') + '\n  ' + json.dumps(name) + ': '
         )
-    # Future: is there a `pprint`-style compact & pretty JSON output?
-    print(json.dumps(result, sort_keys=True, indent=2))
+        sys.stdout.writelines(gen_rendered_json(
+            name_to_subvol[name],
+            extent_id_maker=extent_id_maker,
+            indent=2,
+            level=1,
+        ))
+    sys.stdout.write('\n}\n' if name_to_subvol else '}\n')
 
 
 if __name__ == '__main__':
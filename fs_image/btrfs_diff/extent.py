@@ -2,7 +2,7 @@
 import enum
 import itertools
 
-from typing import NamedTuple, Optional, Tuple, Union
+from typing import Iterator, NamedTuple, Optional, Tuple, Union
 
 
 # Future: use `deepfrozentype` for true immutability.
@@ -30,8 +30,8 @@ class Extent(NamedTuple):
     Users should NOT directly create extents. Also, the fields of `offset`
     and `content` cannot be usefully introspected.
      - Start each file with `empty()`
-     - Use the `btrfs send` workalikes of `truncate()`, `write()`, `clone()`
-       to change files.
+     - Use the `btrfs send` workalikes of `truncate()`, `write()`, `clone()`,
+       `punch_hole()` to change files.
      - Use `.length`, and `gen_trimmed_leaves()` to inspect the objects.
 
     ## KEY INTERNAL INVARIANT
@@ -46,12 +46,8 @@ class Extent(NamedTuple):
     One way would be to create a new, smaller DATA extent.
         Extent(content=Extent.Kind.DATA, offset=0, length=3)
     This is BAD, because it discards object identity between the new and
-    old.  The GOOD approach is to wrap the original object:
-        Extent(
-            Extent(content=Extent.Kind.DATA, offset=0, length=5),
-            offset=1,
-            length=3,
-        )
+    old.  The GOOD approach is to refer to the original object, and to
+    record separately which of its bytes are visible.
 
     This greatly simplifies clone tracking. It lets `gen_trimmed_leaves`
     flatten Extents to one level of nesting: a list of a trimmed DATA or
@@ -59,19 +55,30 @@ class Extent(NamedTuple):
     identity from their time of creation, this retains all the necessary
     information for deciding if two normalized extents share cloned bytes.
 
-    ## Design note
+    ## Representation
+
+    We store just what `gen_trimmed_leaves` yields: the sequence of trimmed
+    leaves, in a persistent AVL tree keyed by file offset.  Each non-leaf
+    `Extent` is a tree node, whose `content` is `(left, leaf, right)`.  The
+    node's own bytes are `leaf`, trimmed to start at `offset`, and its
+    `length` covers the whole subtree.  A file that is just one untrimmed
+    leaf is represented by that leaf.
 
-    For the purposes of write/clone/truncate modeling, `Extent` could do a
-    lot more on-the-fly normalization, which could save RAM.  E.g. we could
-    discard HOLE provenance (just store "hole of length N"), and we could
-    flatten to trimmed leaves more eagerly.  However, none of this extra
-    complexity seems worthwhile for now.
+    Every mutation splits the tree at a couple of offsets, and joins the
+    pieces back together, so it costs O(log N) for a file of N trimmed
+    leaves.  The pieces of a split are shared with the original, which
+    therefore stays valid -- as it must, since it may be a clone source,
+    or a prior state of a file.
 
+    Since history is not recorded, different operation orders often give
+    the same tree.  However, the representation is not canonical, so
+    compare files via `gen_trimmed_leaves`.
     '''
 
-    content: Union['Extent.Kind', Tuple['Extent']]
+    content: Union['Extent.Kind', Tuple['Extent', 'Extent', 'Extent']]
     offset: int
-    length: Optional[int]
+    length: int
+    height: int = 1  # Of the AVL tree: 0 for `empty()`, 1 for leaves
 
     class Kind(enum.Enum):
         DATA = 1
@@ -82,103 +89,175 @@ class Extent(NamedTuple):
             # Assume every reasonable user will have `Extent` in their scope
             return f'Extent.Kind.{self.name}'
 
-    # NB: we do not want this to be `__new__`, since it is allowed **NOT**
-    # to return a new object, but instead to extract one from `content`.
+    # The AVL tree algorithms are "join-based", as in "Just Join for
+    # Parallel Ordered Sets" by Blelloch, Ferizovic & Sun.  A "piece" is
+    # a trimmed leaf, `(offset, length, leaf)`, just as in the output of
+    # `gen_trimmed_leaves`.
+
     @staticmethod
-    def __new(
-        # IMPORTANT: `Extent` may rewrite its inputs before storing them in
-        # the object, so do not try to read them back.  Example: if `offset`
-        # & `length` are such that certain subextents are inaccessible, we
-        # will discard those subextents, and reduce `offset` accordingly.
+    def __leaf(kind: 'Extent.Kind', length: int) -> 'Extent':
+        return Extent(content=kind, offset=0, length=length)
 
-        content: Union['Extent.Kind', Tuple['Extent'], 'Extent'],
-        *,
-        # Hide the first `offset` bytes of the constituent extents.
-        offset: int = 0,
-        # Hide the bytes of the consitutent extents past `offset + length`.
-        # Inferred from the constituent extents if omitted.
-        length: Optional[int] = None,
-    ):
-        if isinstance(content, Extent):  # Avoid writing (self,) everywhere
-            content = (content,)
-        # Runtime enforcement because I don't trust my coding :)
-        assert isinstance(content, Extent.Kind) or (
-            isinstance(content, tuple)
-            and all(isinstance(e, Extent) for e in content)
-        ), f'Invalid extent content: {content}'
-        # If you hit this, you should create a HOLE followed by DATA.
-        assert isinstance(content, tuple) or offset == 0, \
-            'Nonzero offsets only make sense for extents-of-extents'
-        assert offset >= 0, f'offset {offset} < 0'
-
-        # Computed length can be negative -- e.g. this happens if a
-        # `write()` affects bytes past the end of the current extent.
-        # This is OK, and we want to treat this extent as empty.
-        max_length = max(0, sum(e.length for e in content) - offset) \
-            if isinstance(content, tuple) else None
+    @staticmethod
+    def __node(left: 'Extent', piece, right: 'Extent') -> 'Extent':
+        offset, length, leaf = piece
+        assert length > 0, f'Cannot store a 0-length piece of {leaf}'
+        # A file that is just one untrimmed leaf is that leaf.
+        lh = left.height
+        rh = right.height
+        if lh == 0 and rh == 0 and offset == 0 and length == leaf.length:
+            return leaf
+        # `tuple.__new__` skips the slow keyword-argument `__new__`
+        return tuple.__new__(Extent, (
+            (left, leaf, right), offset, left.length + length + right.length,
+            1 + (lh if lh > rh else rh),
+        ))
 
-        if length is None:
-            assert max_length is not None, f'{content} must specify length'
-            length = max_length
-        length = max(0, length)  # e.g. the `truncate` HOLE length may be < 0
-
-        # If the caller needs to add a HOLE at the end, it has to be explicit.
-        assert None in (length, max_length) or max_length >= length, \
-            f'Computed max length {max_length} > specified {length}'
-
-        if isinstance(content, tuple):
-
-            def optimize_content():
-                'Drop hidden and 0-length extents'
-                nonlocal offset  # Will be reduced if we skip initial extents
-                new_content_len = 0
-                for e in content:
-                    if e.length == 0:
-                        continue  # Skip empty extents
-                    if e.length <= offset:
-                        offset -= e.length
-                        continue  # Skip extents that precede `offset`
-                    if new_content_len >= offset + length:
-                        continue  # Skip extents that follow `offset + length`
-                    new_content_len += e.length
-                    yield e
-
-            content = tuple(optimize_content())
-
-        # Elide nesting when we end up with the identity transform on 1 extent
-        if (
-            isinstance(content, tuple) and len(content) == 1
-            and offset == 0 and length == content[0].length
-        ):
-            return content[0]
-
-        return Extent(content=content, offset=offset, length=length)
+    @staticmethod
+    def __expose(e: 'Extent'):
+        'Returns `(left, piece, right)` for a non-empty tree.'
+        if e.content.__class__ is not tuple:  # A leaf
+            return _EMPTY, (0, e.length, e), _EMPTY
+        left, leaf, right = e.content
+        return (
+            left, (e.offset, e.length - left.length - right.length, leaf),
+            right,
+        )
+
+    @staticmethod
+    def __rotate_left(e: 'Extent') -> 'Extent':
+        left, piece, right = Extent.__expose(e)
+        rl, rpiece, rr = Extent.__expose(right)
+        return Extent.__node(Extent.__node(left, piece, rl), rpiece, rr)
+
+    @staticmethod
+    def __rotate_right(e: 'Extent') -> 'Extent':
+        left, piece, right = Extent.__expose(e)
+        ll, lpiece, lr = Extent.__expose(left)
+        return Extent.__node(ll, lpiece, Extent.__node(lr, piece, right))
+
+    @staticmethod
+    def __join_right(left: 'Extent', piece, right: 'Extent') -> 'Extent':
+        'For when `left` is taller than `right`.'
+        ll, lpiece, lr = Extent.__expose(left)
+        if lr.height <= right.height + 1:
+            t = Extent.__node(lr, piece, right)
+            if t.height <= ll.height + 1:
+                return Extent.__node(ll, lpiece, t)
+            return Extent.__rotate_left(
+                Extent.__node(ll, lpiece, Extent.__rotate_right(t))
+            )
+        t = Extent.__join_right(lr, piece, right)
+        t2 = Extent.__node(ll, lpiece, t)
+        if t.height <= ll.height + 1:
+            return t2
+        return Extent.__rotate_left(t2)
+
+    @staticmethod
+    def __join_left(left: 'Extent', piece, right: 'Extent') -> 'Extent':
+        'The mirror image of `__join_right`.'
+        rl, rpiece, rr = Extent.__expose(right)
+        if rl.height <= left.height + 1:
+            t = Extent.__node(left, piece, rl)
+            if t.height <= rr.height + 1:
+                return Extent.__node(t, rpiece, rr)
+            return Extent.__rotate_right(
+                Extent.__node(Extent.__rotate_left(t), rpiece, rr)
+            )
+        t = Extent.__join_left(left, piece, rl)
+        t2 = Extent.__node(t, rpiece, rr)
+        if t.height <= rr.height + 1:
+            return t2
+        return Extent.__rotate_right(t2)
+
+    @staticmethod
+    def __join(left: 'Extent', piece, right: 'Extent') -> 'Extent':
+        'The balanced concatenation of `left`, `piece`, and `right`.'
+        if left.height > right.height + 1:
+            return Extent.__join_right(left, piece, right)
+        if right.height > left.height + 1:
+            return Extent.__join_left(left, piece, right)
+        return Extent.__node(left, piece, right)
+
+    @staticmethod
+    def __split_last(e: 'Extent'):
+        'Returns `(rest, last piece)` for a non-empty tree.'
+        left, piece, right = Extent.__expose(e)
+        if right.height == 0:
+            return left, piece
+        rest, last = Extent.__split_last(right)
+        return Extent.__join(left, piece, rest), last
+
+    @staticmethod
+    def __concat(left: 'Extent', right: 'Extent') -> 'Extent':
+        if left.height == 0:
+            return right
+        if right.height == 0:
+            return left
+        rest, last = Extent.__split_last(left)
+        return Extent.__join(rest, last, right)
+
+    def __split(self, pos: int) -> Tuple['Extent', 'Extent']:
+        'Returns the trees of the bytes before, and from, `pos`.'
+        if pos <= 0:
+            return _EMPTY, self
+        if pos >= self.length:
+            return self, _EMPTY
+        left, (offset, length, leaf), right = Extent.__expose(self)
+        if pos <= left.length:
+            ll, lr = left.__split(pos)
+            return ll, Extent.__join(lr, (offset, length, leaf), right)
+        pos -= left.length
+        if pos >= length:
+            rl, rr = right.__split(pos - length)
+            return Extent.__join(left, (offset, length, leaf), rl), rr
+        # `pos` falls inside this node's piece, so it gets trimmed twice.
+        return (
+            Extent.__join(left, (offset, pos, leaf), _EMPTY),
+            Extent.__join(_EMPTY, (offset + pos, length - pos, leaf), right),
+        )
+
+    def __slice(self, offset: int, length: int) -> 'Extent':
+        assert 0 <= offset and 0 <= length, f'offset {offset}, len {length}'
+        assert offset + length <= self.length, \
+            f'offset {offset} + length {length} > {self.length}'
+        return self.__split(offset)[1].__split(length)[0]
 
     @staticmethod
     def empty():
-        return Extent.__new(())
+        return _EMPTY
 
     def truncate(self, length: int):
-        return Extent.__new((
-            self,
-            Extent.__new(Extent.Kind.HOLE, length=length - self.length),
-        ), length=length)
+        length = max(0, length)
+        if length <= self.length:
+            return self.__split(length)[0]
+        return Extent.__join(self, (
+            0, length - self.length,
+            Extent.__leaf(Extent.Kind.HOLE, length - self.length),
+        ), _EMPTY)
 
     def __put(self, offset: int, what: 'Extent'):
         'Overwrites with `what` a portion of `self` starting at `offset`.'
         # E.g., should `extent.Extent.empty().write(offset=5, length=0)`
         # create a hole, or remain empty?
         assert what.length > 0, 'Future: not sure how to hangle length = 0'
-        return Extent.__new((
-            Extent.__new(self, length=min(self.length, offset)),
-            Extent.__new(Extent.Kind.HOLE, length=offset - self.length),
-            what,
-            Extent.__new(self, offset=(offset + what.length)),
-        ))
+        before, after = self.__split(offset)
+        if offset > self.length:
+            before = before.truncate(offset)  # Adds a HOLE
+        after = after.__split(what.length)[1]
+        if what.content.__class__ is not tuple:  # `what` is a leaf
+            return Extent.__join(before, (0, what.length, what), after)
+        return Extent.__concat(Extent.__concat(before, what), after)
 
     def write(self, *, offset: int, length: int):
         return self.__put(
-            offset, Extent.__new(Extent.Kind.DATA, length=length)
+            offset, Extent.__leaf(Extent.Kind.DATA, length)
+        )
+
+    def punch_hole(self, *, offset: int, length: int):
+        'Like `write`, but the new bytes read as zeros.'
+        return self.__put(
+            offset, Extent.__leaf(Extent.Kind.HOLE, length)
         )
 
     def clone(
@@ -186,45 +265,55 @@ class Extent(NamedTuple):
         *,
         to_offset: int, from_extent: 'Extent', from_offset: int, length: int,
     ):
-        return self.__put(
-            to_offset,
-            Extent.__new(from_extent, offset=from_offset, length=length),
-        )
+        return self.__put(to_offset, from_extent.__slice(from_offset, length))
 
-    def gen_trimmed_leaves(self, *, offset: int=0, length: Optional[int]=None):
+    def gen_trimmed_leaves(
+        self, *, offset: int=0, length: Optional[int]=None,
+    ) -> Iterator[Tuple[int, int, 'Extent']]:
         '''
         Yields the sequence of
            (offset, length, leaf subextent with Extent.Kind content),
         which you would witness on a filesystem, if the operations in `self`
-        were actually executed.
+        were actually executed.  With `offset` and `length`, yields just the
+        leaves of that part of `self`, trimmed to fit.
 
-        Caveat: `offset` and `length` are instructions for how to trim the
-        subextent, using the semantics described in `__new()`'s argument
-        list.  In contrast, `subextent.offset` is, by definition, always 0.
+        Caveat: `subextent.offset` is, by definition, always 0.
         '''
         max_length = self.length - offset
         if length is None:
             length = max_length
         assert length <= max_length, f'len {length}, offset {offset}, {self}'
         assert offset >= 0 and length >= 0, f'offset {offset}, length {length}'
-        assert offset <= self.length, f'offset {offset}, self {self}'
-
-        if isinstance(self.content, Extent.Kind):
-            trimmed_length = min(length, self.length - offset)
-            if trimmed_length > 0:
-                yield offset, trimmed_length, self
-            return
-
-        offset += self.offset
-        for e in self.content:
-            if e.length > offset:
-                yield from e.gen_trimmed_leaves(
-                    offset=offset, length=min(length, e.length - offset)
+
+        # An in-order traversal with an explicit stack, which visits only
+        # the nodes overlapping `[offset, offset + length)`.  Each stack
+        # entry is a subtree, and the file offset at which it starts.
+        end = offset + length
+        stack = []
+        e, e_start = self, 0
+        while True:
+            while e.height:
+                left, _, _ = Extent.__expose(e)
+                stack.append((e, e_start))
+                if offset < e_start + left.length:  # Overlaps `left`
+                    e = left
+                else:
+                    e = _EMPTY
+            if not stack:
+                return
+            e, e_start = stack.pop()
+            left, (piece_offset, piece_length, leaf), right = \
+                Extent.__expose(e)
+            piece_start = e_start + left.length
+            if piece_start >= end:
+                return
+            trim_start = max(0, offset - piece_start)
+            trim_end = min(piece_length, end - piece_start)
+            if trim_end > trim_start:
+                yield (
+                    piece_offset + trim_start, trim_end - trim_start, leaf,
                 )
-                length -= (e.length - offset)
-                if length <= 0:
-                    break
-            offset -= min(offset, e.length)
+            e, e_start = right, piece_start + piece_length
 
     def _gen_leaf_reprs(self):
         for _, length, leaf in self.gen_trimmed_leaves():
@@ -249,3 +338,6 @@ class Extent(NamedTuple):
 
     def __deepcopy__(self, memo):
         return self  # See the docstring
+
+
+_EMPTY = Extent(content=(), offset=0, length=0, height=0)
@@ -11,16 +11,18 @@ the structures of the write forks, respecting `truncate`, `write`, and
  - Run `extents_to_chunks_with_clones()` to summarize which files clone
    which other files.  A quick clarificaiton of the notation:
 
-    * `Extent` is actually a tree of extents, which captures the history of
-      how the file's sequence of extents was created.  Refer to `extent.py`.
+    * `Extent` is a balanced tree of the file's trimmed leaves, i.e. of
+      visible parts of the DATA or HOLE extents that `write`, `truncate`,
+      etc. created.  Clones share leaves by object identity.  It keeps no
+      history.  Refer to "Representation" in the `Extent` docblock.
 
     * `Chunk` more directly corresponds to a filesystem extent. It's either
       data or a hole of a given length. A file is just a contiguous sequence
       of `Chunk`s.  Beyond recording the kind, and the length, each `Chunk`
       records precisely how other files clone from it.
 
-   So `extents_to_chunks_with_clones()` flattens the history-preserving,
-   clone-aware tree in `Extent` objects into a test-friendly list of
+   So `extents_to_chunks_with_clones()` flattens the clone-aware trees of
+   trimmed leaves in `Extent` objects into a test-friendly list of
    `Chunk`s.
 
    For testing, it is important to produce a representation that is as
@@ -95,6 +97,25 @@ the structures of the write forks, respecting `truncate`, `write`, and
       by which the N-1 spanning tree edges are selected.  It's easy to make
       such a process deterministic, but it still adds cognitive load.
 
+    * Once an extent is cloned into many snapshots, the quadratic
+      representation becomes unusable.  `shared_extents=True` selects a
+      linear one, akin to how we render hardlinks:  every underlying
+      extent that is shared by two or more file locations gets an ID, and
+      each `Chunk` lists the `ChunkSharedExtent`s that back its parts.
+      In the above example, with `e0` as the 10-byte extent:
+
+        {'A': {'e0:0+3@0', 'e0:6+3@3'},
+         'B': {'e0:1+5@0'},
+         'C': {'e0:3+5@0'}}
+
+      That is one entry per (file location, shared extent), so N clones
+      take N entries.  Who shares what with whom is implied by overlapping
+      `e0` ranges.  We only list the trimmed leaves of an extent that
+      overlap another file location, but unlike `ChunkClone`s, each entry
+      spans its whole trimmed leaf.  Since the raw IDs depend on
+      the order of the inputs, renderings renumber them in filesystem
+      traversal order -- see `Inode.repr_with_extent_ids`.
+
 [1] The current code tracks clones of HOLEs, because it makes no effort to
     ignore them.  I would guess that btrfs lacks this tracking, since such
     clones would save no space.  Once this is confirmed, it would be very
@@ -111,13 +132,16 @@ the structures of the write forks, respecting `truncate`, `write`, and
 
 '''
 # Future: frozentypes instead of NamedTuples can permit some cleanups below.
-import functools
-
 from collections import defaultdict
-from typing import Dict, Iterable, NamedTuple, Sequence, Tuple
+from types import MappingProxyType
+from typing import (
+    Any, Dict, Iterable, Iterator, List, Mapping, NamedTuple, Sequence,
+    Set, Tuple,
+)
 
 from .extent import Extent
-from .inode import Clone, Chunk, ChunkClone
+from .freeze import freeze, FreezeCache
+from .inode import Clone, Chunk, ChunkClone, ChunkSharedExtent
 from .inode_id import InodeID
 
 
@@ -171,156 +195,131 @@ class _CloneExtentRef(NamedTuple):
         )
 
 
-# If these change, we have to update `_clone_op_compare_key`
-assert Clone._fields.index('inode_id') == 0
-assert _CloneExtentRef._fields.index('clone') == 0
-
-
-# Our _CloneOp ordering obeys the following invariants:
-#  - sort by position first
-#  - sort by action second, putting POPs before PUSHes (see their def'ns)
-# We do not need finer-grained ordering because:
-#  (1) we only do work on POPs,
-#  (2) the work done on all the POPs at one position does not depend on the
-#      order of the _CloneOps -- we symmetrically record the relationship in
-#      both directions:
-#        (just-popped op, each unpopped op)
-#        (each unpopped op, just-popped op)
-#
-# We could get the desired ordering implicitly by:
-#  - relying on the order of field declaration in `_CloneOp` (not bad)
-#  - making `Inode`s comparable (a bit ugly, comparing Extents is pricy,
-#    comparing InodeIDs would require some comparator boilerplate)
-# Luckily, being explicit is not *that* painful.
-def _clone_op_compare_key(c: '_CloneOp'):
-    return (
-        # The preceding asserts make these [1:] hacks tolerable.
-        c.pos, c.action, c.ref[1:], c.ref.clone[1:],
-        c.ref.clone.inode_id.id,
-    )
+def _gen_clone_extent_refs(
+    ino_id: InodeID, extent: Extent,
+) -> Iterable[_CloneExtentRef]:
+    'One `_CloneExtentRef` per item of `extent.gen_trimmed_leaves()`'
+    file_offset = 0
+    for leaf_idx, (offset, length, leaf_extent) in enumerate(
+        extent.gen_trimmed_leaves()
+    ):
+        yield _CloneExtentRef(
+            clone=Clone(inode_id=ino_id, offset=file_offset, length=length),
+            extent=leaf_extent,
+            offset=offset,
+            leaf_idx=leaf_idx,
+        )
+        file_offset += length
 
 
-def _clone_op_compare(fn):
-    @functools.wraps(fn)
-    def cmp(self: '_CloneOp', other: '_CloneOp'):
-        assert isinstance(other, _CloneOp)
-        # We only compare ops within one extent. The tests assume this to
-        # justify focusing on single-extent examples, so check it.
-        assert self.ref.extent is other.ref.extent
-        # All our items are distinct, since `clone.offset` is `inode_offset`,
-        # which is strictly increasing in each inode.  We have no business
-        # comparing a _CloneOp with itself.
-        assert tuple.__ne__(self, other)
-        return fn(_clone_op_compare_key(self), _clone_op_compare_key(other))
-    return cmp
-
-
-class _CloneOp(NamedTuple):
-    PUSH = 'push'
-    POP = 'pop'
-    assert POP < PUSH  # We want to sort all POPs before any PUSHes
-
-    pos: int
-    action: str
-    ref: _CloneExtentRef
-
-    # NamedTuple confuses functools.total_ordering, so define all 6 comparators
-    __eq__ = _clone_op_compare(tuple.__eq__)
-    __ne__ = _clone_op_compare(tuple.__ne__)
-    __lt__ = _clone_op_compare(tuple.__lt__)
-    __le__ = _clone_op_compare(tuple.__le__)
-    __gt__ = _clone_op_compare(tuple.__gt__)
-    __ge__ = _clone_op_compare(tuple.__ge__)
-
-
-def _leaf_extent_id_to_clone_ops(
+def _leaf_extent_id_to_refs(
     ids_and_extents: Iterable[Tuple[InodeID, Extent]]
-):
-    '''
-    To collect the parts of a Chunk that are cloned, we will run a variation
-    on the standard interval-overlap algorithm.  We first sort the starts &
-    ends of each interval, and then do a sequential scan that uses starts to
-    add, and ends to remove, a tracking object from a "current intervals"
-    structure.
-
-    This function simply prepares the set of interval starts & ends for each
-    InodeID, the computation is in `_leaf_ref_to_chunk_clones_from_clone_ops`.
-    '''
-    leaf_extent_id_to_clone_ops = defaultdict(list)
+) -> Mapping[int, Sequence[_CloneExtentRef]]:
+    'Groups the trimmed leaves of all inodes by the `id()` of their extent'
+    leaf_extent_id_to_refs = defaultdict(list)
     for ino_id, extent in ids_and_extents:
-        file_offset = 0
-        for leaf_idx, (offset, length, leaf_extent) in enumerate(
-            extent.gen_trimmed_leaves()
-        ):
-            ref = _CloneExtentRef(
-                clone=Clone(
-                    inode_id=ino_id, offset=file_offset, length=length,
-                ),
-                extent=leaf_extent,
-                offset=offset,
-                leaf_idx=leaf_idx,
-            )
-            leaf_extent_id_to_clone_ops[id(leaf_extent)].extend([
-                _CloneOp(pos=offset, action=_CloneOp.PUSH, ref=ref),
-                _CloneOp(pos=offset + length, action=_CloneOp.POP, ref=ref),
-            ])
-            file_offset += length
-    return leaf_extent_id_to_clone_ops
+        for ref in _gen_clone_extent_refs(ino_id, extent):
+            leaf_extent_id_to_refs[id(ref.extent)].append(ref)
+    return leaf_extent_id_to_refs
 
 
-def _leaf_ref_to_chunk_clones_from_clone_ops(
-    extent_id: int, clone_ops: Iterable[_CloneOp]
-):
-    'As per `_leaf_extent_id_to_clone_ops`, this computes interval overlaps'
-    active_ops: Dict[_CloneExtentRef, _CloneOp] = {}  # Tracks open intervals
-    leaf_ref_to_chunk_clones = defaultdict(list)
-    for op in sorted(clone_ops):
+# If these change, we have to update the `tuple.__new__` calls below.
+assert Clone._fields == ('inode_id', 'offset', 'length')
+assert ChunkClone._fields == ('offset', 'clone')
+
+# A trimmed leaf's clones, before `_trimmed_leaves_to_chunks` makes them
+# into `ChunkClone`s.  The sweep deals only in ints, which is leaner than
+# making intermediate `ChunkClone`s:
+#  - The `InodeID`s of the leaf extent's trimmed leaves, in sweep order.
+#  - For each clone: `(extent_offset, clone_idx, clone_offset,
+#    clone_length)`, where `clone_idx` indexes the above `InodeID`s.
+_LeafClones = Tuple[Sequence[InodeID], Sequence[Tuple[int, int, int, int]]]
+
+
+def _sweep(
+    intervals: Sequence[Tuple[int, int, int]],
+) -> List[Tuple[int, List[Tuple[int, int, int, int]]]]:
+    '''
+    To collect the parts of a Chunk that are cloned, we run a variation on
+    the standard interval-overlap algorithm over the trimmed leaves of one
+    leaf extent.  We first sort the starts & ends of each interval, and
+    then do a sequential scan that uses starts to add, and ends to remove,
+    an interval from the "currently open" ones.
+
+    `intervals` has the `(offset, length, inode_offset)` of each trimmed
+    leaf.  For each one that has clones, we return its index, and its
+    clones as in `_LeafClones`.
+
+    The events are plain `(pos, is_start, idx)` tuples, so the sort
+    compares them natively.  This gives the order we need:
+     - by position first,
+     - then ends before starts, so intervals that merely touch do not
+       overlap,
+     - `idx` just makes the keys unique.
+    We do not need a more meaningful order because:
+     (1) we only do work on ends,
+     (2) the work done on all the ends at one position does not depend on
+         their order -- we symmetrically record the relationship in both
+         directions:
+           (just-ended interval, each open interval)
+           (each open interval, just-ended interval)
+
+    The open intervals are a dict keyed by `idx`, which adds & removes in
+    O(1), and iterates in insertion order.
+    '''
+    events = []
+    for idx, (offset, length, _) in enumerate(intervals):
+        events.append((offset, True, idx))
+        events.append((offset + length, False, idx))
+    events.sort()
+
+    open_intervals: Dict[int, Tuple[int, int]] = {}
+    idx_to_clones = defaultdict(list)
+    for pos, is_start, idx in events:
+        if is_start:
+            offset, _, inode_offset = intervals[idx]
+            # `inode_offset - offset` maps extent offsets to inode offsets
+            open_intervals[idx] = (offset, inode_offset - offset)
+            continue
         # Whenever an interval (aka an Inode's Extent's "trimmed leaf")
-        # ends, we create `ChunkClone` objects **to** and **from** all the
-        # concurrently open intervals.
-        if op.action is _CloneOp.POP:
-            pushed_op = active_ops.pop(op.ref)
-            assert pushed_op.ref is op.ref
-            assert id(op.ref.extent) == extent_id
-            assert pushed_op.pos == op.ref.offset
-            assert pushed_op.pos + op.ref.clone.length == op.pos
-
-            for clone_op in active_ops.values():
-                assert op.ref.extent is clone_op.ref.extent
-
-                # The cloned portion's extent offset is the larger of the 2
-                bigger_offset = max(clone_op.ref.offset, op.ref.offset)
-
-                # Record that `clone_op` clones part of `op`'s inode.
-                leaf_ref_to_chunk_clones[op.ref].append(ChunkClone(
-                    offset=bigger_offset,
-                    clone=Clone(
-                        inode_id=clone_op.ref.clone.inode_id,
-                        offset=clone_op.ref.clone.offset + (
-                            bigger_offset - clone_op.ref.offset
-                        ),
-                        length=op.pos - bigger_offset,
-                    ),
-                ))
-
-                # Record that `op` clones part of `clone_op`'s inode.
-                leaf_ref_to_chunk_clones[clone_op.ref].append(ChunkClone(
-                    offset=bigger_offset,
-                    clone=Clone(
-                        inode_id=op.ref.clone.inode_id,
-                        offset=op.ref.clone.offset + (
-                            bigger_offset - op.ref.offset
-                        ),
-                        length=op.pos - bigger_offset,  # Same length
-                    ),
-                ))
-        # Sorting guarantees all POPs for `pos` are handled before PUSHes
-        elif op.action == _CloneOp.PUSH:
-            assert op.ref not in active_ops
-            active_ops[op.ref] = op
-        else:
-            assert False, op  # pragma: no cover
-    return leaf_ref_to_chunk_clones
+        # ends, we record clones **to** and **from** all the concurrently
+        # open intervals.
+        offset, to_inode_offset = open_intervals.pop(idx)
+        clones = idx_to_clones[idx]
+        for other_idx, (other_offset, other_to_inode_offset) \
+                in open_intervals.items():
+            # The cloned portion's extent offset is the larger of the 2
+            bigger_offset = max(other_offset, offset)
+            length = pos - bigger_offset
+            # Record that the open interval clones part of this inode.
+            clones.append((
+                bigger_offset, other_idx,
+                other_to_inode_offset + bigger_offset, length,
+            ))
+            # Record that this interval clones part of the open one's inode.
+            idx_to_clones[other_idx].append((
+                bigger_offset, idx, to_inode_offset + bigger_offset,
+                length,  # Same length
+            ))
+    return [(idx, clones) for idx, clones in idx_to_clones.items() if clones]
+
+
+def _gen_refs_and_chunk_clones(
+    refs_lists: Iterable[Sequence[_CloneExtentRef]],
+) -> Iterator[Tuple[_CloneExtentRef, _LeafClones]]:
+    '''
+    Sweeps the trimmed leaves of each leaf extent, yielding the clones of
+    every trimmed leaf that has any.
+    '''
+    for refs in refs_lists:
+        # Most leaves are not cloned, skip the sweep
+        if len(refs) < 2:
+            continue
+        ino_ids = [r.clone.inode_id for r in refs]
+        for idx, clones in _sweep([
+            (r.offset, r.clone.length, r.clone.offset) for r in refs
+        ]):
+            yield refs[idx], (ino_ids, clones)
 
 
 def _id_to_leaf_idx_to_chunk_clones(
@@ -328,78 +327,334 @@ def _id_to_leaf_idx_to_chunk_clones(
 ):
     'Aggregates newly created ChunkClones per InodeID, and per "trimmed leaf"'
     id_to_leaf_idx_to_chunk_clones = defaultdict(dict)
-    for extent_id, clone_ops in _leaf_extent_id_to_clone_ops(
-        ids_and_extents
-    ).items():
-        leaf_ref_to_chunk_clones = _leaf_ref_to_chunk_clones_from_clone_ops(
-            extent_id, clone_ops
-        )
-        for leaf_ref, offsets_clones in leaf_ref_to_chunk_clones.items():
-            d = id_to_leaf_idx_to_chunk_clones[leaf_ref.clone.inode_id]
-            # A `leaf_idx` from a specific inode ID refers to one extent,
-            # and each extent is handled in one iteration, so it cannot be
-            # that two iterations contribute to the same `leaf_idx` key.
-            assert leaf_ref.leaf_idx not in d
-            # `leaf_idx` is the position in `gen_trimmed_leaves` of the
-            # chunk, whose clones we computed.  That fully specifies where
-            #  `extents_to_chunks_with_clones` should put the clones.
-            d[leaf_ref.leaf_idx] = offsets_clones
+    for leaf_ref, offsets_clones in _gen_refs_and_chunk_clones(
+        _leaf_extent_id_to_refs(ids_and_extents).values(),
+    ):
+        d = id_to_leaf_idx_to_chunk_clones[leaf_ref.clone.inode_id]
+        # A `leaf_idx` from a specific inode ID refers to one extent,
+        # and each extent is handled in one iteration, so it cannot be
+        # that two iterations contribute to the same `leaf_idx` key.
+        assert leaf_ref.leaf_idx not in d
+        # `leaf_idx` is the position in `gen_trimmed_leaves` of the
+        # chunk, whose clones we computed.  That fully specifies where
+        #  `extents_to_chunks_with_clones` should put the clones.
+        d[leaf_ref.leaf_idx] = offsets_clones
 
     return id_to_leaf_idx_to_chunk_clones
 
 
-def extents_to_chunks_with_clones(
-    ids_and_extents: Sequence[Tuple[InodeID, Extent]],
-) -> Iterable[Tuple[InodeID, Sequence[Chunk]]]:
+def _id_to_leaf_idx_to_shared_extent_id(
+    ids_and_extents: Iterable[Tuple[InodeID, Extent]],
+) -> Mapping[InodeID, Mapping[int, int]]:
     '''
-    Converts the nested, history-preserving `Extent` structures into flat
-    sequences of `Chunk`s, while being careful to annotate cloned parts as
-    described in this file's docblock.  The `InodeID`s are needed to ensure
-    that the `Chunk`s' `Clone` objects refer to the appropriate files.
+    The linear-size counterpart of `_id_to_leaf_idx_to_chunk_clones`.
+
+    A trimmed leaf shares storage iff its range of the leaf extent overlaps
+    that of another trimmed leaf.  After sorting one extent's leaves by
+    start, leaf `i` overlaps an earlier leaf iff it starts before the
+    largest earlier end, and a later leaf iff the next leaf starts before
+    `i` ends.  So, unlike the pairwise sweep, this costs O(N log N).
+
+    Shared extent IDs are numbered in order of first appearance.
     '''
-    id_to_leaf_idx_to_chunk_clones = _id_to_leaf_idx_to_chunk_clones(
-        ids_and_extents
-    )
+    leaf_extent_id_to_refs = defaultdict(list)
     for ino_id, extent in ids_and_extents:
-        leaf_to_chunk_clones = id_to_leaf_idx_to_chunk_clones.get(ino_id, {})
-        new_chunks = []
-        for leaf_idx, (offset, length, extent) in enumerate(
+        for leaf_idx, (offset, length, leaf_extent) in enumerate(
             extent.gen_trimmed_leaves()
         ):
-            chunk_clones = leaf_to_chunk_clones.get(leaf_idx, [])
-            assert isinstance(extent.content, Extent.Kind)
-
-            # If the chunk kind matches, merge into the previous chunk.
-            if new_chunks and new_chunks[-1].kind == extent.content:
-                prev_length = new_chunks[-1].length
-                prev_clones = new_chunks[-1].chunk_clones
-            else:  # Otherwise, make a new one.
-                prev_length = 0
-                prev_clones = set()
-                new_chunks.append(None)
-
-            new_chunks[-1] = Chunk(
-                kind=extent.content,
-                length=length + prev_length,
-                chunk_clones=prev_clones,
+            leaf_extent_id_to_refs[id(leaf_extent)].append(
+                (offset, offset + length, ino_id, leaf_idx)
             )
+
+    id_to_leaf_idx_to_shared_extent_id = defaultdict(dict)
+    next_shared_extent_id = 0
+    for refs in leaf_extent_id_to_refs.values():
+        refs.sort(key=lambda ref: ref[0])
+        found_shared = False
+        max_end = None
+        for i, (start, end, ino_id, leaf_idx) in enumerate(refs):
+            if (max_end is not None and start < max_end) or (
+                i + 1 < len(refs) and refs[i + 1][0] < end
+            ):
+                found_shared = True
+                id_to_leaf_idx_to_shared_extent_id[ino_id][leaf_idx] = \
+                    next_shared_extent_id
+            max_end = end if max_end is None else max(max_end, end)
+        if found_shared:
+            next_shared_extent_id += 1
+    return id_to_leaf_idx_to_shared_extent_id
+
+
+def _trimmed_leaves_to_chunks(
+    trimmed_leaves: Iterable[Tuple[int, int, Extent]],
+    leaf_to_chunk_clones: Mapping[int, _LeafClones],
+    leaf_to_shared_extent_id: Mapping[int, int],
+) -> Sequence[Chunk]:
+    '''
+    Merges one inode's `gen_trimmed_leaves` into `Chunk`s, annotating them
+    with the clones or shared extents of each leaf, keyed by `leaf_idx`.
+    '''
+    new_chunks = []
+    for leaf_idx, (offset, length, extent) in enumerate(trimmed_leaves):
+        chunk_clones = leaf_to_chunk_clones.get(leaf_idx)
+        assert isinstance(extent.content, Extent.Kind)
+
+        # If the chunk kind matches, merge into the previous chunk.
+        if new_chunks and new_chunks[-1].kind == extent.content:
+            prev_length = new_chunks[-1].length
+            prev_clones = new_chunks[-1].chunk_clones
+            prev_shared_extents = new_chunks[-1].shared_extents
+        else:  # Otherwise, make a new one.
+            prev_length = 0
+            prev_clones = set()
+            prev_shared_extents = []
+            new_chunks.append(None)
+
+        shared_extent_id = leaf_to_shared_extent_id.get(leaf_idx)
+        if shared_extent_id is not None:
+            prev_shared_extents.append(ChunkSharedExtent(
+                offset=prev_length,
+                length=length,
+                extent_offset=offset,
+                extent_id=shared_extent_id,
+            ))
+
+        new_chunks[-1] = Chunk(
+            kind=extent.content,
+            length=length + prev_length,
+            chunk_clones=prev_clones,
+            shared_extents=prev_shared_extents,
+        )
+        if chunk_clones:
+            ino_ids, clones = chunk_clones
+            # `tuple.__new__` skips the slow keyword-argument `__new__`
+            # of `ChunkClone(offset, Clone(inode_id, offset, length))`.
             new_chunks[-1].chunk_clones.update(
                 # Future: when switching to frozentype, __new__ should
                 # validate that clone offset & length are sane relative
                 # to the trimmed extent.
-                ChunkClone(
-                    clone=clone,
+                tuple.__new__(ChunkClone, (
                     # Subtract `offset` because `ChunkClone.offset` is
                     # Extent-relative, but in the actual file layout, the
                     # leaf Extent is trimmed further.
-                    offset=clone_offset + prev_length - offset
-                ) for clone_offset, clone in chunk_clones
+                    extent_offset + prev_length - offset,
+                    tuple.__new__(Clone, (
+                        ino_ids[clone_idx], clone_offset, clone_length,
+                    )),
+                )) for extent_offset, clone_idx, clone_offset, clone_length
+                    in clones
             )
-        # Future: `deepfrozen` was made for this:
-        yield ino_id, tuple(
-            Chunk(
-                kind=c.kind,
-                length=c.length,
-                chunk_clones=frozenset(c.chunk_clones),
-            ) for c in new_chunks
+    # Future: `deepfrozen` was made for this:
+    return tuple(
+        Chunk(
+            kind=c.kind,
+            length=c.length,
+            chunk_clones=frozenset(c.chunk_clones),
+            shared_extents=tuple(c.shared_extents),
+        ) for c in new_chunks
+    )
+
+
+def extents_to_chunks_with_clones(
+    ids_and_extents: Sequence[Tuple[InodeID, Extent]],
+    *,
+    shared_extents: bool = False,
+) -> Iterable[Tuple[InodeID, Sequence[Chunk]]]:
+    '''
+    Converts the `Extent` trees of trimmed leaves (see "Representation" in
+    `extent.py`) into flat sequences of `Chunk`s, while being careful to
+    annotate cloned parts as described in this file's docblock.  The
+    `InodeID`s are needed to ensure that the `Chunk`s' `Clone` objects
+    refer to the appropriate files.
+
+    With `shared_extents`, the `Chunk`s get linear-size `shared_extents`
+    instead of quadratic-size `chunk_clones`, see the docblock.
+    '''
+    if shared_extents:
+        id_to_leaf_idx_to_chunk_clones = {}
+        id_to_leaf_idx_to_shared_extent_id = \
+            _id_to_leaf_idx_to_shared_extent_id(ids_and_extents)
+    else:
+        id_to_leaf_idx_to_chunk_clones = _id_to_leaf_idx_to_chunk_clones(
+            ids_and_extents,
+        )
+        id_to_leaf_idx_to_shared_extent_id = {}
+    for ino_id, extent in ids_and_extents:
+        yield ino_id, _trimmed_leaves_to_chunks(
+            extent.gen_trimmed_leaves(),
+            id_to_leaf_idx_to_chunk_clones.get(ino_id, {}),
+            id_to_leaf_idx_to_shared_extent_id.get(ino_id, {}),
         )
+
+
+def _freeze_chunks(
+    chunks: Sequence[Chunk], *, _memo,
+) -> Tuple[Sequence[Chunk], Sequence[Tuple[Any, Any]]]:
+    '''
+    Like `freeze(chunks)`, but much faster, since it knows that only the
+    `InodeID`s in our `Chunk`s are mutable -- so, `Chunk`s without clones
+    are kept as-is.  Also returns `(inner map, frozen inner map)` pairs
+    for the `InodeIDMap`s that the `Clone`s refer to.
+    '''
+    id_to_frozen_id = {}
+    id_to_inner_pair = {}
+    frozen_chunks = []
+    for chunk in chunks:
+        if chunk.chunk_clones:
+            frozen_clones = []
+            for cc in chunk.chunk_clones:
+                ino_id = cc.clone.inode_id
+                frozen_id = id_to_frozen_id.get(id(ino_id))
+                if frozen_id is None:
+                    frozen_id = id_to_frozen_id[id(ino_id)] = freeze(
+                        ino_id, _memo=_memo,
+                    )
+                    id_to_inner_pair[id(ino_id.inner_id_map)] = (
+                        ino_id.inner_id_map, frozen_id.inner_id_map,
+                    )
+                frozen_clones.append(tuple.__new__(ChunkClone, (
+                    cc.offset, tuple.__new__(Clone, (
+                        frozen_id, cc.clone.offset, cc.clone.length,
+                    )),
+                )))
+            chunk = chunk._replace(chunk_clones=frozenset(frozen_clones))
+        frozen_chunks.append(chunk)
+    return tuple(frozen_chunks), tuple(id_to_inner_pair.values())
+
+
+class CloneIndex:
+    '''
+    Keeps the output of `extents_to_chunks_with_clones` (without
+    `shared_extents`) up to date as the input inodes change, so that a
+    `SubvolumeSet` can be frozen repeatedly while its send-streams are
+    being applied.
+
+    `Extent`s are immutable, so every `write`, `clone`, `truncate`, etc
+    gives its inode a new `Extent` object.  `update` thus finds the
+    changed inodes by `Extent` identity, and only re-runs the interval
+    sweep for the leaf extents that gained or lost a trimmed leaf.  The
+    costly part of the work is proportional to the number of changed
+    inodes, plus the inodes that share a leaf extent with them -- their
+    `ChunkClone`s may have changed, too.
+
+    Likewise, `freeze_chunks` re-freezes only the `Chunk`s that changed.
+
+    IMPORTANT: Like `SubvolumeSet`, keep this `deepcopy`able.  The index
+    must be copied in one operation with the `InodeID`s that it refers to.
+    '''
+
+    def __init__(self):
+        # The `Extent` of each inode, as of the last `update`.
+        self._id_to_extent: Dict[InodeID, Extent] = {}
+        # One ref per item of the inode's `gen_trimmed_leaves()`
+        self._id_to_refs: Dict[InodeID, Sequence[_CloneExtentRef]] = {}
+        # Keyed by the `id()` of the leaf extent.  The `_CloneExtentRef`s
+        # keep their leaf extents alive, so these IDs cannot be reused.
+        self._leaf_extent_id_to_refs: Dict[int, Set[_CloneExtentRef]] = {}
+        self._id_to_leaf_idx_to_chunk_clones: Dict[
+            InodeID, Dict[int, _LeafClones]
+        ] = {}
+        self._id_to_chunks: Dict[InodeID, Sequence[Chunk]] = {}
+        # From `freeze_chunks`: for each `InodeID`, its `Chunk`s, their
+        # frozen copy, and `(inner map, frozen inner map)` pairs for the
+        # `InodeIDMap`s that their `Clone`s refer to.
+        self._frozen_chunks = FreezeCache()
+
+    def _remove(self, ino_id: InodeID, dirty_leaf_extent_ids: Set[int]):
+        del self._id_to_extent[ino_id]
+        for ref in self._id_to_refs.pop(ino_id):
+            extent_id = id(ref.extent)
+            refs = self._leaf_extent_id_to_refs[extent_id]
+            refs.remove(ref)
+            if not refs:
+                del self._leaf_extent_id_to_refs[extent_id]
+            dirty_leaf_extent_ids.add(extent_id)
+        del self._id_to_leaf_idx_to_chunk_clones[ino_id]
+        del self._id_to_chunks[ino_id]
+
+    def _add(
+        self, ino_id: InodeID, extent: Extent,
+        dirty_leaf_extent_ids: Set[int],
+    ):
+        self._id_to_extent[ino_id] = extent
+        refs = self._id_to_refs[ino_id] = tuple(
+            _gen_clone_extent_refs(ino_id, extent)
+        )
+        for ref in refs:
+            extent_id = id(ref.extent)
+            self._leaf_extent_id_to_refs.setdefault(extent_id, set()).add(ref)
+            dirty_leaf_extent_ids.add(extent_id)
+        self._id_to_leaf_idx_to_chunk_clones[ino_id] = {}
+
+    def update(
+        self, ids_and_extents: Iterable[Tuple[InodeID, Extent]],
+    ) -> Mapping[InodeID, Sequence[Chunk]]:
+        '''
+        `ids_and_extents` must be the complete current input -- inodes
+        that are not in it are dropped from the index.  Returns the same
+        `Chunk`s as `extents_to_chunks_with_clones(ids_and_extents)`.
+        '''
+        dirty_leaf_extent_ids = set()
+        stale_ids = set()  # Whose `Chunk`s must be recomputed
+        seen_ids = set()
+        for ino_id, extent in ids_and_extents:
+            seen_ids.add(ino_id)
+            prev_extent = self._id_to_extent.get(ino_id)
+            if prev_extent is extent:
+                continue
+            if prev_extent is not None:
+                self._remove(ino_id, dirty_leaf_extent_ids)
+            self._add(ino_id, extent, dirty_leaf_extent_ids)
+            stale_ids.add(ino_id)
+        for ino_id in [i for i in self._id_to_extent if i not in seen_ids]:
+            self._remove(ino_id, dirty_leaf_extent_ids)
+
+        dirty_refs_lists = []
+        for extent_id in dirty_leaf_extent_ids:
+            refs = list(self._leaf_extent_id_to_refs.get(extent_id, ()))
+            for ref in refs:
+                stale_ids.add(ref.clone.inode_id)
+                self._id_to_leaf_idx_to_chunk_clones[
+                    ref.clone.inode_id
+                ].pop(ref.leaf_idx, None)
+            dirty_refs_lists.append(refs)
+        for ref, offsets_clones in _gen_refs_and_chunk_clones(
+            dirty_refs_lists,
+        ):
+            self._id_to_leaf_idx_to_chunk_clones[ref.clone.inode_id][
+                ref.leaf_idx
+            ] = offsets_clones
+
+        for ino_id in stale_ids:
+            refs = self._id_to_refs.get(ino_id)
+            if refs is None:  # Removed above
+                continue
+            self._id_to_chunks[ino_id] = _trimmed_leaves_to_chunks(
+                ((r.offset, r.clone.length, r.extent) for r in refs),
+                self._id_to_leaf_idx_to_chunk_clones[ino_id],
+                {},
+            )
+        return MappingProxyType(self._id_to_chunks)
+
+    def freeze_chunks(self, *, _memo) -> None:
+        '''
+        Records in `_memo` the frozen `Chunk`s of each inode as of the last
+        `update`, so that `freeze`ing the inodes with this `_memo` uses them.
+        The frozen `Chunk`s of the previous call are reused if the inode's
+        `Chunk`s did not change, and if the `InodeIDMap`s that its `Clone`s
+        refer to froze to the same objects, see `InodeIDMap.freeze`.
+        '''
+        prev_id_to_frozen = self._frozen_chunks.value or {}
+        id_to_frozen = {}
+        for ino_id, chunks in self._id_to_chunks.items():
+            entry = prev_id_to_frozen.get(ino_id)
+            if entry is not None and entry[0] is chunks and all(
+                freeze(inner, _memo=_memo) is frozen_inner
+                    for inner, frozen_inner in entry[2]
+            ):
+                _memo[id(chunks)] = entry[1]
+            else:
+                entry = (chunks, *_freeze_chunks(chunks, _memo=_memo))
+                _memo[id(chunks)] = entry[1]
+            id_to_frozen[ino_id] = entry
+        self._frozen_chunks.value = id_to_frozen
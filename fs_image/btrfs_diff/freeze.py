@@ -13,12 +13,31 @@ provisions for `freeze`ing self-referential structures, because it is
 impossible to construct a recursively immutable structure that references
 itself.
 
+`FreezeCache` lets an object reuse its previous `freeze` result, so that
+freezing a big structure again costs little more than its changes.
+
 Future: Once `deepfrozen` is landed, this sort of thing should get nicer.
 '''
 from enum import Enum
 from types import MappingProxyType
 
 
+class FreezeCache:
+    '''
+    Holds a `freeze` result for reuse by later `freeze`s -- it is up to the
+    owner to tell when the result is stale.  A `deepcopy` of the cache is
+    empty, since frozen objects are not `deepcopy`able, and since a copy is
+    usually made in order to diverge from the original.
+    '''
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = None
+
+    def __deepcopy__(self, memo):
+        return type(self)()
+
+
 def freeze(obj, *, _memo=None, **kwargs):
     # Don't bother memoizing primitive types
     if isinstance(obj, (bytes, Enum, float, int, str, type(None))):
@@ -27,7 +46,9 @@ def freeze(obj, *, _memo=None, **kwargs):
     if _memo is None:
         _memo = {}
 
-    if id(obj) in _memo:  # Already frozen?
+    # With `kwargs`, the result depends on them, so we cannot reuse it.
+    # E.g. `Subvolume` snapshots share inodes, whose `Chunk`s differ.
+    if not kwargs and id(obj) in _memo:  # Already frozen?
         return _memo[id(obj)]
 
     if hasattr(obj, 'freeze'):
@@ -56,5 +77,6 @@ def freeze(obj, *, _memo=None, **kwargs):
         else:
             raise NotImplementedError(type(obj))
 
-    _memo[id(obj)] = frozen
+    if not kwargs:
+        _memo[id(obj)] = frozen
     return frozen
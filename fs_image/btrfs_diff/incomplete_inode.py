@@ -21,20 +21,78 @@ the time of writing because:
    This extra risk doesn't seem worth the debuggability reward of having
    IncompleteInodes know their identity.
 
+A big filesystem has millions of inodes, so we avoid having an object
+per inode.  `IncompleteInodeMap` stores each inode as a row of a
+`CowIntTable`, which packs the `int` fields into arrays, and an
+`IncompleteInode` is just a view of its row -- reading and writing the
+attributes reads and writes the row.  The map makes a new view on each
+lookup, so compare inodes by ID, not via `is`.  An inode that was made by
+its constructor is the only row of a table of its own, and storing it
+in a map copies that row.  The remaining per-inode objects are the
+`Extent` of a file, and the xattrs `dict`, which copies of the row
+share, so `apply_item` replaces it instead of mutating it.  `owner` and
+`utimes` are made on access, sharing the common `owner`s.
+
+`freeze` keeps its result in `_frozen`, and reuses it while the inode
+matches it, so that freezing a mostly-unchanged filesystem again mostly
+returns the same `Inode` objects.  `_frozen` is not copied.
+
 Future: with `deepfrozen` done, it would be simplest to merge
 `IncompleteInode` with `Inode`, and just have `apply_item` return a
 partly-modified copy, in the style of `NamedTuple._replace`.
 '''
+import functools
 import itertools
 import stat
 
-from typing import Dict, Optional, Sequence
+from types import MappingProxyType
+from typing import (
+    Dict, Iterator, Mapping, MutableMapping, Optional, Sequence,
+)
 
+from .cow_map import CowIntTable
 from .extent import Extent
 from .freeze import freeze
 from .inode import Chunk, Inode, InodeOwner, InodeUtimes
 from .parse_dump import SendStreamItem, SendStreamItems
 
+# `fallocate(2)` mode flags from `linux/falloc.h`, for version 2 streams.
+_FALLOC_FL_KEEP_SIZE = 0x01
+_FALLOC_FL_PUNCH_HOLE = 0x02
+_FALLOC_FL_ZERO_RANGE = 0x10
+
+_NO_XATTRS = MappingProxyType({})
+
+# The fields of the `CowIntTable` row of an inode.  `_DATA` is the
+# `extent`, `dest`, or `dev` of the inode types that have one.
+(
+    _FILE_TYPE, _MODE, _UID, _GID, _CTIME, _CTIME_NS, _MTIME, _MTIME_NS,
+    _ATIME, _ATIME_NS, _DATA, _XATTRS, _FROZEN,
+) = range(13)
+_ROW_FIELDS = 'iiiiqiqiqiOOC'
+
+
+# Few distinct owners occur in practice, so don't store a copy per inode.
+@functools.lru_cache(maxsize=1024)
+def _inode_owner(uid: int, gid: int) -> InodeOwner:
+    return InodeOwner(uid=uid, gid=gid)
+
+
+class _Field:
+    'An attribute of `IncompleteInode` that is a field of its row.'
+    __slots__ = ('_field',)
+
+    def __init__(self, field: int):
+        self._field = field
+
+    def __get__(self, ino, owner=None):
+        if ino is None:
+            return self
+        return ino._table.get(ino._id, self._field)
+
+    def __set__(self, ino, value):
+        ino._table.set(ino._id, self._field, value)
+
 
 class IncompleteInode:
     '''
@@ -42,31 +100,112 @@ class IncompleteInode:
     different inode types have different data, different construction logic,
     and freezing logic.
     '''
-    file_type: int  # Upper bits of `st_mode` matching `S_IFMT`
-    mode: Optional[int]  # Bottom 12 bits of `st_mode`
-    owner: Optional[InodeOwner]
-    utimes: Optional[InodeUtimes]
-    xattrs: Dict[bytes, bytes]
-    # If any of these are None, the filesystem was created badly.
-    # Exception: symlinks don't have permissions.
+    # Upper bits of `st_mode` matching `S_IFMT`
+    file_type: int = _Field(_FILE_TYPE)
+    mode: Optional[int] = _Field(_MODE)  # Bottom 12 bits of `st_mode`
+    # If `mode`, `owner`, or `utimes` are None, the filesystem was created
+    # badly.  Exception: symlinks don't have permissions.
+    # `None` until the first xattr.  Shared by copies, see the docblock.
+    _xattrs: Optional[Dict[bytes, bytes]] = _Field(_XATTRS)
+
+    __slots__ = ('_table', '_id')  # Our row, see the docblock
 
     def __init__(self, *, item: SendStreamItem):
         assert isinstance(item, self.INITIAL_ITEM)
-        self.file_type = self.FILE_TYPE
-        self.mode = None
-        self.owner = None
-        self.utimes = None
-        self.xattrs = {}
+        self._table = CowIntTable(_ROW_FIELDS)
+        self._id = 0
+        self._table.set_row(
+            self._id, (self.FILE_TYPE,) + (None,) * (len(_ROW_FIELDS) - 1),
+        )
+
+    def __deepcopy__(self, memo):
+        'A copy in a table of its own, see the docblock.'
+        new = self.__class__.__new__(self.__class__)
+        memo[id(self)] = new
+        new._table = CowIntTable(_ROW_FIELDS)
+        new._id = 0
+        row = self._table.get_row(self._id)
+        row[_FROZEN] = None
+        new._table.set_row(new._id, row)
+        return new
+
+    @property
+    def owner(self) -> Optional[InodeOwner]:
+        uid = self._table.get(self._id, _UID)
+        if uid is None:
+            return None
+        return _inode_owner(uid, self._table.get(self._id, _GID))
+
+    @owner.setter
+    def owner(self, owner: Optional[InodeOwner]) -> None:
+        self._table.set(self._id, _UID, None if owner is None else owner.uid)
+        self._table.set(self._id, _GID, None if owner is None else owner.gid)
+
+    @property
+    def utimes(self) -> Optional[InodeUtimes]:
+        row = self._table.get_row(self._id)
+        if row[_CTIME] is None:
+            return None
+        return InodeUtimes(
+            ctime=(row[_CTIME], row[_CTIME_NS]),
+            mtime=(row[_MTIME], row[_MTIME_NS]),
+            atime=(row[_ATIME], row[_ATIME_NS]),
+        )
+
+    @utimes.setter
+    def utimes(self, utimes: Optional[InodeUtimes]) -> None:
+        row = self._table.get_row(self._id)
+        row[_CTIME:_ATIME_NS + 1] = (None,) * 6 if utimes is None \
+            else (*utimes.ctime, *utimes.mtime, *utimes.atime)
+        self._table.set_row(self._id, row)
+
+    @property
+    def _frozen(self) -> Optional[Inode]:
+        'The last `freeze` result, may be stale.'
+        return self._table.get(self._id, _FROZEN)
+
+    @_frozen.setter
+    def _frozen(self, ino: Inode) -> None:
+        self._table.set_cache(self._id, _FROZEN, ino)
+
+    @property
+    def xattrs(self) -> Mapping[bytes, bytes]:
+        'Read-only when empty, use `apply_item` to add xattrs.'
+        return _NO_XATTRS if self._xattrs is None else self._xattrs
 
     def freeze(self, *, _memo, chunks: Sequence[Chunk]) -> Inode:
-        'Returns a recursively immutable `Inode` based on `self`.'
+        '''
+        Returns a recursively immutable `Inode` based on `self`.  If `self`
+        did not change since the last `freeze`, and `chunks` froze to the
+        same object, this is the same `Inode` as last time.
+        '''
+        ino = self._frozen
+        if ino is not None and self._matches_frozen(ino):
+            frozen_chunks = freeze(chunks, _memo=_memo)
+            if ino.chunks is not frozen_chunks:
+                # E.g. snapshots share this inode, but with other `Clone`s
+                ino = self._frozen = ino._replace(chunks=frozen_chunks)
+            return ino
         # NB: If any freezing bugs turn up in this implementation, consider
         # wrapping a single `freeze` around the `freeze_kwargs` call to
         # ensure that everything gets processed.
         ino = Inode(**self._freeze_kwargs(_memo=_memo, chunks=chunks))
         assert (ino.chunks is not None) ^ (chunks is None)
+        self._frozen = ino
         return ino
 
+    def _matches_frozen(self, ino: Inode) -> bool:
+        '''
+        Is `ino` still what `freeze` would make of `self`, up to `chunks`?
+        Comparing is much cheaper than freezing, and unlike hooking our
+        mutations, it also notices direct edits, as in `inode_utils.py`.
+        '''
+        return (
+            ino.file_type == self.file_type and ino.mode == self.mode and
+            ino.owner == self.owner and ino.utimes == self.utimes and
+            ino.xattrs == self.xattrs
+        )
+
     def _freeze_kwargs(self, *, _memo, chunks: Sequence[Chunk]):
         return {
             'file_type': self.file_type,
@@ -74,15 +213,20 @@ class IncompleteInode:
             # No need to freeze owner/utimes, they're recursively immutable.
             'owner': self.owner,
             'utimes': self.utimes,
-            'xattrs': freeze(self.xattrs, _memo=_memo),
+            'xattrs': _NO_XATTRS if self._xattrs is None
+                else freeze(self._xattrs, _memo=_memo),
         }
 
     def apply_item(self, item: SendStreamItem) -> None:
         assert not isinstance(item, SendStreamItems.clone), 'Do .apply_clone()'
+        # Copies share `_xattrs`, so replace it instead of mutating it.
         if isinstance(item, SendStreamItems.remove_xattr):
-            del self.xattrs[item.name]
+            xattrs = dict(self.xattrs)
+            # A missing xattr is a `KeyError`, even if there are none.
+            del xattrs[item.name]
+            self._xattrs = xattrs or None
         elif isinstance(item, SendStreamItems.set_xattr):
-            self.xattrs[item.name] = item.data
+            self._xattrs = {**self.xattrs, item.name: item.data}
         elif isinstance(item, SendStreamItems.chmod):
             if stat.S_IFMT(item.mode) != 0:
                 raise RuntimeError(
@@ -90,13 +234,15 @@ class IncompleteInode:
                 )
             self.mode = item.mode
         elif isinstance(item, SendStreamItems.chown):
-            self.owner = InodeOwner(uid=item.uid, gid=item.gid)
+            self.owner = _inode_owner(item.uid, item.gid)
         elif isinstance(item, SendStreamItems.utimes):
             self.utimes = InodeUtimes(
                 ctime=item.ctime,
                 mtime=item.mtime,
                 atime=item.atime,
             )
+        elif isinstance(item, SendStreamItems.fileattr):
+            pass  # Like `btrfs receive`, we do not yet support these flags.
         else:
             raise RuntimeError(f'{self} cannot apply {item}')
 
@@ -110,12 +256,16 @@ class IncompleteInode:
 
 
 class IncompleteDir(IncompleteInode):
+    __slots__ = ()
+
     FILE_TYPE = stat.S_IFDIR
     INITIAL_ITEM = SendStreamItems.mkdir
 
 
 class IncompleteFile(IncompleteInode):
-    extent: Extent
+    extent: Extent = _Field(_DATA)
+
+    __slots__ = ()
 
     FILE_TYPE = stat.S_IFREG
     INITIAL_ITEM = SendStreamItems.mkfile
@@ -144,9 +294,37 @@ class IncompleteFile(IncompleteInode):
             self.extent = self.extent.write(
                 offset=item.offset, length=item.len,
             )
+        elif isinstance(item, SendStreamItems.encoded_write):
+            # Only the logical length matters, so never decode `data`.
+            self.extent = self.extent.write(
+                offset=item.offset, length=item.unencoded_file_len,
+            )
+        elif isinstance(item, SendStreamItems.fallocate):
+            self._apply_fallocate(item)
         else:
             super().apply_item(item=item)
 
+    def _apply_fallocate(self, item: SendStreamItems.fallocate) -> None:
+        if item.mode & ~(
+            _FALLOC_FL_KEEP_SIZE | _FALLOC_FL_PUNCH_HOLE | _FALLOC_FL_ZERO_RANGE
+        ) or (
+            item.mode & _FALLOC_FL_PUNCH_HOLE and
+            not item.mode & _FALLOC_FL_KEEP_SIZE
+        ):
+            raise RuntimeError(f'{self} cannot apply {item}: bad mode')
+        end = item.offset + item.len
+        if item.mode & _FALLOC_FL_KEEP_SIZE:
+            end = min(end, self.extent.length)
+        if item.mode & (_FALLOC_FL_PUNCH_HOLE | _FALLOC_FL_ZERO_RANGE):
+            # Either way, the range now reads as zeros -- i.e. a hole.
+            if end > item.offset:
+                self.extent = self.extent.punch_hole(
+                    offset=item.offset, length=end - item.offset,
+                )
+        elif end > self.extent.length:
+            # Preallocation only matters if it extends the file.
+            self.extent = self.extent.truncate(length=end)
+
     def apply_clone(
         self, item: SendStreamItems.clone, from_ino: IncompleteInode,
     ) -> None:
@@ -183,28 +361,36 @@ class IncompleteFile(IncompleteInode):
 
 
 class IncompleteSocket(IncompleteInode):
+    __slots__ = ()
+
     FILE_TYPE = stat.S_IFSOCK
     INITIAL_ITEM = SendStreamItems.mksock
 
 
 class IncompleteFifo(IncompleteInode):
+    __slots__ = ()
+
     FILE_TYPE = stat.S_IFIFO
     INITIAL_ITEM = SendStreamItems.mkfifo
 
 
 class IncompleteDevice(IncompleteInode):
-    dev: int
+    dev: int = _Field(_DATA)
+
+    __slots__ = ()
 
+    FILE_TYPE = None  # Set per instance, from the `mknod` mode
     INITIAL_ITEM = SendStreamItems.mknod
 
     def __init__(self, *, item: SendStreamItem):
-        self.FILE_TYPE = stat.S_IFMT(item.mode)
-        if self.FILE_TYPE not in (stat.S_IFBLK, stat.S_IFCHR):
+        file_type = stat.S_IFMT(item.mode)
+        if file_type not in (stat.S_IFBLK, stat.S_IFCHR):
             raise RuntimeError(f'unexpected device mode in {item}')
         super().__init__(item=item)
+        self.file_type = file_type
         # NB: At present, `btrfs send` redundantly sends a `chmod` after
         # device creation, but we've already saved the file type.
-        self.mode = item.mode & ~self.FILE_TYPE
+        self.mode = item.mode & ~file_type
         self.dev = item.dev
 
     def _freeze_kwargs(self, *, _memo, chunks: Sequence[Chunk]):
@@ -213,9 +399,14 @@ class IncompleteDevice(IncompleteInode):
             **super()._freeze_kwargs(_memo=_memo, chunks=chunks),
         }
 
+    def _matches_frozen(self, ino: Inode) -> bool:
+        return ino.dev == self.dev and super()._matches_frozen(ino)
+
 
 class IncompleteSymlink(IncompleteInode):
-    dest: bytes
+    dest: bytes = _Field(_DATA)
+
+    __slots__ = ()
 
     FILE_TYPE = stat.S_IFLNK
     INITIAL_ITEM = SendStreamItems.symlink
@@ -230,8 +421,82 @@ class IncompleteSymlink(IncompleteInode):
             **super()._freeze_kwargs(_memo=_memo, chunks=chunks),
         }
 
+    def _matches_frozen(self, ino: Inode) -> bool:
+        return ino.dest == self.dest and super()._matches_frozen(ino)
+
     def apply_item(self, item: SendStreamItem) -> None:
         if isinstance(item, SendStreamItems.chmod):
             raise RuntimeError(f'{item} cannot chmod symlink {self}')
         else:
             super().apply_item(item=item)
+
+
+class IncompletePlaceholder(IncompleteInode):
+    '''
+    Stands in for an inode of the unknown parent of an incremental
+    send-stream, until an item reveals its type, see `Subvolume`.  Its
+    metadata is `None` until the stream sets it.
+    '''
+    __slots__ = ()
+
+    FILE_TYPE = 0  # Rendered as `Unknown`, see `inode.py`
+    # Any item may be the first to refer to an inode of the parent.
+    INITIAL_ITEM = object
+
+
+_FILE_TYPE_TO_CLASS = {
+    cls.FILE_TYPE: cls for cls in [
+        IncompleteDir, IncompleteFile, IncompleteSocket, IncompleteFifo,
+        IncompleteSymlink, IncompletePlaceholder,
+    ]
+}
+_FILE_TYPE_TO_CLASS[stat.S_IFBLK] = IncompleteDevice
+_FILE_TYPE_TO_CLASS[stat.S_IFCHR] = IncompleteDevice
+
+
+class IncompleteInodeMap(MutableMapping):
+    '''
+    Maps `int` IDs to `IncompleteInode`s, storing them as the rows of a
+    `CowIntTable`, see the docblock.  `copy()` is O(1), and the copies'
+    inodes are independent.
+    '''
+    __slots__ = ('_table',)
+
+    def __init__(self):
+        self._table = CowIntTable(_ROW_FIELDS)
+
+    def copy(self) -> 'IncompleteInodeMap':
+        new = IncompleteInodeMap.__new__(IncompleteInodeMap)
+        new._table = self._table.copy()
+        return new
+
+    def __getitem__(self, id: int) -> IncompleteInode:
+        'A new view of the row of inode `id`.'
+        cls = _FILE_TYPE_TO_CLASS[self._table.get(id, _FILE_TYPE)]
+        ino = cls.__new__(cls)
+        ino._table = self._table
+        ino._id = id
+        return ino
+
+    def get(self, id: int, default=None):
+        'Faster than `Mapping.get`, which handles a `KeyError` on misses.'
+        return self[id] if id in self._table else default
+
+    def __setitem__(self, id: int, ino: IncompleteInode) -> None:
+        'Copies the row of `ino`, so later changes to `ino` do not show.'
+        self._table.set_row(id, ino._table.get_row(ino._id))
+
+    def __delitem__(self, id: int) -> None:
+        del self._table[id]
+
+    def __contains__(self, id) -> bool:
+        return id in self._table
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._table)
+
+    def __len__(self) -> int:
+        return len(self._table)
+
+    def __repr__(self):
+        return f'IncompleteInodeMap({dict(self.items())})'
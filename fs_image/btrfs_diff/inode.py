@@ -12,7 +12,9 @@ Avoid whitespace when possible, since IncompleteInode uses space separators.
 import stat
 
 from datetime import datetime
-from typing import NamedTuple, Mapping, Optional, Set, Sequence, Tuple
+from typing import (
+    Any, Callable, NamedTuple, Mapping, Optional, Set, Sequence, Tuple,
+)
 
 from .extent import Extent
 from .inode_id import InodeID
@@ -81,6 +83,9 @@ class InodeUtimes(NamedTuple):
 
 
 S_IFMT_TO_FILE_TYPE_NAME = {
+    # Not an `S_IFMT` type: an `IncompletePlaceholder` whose type the
+    # send-stream never revealed.
+    0: 'Unknown',
     stat.S_IFBLK: 'Block',
     stat.S_IFCHR: 'Char',
     stat.S_IFDIR: 'Dir',
@@ -131,6 +136,8 @@ class Inode(NamedTuple):
     def assert_valid_and_complete(self):
         if None in (self.file_type, self.owner, self.utimes):
             raise RuntimeError(f'{self} must have file_type, owner & utimes')
+        if not self.file_type:
+            raise RuntimeError(f'{self} must have a known file_type')
         if stat.S_ISLNK(self.file_type) ^ (self.mode is None):
             raise RuntimeError(f'only symlinks must omit mode, got {self}')
         if self.file_type & ~stat.S_IFMT(self.file_type):
@@ -145,7 +152,7 @@ class Inode(NamedTuple):
         if (self.dest is not None) ^ stat.S_ISLNK(self.file_type):
             raise RuntimeError(f'{self} must have .dest iff it is a symlink')
 
-    def _repr_fields(self):
+    def _repr_fields(self, extent_id_fn: Callable[[int], Any]):
         yield S_IFMT_TO_FILE_TYPE_NAME.get(self.file_type, str(self.file_type))
         if self.mode is not None:
             yield f'm{self.mode:o}'
@@ -168,6 +175,12 @@ class Inode(NamedTuple):
                         repr(cc) for cc in c.chunk_clones
                     )) + ')')
                         if c.chunk_clones else ''
+                ) + (
+                    ('[' + '/'.join(
+                        se.repr_with_extent_id(extent_id_fn(se.extent_id))
+                            for se in c.shared_extents
+                    ) + ']')
+                        if c.shared_extents else ''
                 ) for c in self.chunks
             )
         if self.dev is not None:
@@ -175,8 +188,16 @@ class Inode(NamedTuple):
         if self.dest is not None:
             yield f'{_repr_decode(self.dest)}'
 
+    def repr_with_extent_ids(self, extent_id_fn: Callable[[int], Any]) -> str:
+        '''
+        Like `repr`, but `extent_id_fn` maps the `extent_id` of each
+        `ChunkSharedExtent` to what we display.  `Subvolume.render` uses
+        this to number shared extents in traversal order, like hardlinks.
+        '''
+        return '(' + ' '.join(self._repr_fields(extent_id_fn)) + ')'
+
     def __repr__(self):
-        return '(' + ' '.join(self._repr_fields()) + ')'
+        return self.repr_with_extent_ids(lambda extent_id: extent_id)
 
 
 class Clone(NamedTuple):
@@ -203,13 +224,39 @@ class ChunkClone(NamedTuple):
         return f'{repr(self.clone)}@{self.offset}'
 
 
+class ChunkSharedExtent(NamedTuple):
+    '''
+    The linear-size alternative to `ChunkClone`s, see `extents_to_chunks.py`.
+    Rather than listing every other place that shares this storage, we just
+    name the shared extent.  Each place sharing it will name it, too.
+    '''
+    offset: int  # Offset into the `Chunk`
+    length: int
+    extent_offset: int  # Offset into the shared extent
+    # Identifies the shared extent within one `extents_to_chunks_with_clones`
+    # call.  Renderings renumber it, see `Inode.repr_with_extent_ids`.
+    extent_id: int
+
+    def repr_with_extent_id(self, extent_id: Any) -> str:
+        return f'e{extent_id}:{self.extent_offset}+{self.length}@{self.offset}'
+
+    def __repr__(self):
+        return self.repr_with_extent_id(self.extent_id)
+
+
 class Chunk(NamedTuple):
     kind: Extent.Kind
     length: int
     chunk_clones: Set[ChunkClone]
+    # Only populated by `extents_to_chunks_with_clones(shared_extents=True)`,
+    # which then leaves `chunk_clones` empty.
+    shared_extents: Sequence[ChunkSharedExtent] = ()
 
     def __repr__(self):
         return f'({self.kind.name}/{self.length}' + (
             (': ' + ', '.join(repr(c) for c in self.chunk_clones))
                 if self.chunk_clones else ''
+        ) + (
+            ('; ' + ', '.join(repr(se) for se in self.shared_extents))
+                if self.shared_extents else ''
         ) + ')'
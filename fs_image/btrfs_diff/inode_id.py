@@ -6,21 +6,19 @@ reason, InodeIDs are tightly integrated with a path mapping, which is used
 to represent the Inode instead of the underlying integer ID, whenever
 possible.
 '''
+import copy
 import itertools
 import os
 
-from collections import defaultdict, deque
+from types import MappingProxyType
 
 from typing import (
-    Any, Iterator, Mapping, NamedTuple, Optional, Sequence, Set, Tuple,
+    Any, Iterator, Mapping, MutableMapping, NamedTuple, Optional, Sequence,
+    Set, Tuple,
 )
 
-from .freeze import freeze
-
-
-def tail(n: int, iterable):
-    "Return an iterator over the last n items"
-    return iter(deque(iterable, maxlen=n))  # tail(3, 'ABCDEFG') --> E F G
+from .cow_map import CowIntMap, CowIntTable, CowMap
+from .freeze import freeze, FreezeCache
 
 
 class InodeID(NamedTuple):
@@ -101,15 +99,94 @@ class _ReversePathEntry(NamedTuple):
 
 
 _ROOT_REVERSE_ENTRY = _ReversePathEntry(name=None, parent_int_id=None)
+_ROOT_INT_ID = 0
+
+# The fields of a `_ReverseEntryMap` row.
+_PARENT_INT_ID, _NAME = range(2)
+
+
+class _ReverseEntryMap(MutableMapping):
+    '''
+    `int` ID -> tuple of `_ReversePathEntry`s.  Most inodes have a single
+    entry, whose fields are stored in a `CowIntTable` row, so that they
+    cost no objects besides the name, which the parent's entries share.
+    Several entries are kept as a tuple in the name field.  The tuples of
+    entries are made on access.
+    '''
+    __slots__ = ('_table',)
+
+    def __init__(self):
+        self._table = CowIntTable('qO')
+
+    def copy(self) -> '_ReverseEntryMap':
+        'O(1), see `CowIntTable.copy`.'
+        new = _ReverseEntryMap.__new__(_ReverseEntryMap)
+        new._table = self._table.copy()
+        return new
+
+    def __getitem__(self, int_id: int) -> Tuple[_ReversePathEntry, ...]:
+        parent_int_id, name = self._table.get_row(int_id)
+        if name.__class__ is tuple:
+            return name
+        return (_ReversePathEntry(name=name, parent_int_id=parent_int_id),)
+
+    def get(self, int_id: int, default=None):
+        'Faster than `Mapping.get`, which handles a `KeyError` on misses.'
+        return self[int_id] if int_id in self._table else default
+
+    def __setitem__(
+        self, int_id: int, entries: Tuple[_ReversePathEntry, ...],
+    ) -> None:
+        if len(entries) == 1:
+            entry, = entries
+            self._table.set_row(int_id, (entry.parent_int_id, entry.name))
+        else:
+            self._table.set_row(int_id, (None, tuple(entries)))
+
+    def __delitem__(self, int_id: int) -> None:
+        del self._table[int_id]
+
+    def __contains__(self, int_id) -> bool:
+        return int_id in self._table
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._table)
+
+    def __len__(self) -> int:
+        return len(self._table)
+
+    def __repr__(self):
+        return f'_ReverseEntryMap({dict(self.items())})'
+
+    def freeze(self, *, _memo):
+        '''
+        Like `freeze` on a `dict`.  The entries are already immutable, and
+        must not go through `freeze`, which would memoize them by `id()`,
+        although we make new ones on each access.
+        '''
+        return MappingProxyType(dict(self.items()))
 
 
 class _InnerInodeIDMap(NamedTuple):
     'Explained where `InodeIDMap.inner` is declared.'
     description: Any  # repr()able, to be used for repr()ing InodeIDs
-    # The key is not an `InodeID` to avoid a circular dependency.  The
-    # values correspond to different hardlinks to the same file inode.
-    # Directories will always have a single element in the set.
-    id_to_reverse_entries: Mapping[int, Set[_ReversePathEntry]]
+    # The key is not an `InodeID` to avoid a circular dependency, and so
+    # that a compact `_ReverseEntryMap` can store this.  The values
+    # correspond to different hardlinks to the same file inode.
+    # Directories will always have a single element.
+    id_to_reverse_entries: Mapping[int, Tuple[_ReversePathEntry, ...]]
+    # Cache the paths of directories in both directions, so that making
+    # or looking up the paths of N files in one directory costs O(N), not
+    # O(N * depth).  The map clears them whenever a directory is renamed
+    # or removed, since that can change the paths of all its descendants.
+    # Frozen maps compute them in full, since they cannot be mutated.
+    dir_paths: Mapping[int, bytes]
+    path_to_dir_id: Mapping[bytes, int]
+    # The last `InodeIDMap.freeze` result, which every mutation clears.
+    # Reusing it keeps the frozen `InodeID`s that refer to it valid, so
+    # `SubvolumeSet.freeze` can reuse the frozen `Chunk`s with `Clone`s of
+    # this map, too.  `None` in frozen maps.
+    freeze_cache: Optional[FreezeCache]
 
     def _assert_mine(self, inode_id: InodeID) -> InodeID:
         if inode_id.inner_id_map is not self:
@@ -117,12 +194,35 @@ class _InnerInodeIDMap(NamedTuple):
             raise RuntimeError(f'Wrong map for InodeID #{inode_id.id}')
         return inode_id
 
-    def _rev_entry_to_path(self, rev_entry: _ReversePathEntry) -> bytes:
-        # Directories don't have hardlink, so they have just 1 reverese entry
-        parent, = self.id_to_reverse_entries[rev_entry.parent_int_id]
-        if parent != _ROOT_REVERSE_ENTRY:
-            yield from self._rev_entry_to_path(parent)
-        yield rev_entry.name
+    def _clear_caches(self):
+        self.dir_paths.clear()
+        self.path_to_dir_id.clear()
+
+    def _dir_path(self, int_id: int) -> bytes:
+        path = self.dir_paths.get(int_id)
+        if path is not None:
+            return path
+        # Walk up to the root, or to the nearest cached ancestor.
+        # Directories don't have hardlinks, so they have just 1 reverse
+        # entry.  Not recursive, so that deep trees cannot hit the stack
+        # limit.
+        uncached = []
+        while True:
+            rev_entry, = self.id_to_reverse_entries[int_id]
+            if rev_entry == _ROOT_REVERSE_ENTRY:
+                path = b'.'
+                break
+            uncached.append((int_id, rev_entry.name))
+            int_id = rev_entry.parent_int_id
+            path = self.dir_paths.get(int_id)
+            if path is not None:
+                break
+        can_cache = isinstance(self.dir_paths, dict)  # Frozen maps cannot
+        for int_id, name in reversed(uncached):
+            path = name if path == b'.' else path + b'/' + name
+            if can_cache:
+                self.dir_paths[int_id] = path
+        return path
 
     def gen_paths(self, inode_id: InodeID) -> Iterator[bytes]:
         for rev_entry in self.id_to_reverse_entries.get(
@@ -131,14 +231,44 @@ class _InnerInodeIDMap(NamedTuple):
         ):
             if rev_entry == _ROOT_REVERSE_ENTRY:
                 yield b'.'
-            else:
-                yield b'/'.join(self._rev_entry_to_path(rev_entry))
-
+                continue
+            parent_path = self._dir_path(rev_entry.parent_int_id)
+            yield rev_entry.name if parent_path == b'.' \
+                else parent_path + b'/' + rev_entry.name
+
+    def _cached_freeze(self, *, _memo) -> Optional['InodeIDMap']:
+        'The frozen map in `freeze_cache`, unless our description changed.'
+        frozen = self.freeze_cache.value
+        if frozen is not None and frozen.inner.description == freeze(
+            self.description, _memo=_memo,
+        ):
+            return frozen
+        return None
 
-class _PathEntry(NamedTuple):
-    id: InodeID
-    # `None` -> the entry is a file, a mapping -> it's a directory.
-    name_to_child: Optional[Mapping[bytes, '_PathEntry']]
+    def freeze(self, *, _memo):
+        'Returns a recursively immutable copy of `self`.'
+        frozen_map = self._cached_freeze(_memo=_memo)
+        if frozen_map is not None:
+            return frozen_map.inner
+        dir_paths = {
+            i: self._dir_path(i) for i in sorted({
+                e.parent_int_id
+                    for entries in self.id_to_reverse_entries.values()
+                        for e in entries
+                            if e.parent_int_id is not None
+            })
+        }
+        return type(self)(
+            description=freeze(self.description, _memo=_memo),
+            id_to_reverse_entries=freeze(
+                self.id_to_reverse_entries, _memo=_memo,
+            ),
+            dir_paths=MappingProxyType(dir_paths),
+            path_to_dir_id=MappingProxyType({
+                p: i for i, p in dir_paths.items() if i != _ROOT_INT_ID
+            }),
+            freeze_cache=None,
+        )
 
 
 class InodeIDMap(NamedTuple):
@@ -149,16 +279,29 @@ class InodeIDMap(NamedTuple):
 
     Unlike a real filesystem, this does not resolve symlinks.
 
-    IMPORTANT: Keep this object `deepcopy`able for the purpose of
-    snapshotting subvolumes -- it currently has a test to check this, but
-    the test may not catch every kind of copy-related problem.  In
-    particular, because `description` has type `Any`, it can bring
-    `deepcopy` issues -- see the notes on the `deepcopy`ability
-    of `SubvolumeDescription` in `volume.py` to understand the risks.
+    The directory structure is stored as two indexes of integer inode IDs:
+    `id_to_children` maps each directory to its entries, and
+    `inner.id_to_reverse_entries` maps each inode to its parents.  Thus,
+    `get_id`, `add_file`, `add_dir`, `remove_path`, and `rename_path` are
+    O(depth of the path) at worst.  Directory paths are cached in both
+    directions, so these, and `get_paths`, usually cost O(1) lookups plus
+    the handling of the path bytes.
+
+    `snapshot()` is O(1): the maps share the copy-on-write maps of
+    directory entries and reverse entries (see `cow_map.py`), and each
+    mutation copies just the entries on the path that it touches.
+
+    IMPORTANT: Keep this object `deepcopy`able for the sake of tests -- it
+    currently has a test to check this, but the test may not catch every
+    kind of copy-related problem.  In particular, because `description`
+    has type `Any`, it can bring `deepcopy` issues -- see the notes on the
+    `deepcopy`ability of `SubvolumeDescription` in `volume.py` to
+    understand the risks.
     '''
     inode_id_counter: Iterator[int]
-    # `_PathEntry.id`s contain references to `self.inner`.
-    root: _PathEntry
+    # Directory ID -> name -> child ID.  Files have no entry here.  The
+    # same `bytes` object names a child here and in its `_ReversePathEntry`.
+    id_to_children: Mapping[int, Mapping[bytes, int]]
     # This structure is separated from `self` so that `InodeID`s do NOT have
     # a circular dependency on `InodeIDMap`.  This dependency-factoring is
     # necessary so that our `freeze()` can make a recursively-immutable
@@ -169,162 +312,198 @@ class InodeIDMap(NamedTuple):
     def new(cls, *, description: Any=''):
         inner = _InnerInodeIDMap(
             description=description,
-            id_to_reverse_entries=defaultdict(set),
+            id_to_reverse_entries=_ReverseEntryMap(),
+            dir_paths={},
+            path_to_dir_id={},
+            freeze_cache=FreezeCache(),
         )
         counter = itertools.count()
+        root_id = next(counter)
+        assert root_id == _ROOT_INT_ID, root_id
         self = cls(
             inode_id_counter=counter,
-            root=_PathEntry(
-                id=InodeID(id=next(counter), inner_id_map=inner),
-                name_to_child={},
-            ),
+            id_to_children=CowIntMap(),
             inner=inner,
         )
-        self.inner.id_to_reverse_entries[self.root.id.id].add(
-            _ROOT_REVERSE_ENTRY
-        )
+        self.id_to_children[root_id] = CowMap()
+        self.inner.id_to_reverse_entries[root_id] = (_ROOT_REVERSE_ENTRY,)
         return self
 
-    def freeze(self, *, _memo):
-        'Returns a recursively immutable copy of `self`.'
-        return self._make(
-            freeze(i, _memo=_memo)  # can't add IDs once frozen
-                for i in self._replace(inode_id_counter=None)
+    def snapshot(self, *, description: Any='') -> 'InodeIDMap':
+        '''
+        Returns an independent copy of `self` in O(1).  Its `InodeID`s have
+        the same numbers as ours, but a new `inner`.
+        '''
+        return type(self)(
+            inode_id_counter=copy.copy(self.inode_id_counter),
+            id_to_children=self.id_to_children.copy(),
+            inner=_InnerInodeIDMap(
+                description=description,
+                id_to_reverse_entries=self.inner.id_to_reverse_entries.copy(),
+                dir_paths={},
+                path_to_dir_id={},
+                freeze_cache=FreezeCache(),
+            ),
         )
 
+    def freeze(self, *, _memo):
+        '''
+        Returns a recursively immutable copy of `self`.  Until `self` is
+        mutated, freezing it again returns the same copy.
+        '''
+        frozen = self.inner._cached_freeze(_memo=_memo)
+        if frozen is None:
+            frozen = self.inner.freeze_cache.value = self._make(
+                freeze(i, _memo=_memo)  # can't add IDs once frozen
+                    for i in self._replace(inode_id_counter=None)
+            )
+        return frozen
+
     def next(self) -> InodeID:
         return InodeID(
             id=next(self.inode_id_counter), inner_id_map=self.inner,
         )
 
-    def _gen_entries(self, parts: Sequence[bytes]) -> Iterator[_PathEntry]:
-        entry = self.root
-        yield entry
+    def _get_int_id(self, parts: Sequence[bytes]) -> Optional[int]:
+        '''
+        Returns None if the path does not exist, raises if the path
+        contains a file as a non-final component.
+        '''
+        if not parts:
+            return _ROOT_INT_ID
+        path_to_dir_id = self.inner.path_to_dir_id
+        int_id = path_to_dir_id.get(b'/'.join(parts))
+        if int_id is not None:
+            return int_id
+        # Walk from the root, caching the directories on the way.
+        can_cache = isinstance(path_to_dir_id, dict)  # Frozen maps cannot
+        path = None
+        name_to_child = self.id_to_children[_ROOT_INT_ID]
         for name in parts:
-            if entry.name_to_child is None:
+            if name_to_child is None:
                 raise RuntimeError(f"{name}'s parent in {parts} is a file")
-            entry = entry.name_to_child.get(name)
-            yield entry
-            if entry is None:
-                # The path is missing some ancestors -- our callers handle
-                # this differently.  A last value of `None` is a sentinel.
-                break
+            int_id = name_to_child.get(name)
+            if int_id is None:
+                return None
+            name_to_child = self.id_to_children.get(int_id)
+            path = name if path is None else path + b'/' + name
+            if can_cache and name_to_child is not None:
+                path_to_dir_id[path] = int_id
+        return int_id
+
+    def _get_parent_and_id(
+        self, parts: Sequence[bytes],
+    ) -> Tuple[Optional[int], Optional[int]]:
+        '''
+        For nonempty `parts`.  Returns `(None, None)` if the parent of
+        `parts` does not exist, and raises if it is a file.
+        '''
+        parent_id = self._get_int_id(parts[:-1])
+        if parent_id is None:
+            return None, None
+        name_to_child = self.id_to_children.get(parent_id)
+        if name_to_child is None:
+            raise RuntimeError(
+                f"{parts[-1]}'s parent in {parts} is a file"
+            )
+        return parent_id, name_to_child.get(parts[-1])
 
-    def _get_parts_parent_and_entry(
+    def _children_for_write(self, int_id: int) -> Mapping[bytes, int]:
+        'The entries of directory `int_id`, safe to mutate.'
+        # Frozen maps lack `get_mut`, but fail on mutation anyhow.
+        if not isinstance(self.id_to_children, CowIntMap):
+            return self.id_to_children[int_id]
+        return self.id_to_children.get_mut(int_id, CowMap.copy)
+
+    def _get_parts_parent_and_id(
         self, path: bytes,
-    ) -> Tuple[_PathEntry, _PathEntry]:
+    ) -> Tuple[Sequence[bytes], int, int]:
         'Contract: never call this on the root, aka empty `parts`'
         parts = _norm_split_path(path)
         if not parts:
             raise RuntimeError(f'Cannot remove the root path')
-        parent, entry = tail(2, self._gen_entries(parts))
-        if entry is None:
+        parent_id, int_id = self._get_parent_and_id(parts)
+        if int_id is None:
             raise RuntimeError(f'Cannot remove non-existent {path}')
-        return parts, parent, entry
+        return parts, parent_id, int_id
 
     # We must differentiate between files and directories because hardlinks
     # to directories would cause a combinatorial explosion of possible paths
     # to a file, which would unnecessarily complicate our implementation.
 
     def add_file(self, ino_id: InodeID, path: bytes) -> InodeID:
-        self._add_path(_PathEntry(id=ino_id, name_to_child=None), path)
+        self._add_path(ino_id, path, is_dir=False)
         return ino_id
 
     def add_dir(self, ino_id: InodeID, path: bytes) -> InodeID:
-        self._add_path(_PathEntry(id=ino_id, name_to_child={}), path)
+        self._add_path(ino_id, path, is_dir=True)
         return ino_id
 
-    def _add_path(self, entry: _PathEntry, path: bytes) -> None:
-        self.inner._assert_mine(entry.id)
+    def _add_path(self, ino_id: InodeID, path: bytes, *, is_dir: bool):
+        int_id = self.inner._assert_mine(ino_id).id
 
         # Block an ID from being added as both a file and a directory, ban
-        # directory hardlinks.
-        for prev_path in self.inner.gen_paths(entry.id):
-            prev_entry = self._get_entry(prev_path)
-            if (entry.name_to_child, prev_entry.name_to_child) != (None, None):
-                raise RuntimeError(
-                    f'Tried to add non-file hardlink for {entry.id}'
-                )
-            break  # It's enough to check 1 entry
+        # directory hardlinks.  An ID only has children while it has a
+        # path, or in the middle of `rename_path`.
+        if self.inner.id_to_reverse_entries.get(int_id) and (
+            is_dir or int_id in self.id_to_children
+        ):
+            raise RuntimeError(f'Tried to add non-file hardlink for {ino_id}')
 
         parts = _norm_split_path(path)
-        parent, = tail(1, self._gen_entries(parts[:-1]))
-        if parent is None:
+        parent_id = self._get_int_id(parts[:-1])
+        if parent_id is None:
             raise RuntimeError(f'Missing ancestor for {path}')
-        if parent.name_to_child is None:
+        name_to_child = self.id_to_children.get(parent_id)
+        if name_to_child is None:
             raise RuntimeError(f"The parent of {path} is a file")
 
-        old = parent.name_to_child.get(parts[-1])
+        name = parts[-1]
+        old = name_to_child.get(name)
         if old is not None:
-            raise RuntimeError(
-                f'Adding #{entry.id.id} to {path} which has #{old.id.id}'
-            )
-
-        reverse_parent = self.inner.id_to_reverse_entries.get(parent.id.id)
-        assert isinstance(reverse_parent, set) and len(reverse_parent) == 1
-
-        parent.name_to_child[parts[-1]] = entry
-        self.inner.id_to_reverse_entries[entry.id.id].add(_ReversePathEntry(
-            name=parts[-1],
-            parent_int_id=parent.id.id,
-        ))
+            raise RuntimeError(f'Adding #{int_id} to {path} which has #{old}')
+
+        if is_dir:
+            if int_id not in self.id_to_children:
+                self.id_to_children[int_id] = CowMap()
+            if isinstance(self.inner.path_to_dir_id, dict):
+                self.inner.path_to_dir_id[b'/'.join(parts)] = int_id
+        self._children_for_write(parent_id)[name] = int_id
+        self.inner.freeze_cache.value = None
+        id_to_rev = self.inner.id_to_reverse_entries
+        id_to_rev[int_id] = id_to_rev.get(int_id, ()) + (
+            _ReversePathEntry(name=name, parent_int_id=parent_id),
+        )
 
     def remove_path(self, path: bytes) -> InodeID:
-        _parts, parent, entry = self._get_parts_parent_and_entry(path)
-        if entry.name_to_child:
+        parts, parent_id, int_id = self._get_parts_parent_and_id(path)
+        if self.id_to_children.get(int_id):
             raise RuntimeError(f'Cannot remove {path} since it has children')
-        return self._remove_path_unsafe(path).id
-
-    def _reverse_entry_matches_path_parts(
-        self, reverse_entry: _ReversePathEntry, parts: Sequence[bytes]
-    ):
-        for part in reversed(parts):
-            if reverse_entry == _ROOT_REVERSE_ENTRY:
-                return False  # `parts` is longer than the path to the root
-            if reverse_entry is None or part != reverse_entry.name:
-                return False  # Different paths
-            reverse_entry = self.inner.id_to_reverse_entries.get(
-                reverse_entry.parent_int_id
-            )
-            assert isinstance(reverse_entry, set) and len(reverse_entry) == 1
-            reverse_entry, = reverse_entry
-        # Since `parts` never has a component corresponding to the root
-        # inode, if we got this far, it must be that all of `parts` had a
-        # name match.
-        #
-        # If we're not at the root, then `parts` accidentally happened to be
-        # a suffix of this `_ReversePathEntry`, but it's not a match.
-        return reverse_entry == _ROOT_REVERSE_ENTRY
-
-    def _matching_reverse_path_entry(self, reverse_entries, parts):
-        '''
-        File hardlinks means an inode will have many `reverse_path_entries`,
-        so we'll check each one to find the one that matches `parts`.
-        Invariant: `reverse_entries` corresponds to an existing `_PathEntry`
-        whose path is in `parts`.
-        '''
-        if not reverse_entries:  # pragma: no cover
-            raise AssertionError(f'{parts} entry has no _ReversePathEntry')
-        # See if any of the `ReverseParentEntries` match `parts`.
-        for reverse_entry in reverse_entries:
-            if self._reverse_entry_matches_path_parts(reverse_entry, parts):
-                return reverse_entry
-        raise AssertionError(  # pragma: no cover
-            f'No _ReversePathEntry matched {parts}'
-        )
-
-    def _remove_path_unsafe(self, path: bytes) -> _PathEntry:
+        self._remove_path_unsafe(parts, parent_id, int_id)
+        if int_id in self.id_to_children:
+            # Directories have just 1 path, so this one is now anonymous.
+            del self.id_to_children[int_id]
+        return InodeID(id=int_id, inner_id_map=self.inner)
+
+    def _remove_path_unsafe(
+        self, parts: Sequence[bytes], parent_id: int, int_id: int,
+    ) -> None:
         'Does not check if path has children, used by `rename_path`.'
-        parts, parent, entry = self._get_parts_parent_and_entry(path)
-
-        del parent.name_to_child[parts[-1]]
-
-        entries = self.inner.id_to_reverse_entries[entry.id.id]
-        entries.remove(self._matching_reverse_path_entry(entries, parts))
-        if not entries:
-            del self.inner.id_to_reverse_entries[entry.id.id]
-
-        return entry
+        del self._children_for_write(parent_id)[parts[-1]]
+        self.inner.freeze_cache.value = None
+
+        # A file has 1 reverse entry per hardlink, and only the one for
+        # this path has this name & parent.
+        removed = _ReversePathEntry(name=parts[-1], parent_int_id=parent_id)
+        id_to_rev = self.inner.id_to_reverse_entries
+        entries = tuple(e for e in id_to_rev[int_id] if e != removed)
+        if entries:
+            id_to_rev[int_id] = entries
+        else:
+            del id_to_rev[int_id]
+
+        if int_id in self.id_to_children:
+            self.inner._clear_caches()  # Paths of descendants may change
 
     def rename_path(self, src: bytes, dest: bytes):
         '''
@@ -334,39 +513,49 @@ class InodeIDMap(NamedTuple):
          - is not exception-safe, since the add can fail after the remove
            succeeded.
         '''
-        entry = self._remove_path_unsafe(src)
+        parts, parent_id, int_id = self._get_parts_parent_and_id(src)
+        self._remove_path_unsafe(parts, parent_id, int_id)
+        ino_id = InodeID(id=int_id, inner_id_map=self.inner)
+        # The children of a directory stay in `id_to_children`, so moving
+        # it is O(1) regardless of the size of its subtree.
+        is_dir = int_id in self.id_to_children
         try:
-            self._add_path(entry, dest)
+            self._add_path(ino_id, dest, is_dir=is_dir)
         except Exception:
-            self._add_path(entry, src)
+            self._add_path(ino_id, src, is_dir=is_dir)
             raise
 
-    def _get_entry(self, path: bytes) -> _PathEntry:
-        entry, = tail(1, self._gen_entries(_norm_split_path(path)))
-        return entry
-
     def get_id(self, path: bytes) -> Optional[InodeID]:
         '''
         Returns None if the path does not exist, raises if the path
         contains a file as a non-final component.
         '''
-        entry = self._get_entry(path)
-        return None if entry is None else entry.id
+        parts = _norm_split_path(path)
+        if not parts:
+            return InodeID(id=_ROOT_INT_ID, inner_id_map=self.inner)
+        # Looking up the parent is cheap, since it is a cached directory.
+        _parent_id, int_id = self._get_parent_and_id(parts)
+        return None if int_id is None \
+            else InodeID(id=int_id, inner_id_map=self.inner)
 
     def get_paths(self, inode_id: InodeID) -> Set[bytes]:
         return set(self.inner.gen_paths(inode_id))
 
+    def has_paths(self, inode_id: InodeID) -> bool:
+        'Like `bool(get_paths(inode_id))`, but without making the paths.'
+        return bool(self.inner.id_to_reverse_entries.get(
+            self.inner._assert_mine(inode_id).id
+        ))
+
     def get_children(self, inode_id: InodeID) -> Optional[Set[bytes]]:
-        '''
-        Returns None if the is a file, raises if the path contains a file as
-        a non-final component.
-        '''
-        paths = list(self.inner.gen_paths(inode_id))
-        if len(paths) > 1:  # Directories have 1 path, 0 paths is an error
+        'Returns None if the inode is a file.'
+        name_to_child = self.id_to_children.get(
+            self.inner._assert_mine(inode_id).id
+        )
+        if name_to_child is None:
             return None  # A file
-        path, = paths
-        entry = self._get_entry(path)  # Not None since we started from InodeID
-        return None if entry.name_to_child is None else {
+        path, = self.inner.gen_paths(inode_id)  # Directories have 1 path
+        return {
             os.path.normpath(os.path.join(path, name))
-                for name in entry.name_to_child
+                for name in name_to_child
         }
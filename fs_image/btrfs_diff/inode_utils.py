@@ -11,6 +11,7 @@ from collections import Counter
 from typing import Optional, Tuple, Union, Iterator
 
 from .incomplete_inode import IncompleteInode, IncompleteDir
+from .send_stream import SendStreamItems
 
 _SELINUX_XATTR = b'security.selinux'
 
@@ -54,4 +55,7 @@ def erase_selinux_xattr(ino: IncompleteInode, data: Optional[bytes]):
         # Getting coverage for this line would force us to have a hard
         # dependency on running this test on an SELinux-enabled filesystem.
         # Mocking that seems like useless effort, so let's waive coverage.
-        del ino.xattrs[_SELINUX_XATTR]  # pragma: no cover
+        # Inodes share their xattrs with snapshots, so don't mutate them.
+        ino.apply_item(SendStreamItems.remove_xattr(  # pragma: no cover
+            path=b'', name=_SELINUX_XATTR,
+        ))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+'''
+Parses many send-stream files concurrently, on a pool of worker processes.
+
+Decoding a send-stream is CPU-bound and independent of any other stream,
+but the resulting items must be applied to a `SubvolumeSet` in dependency
+order, by a single process.  `parse_send_stream_files` therefore yields
+each stream's items in input order, while the workers are already parsing
+the streams that come next:
+
+    subvols = SubvolumeSet.new()
+    for items in parse_send_stream_files(paths):
+        mutator = SubvolumeSetMutator.new(subvols, items[0])
+        for item in items[1:]:
+            mutator.apply_item(item)
+
+`parse_btrfs_dump_parallel` similarly splits one big `btrfs receive --dump`
+output into chunks of lines, since the items of a dump do not depend on
+each other -- just on the subvolume name from the first line.
+
+`SendStreamItems` do not pickle (their constructors are keyword-only), and
+pickling one class reference per item would be wasteful anyway.  Workers
+instead send back "compact" items -- plain tuples of an item type index,
+followed by the field values.
+'''
+import itertools
+import mmap
+import os
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, Iterable, Iterator, List, Tuple
+
+from .parse_dump import parse_btrfs_dump, parse_btrfs_dump_lines
+from .parse_send_stream import parse_send_stream, parse_send_stream_buffer
+from .send_stream import SendStreamItem, SendStreamItems
+
+# Every process computes the same order, so the indexes are portable.
+_ITEM_TYPES = tuple(sorted(
+    (t for k, t in SendStreamItems.__dict__.items() if k[0] != '_'),
+    key=lambda t: t.__name__,
+))
+_ITEM_TYPE_TO_IDX = {t: i for i, t in enumerate(_ITEM_TYPES)}
+# Omit the first field, `DO_NOT_USE_type`, which enriched namedtuples add.
+_ITEM_TYPE_FIELDS = tuple(t._fields[1:] for t in _ITEM_TYPES)
+
+CompactItem = Tuple
+
+
+def items_to_compact(items: Iterable[SendStreamItem]) -> List[CompactItem]:
+    type_to_idx = _ITEM_TYPE_TO_IDX
+    return [(type_to_idx[type(i)], *i[1:]) for i in items]
+
+
+def compact_to_items(
+    compact_items: Iterable[CompactItem],
+) -> Iterator[SendStreamItem]:
+    for type_idx, *values in compact_items:
+        yield _ITEM_TYPES[type_idx](
+            **dict(zip(_ITEM_TYPE_FIELDS[type_idx], values))
+        )
+
+
+def _parse_file_to_compact(path: bytes, lazy_data: bool) -> List[CompactItem]:
+    'Runs on a worker process.'
+    with open(path, 'rb') as infile:
+        try:
+            m = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):  # Pipes, empty files, etc.
+            return items_to_compact(
+                parse_send_stream(infile, lazy_data=lazy_data)
+            )
+        with m:
+            return items_to_compact(
+                parse_send_stream_buffer(m, lazy_data=lazy_data)
+            )
+
+
+def parse_send_stream_files(
+    paths: Iterable[bytes], *, max_workers: int = None,
+    lazy_data: bool = False,
+) -> Iterator[List[SendStreamItem]]:
+    '''
+    Yields, in the order of `paths`, the list of items in each send-stream.
+    Up to `max_workers` (default: the CPU count) streams are parsed at
+    once.  With `lazy_data`, the `WriteDataRef`s refer to the files at
+    `paths`.
+    '''
+    max_workers = max_workers or os.cpu_count() or 1
+    paths = iter(paths)
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+
+        def submit_next(count):
+            for path in itertools.islice(paths, count):
+                pending.append(
+                    pool.submit(_parse_file_to_compact, path, lazy_data)
+                )
+
+        # Parsing ahead keeps the workers busy while the caller applies the
+        # items, but parsed streams wait in RAM, so bound their number.
+        pending = deque()
+        submit_next(2 * max_workers)
+        while pending:
+            compact_items = pending.popleft().result()
+            submit_next(1)
+            yield list(compact_to_items(compact_items))
+
+
+def _parse_dump_lines_to_compact(
+    lines: List[bytes], subvol_name: bytes,
+) -> List[CompactItem]:
+    'Runs on a worker process.'
+    return items_to_compact(parse_btrfs_dump_lines(lines, subvol_name))
+
+
+def parse_btrfs_dump_parallel(
+    binary_infile: BinaryIO, *, max_workers: int = None,
+    chunk_lines: int = 10000,
+) -> Iterator[SendStreamItem]:
+    '''
+    Yields the same items as `parse_dump.parse_btrfs_dump`, but parses up
+    to `max_workers` (default: the CPU count) chunks of `chunk_lines` lines
+    at once.  An error in a line is raised after the items of the lines
+    before it were yielded, as with `parse_btrfs_dump`.
+    '''
+    max_workers = max_workers or os.cpu_count() or 1
+    lines = iter(binary_infile)
+    first_line = next(lines, None)
+    if first_line is None:
+        return
+    first_item, = parse_btrfs_dump([first_line])
+    yield first_item
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+
+        def submit_next(count):
+            for _ in range(count):
+                chunk = list(itertools.islice(lines, chunk_lines))
+                if not chunk:
+                    return
+                pending.append((chunk, pool.submit(
+                    _parse_dump_lines_to_compact, chunk, first_item.path,
+                )))
+
+        # As in `parse_send_stream_files`, bound the parsed chunks in RAM.
+        pending = deque()
+        submit_next(2 * max_workers)
+        while pending:
+            chunk, future = pending.popleft()
+            if future.exception() is not None:
+                # Re-parse here to yield the good items before the error.
+                yield from parse_btrfs_dump_lines(chunk, first_item.path)
+                # The worker failed for some other reason, e.g. it died.
+                raise future.exception()
+            submit_next(1)
+            yield from compact_to_items(future.result())
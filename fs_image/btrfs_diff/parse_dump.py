@@ -53,11 +53,14 @@ Limitations of `btrfs receive --dump` (filed as T25376790):
    unravel the source of a clone when more than one source is in use.
 '''
 import datetime
+import functools
 import os
 import re
 
 from collections import OrderedDict
-from typing import Any, BinaryIO, Dict, Iterable, Optional, Pattern
+from typing import (
+    Any, BinaryIO, Dict, Iterable, List, Optional, Pattern, Tuple,
+)
 
 from .send_stream import SendStreamItem, SendStreamItems
 
@@ -102,6 +105,8 @@ def unquote_btrfs_progs_path(s):
     custom un-quoting function.  Future: fix `btrfs-progs` so that other
     fields (paths & data) are quoted too.
     '''
+    if b'\\' not in s:
+        return s  # Most paths have no escapes, skip the slow regex
     return _ESCAPED_REGEX.sub(lambda m: _ESCAPED_TO_UNESCAPED[m.group(0)], s)
 
 
@@ -110,35 +115,56 @@ class RegexItemParser:
 
     regex: Pattern = re.compile(b'')
 
+    def __init_subclass__(cls, **kwargs):
+        '''
+        Looks up the converters of the fields once per class, rather than
+        once per parsed line:
+         - `conv_FIELD_NAME` class methods take a single positional
+           argument, and handle most cases.
+         - We currently only use `context_conv_FIELD_NAME` when a detail
+           field needs to know the subvolume name, see e.g. `clone`.
+        '''
+        super().__init_subclass__(**kwargs)
+        cls._field_convs: List[Tuple[str, Any, Any]] = [
+            (
+                k,
+                getattr(cls, f'conv_{k}', None),
+                getattr(cls, f'context_conv_{k}', None),
+            ) for k in cls.regex.groupindex
+        ]
+
     @classmethod
     def parse_details(
         cls, subvol_name: bytes, details: bytes,
     ) -> Optional[Dict[str, Any]]:
         m = cls.regex.fullmatch(details)
-        return {
-            # Handle `conv_FIELD_NAME` class methods for converting fields.
-            # These take a single positional argument, and handle most
-            # cases.
-            #
-            # We currently only use `context_conv_FIELD_NAME` when a detail
-            # field needs to know the subvolume name, see e.g. `clone`.
-            k: getattr(
-                cls, f'context_conv_{k}', lambda value, subvol_name: value
-            )(
-                getattr(cls, f'conv_{k}', lambda x: x)(v),
-                subvol_name=subvol_name,
-            )
-                for k, v in m.groupdict().items()
-        } if m else None
+        if not m:
+            return None
+        groups = m.groupdict()
+        fields = {}
+        for k, conv, context_conv in cls._field_convs:
+            v = groups[k]
+            if conv is not None:
+                v = conv(v)
+            if context_conv is not None:
+                v = context_conv(v, subvol_name=subvol_name)
+            fields[k] = v
+        return fields
 
 
 def _normalize_subvolume_path(s: bytes, *, subvol_name: bytes) -> bytes:
     # `normpath` is needed since `btrfs receive --dump` is inconsistent
     # about trailing slashes on directory paths.
-    stripped = os.path.relpath(s, subvol_name)
-    if len(stripped) >= len(s) or stripped.startswith(b'..'):
-        raise RuntimeError(f'{s} did not start with {subvol_name}')
-    return stripped
+    #
+    # For the relative paths of `--dump`, this is equivalent to checking
+    # that `os.path.relpath(s, subvol_name)` is shorter than `s`, and does
+    # not start with `..` -- but `relpath` is slow, since it calls `getcwd`.
+    path = os.path.normpath(s)
+    if path == subvol_name and len(s) > 1:
+        return b'.'
+    if path.startswith(subvol_name + b'/'):
+        return path[len(subvol_name) + 1:]
+    raise RuntimeError(f'{s} did not start with {subvol_name}')
 
 
 def _from_octal(s: bytes) -> int:
@@ -306,8 +332,10 @@ class SendStreamItemParsers:
             br'ctime=(?P<ctime>[^ ]+)'
         )
 
-        @classmethod
-        def conv_atime(cls, t: bytes) -> float:
+        # `strptime` is slow, but most timestamps in a dump are repeats.
+        @staticmethod
+        @functools.lru_cache(maxsize=2 ** 12)
+        def conv_atime(t: bytes) -> Tuple[int, int]:
             return (int(datetime.datetime.strptime(
                 t.decode(), '%Y-%m-%dT%H:%M:%S%z'
             ).timestamp()), 0)  # --dump discards nanoseconds
@@ -321,6 +349,38 @@ class SendStreamItemParsers:
         conv_offset = staticmethod(int)
         conv_len = staticmethod(int)
 
+    # Since `--dump` does not show the data, we parse this into an
+    # `update_extent` of the logical length, see `NAME_TO_ITEM_TYPE`.
+    class encoded_write(RegexItemParser):
+        regex = re.compile(
+            br'offset=(?P<offset>[0-9]+) '
+            br'len=[0-9]+,? '
+            br'unencoded_file_len=(?P<len>[0-9]+),? '
+            br'unencoded_len=[0-9]+,? '
+            br'unencoded_offset=[0-9]+,? '
+            br'compression=[0-9]+,? '
+            br'encryption=[0-9]+'
+        )
+        conv_offset = staticmethod(int)
+        conv_len = staticmethod(int)
+
+    class fallocate(RegexItemParser):
+        regex = re.compile(
+            br'mode=(?P<mode>[0-9]+) '
+            br'offset=(?P<offset>[0-9]+) '
+            br'len=(?P<len>[0-9]+)'
+        )
+        conv_mode = staticmethod(int)
+        conv_offset = staticmethod(int)
+        conv_len = staticmethod(int)
+
+    class fileattr(RegexItemParser):
+        regex = re.compile(br'fileattr=0x(?P<attr>[0-9a-f]+)')
+
+        @staticmethod
+        def conv_attr(attr: bytes) -> int:
+            return int(attr, base=16)
+
 
 # The inner classes of SendStreamItems, omitting internals like __doc__.
 # The keys must be bytes because `btrfs` does not give us unicode.
@@ -329,65 +389,122 @@ NAME_TO_PARSER_TYPE = {
         for k, v in SendStreamItemParsers.__dict__.items() if k[0] != '_'
 }
 NAME_TO_ITEM_TYPE = {
-    k.encode(): v
-        for k, v in SendStreamItems.__dict__.items()
-            if k[0] != '_' and k != 'write'
+    **{
+        k.encode(): v
+            for k, v in SendStreamItems.__dict__.items()
+                if k[0] != '_' and k not in ('write', 'encoded_write')
+    },
+    b'encoded_write': SendStreamItems.update_extent,
 }
 assert set(NAME_TO_PARSER_TYPE.keys()) == set(NAME_TO_ITEM_TYPE.keys())
 
 
-def parse_btrfs_dump(binary_infile: BinaryIO) -> Iterable[SendStreamItem]:
-    reg = re.compile(br'([^ ]+) +((\\ |[^ ])+) *(.*)\n')
-    subvol_name = None
-    for l in binary_infile:
-        m = reg.fullmatch(l)
-        if not m:
-            raise RuntimeError(f'line has unexpected format: {repr(l)}')
-        item_name, path, _, details = m.groups()
-
-        # This parser maps `write` to `update_extent` regardless of whether
-        # the send-stream used `--no-data` or not.  The reason is that
-        # `btrfs receive --dump` never displays the `data` field (because it
-        # can be huge, and not very illuminating to the user).
-        if item_name == b'write':
-            item_name = b'update_extent'
-
-        item_class = NAME_TO_ITEM_TYPE.get(item_name)
-        if not item_class:
-            raise RuntimeError(f'unknown item type {item_name} in {repr(l)}')
-        item_parser = NAME_TO_PARSER_TYPE[item_name]
-
-        # We MUST unquote here, or paths in field 1 will not be comparable
-        # with as-of-now unquoted paths in the other fields.  For example,
-        # `ItemFilters.rename` compares such paths.
-        unnormalized_path = unquote_btrfs_progs_path(path)
-
-        if subvol_name is None:
-            if not item_class.sets_subvol_name:
-                raise RuntimeError(
-                    f'First stream item did not set subvolume name: {l}'
-                )
-            path = os.path.normpath(unnormalized_path)
-            subvol_name = path
-            if b'/' in path:
-                raise RuntimeError(f'subvol path {path} contains /')
-        elif item_class.sets_subvol_name:
+def _split_line(l: bytes) -> Optional[Tuple[bytes, bytes, bytes]]:
+    '''
+    Splits a `--dump` line into the item name, the quoted path, and the
+    details.  This is the same as a `fullmatch` of
+        br'([^ ]+) +((\\ |[^ ])+) *(.*)\n'
+    but that regex is a big part of the cost of parsing a line.
+    '''
+    if not l.endswith(b'\n'):
+        return None
+    end = len(l) - 1
+    name_end = l.find(b' ', 0, end)
+    if name_end <= 0:
+        return None
+    path_start = name_end + 1
+    while path_start < end and l[path_start] == 0x20:  # ord(' ')
+        path_start += 1
+    # The path ends at the first space that is not escaped by a backslash.
+    path_end = l.find(b' ', path_start, end)
+    while path_end > 0 and l[path_end - 1] == 0x5c:  # ord('\\')
+        path_end = l.find(b' ', path_end + 1, end)
+    if path_end == -1:
+        path_end = end
+    if path_end == path_start:
+        return None
+    details_start = path_end
+    while details_start < end and l[details_start] == 0x20:
+        details_start += 1
+    details = l[details_start:end]
+    if b'\n' in details:  # Unlike the path, the regex's `.*` excludes \n
+        return None
+    return l[:name_end], l[path_start:path_end], details
+
+
+def _parse_line(l: bytes, subvol_name: Optional[bytes]) -> SendStreamItem:
+    '''
+    `subvol_name` comes from the first item of the dump, so pass `None`
+    when parsing the first line.
+    '''
+    split = _split_line(l)
+    if split is None:
+        raise RuntimeError(f'line has unexpected format: {repr(l)}')
+    item_name, path, details = split
+
+    # This parser maps `write` to `update_extent` regardless of whether
+    # the send-stream used `--no-data` or not.  The reason is that
+    # `btrfs receive --dump` never displays the `data` field (because it
+    # can be huge, and not very illuminating to the user).
+    if item_name == b'write':
+        item_name = b'update_extent'
+
+    item_class = NAME_TO_ITEM_TYPE.get(item_name)
+    if not item_class:
+        raise RuntimeError(f'unknown item type {item_name} in {repr(l)}')
+    item_parser = NAME_TO_PARSER_TYPE[item_name]
+
+    # We MUST unquote here, or paths in field 1 will not be comparable
+    # with as-of-now unquoted paths in the other fields.  For example,
+    # `ItemFilters.rename` compares such paths.
+    unnormalized_path = unquote_btrfs_progs_path(path)
+
+    if subvol_name is None:
+        if not item_class.sets_subvol_name:
             raise RuntimeError(
-                f'Subvolume {subvol_name} created more than once.'
-            )
-        else:
-            path = _normalize_subvolume_path(
-                unnormalized_path, subvol_name=subvol_name,
+                f'First stream item did not set subvolume name: {l}'
             )
+        path = os.path.normpath(unnormalized_path)
+        subvol_name = path
+        if b'/' in path:
+            raise RuntimeError(f'subvol path {path} contains /')
+    elif item_class.sets_subvol_name:
+        raise RuntimeError(
+            f'Subvolume {subvol_name} created more than once.'
+        )
+    else:
+        path = _normalize_subvolume_path(
+            unnormalized_path, subvol_name=subvol_name,
+        )
+
+    fields = item_parser.parse_details(subvol_name, details)
+    if fields is None:
+        raise RuntimeError(f'unexpected format in line details: {repr(l)}')
+
+    assert 'path' not in fields, f'{item_name}.regex defined <path>'
+    fields['path'] = path
 
-        fields = item_parser.parse_details(subvol_name, details)
-        if fields is None:
-            raise RuntimeError(f'unexpected format in line details: {repr(l)}')
+    return item_class(**fields)
 
-        assert 'path' not in fields, f'{item_name}.regex defined <path>'
-        fields['path'] = path
 
-        yield item_class(**fields)
+def parse_btrfs_dump_lines(
+    lines: Iterable[bytes], subvol_name: bytes,
+) -> Iterable[SendStreamItem]:
+    '''
+    Parses the lines of a dump that follow its first line, whose item
+    named the subvolume.  `parallel_parse.py` uses this to parse chunks of
+    a dump concurrently.
+    '''
+    for l in lines:
+        yield _parse_line(l, subvol_name)
+
+
+def parse_btrfs_dump(binary_infile: BinaryIO) -> Iterable[SendStreamItem]:
+    lines = iter(binary_infile)
+    for l in lines:
+        item = _parse_line(l, None)
+        yield item
+        yield from parse_btrfs_dump_lines(lines, item.path)
 
 
 if __name__ == '__main__':  # pragma: no cover
@@ -1,17 +1,57 @@
 #!/usr/bin/env python3
-'Parses the btrfs send-stream binary format. Only version 1 is supported.'
+'''
+Parses the btrfs send-stream binary format, versions 1 and 2.
+
+Version 2 adds the `encoded_write`, `fallocate` and `fileattr` commands.
+We never decompress the payload of `encoded_write`, since `IncompleteFile`
+only needs its logical (unencoded) length.
+
+There are two entry points that yield identical `SendStreamItems`:
+
+ - `parse_send_stream` reads from any binary file object, including pipes.
+
+ - `parse_send_stream_buffer` works on a buffer that already holds the
+   whole stream, e.g. `bytes` or an `mmap.mmap` of a send-stream file.
+   It decodes commands in place via `memoryview` slices & precompiled
+   `struct.Struct`s, so it does not copy each command before decoding it.
+   Prefer it for large send-streams that live in regular files.
+
+Both take `lazy_data=True`, which replaces the `data` bytes of each `write`
+and `encoded_write` by a `WriteDataRef` -- the offset & length of the data
+in the send-stream.  The memory used by the parsed items then scales with
+the send-stream's metadata, not with the size of the files it carries.
+
+Both also take `verify_crc=True`, which checks the CRC32C of every command.
+The pure-Python CRC is slow, so large send-streams are checked in batches
+on worker processes, while the parse continues.  A bad CRC thus raises a
+`RuntimeError` up to a few batches after its command was yielded -- at the
+latest, right before the generator would finish.  Consumers must not
+commit to the items' validity until the iteration has completed.
+'''
 import enum
 import os
 import struct
 import uuid
 
-from io import BytesIO
-from typing import NamedTuple, Iterable
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, NamedTuple, Tuple
 
-from .send_stream import SendStreamItem, SendStreamItems
+from .crc32c import crc32c
+
+from .send_stream import SendStreamItem, SendStreamItems, WriteDataRef
 
 BTRFS_SEND_STREAM_MAGIC = b'btrfs-stream\0'
 
+# Precompiled so that the hot decoding loops never parse format strings.
+_VERSION = struct.Struct('<I')
+_COMMAND_HEADER = struct.Struct('<IHI')
+_ATTRIBUTE_HEADER = struct.Struct('<HH')
+_UINT16 = struct.Struct('<H')
+_UINT32 = struct.Struct('<I')
+_UINT64 = struct.Struct('<Q')
+_TIME = struct.Struct('<QI')
+
 
 def file_unpack(fmt, infile):
     size = struct.calcsize(fmt)
@@ -21,16 +61,31 @@ def file_unpack(fmt, infile):
     return struct.unpack(fmt, b)
 
 
+def _unpack_from(st: struct.Struct, view: memoryview, pos: int):
+    if pos + st.size > len(view):
+        raise RuntimeError(
+            f'Not enough bytes {bytes(view[pos:])} for format {st.format}'
+        )
+    return st.unpack_from(view, pos)
+
+
 def check_magic(infile) -> None:
     magic = infile.read(len(BTRFS_SEND_STREAM_MAGIC))
     if magic != BTRFS_SEND_STREAM_MAGIC:
         raise RuntimeError(f'Magic {magic}, not "{BTRFS_SEND_STREAM_MAGIC}"')
 
 
-def check_version(infile) -> None:
+def _check_version_number(version: int) -> None:
+    if version not in (1, 2):
+        raise RuntimeError(
+            f'Got version {version}, but we require version 1 or 2'
+        )
+
+
+def check_version(infile) -> int:
     version, = file_unpack('<I', infile)
-    if version != 1:
-        raise RuntimeError(f'Got version {version}, but we require version 1')
+    _check_version_number(version)
+    return version
 
 
 class CommandKind(enum.Enum):
@@ -65,6 +120,11 @@ class CommandKind(enum.Enum):
     END = 21
     UPDATE_EXTENT = 22
 
+    # Version 2
+    FALLOCATE = 23
+    FILEATTR = 24
+    ENCODED_WRITE = 25
+
 
 class CommandHeader(NamedTuple):
     kind: CommandKind
@@ -112,6 +172,15 @@ class AttributeKind(enum.Enum):
     CLONE_OFFSET = 23
     CLONE_LEN = 24
 
+    # Version 2
+    FALLOCATE_MODE = 25
+    FILEATTR = 26
+    UNENCODED_FILE_LEN = 27
+    UNENCODED_LEN = 28
+    UNENCODED_OFFSET = 29
+    COMPRESSION = 30
+    ENCRYPTION = 31
+
 
 class AttributeHeader(NamedTuple):
     kind: AttributeKind
@@ -124,16 +193,226 @@ class AttributeHeader(NamedTuple):
 
 
 def conv_uuid(s: bytes) -> str:
-    return str(uuid.UUID(bytes=s)).encode()  # All our other strings are bytes
+    # `UUID` requires `bytes`.  All our other strings are bytes, too.
+    return str(uuid.UUID(bytes=bytes(s))).encode()
+
+
+def conv_uint32(s: bytes) -> int:
+    i, = _UINT32.unpack(s)
+    return i
 
 
 def conv_uint64(s: bytes) -> int:
-    i, = struct.unpack('<Q', s)
+    i, = _UINT64.unpack(s)
     return i
 
 
 def conv_time(s: bytes) -> float:
-    return struct.unpack('<QI', s)
+    return _TIME.unpack(s)
+
+
+# Attribute data may be a `memoryview` from the buffer parser.  Either way,
+# any bytes we return must be a standalone `bytes` object, since that is
+# what `SendStreamItems` hold.  NB: `bytes(b)` does not copy `bytes`.
+conv_bytes = bytes
+
+
+def conv_path(s: bytes) -> bytes:
+    return os.path.normpath(bytes(s))
+
+
+_ATTRIBUTE_KIND_TO_CONV = {
+    AttributeKind.UUID: conv_uuid,
+    AttributeKind.CTRANSID: conv_uint64,
+    AttributeKind.INO: conv_uint64,
+    AttributeKind.SIZE: conv_uint64,
+    AttributeKind.MODE: conv_uint64,
+    AttributeKind.UID: conv_uint64,
+    AttributeKind.GID: conv_uint64,
+    AttributeKind.RDEV: conv_uint64,
+    AttributeKind.CTIME: conv_time,
+    AttributeKind.MTIME: conv_time,
+    AttributeKind.ATIME: conv_time,
+    AttributeKind.XATTR_NAME: conv_bytes,
+    AttributeKind.XATTR_DATA: conv_bytes,
+    AttributeKind.PATH: conv_path,
+    AttributeKind.PATH_TO: conv_path,
+    # NB This is NOT normalized since we don't want to normalize symlinks
+    AttributeKind.PATH_LINK: conv_bytes,
+    AttributeKind.FILE_OFFSET: conv_uint64,
+    AttributeKind.DATA: conv_bytes,
+    AttributeKind.CLONE_UUID: conv_uuid,
+    AttributeKind.CLONE_CTRANSID: conv_uint64,
+    AttributeKind.CLONE_PATH: conv_path,
+    AttributeKind.CLONE_OFFSET: conv_uint64,
+    AttributeKind.CLONE_LEN: conv_uint64,
+    AttributeKind.FALLOCATE_MODE: conv_uint32,
+    AttributeKind.FILEATTR: conv_uint64,
+    AttributeKind.UNENCODED_FILE_LEN: conv_uint64,
+    AttributeKind.UNENCODED_LEN: conv_uint64,
+    AttributeKind.UNENCODED_OFFSET: conv_uint64,
+    AttributeKind.COMPRESSION: conv_uint32,
+    AttributeKind.ENCRYPTION: conv_uint32,
+}
+assert set(_ATTRIBUTE_KIND_TO_CONV) == set(AttributeKind)
+
+# For each command, the item type to make, and the item fields to populate
+# from attributes -- optionally with a further conversion (or None), and a
+# default for when the attribute is absent.  `None` marks the END command.
+_COMMAND_KIND_TO_ITEM_FIELDS = {
+    CommandKind.SUBVOL: (SendStreamItems.subvol, [
+        ('path', AttributeKind.PATH),
+        ('uuid', AttributeKind.UUID),
+        ('transid', AttributeKind.CTRANSID),
+    ]),
+    CommandKind.SNAPSHOT: (SendStreamItems.snapshot, [
+        ('path', AttributeKind.PATH),
+        ('uuid', AttributeKind.UUID),
+        ('transid', AttributeKind.CTRANSID),
+        ('parent_uuid', AttributeKind.CLONE_UUID),
+        ('parent_transid', AttributeKind.CLONE_CTRANSID),
+    ]),
+    CommandKind.MKFILE: (SendStreamItems.mkfile, [
+        ('path', AttributeKind.PATH),
+    ]),
+    CommandKind.MKDIR: (SendStreamItems.mkdir, [
+        ('path', AttributeKind.PATH),
+    ]),
+    CommandKind.MKNOD: (SendStreamItems.mknod, [
+        ('path', AttributeKind.PATH),
+        ('mode', AttributeKind.MODE),
+        ('dev', AttributeKind.RDEV),
+    ]),
+    CommandKind.MKFIFO: (SendStreamItems.mkfifo, [
+        ('path', AttributeKind.PATH),
+    ]),
+    CommandKind.MKSOCK: (SendStreamItems.mksock, [
+        ('path', AttributeKind.PATH),
+    ]),
+    CommandKind.SYMLINK: (SendStreamItems.symlink, [
+        ('path', AttributeKind.PATH),
+        # NB Unlike the other `dest` attributes, we don't normalize this.
+        ('dest', AttributeKind.PATH_LINK, os.path.normpath),
+    ]),
+    CommandKind.RENAME: (SendStreamItems.rename, [
+        ('path', AttributeKind.PATH),
+        ('dest', AttributeKind.PATH_TO),
+    ]),
+    CommandKind.LINK: (SendStreamItems.link, [
+        ('path', AttributeKind.PATH),
+        ('dest', AttributeKind.PATH_LINK, os.path.normpath),
+    ]),
+    CommandKind.UNLINK: (SendStreamItems.unlink, [
+        ('path', AttributeKind.PATH),
+    ]),
+    CommandKind.RMDIR: (SendStreamItems.rmdir, [
+        ('path', AttributeKind.PATH),
+    ]),
+    CommandKind.WRITE: (SendStreamItems.write, [
+        ('path', AttributeKind.PATH),
+        ('offset', AttributeKind.FILE_OFFSET),
+        ('data', AttributeKind.DATA),
+    ]),
+    CommandKind.CLONE: (SendStreamItems.clone, [
+        ('path', AttributeKind.PATH),
+        ('offset', AttributeKind.FILE_OFFSET),
+        ('len', AttributeKind.CLONE_LEN),
+        ('from_uuid', AttributeKind.CLONE_UUID),
+        ('from_transid', AttributeKind.CLONE_CTRANSID),
+        ('from_path', AttributeKind.CLONE_PATH),
+        ('clone_offset', AttributeKind.CLONE_OFFSET),
+    ]),
+    CommandKind.SET_XATTR: (SendStreamItems.set_xattr, [
+        ('path', AttributeKind.PATH),
+        ('name', AttributeKind.XATTR_NAME),
+        ('data', AttributeKind.XATTR_DATA),
+    ]),
+    CommandKind.REMOVE_XATTR: (SendStreamItems.remove_xattr, [
+        ('path', AttributeKind.PATH),
+        ('name', AttributeKind.XATTR_NAME),
+    ]),
+    CommandKind.TRUNCATE: (SendStreamItems.truncate, [
+        ('path', AttributeKind.PATH),
+        ('size', AttributeKind.SIZE),
+    ]),
+    CommandKind.CHMOD: (SendStreamItems.chmod, [
+        ('path', AttributeKind.PATH),
+        ('mode', AttributeKind.MODE),
+    ]),
+    CommandKind.CHOWN: (SendStreamItems.chown, [
+        ('path', AttributeKind.PATH),
+        ('uid', AttributeKind.UID),
+        ('gid', AttributeKind.GID),
+    ]),
+    CommandKind.UTIMES: (SendStreamItems.utimes, [
+        ('path', AttributeKind.PATH),
+        ('ctime', AttributeKind.CTIME),
+        ('mtime', AttributeKind.MTIME),
+        ('atime', AttributeKind.ATIME),
+    ]),
+    CommandKind.END: None,
+    CommandKind.UPDATE_EXTENT: (SendStreamItems.update_extent, [
+        ('path', AttributeKind.PATH),
+        ('offset', AttributeKind.FILE_OFFSET),
+        ('len', AttributeKind.SIZE),
+    ]),
+    CommandKind.FALLOCATE: (SendStreamItems.fallocate, [
+        ('path', AttributeKind.PATH),
+        ('mode', AttributeKind.FALLOCATE_MODE),
+        ('offset', AttributeKind.FILE_OFFSET),
+        ('len', AttributeKind.SIZE),
+    ]),
+    CommandKind.FILEATTR: (SendStreamItems.fileattr, [
+        ('path', AttributeKind.PATH),
+        ('attr', AttributeKind.FILEATTR),
+    ]),
+    CommandKind.ENCODED_WRITE: (SendStreamItems.encoded_write, [
+        ('path', AttributeKind.PATH),
+        ('offset', AttributeKind.FILE_OFFSET),
+        ('unencoded_file_len', AttributeKind.UNENCODED_FILE_LEN),
+        ('unencoded_len', AttributeKind.UNENCODED_LEN),
+        ('unencoded_offset', AttributeKind.UNENCODED_OFFSET),
+        # Like `btrfs receive`, default to no compression / encryption.
+        ('compression', AttributeKind.COMPRESSION, None, 0),
+        ('encryption', AttributeKind.ENCRYPTION, None, 0),
+        ('data', AttributeKind.DATA),
+    ]),
+}
+assert set(_COMMAND_KIND_TO_ITEM_FIELDS) == set(CommandKind)
+
+
+def _make_item_maker(item_type, fields):
+    'Compiles a `_COMMAND_KIND_TO_ITEM_FIELDS` entry into a function.'
+    conv_fields = []
+    defaults = {}
+    for name, kind, *rest in fields:
+        conv = rest[0] if rest else None
+        if len(rest) > 1:
+            defaults[kind.value] = rest[1]
+        conv_fields.append((name, kind.value, conv))
+
+    def make_item(type_to_attr):
+        return item_type(**{
+            name: type_to_attr[attr_type] if conv is None
+                else conv(type_to_attr[attr_type])
+                    for name, attr_type, conv in conv_fields
+        })
+
+    if not defaults:
+        return make_item
+    return lambda type_to_attr: make_item({**defaults, **type_to_attr})
+
+
+# The decoding loops look up the raw integers from the stream in these
+# tables, which are built once at import time.  That saves creating enum
+# members, or walking `if` chains, for every attribute of every command.
+_ATTRIBUTE_TYPE_TO_KIND_AND_CONV = {
+    kind.value: (kind, conv) for kind, conv in _ATTRIBUTE_KIND_TO_CONV.items()
+}
+_COMMAND_TYPE_TO_ITEM_MAKER = {
+    kind.value: None if v is None else _make_item_maker(*v)
+        for kind, v in _COMMAND_KIND_TO_ITEM_FIELDS.items()
+}
 
 
 def read_attribute(infile):
@@ -141,189 +420,393 @@ def read_attribute(infile):
     attr_data = infile.read(attr_header.length)
     if len(attr_data) != attr_header.length:
         raise RuntimeError(f'{attr_header} got {len(attr_data)} bytes')
+    return attr_header.kind, _ATTRIBUTE_KIND_TO_CONV[attr_header.kind](
+        attr_data
+    )
+
+
+def _raw_to_command_header(length: int, cmd_type: int, crc: int):
+    return CommandHeader(kind=CommandKind(cmd_type), length=length, crc=crc)
+
+
+_DATA_TYPE = AttributeKind.DATA.value
+# In version 2, DATA is always the last attribute of its command, and its
+# header omits the length.
+_V2_DATA_HEADER = _UINT16.pack(_DATA_TYPE)
+
+
+def _decode_command(
+    view: memoryview, pos: int, length: int, cmd_type: int, crc: int,
+    data_ref_base: int = None, version: int = 1,
+):
+    '''
+    Decodes the attributes in `view[pos:pos + length]`, which is the body
+    of the command whose raw header fields are `length, cmd_type, crc`.
+    Returns the `SendStreamItem`, or None for the END command.
+
+    If `data_ref_base` is set, it is the send-stream offset of `view[0]`,
+    and any DATA attribute becomes a `WriteDataRef` instead of `bytes`.
+    '''
+    try:
+        make_item = _COMMAND_TYPE_TO_ITEM_MAKER[cmd_type]
+    except KeyError:
+        CommandKind(cmd_type)  # Raises `ValueError` for unknown commands
+        raise  # pragma: no cover
+
+    # This loop is hot, so avoid creating `AttributeHeader`s except to
+    # report errors.
+    attr_header_size = _ATTRIBUTE_HEADER.size
+    unpack_attr_header = _ATTRIBUTE_HEADER.unpack_from
+    end = pos + length
+    type_to_attr = {}
+    data_to_end = version >= 2
+    while pos != end:
+        if data_to_end and view[pos:pos + _UINT16.size] == _V2_DATA_HEADER:
+            pos += _UINT16.size
+            attr_type, attr_len = _DATA_TYPE, end - pos
+        else:
+            if pos + attr_header_size > end:
+                raise RuntimeError(
+                    f'Not enough bytes {bytes(view[pos:end])} for format '
+                    f'{_ATTRIBUTE_HEADER.format}'
+                )
+            attr_type, attr_len = unpack_attr_header(view, pos)
+            pos += attr_header_size
+        try:
+            attr_kind, conv = _ATTRIBUTE_TYPE_TO_KIND_AND_CONV[attr_type]
+        except KeyError:
+            AttributeKind(attr_type)  # Raises `ValueError` for unknown types
+            raise  # pragma: no cover
+        if pos + attr_len > end:
+            attr_header = AttributeHeader(kind=attr_kind, length=attr_len)
+            raise RuntimeError(f'{attr_header} got {end - pos} bytes')
+        if attr_type in type_to_attr:
+            cmd_header = _raw_to_command_header(length, cmd_type, crc)
+            raise RuntimeError(f'{attr_kind} occurred twice in {cmd_header}')
+        if attr_type == _DATA_TYPE and data_ref_base is not None:
+            type_to_attr[attr_type] = WriteDataRef(
+                offset=data_ref_base + pos, length=attr_len,
+            )
+        else:
+            type_to_attr[attr_type] = conv(view[pos:pos + attr_len])
+        pos += attr_len
+
+    if make_item is None:
+        return None
+    try:
+        return make_item(type_to_attr)
+    except KeyError as ex:
+        raise RuntimeError(
+            f'{CommandKind(cmd_type)} lacks {AttributeKind(ex.args[0])}'
+        )
 
-    if attr_header.kind == AttributeKind.UUID:
-        return attr_header.kind, conv_uuid(attr_data)
-    elif attr_header.kind == AttributeKind.CTRANSID:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.INO:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.SIZE:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.MODE:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.UID:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.GID:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.RDEV:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.CTIME:
-        return attr_header.kind, conv_time(attr_data)
-    elif attr_header.kind == AttributeKind.MTIME:
-        return attr_header.kind, conv_time(attr_data)
-    elif attr_header.kind == AttributeKind.ATIME:
-        return attr_header.kind, conv_time(attr_data)
-    elif attr_header.kind == AttributeKind.XATTR_NAME:
-        return attr_header.kind, attr_data
-    elif attr_header.kind == AttributeKind.XATTR_DATA:
-        return attr_header.kind, attr_data
-    elif attr_header.kind == AttributeKind.PATH:
-        return attr_header.kind, os.path.normpath(attr_data)
-    elif attr_header.kind == AttributeKind.PATH_TO:
-        return attr_header.kind, os.path.normpath(attr_data)
-    elif attr_header.kind == AttributeKind.PATH_LINK:
-        # NB This is NOT normalized since we don't want to normalize symlinks
-        return attr_header.kind, attr_data
-    elif attr_header.kind == AttributeKind.FILE_OFFSET:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.DATA:
-        return attr_header.kind, attr_data
-    elif attr_header.kind == AttributeKind.CLONE_UUID:
-        return attr_header.kind, conv_uuid(attr_data)
-    elif attr_header.kind == AttributeKind.CLONE_CTRANSID:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.CLONE_PATH:
-        return attr_header.kind, os.path.normpath(attr_data)
-    elif attr_header.kind == AttributeKind.CLONE_OFFSET:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.CLONE_LEN:
-        return attr_header.kind, conv_uint64(attr_data)
-
-    raise RuntimeError(f'Fix me: unhandled {attr_header}')  # pragma: no cover
-
-
-def read_command(infile):
-    cmd_header = CommandHeader.from_file(infile)
 
+# A command to check: its stream offset, raw header fields, and body.
+_CrcCheck = Tuple[int, int, int, int, bytes]
+
+
+def _find_bad_crcs(checks: List[_CrcCheck]) -> List[Tuple[_CrcCheck, int]]:
+    'Runs on worker processes. Returns the failed checks & their real CRCs.'
+    bad = []
+    for check in checks:
+        _pos, length, cmd_type, crc, body = check
+        # The CRC covers the header with its `crc` field zeroed.
+        actual = crc32c(body, crc32c(_COMMAND_HEADER.pack(length, cmd_type, 0)))
+        if actual != crc:
+            bad.append((check, actual))
+    return bad
+
+
+class _CrcVerifier:
+    '''
+    Accumulates commands into batches of ~`batch_bytes`, and checks each
+    full batch on a process pool, keeping a bounded number of batches in
+    flight.  The pool only starts once the first batch fills up, so small
+    send-streams are checked in-process by `finish()`.
+    '''
+
+    def __init__(self, *, batch_bytes: int = 2 ** 20, max_workers=None):
+        self._batch_bytes = batch_bytes
+        self._max_workers = max_workers or os.cpu_count() or 1
+        self._pool = None
+        self._futures = deque()
+        self._batch = []
+        self._batch_size = 0
+
+    def add(self, pos: int, length: int, cmd_type: int, crc: int, body):
+        self._batch.append((pos, length, cmd_type, crc, bytes(body)))
+        self._batch_size += length
+        if self._batch_size < self._batch_bytes:
+            return
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self._max_workers)
+        self._futures.append(self._pool.submit(_find_bad_crcs, self._batch))
+        self._batch = []
+        self._batch_size = 0
+        # Bound the memory held by pending batches.  This also surfaces
+        # errors before the entire stream is parsed.
+        while len(self._futures) > 2 * self._max_workers:
+            self._raise_if_bad(self._futures.popleft().result())
+
+    def finish(self) -> None:
+        'Raises if any command added so far had a bad CRC.'
+        self._raise_if_bad(_find_bad_crcs(self._batch))
+        self._batch = []
+        while self._futures:
+            self._raise_if_bad(self._futures.popleft().result())
+
+    def close(self) -> None:
+        if self._pool is not None:
+            # Not `cancel_futures=True`, which needs Python 3.9.
+            for future in self._futures:
+                future.cancel()
+            self._futures.clear()
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+    @staticmethod
+    def _raise_if_bad(bad) -> None:
+        if bad:
+            (pos, length, cmd_type, crc, _body), actual = bad[0]
+            cmd_header = _raw_to_command_header(length, cmd_type, crc)
+            raise RuntimeError(
+                f'{cmd_header} at offset {pos} has CRC32C {actual:#x}'
+            )
+
+
+def _read_command_body(
+    infile, cmd_header: CommandHeader, data_ref_base: int = None,
+    verifier: _CrcVerifier = None, pos: int = None, version: int = 1,
+):
     s = infile.read(cmd_header.length)
     if len(s) != cmd_header.length:
         raise RuntimeError(f'{cmd_header} got {len(s)} bytes')
-    # Future: pull in the `crc32c` module and check the CRC.
-
-    attr_bytes = BytesIO(s)
-    kind_to_attr = {}
-    while attr_bytes.tell() != len(s):
-        kind, attr = read_attribute(attr_bytes)
-        if kind in kind_to_attr:
-            raise RuntimeError(f'{kind} occurred twice in {cmd_header}')
-        kind_to_attr[kind] = attr
-
-    if cmd_header.kind == CommandKind.SUBVOL:
-        return SendStreamItems.subvol(
-            path=kind_to_attr[AttributeKind.PATH],
-            uuid=kind_to_attr[AttributeKind.UUID],
-            transid=kind_to_attr[AttributeKind.CTRANSID],
-        )
-    elif cmd_header.kind == CommandKind.SNAPSHOT:
-        return SendStreamItems.snapshot(
-            path=kind_to_attr[AttributeKind.PATH],
-            uuid=kind_to_attr[AttributeKind.UUID],
-            transid=kind_to_attr[AttributeKind.CTRANSID],
-            parent_uuid=kind_to_attr[AttributeKind.CLONE_UUID],
-            parent_transid=kind_to_attr[AttributeKind.CLONE_CTRANSID],
-        )
-    elif cmd_header.kind == CommandKind.MKFILE:
-        return SendStreamItems.mkfile(path=kind_to_attr[AttributeKind.PATH])
-    elif cmd_header.kind == CommandKind.MKDIR:
-        return SendStreamItems.mkdir(path=kind_to_attr[AttributeKind.PATH])
-    elif cmd_header.kind == CommandKind.MKNOD:
-        return SendStreamItems.mknod(
-            path=kind_to_attr[AttributeKind.PATH],
-            mode=kind_to_attr[AttributeKind.MODE],
-            dev=kind_to_attr[AttributeKind.RDEV],
-        )
-    elif cmd_header.kind == CommandKind.MKFIFO:
-        return SendStreamItems.mkfifo(path=kind_to_attr[AttributeKind.PATH])
-    elif cmd_header.kind == CommandKind.MKSOCK:
-        return SendStreamItems.mksock(path=kind_to_attr[AttributeKind.PATH])
-    elif cmd_header.kind == CommandKind.SYMLINK:
-        return SendStreamItems.symlink(
-            path=kind_to_attr[AttributeKind.PATH],
-            # NB Unlike the other `dest` attributes, we don't normalize this.
-            dest=os.path.normpath(kind_to_attr[AttributeKind.PATH_LINK]),
-        )
-    elif cmd_header.kind == CommandKind.RENAME:
-        return SendStreamItems.rename(
-            path=kind_to_attr[AttributeKind.PATH],
-            dest=kind_to_attr[AttributeKind.PATH_TO],
-        )
-    elif cmd_header.kind == CommandKind.LINK:
-        return SendStreamItems.link(
-            path=kind_to_attr[AttributeKind.PATH],
-            dest=os.path.normpath(kind_to_attr[AttributeKind.PATH_LINK]),
-        )
-    elif cmd_header.kind == CommandKind.UNLINK:
-        return SendStreamItems.unlink(path=kind_to_attr[AttributeKind.PATH])
-    elif cmd_header.kind == CommandKind.RMDIR:
-        return SendStreamItems.rmdir(path=kind_to_attr[AttributeKind.PATH])
-    elif cmd_header.kind == CommandKind.WRITE:
-        return SendStreamItems.write(
-            path=kind_to_attr[AttributeKind.PATH],
-            offset=kind_to_attr[AttributeKind.FILE_OFFSET],
-            data=kind_to_attr[AttributeKind.DATA],
-        )
-    elif cmd_header.kind == CommandKind.CLONE:
-        return SendStreamItems.clone(
-            path=kind_to_attr[AttributeKind.PATH],
-            offset=kind_to_attr[AttributeKind.FILE_OFFSET],
-            len=kind_to_attr[AttributeKind.CLONE_LEN],
-            from_uuid=kind_to_attr[AttributeKind.CLONE_UUID],
-            from_transid=kind_to_attr[AttributeKind.CLONE_CTRANSID],
-            from_path=kind_to_attr[AttributeKind.CLONE_PATH],
-            clone_offset=kind_to_attr[AttributeKind.CLONE_OFFSET],
-        )
-    elif cmd_header.kind == CommandKind.SET_XATTR:
-        return SendStreamItems.set_xattr(
-            path=kind_to_attr[AttributeKind.PATH],
-            name=kind_to_attr[AttributeKind.XATTR_NAME],
-            data=kind_to_attr[AttributeKind.XATTR_DATA],
-        )
-    elif cmd_header.kind == CommandKind.REMOVE_XATTR:
-        return SendStreamItems.remove_xattr(
-            path=kind_to_attr[AttributeKind.PATH],
-            name=kind_to_attr[AttributeKind.XATTR_NAME],
-        )
-    elif cmd_header.kind == CommandKind.TRUNCATE:
-        return SendStreamItems.truncate(
-            path=kind_to_attr[AttributeKind.PATH],
-            size=kind_to_attr[AttributeKind.SIZE],
-        )
-    elif cmd_header.kind == CommandKind.CHMOD:
-        return SendStreamItems.chmod(
-            path=kind_to_attr[AttributeKind.PATH],
-            mode=kind_to_attr[AttributeKind.MODE],
-        )
-    elif cmd_header.kind == CommandKind.CHOWN:
-        return SendStreamItems.chown(
-            path=kind_to_attr[AttributeKind.PATH],
-            uid=kind_to_attr[AttributeKind.UID],
-            gid=kind_to_attr[AttributeKind.GID],
-        )
-    elif cmd_header.kind == CommandKind.UTIMES:
-        return SendStreamItems.utimes(
-            path=kind_to_attr[AttributeKind.PATH],
-            ctime=kind_to_attr[AttributeKind.CTIME],
-            mtime=kind_to_attr[AttributeKind.MTIME],
-            atime=kind_to_attr[AttributeKind.ATIME],
-        )
-    elif cmd_header.kind == CommandKind.END:
-        return None
-    elif cmd_header.kind == CommandKind.UPDATE_EXTENT:
-        return SendStreamItems.update_extent(
-            path=kind_to_attr[AttributeKind.PATH],
-            offset=kind_to_attr[AttributeKind.FILE_OFFSET],
-            len=kind_to_attr[AttributeKind.SIZE],
+    if verifier is not None:
+        verifier.add(
+            pos, cmd_header.length, cmd_header.kind.value, cmd_header.crc, s,
         )
 
-    raise AssertionError(f'Fix me: unhandled {cmd_header}')  # pragma: no cover
+    return _decode_command(
+        memoryview(s), 0, cmd_header.length, cmd_header.kind.value,
+        cmd_header.crc, data_ref_base, version,
+    )
+
 
+def read_command(infile, *, version: int = 1):
+    return _read_command_body(
+        infile, CommandHeader.from_file(infile), version=version,
+    )
 
-def parse_send_stream(infile) -> Iterable[SendStreamItem]:
+
+def parse_send_stream(
+    infile, *, lazy_data: bool = False, verify_crc: bool = False,
+) -> Iterable[SendStreamItem]:
+    '''
+    With `lazy_data`, the `WriteDataRef` offsets count from the position
+    of `infile` when the parse started.  Each command body is still read
+    in full (a command is at most a few dozen KiB), but the bytes written
+    are dropped as soon as the command is decoded.
+    '''
+    check_magic(infile)
+    version = check_version(infile)
+    verifier = _CrcVerifier() if verify_crc else None
+    try:
+        pos = _STREAM_HEADER_SIZE
+        while True:
+            cmd_header = CommandHeader.from_file(infile)
+            cmd = _read_command_body(
+                infile, cmd_header,
+                pos + _COMMAND_HEADER.size if lazy_data else None,
+                verifier, pos, version,
+            )
+            if cmd is None:
+                if verifier is not None:
+                    verifier.finish()
+                return
+            yield cmd
+            pos += _COMMAND_HEADER.size + cmd_header.length
+    finally:
+        if verifier is not None:
+            verifier.close()
+
+
+_STREAM_HEADER_SIZE = len(BTRFS_SEND_STREAM_MAGIC) + _VERSION.size
+
+
+def _check_buffer_magic_and_version(view: memoryview) -> int:
+    magic = bytes(view[:len(BTRFS_SEND_STREAM_MAGIC)])
+    if magic != BTRFS_SEND_STREAM_MAGIC:
+        raise RuntimeError(f'Magic {magic}, not "{BTRFS_SEND_STREAM_MAGIC}"')
+    version, = _unpack_from(_VERSION, view, len(BTRFS_SEND_STREAM_MAGIC))
+    _check_version_number(version)
+    return version
+
+
+def parse_send_stream_buffer(
+    buf, *, lazy_data: bool = False, verify_crc: bool = False,
+) -> Iterable[SendStreamItem]:
+    '''
+    Yields the same items as `parse_send_stream`, but takes a bytes-like
+    object holding the entire send-stream.  Typical usage for files:
+
+        with open(path, 'rb') as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ,
+        ) as m:
+            for item in parse_send_stream_buffer(m):
+                ...
+
+    The generator holds a `memoryview` of `buf` until it is exhausted or
+    closed, so finish (or `.close()`) it before closing the `mmap`.
+
+    With `lazy_data`, `buf[ref.offset:ref.offset + ref.length]` gets the
+    bytes of any `WriteDataRef` -- no copy is made until then.
+    '''
+    verifier = _CrcVerifier() if verify_crc else None
+    try:
+        with memoryview(buf) as view:
+            version = _check_buffer_magic_and_version(view)
+            pos = _STREAM_HEADER_SIZE
+            while True:
+                length, cmd_type, crc = _unpack_from(
+                    _COMMAND_HEADER, view, pos,
+                )
+                pos += _COMMAND_HEADER.size
+                if pos + length > len(view):
+                    cmd_header = _raw_to_command_header(length, cmd_type, crc)
+                    raise RuntimeError(
+                        f'{cmd_header} got {len(view) - pos} bytes'
+                    )
+                if verifier is not None:
+                    verifier.add(
+                        pos - _COMMAND_HEADER.size, length, cmd_type, crc,
+                        view[pos:pos + length],
+                    )
+                cmd = _decode_command(
+                    view, pos, length, cmd_type, crc,
+                    0 if lazy_data else None, version,
+                )
+                if cmd is None:
+                    if verifier is not None:
+                        verifier.finish()
+                    return
+                yield cmd
+                pos += length
+    finally:
+        if verifier is not None:
+            verifier.close()
+
+
+def _kinds_to_item_makers(kinds: Iterable[CommandKind]):
+    '''
+    Maps the raw type of every known command to its item maker if it is
+    among `kinds`, or to `False` if it should be skipped.  END always maps
+    to `None`, so that scans know where to stop.
+    '''
+    types = {k.value for k in kinds}
+    return {
+        cmd_type: make_item if cmd_type in types or make_item is None
+            else False
+                for cmd_type, make_item in _COMMAND_TYPE_TO_ITEM_MAKER.items()
+    }
+
+
+def _check_command_type(cmd_type_to_maker, cmd_type: int):
+    try:
+        return cmd_type_to_maker[cmd_type]
+    except KeyError:
+        CommandKind(cmd_type)  # Raises `ValueError` for unknown commands
+        raise  # pragma: no cover
+
+
+def scan_send_stream(
+    infile, kinds: Iterable[CommandKind], *, lazy_data: bool = False,
+) -> Iterable[SendStreamItem]:
+    '''
+    Like `parse_send_stream`, but yields only the commands of the given
+    `kinds`.  For all other commands, we only read the 10-byte header, and
+    then seek past the body -- or, if `infile` is a pipe, read & discard it.
+    Use this to cheaply check if a large send-stream contains something.
+
+    Since skipped commands are never decoded, they are only validated as
+    far as their header goes.  CRCs are not checked.
+    '''
+    for _offset, item in scan_send_stream_offsets(
+        infile, kinds, lazy_data=lazy_data,
+    ):
+        yield item
+
+
+def scan_send_stream_offsets(
+    infile, kinds: Iterable[CommandKind], *, lazy_data: bool = False,
+) -> Iterable[Tuple[int, SendStreamItem]]:
+    '''
+    Like `scan_send_stream`, but yields `(offset, item)` pairs, where
+    `offset` locates the command in the stream for `read_command_at`.
+    '''
+    cmd_type_to_maker = _kinds_to_item_makers(kinds)
+    seekable = infile.seekable()
     check_magic(infile)
-    check_version(infile)
+    version = check_version(infile)
+    pos = _STREAM_HEADER_SIZE
     while True:
-        cmd = read_command(infile)
-        if cmd is None:
+        length, cmd_type, crc = file_unpack('<IHI', infile)
+        make_item = _check_command_type(cmd_type_to_maker, cmd_type)
+        if make_item is None:
             return
-        yield cmd
+        if make_item is False:
+            if seekable:
+                infile.seek(length, os.SEEK_CUR)
+            else:
+                got = len(infile.read(length))
+                if got != length:
+                    cmd_header = _raw_to_command_header(length, cmd_type, crc)
+                    raise RuntimeError(f'{cmd_header} got {got} bytes')
+        else:
+            yield pos, _read_command_body(
+                infile, _raw_to_command_header(length, cmd_type, crc),
+                pos + _COMMAND_HEADER.size if lazy_data else None,
+                version=version,
+            )
+        pos += _COMMAND_HEADER.size + length
+
+
+def read_command_at(
+    infile, offset: int, *, version: int, lazy_data: bool = False,
+) -> SendStreamItem:
+    '''
+    Decodes the command at `offset` in a seekable send-stream, as found by
+    `scan_send_stream_offsets`.  `version` is the send-stream's version.
+    '''
+    infile.seek(offset)
+    return _read_command_body(
+        infile, CommandHeader.from_file(infile),
+        offset + _COMMAND_HEADER.size if lazy_data else None,
+        version=version,
+    )
+
+
+def scan_send_stream_buffer(
+    buf, kinds: Iterable[CommandKind], *, lazy_data: bool = False,
+) -> Iterable[SendStreamItem]:
+    '''
+    `scan_send_stream` for buffers, see `parse_send_stream_buffer`.
+    '''
+    cmd_type_to_maker = _kinds_to_item_makers(kinds)
+    with memoryview(buf) as view:
+        version = _check_buffer_magic_and_version(view)
+        pos = _STREAM_HEADER_SIZE
+        while True:
+            length, cmd_type, crc = _unpack_from(_COMMAND_HEADER, view, pos)
+            pos += _COMMAND_HEADER.size
+            if pos + length > len(view):
+                cmd_header = _raw_to_command_header(length, cmd_type, crc)
+                raise RuntimeError(f'{cmd_header} got {len(view) - pos} bytes')
+            make_item = _check_command_type(cmd_type_to_maker, cmd_type)
+            if make_item is None:
+                return
+            if make_item is not False:
+                yield _decode_command(
+                    view, pos, length, cmd_type, crc,
+                    0 if lazy_data else None, version,
+                )
+            pos += length
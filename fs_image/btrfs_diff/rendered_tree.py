@@ -65,10 +65,10 @@ wraps only objects that occur more than once. For example, (ii) becomes:
  (ii) if 'a' and 'b' are the same inode:
       `['(Dir)': {'a': [['(File)', 0]], 'a': [['(File)', 0]]]`
 '''
-import os
 
 from typing import (
-    Any, Coroutine, Hashable, Mapping, NamedTuple, Optional, Tuple, Union,
+    Any, Coroutine, Hashable, Iterator, Mapping, NamedTuple, Optional, Tuple,
+    Union,
 )
 from itertools import count
 
@@ -77,20 +77,32 @@ from .coroutine_utils import while_not_exited
 RenderedTree = Union[Tuple[Any], Tuple[Any, Mapping[bytes, 'RenderedTree']]]
 
 
-def gather_bottom_up(
-    ser: RenderedTree,
-    *,
-    # Private, and NOT like the public `top_path` arg of `gather_bottom_up`.
-    # Not `bytes` since we `surrogateescape` everything at render time to
-    # let us produce JSON-friendly `utf-8`.
-    _path: str='.',
-) -> Coroutine[
+def _children_of(ser: RenderedTree) -> Optional[Iterator[Tuple[str, Any]]]:
+    'Validates `ser`, returns None for files, or the sorted children.'
+    if not isinstance(ser, list):
+        raise RuntimeError(f'Unknown type in rendered subvolume: {ser}')
+    elif len(ser) == 1:
+        return None
+    elif len(ser) != 2:
+        raise RuntimeError(f'Rendered inode list length != 1, 2: {ser}')
+    # Normally, we'd just get a 1-element list, but this is OK too.
+    if ser[1] is None:
+        return None
+    # Traverse children in the same order as `gather_bottom_up`, ensuring
+    # that in tests actual & expected traversal IDs agree.
+    return iter(sorted(ser[1].items()))
+
+
+def gather_bottom_up(ser: RenderedTree) -> Coroutine[
     Tuple[
-        bytes,  # full path to current inode
+        # Full path to current inode.  Not `bytes` since we
+        # `surrogateescape` everything at render time to let us produce
+        # JSON-friendly `utf-8`.
+        str,
         Any,  # the current inode
         # None for files. For directories, maps the names of the child
         # inodes to whatever result type they had sent us.
-        Optional[Mapping[bytes, Any]],
+        Optional[Mapping[str, Any]],
     ],  # yield
     Any,  # send -- whatever result type we are aggregating.
     Any,  # return -- the final result, whatever you sent for `top_path`
@@ -100,29 +112,33 @@ def gather_bottom_up(
     `Subvolume.render`.  This matches the traversal order of
     `Subvolume.gather_bottom_up`.  See that docblock for a discussion of the
     merits of traversal coroutines.
-    '''
-    if not isinstance(ser, list):
-        raise RuntimeError(f'Unknown type in rendered subvolume: {ser}')
-    elif len(ser) == 1:
-        return (yield _path, ser[0], None)
-    elif len(ser) != 2:
-        raise RuntimeError(f'Rendered inode list length != 1, 2: {ser}')
 
-    ino, children = ser
-    # Normally, we'd just get a 1-element list, but this is OK too.
-    if children is None:
-        child_results = None
-    else:
-        child_results = {}
-        # Traverse children in the same order as `gather_bottom_up`,
-        # ensuring that in tests actual & expected traversal IDs agree.
-        for name, child_ser in sorted(children.items()):
-            child_results[name] = (yield from gather_bottom_up(
-                child_ser,
-                # normpath to remove the leading ./
-                _path=os.path.normpath(os.path.join(_path, name)),
-            ))
-    return (yield (_path, ino, child_results))  # noqa: B901
+    Like `Subvolume.gather_bottom_up`, this uses an explicit stack, so it
+    works on arbitrarily deep trees.
+    '''
+    # Stack frames are `[name, path, ser, children, child_results]`.
+    children = _children_of(ser)
+    stack = [[None, '.', ser, children, None if children is None else {}]]
+    while True:
+        name, path, ser, children, child_results = stack[-1]
+        if children is not None:
+            child = next(children, None)
+            if child is not None:
+                child_name, child_ser = child
+                grandchildren = _children_of(child_ser)
+                stack.append([
+                    child_name,
+                    child_name if path == '.' else f'{path}/{child_name}',
+                    child_ser,
+                    grandchildren,
+                    None if grandchildren is None else {},
+                ])
+                continue
+        stack.pop()
+        result = yield (path, ser[0], child_results)
+        if not stack:
+            return result  # noqa: B901
+        stack[-1][4][name] = result
 
 
 def map_bottom_up(ser: RenderedTree, fn) -> RenderedTree:
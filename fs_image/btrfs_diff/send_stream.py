@@ -100,7 +100,7 @@ class SendStreamItems:
     #
 
     class write(metaclass=SendStreamItem):
-        fields = ['offset', 'data']
+        fields = ['offset', 'data']  # `data` is `bytes` or a `WriteDataRef`
 
     class clone(metaclass=SendStreamItem):
         fields = [
@@ -134,6 +134,74 @@ class SendStreamItems:
     class update_extent(metaclass=SendStreamItem):
         fields = ['offset', 'len']
 
+    #
+    # send-stream version 2
+    #
+
+    # Writes `unencoded_file_len` bytes at `offset`.  They start at
+    # `unencoded_offset` in the `unencoded_len` bytes that result from
+    # decoding `data` as per `compression` & `encryption`.
+    class encoded_write(metaclass=SendStreamItem):
+        fields = [
+            'offset',
+            'unencoded_file_len',
+            'unencoded_len',
+            'unencoded_offset',
+            'compression',
+            'encryption',
+            'data',  # `bytes` or a `WriteDataRef`
+        ]
+
+    # The arguments of `fallocate(2)`.
+    class fallocate(metaclass=SendStreamItem):
+        fields = ['mode', 'offset', 'len']
+
+    # `FS_IOC_SETFLAGS`-style inode flags, e.g. `FS_IMMUTABLE_FL`.
+    class fileattr(metaclass=SendStreamItem):
+        fields = ['attr']
+
+
+class WriteDataRef:
+    '''
+    With `lazy_data=True`, the send-stream parsers put one of these into
+    the `data` of `write` and `encoded_write` instead of the bytes, so that
+    analyzing a large send-stream does not hold its file contents in memory.
+
+    It records where the bytes live: `offset` counts from the start of the
+    send-stream (i.e. its magic).  Like `bytes`, it supports `len()`, which
+    is all that `IncompleteFile` needs.  Use `read()` to get the bytes.
+    '''
+    __slots__ = ('offset', 'length')
+
+    def __init__(self, *, offset: int, length: int):
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __eq__(self, other):
+        if not isinstance(other, WriteDataRef):
+            return NotImplemented
+        return (self.offset, self.length) == (other.offset, other.length)
+
+    def __hash__(self):
+        return hash((self.offset, self.length))
+
+    def __repr__(self):
+        return f'WriteDataRef(offset={self.offset}, length={self.length})'
+
+    def read(self, infile) -> bytes:
+        '''
+        `infile` must be a seekable binary file, in which the send-stream
+        starts at position 0.  Moves the file position.
+        '''
+        infile.seek(self.offset)
+        data = infile.read(self.length)
+        if len(data) != self.length:
+            raise RuntimeError(f'{self} got {len(data)} bytes')
+        return data
+
 
 def get_frequency_of_selinux_xattrs(items):
     'Returns {"xattr_value": <count>}. Useful for ItemFilters.selinux_xattr.'
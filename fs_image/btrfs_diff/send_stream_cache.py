@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+'''
+A compact, versioned binary form of parsed `SendStreamItems`, and an
+on-disk cache of parsed send-streams keyed by their content hash.
+
+Analyzing the same package repeatedly should not pay for re-parsing its
+send-stream every time:
+
+    items = parse_send_stream_cached(path, cache_dir)
+
+The first call parses the stream at `path` and stores the items under
+`cache_dir`, named by the SHA-256 of the stream.  Later calls just load
+the items, which is several times faster than `parse_send_stream`, and
+much faster than `parse_dump`.  The cache is safe to share between
+processes, and to delete at any time.
+
+`dump_items` and `load_items` work for any items, including those from
+`parse_dump` or from `lazy_data` parses.
+
+## Format
+
+All integers are little-endian.  After `_MAGIC` and `_HEADER` come three
+tables:
+
+ - Byte strings, each a u32 length & the bytes.  Items refer to them by
+   index, so repeated paths, xattrs, or data blocks are stored once.
+
+ - Signatures, each an item type name, followed by one "tag" character
+   per field, which says how that field is stored.  Types are recorded by
+   name, so that adding item types does not invalidate existing caches.
+
+ - Items, each a u16 signature index, followed by a `struct` that packs
+   the field values according to the signature's tags.  We decode each
+   item with a single `unpack_from`.
+
+Any change to this layout must bump `_FORMAT_VERSION`.
+'''
+import hashlib
+import operator
+import os
+import struct
+
+from typing import BinaryIO, Callable, Iterable, List, Tuple
+
+from .parse_send_stream import parse_send_stream
+from .send_stream import SendStreamItem, SendStreamItems, WriteDataRef
+
+_MAGIC = b'btrfs-diff-items\0'
+_FORMAT_VERSION = 1
+# format version, #byte strings, #signatures, #items
+_HEADER = struct.Struct('<IQIQ')
+_LENGTH = struct.Struct('<I')
+_SIGNATURE_HEADER = struct.Struct('<BB')  # type name length, #fields
+_SIGNATURE_INDEX = struct.Struct('<H')
+# How each kind of field value is packed into the item's `struct`.
+_TAG_TO_FORMAT = {
+    'b': 'I',  # `bytes`, as an index into the byte string table
+    'u': 'Q',  # non-negative `int`
+    'i': 'q',  # negative `int`
+    't': 'qI',  # time, as a (seconds, nanoseconds) tuple
+    'r': 'QQ',  # `WriteDataRef`
+    'n': '',  # `None`
+}
+_NAME_TO_ITEM_TYPE = {
+    k: t for k, t in SendStreamItems.__dict__.items() if k[0] != '_'
+}
+_HASH_CHUNK_SIZE = 2 ** 20
+
+
+def _tag_and_values(v) -> Tuple[str, tuple]:
+    'Returns the tag of the field value `v`, and what to pack for it.'
+    if isinstance(v, bytes):
+        return 'b', (v,)  # `dump_items` replaces this with the index
+    # `bool` is an `int`, but would not round-trip.
+    if isinstance(v, int) and not isinstance(v, bool):
+        return ('u' if v >= 0 else 'i'), (v,)
+    if isinstance(v, tuple) and len(v) == 2 and all(
+        type(t) is int for t in v
+    ):
+        return 't', v
+    if isinstance(v, WriteDataRef):
+        return 'r', (v.offset, v.length)
+    if v is None:
+        return 'n', ()
+    raise RuntimeError(f'Cannot serialize field value {repr(v)}')
+
+
+def dump_items(items: Iterable[SendStreamItem], outfile: BinaryIO) -> None:
+    bytes_to_idx = {}
+    signature_to_idx = {}
+    packed_items = []
+    for item in items:
+        tags = []
+        values = []
+        # Skip `DO_NOT_USE_type`, which enriched namedtuples add.
+        for v in item[1:]:
+            tag, vs = _tag_and_values(v)
+            tags.append(tag)
+            if tag == 'b':
+                vs = (bytes_to_idx.setdefault(v, len(bytes_to_idx)),)
+            values.extend(vs)
+        signature = (type(item).__name__, ''.join(tags))
+        sig_idx = signature_to_idx.setdefault(signature, len(signature_to_idx))
+        packed_items.append((sig_idx, values))
+
+    outfile.write(_MAGIC)
+    outfile.write(_HEADER.pack(
+        _FORMAT_VERSION, len(bytes_to_idx), len(signature_to_idx),
+        len(packed_items),
+    ))
+    for b in bytes_to_idx:  # Dicts preserve insertion order
+        outfile.write(_LENGTH.pack(len(b)))
+        outfile.write(b)
+    structs = []
+    for name, tags in signature_to_idx:
+        outfile.write(_SIGNATURE_HEADER.pack(len(name), len(tags)))
+        outfile.write(name.encode())
+        outfile.write(tags.encode())
+        structs.append(_signature_struct(tags))
+    for sig_idx, values in packed_items:
+        outfile.write(_SIGNATURE_INDEX.pack(sig_idx))
+        outfile.write(structs[sig_idx].pack(*values))
+
+
+def _get_none(values):
+    return None
+
+
+def _signature_struct(tags: str) -> struct.Struct:
+    return struct.Struct('<' + ''.join(_TAG_TO_FORMAT[t] for t in tags))
+
+
+def _make_item_maker(
+    name: str, tags: str, byte_strings: List[bytes],
+) -> Callable[[tuple], SendStreamItem]:
+    '''
+    Returns a function that turns the unpacked values of an item with this
+    signature into the item.
+    '''
+    item_type = _NAME_TO_ITEM_TYPE.get(name)
+    if item_type is None:
+        raise RuntimeError(f'Unknown item type {name}')
+    fields = item_type._fields[1:]  # Skip `DO_NOT_USE_type`
+    if len(fields) != len(tags):
+        raise RuntimeError(f'{name} has fields {fields}, but tags {tags}')
+    if any(t not in _TAG_TO_FORMAT for t in tags):
+        raise RuntimeError(f'{name} has bad tags {tags}')
+
+    # Each field's value is computed from the unpacked values by a getter.
+    getters = []
+    pos = 0
+    for field, tag in zip(fields, tags):
+        if tag == 'b':
+            getter = (lambda p: lambda vs: byte_strings[vs[p]])(pos)
+        elif tag == 't':
+            getter = operator.itemgetter(slice(pos, pos + 2))
+        elif tag == 'r':
+            getter = (lambda p: lambda vs: WriteDataRef(
+                offset=vs[p], length=vs[p + 1],
+            ))(pos)
+        elif tag == 'n':
+            getter = _get_none
+        else:
+            getter = operator.itemgetter(pos)
+        getters.append((field, getter))
+        pos += len(_TAG_TO_FORMAT[tag])
+
+    return lambda values: item_type(**{f: g(values) for f, g in getters})
+
+
+def load_items(infile: BinaryIO) -> List[SendStreamItem]:
+    'Reads the whole of `infile`, which was written by `dump_items`.'
+    view = memoryview(infile.read())
+    if view[:len(_MAGIC)] != _MAGIC:
+        raise RuntimeError(f'Magic {bytes(view[:len(_MAGIC)])}, not {_MAGIC}')
+    pos = len(_MAGIC)
+
+    def unpack(st):
+        nonlocal pos
+        if pos + st.size > len(view):
+            raise RuntimeError(
+                f'Send-stream items truncated: {pos + st.size} > {len(view)}'
+            )
+        values = st.unpack_from(view, pos)
+        pos += st.size
+        return values
+
+    def read_bytes(size):
+        nonlocal pos
+        if pos + size > len(view):
+            raise RuntimeError(
+                f'Send-stream items truncated: {pos + size} > {len(view)}'
+            )
+        b = bytes(view[pos:pos + size])
+        pos += size
+        return b
+
+    fmt_version, num_bytes, num_signatures, num_items = unpack(_HEADER)
+    if fmt_version != _FORMAT_VERSION:
+        raise RuntimeError(
+            f'Items format version {fmt_version} != {_FORMAT_VERSION}'
+        )
+    byte_strings = [read_bytes(*unpack(_LENGTH)) for _ in range(num_bytes)]
+    signatures = []
+    for _ in range(num_signatures):
+        name_len, num_tags = unpack(_SIGNATURE_HEADER)
+        name = read_bytes(name_len).decode()
+        tags = read_bytes(num_tags).decode()
+        make_item = _make_item_maker(name, tags, byte_strings)  # Validates
+        signatures.append((_signature_struct(tags), make_item))
+    # The hot loop, so `unpack` is inlined.
+    items = []
+    sig_idx_size = _SIGNATURE_INDEX.size
+    try:
+        for _ in range(num_items):
+            sig_idx, = _SIGNATURE_INDEX.unpack_from(view, pos)
+            st, make_item = signatures[sig_idx]
+            items.append(make_item(st.unpack_from(view, pos + sig_idx_size)))
+            pos += sig_idx_size + st.size
+    except struct.error as ex:
+        raise RuntimeError(f'Send-stream items truncated at {pos}') from ex
+    except IndexError as ex:  # Bad signature or byte string index
+        raise RuntimeError(f'Send-stream items corrupt at {pos}') from ex
+    if pos != len(view):
+        raise RuntimeError(f'{len(view) - pos} trailing bytes after items')
+    return items
+
+
+def content_hash(infile: BinaryIO) -> str:
+    'The hex SHA-256 of the rest of `infile`.'
+    h = hashlib.sha256()
+    for chunk in iter(lambda: infile.read(_HASH_CHUNK_SIZE), b''):
+        h.update(chunk)
+    return h.hexdigest()
+
+
+def load_or_parse_items(
+    path: bytes, cache_dir: bytes,
+    parse: Callable[[BinaryIO], Iterable[SendStreamItem]],
+    *, parser_id: str,
+) -> List[SendStreamItem]:
+    '''
+    Returns the items that `parse` makes from the file at `path`, from the
+    cache if possible.  `parser_id` is part of the cache key, and must
+    differ between parsers that may give different items for one input.
+    '''
+    with open(path, 'rb') as infile:
+        key = f'{content_hash(infile)}.{parser_id}'.encode()
+        cache_path = os.path.join(cache_dir, key)
+        try:
+            with open(cache_path, 'rb') as f:
+                return load_items(f)
+        except (OSError, RuntimeError, struct.error):
+            pass  # Parse below
+        infile.seek(0)
+        items = list(parse(infile))
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write-and-rename, so that concurrent readers never see partial files.
+    tmp_path = cache_path + b'.tmp' + str(os.getpid()).encode()
+    with open(tmp_path, 'wb') as f:
+        dump_items(items, f)
+    os.rename(tmp_path, cache_path)
+    return items
+
+
+def parse_send_stream_cached(
+    path: bytes, cache_dir: bytes, *, lazy_data: bool = False,
+) -> List[SendStreamItem]:
+    'A cached `parse_send_stream` of the file at `path`.'
+    return load_or_parse_items(
+        path, cache_dir,
+        lambda infile: parse_send_stream(infile, lazy_data=lazy_data),
+        parser_id='parse_send_stream' + ('-lazy_data' if lazy_data else ''),
+    )
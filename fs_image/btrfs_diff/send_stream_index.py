@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+'''
+A sidecar index for a send-stream file, which records the offset, kind,
+and touched paths of every command.  With it, finding the commands that
+affect a path costs O(matches) seeks, instead of a pass over the stream.
+
+Typical usage:
+
+    with open(path, 'rb') as f:
+        idx = load_or_build_index(path)
+        for item in idx.items_for_path(f, b'etc/passwd'):
+            ...
+
+The index is built with `scan_send_stream_offsets`, so making it costs one
+full parse.  Do it when the send-stream is produced, or let the first
+`load_or_build_index` do it.  The index records the SHA-256 of the
+send-stream, so checking that it is fresh costs a sequential read of the
+stream, but no parsing.
+
+"Touched paths" are the `path` of each item, and additionally the `dest`
+of `rename` & `link`, and the `from_path` of `clone`.  Send-streams refer
+to inodes only via paths, so to track an inode across names, follow the
+`rename` and `link` items that `items_for_path` returns.
+
+## Format
+
+All integers are little-endian.  `_HEADER` ends with the raw SHA-256 of
+the send-stream.  After `_MAGIC` and `_HEADER`, we store each path as a
+u16 length and its bytes, and then the 4 columns of the command table,
+each as a packed array: u64 offsets, u16 command types, and two u32 path
+IDs -- the second is `_NO_PATH` for most commands.
+'''
+import array
+import os
+import struct
+import sys
+
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .parse_send_stream import (
+    check_magic, check_version, CommandKind, read_command_at,
+    scan_send_stream_offsets,
+)
+from .send_stream import SendStreamItem, SendStreamItems
+from .send_stream_cache import content_hash
+
+_MAGIC = b'btrfs-diff-index\0'
+_FORMAT_VERSION = 2
+# format version, send-stream version, send-stream size, #paths, #commands,
+# send-stream SHA-256
+_HEADER = struct.Struct('<IIQQQ32s')
+_PATH_LENGTH = struct.Struct('<H')
+_NO_PATH = 0xffffffff
+# Which field of an item, if any, holds a second path.
+_ITEM_TYPE_TO_OTHER_PATH_FIELD = {
+    SendStreamItems.rename: 'dest',
+    SendStreamItems.link: 'dest',
+    SendStreamItems.clone: 'from_path',
+}
+_COLUMN_TYPECODES = ('Q', 'H', 'I', 'I')
+_SIDECAR_SUFFIX = b'.index'
+
+
+# Items are named after their commands.
+_ITEM_TYPE_TO_COMMAND_TYPE = {
+    getattr(SendStreamItems, kind.name.lower()): kind.value
+        for kind in CommandKind if kind != CommandKind.END
+}
+
+
+def _read_exactly(infile, size: int) -> bytes:
+    b = infile.read(size)
+    if len(b) != size:
+        raise RuntimeError(f'Send-stream index truncated: {size} > {len(b)}')
+    return b
+
+
+class SendStreamIndex:
+    '''
+    Make one via `build()` or `load()`.  The command table is stored as
+    columns of `array`s, since that is compact both in RAM and on disk.
+    '''
+
+    def __init__(
+        self, *, version: int, stream_size: int, stream_hash: bytes,
+        paths: Tuple[bytes, ...], offsets: array.array,
+        cmd_types: array.array, path_ids: array.array,
+        other_path_ids: array.array,
+    ):
+        self.version = version  # Of the indexed send-stream
+        self.stream_size = stream_size
+        # The SHA-256 of the send-stream lets us detect stale indexes.
+        self.stream_hash = stream_hash
+        self.paths = paths
+        # The columns of the command table
+        self.offsets = offsets
+        self.cmd_types = cmd_types
+        self.path_ids = path_ids
+        self.other_path_ids = other_path_ids
+        self._path_to_cmd_idxs = None  # Built on first query
+
+    def _columns(self):
+        return (
+            self.offsets, self.cmd_types, self.path_ids, self.other_path_ids,
+        )
+
+    def __eq__(self, other):
+        if not isinstance(other, SendStreamIndex):
+            return NotImplemented
+        return (
+            self.version, self.stream_size, self.stream_hash, self.paths,
+        ) == (
+            other.version, other.stream_size, other.stream_hash, other.paths,
+        ) and self._columns() == other._columns()
+
+    @classmethod
+    def build(cls, infile) -> 'SendStreamIndex':
+        '`infile` is a seekable send-stream, positioned at its start.'
+        start = infile.tell()
+        check_magic(infile)
+        version = check_version(infile)
+        infile.seek(start)
+
+        path_to_id = {}
+        columns = [array.array(t) for t in _COLUMN_TYPECODES]
+        offsets, cmd_types, path_ids, other_path_ids = columns
+        # We have to decode every command to learn its paths, but thanks to
+        # `lazy_data`, we do not keep the data in RAM.
+        for offset, item in scan_send_stream_offsets(
+            infile, CommandKind, lazy_data=True,
+        ):
+            offsets.append(offset)
+            cmd_types.append(_ITEM_TYPE_TO_COMMAND_TYPE[type(item)])
+            path_ids.append(path_to_id.setdefault(item.path, len(path_to_id)))
+            other_field = _ITEM_TYPE_TO_OTHER_PATH_FIELD.get(type(item))
+            other_path_ids.append(_NO_PATH if other_field is None else (
+                path_to_id.setdefault(
+                    getattr(item, other_field), len(path_to_id),
+                )
+            ))
+        infile.seek(start)
+        stream_hash = bytes.fromhex(content_hash(infile))
+        return cls(
+            version=version,
+            stream_size=infile.tell() - start,
+            stream_hash=stream_hash,
+            paths=tuple(path_to_id),
+            offsets=offsets,
+            cmd_types=cmd_types,
+            path_ids=path_ids,
+            other_path_ids=other_path_ids,
+        )
+
+    def dump(self, outfile) -> None:
+        outfile.write(_MAGIC)
+        outfile.write(_HEADER.pack(
+            _FORMAT_VERSION, self.version, self.stream_size, len(self.paths),
+            len(self.offsets), self.stream_hash,
+        ))
+        for path in self.paths:
+            outfile.write(_PATH_LENGTH.pack(len(path)))
+            outfile.write(path)
+        for column in self._columns():
+            if sys.byteorder == 'big':  # pragma: no cover
+                column = array.array(column.typecode, column)
+                column.byteswap()
+            outfile.write(column.tobytes())
+
+    @classmethod
+    def load(cls, infile) -> 'SendStreamIndex':
+        magic = infile.read(len(_MAGIC))
+        if magic != _MAGIC:
+            raise RuntimeError(f'Magic {magic}, not {_MAGIC}')
+        fmt_version, version, stream_size, num_paths, num_cmds, \
+            stream_hash = _HEADER.unpack(_read_exactly(infile, _HEADER.size))
+        if fmt_version != _FORMAT_VERSION:
+            raise RuntimeError(
+                f'Index format version {fmt_version} != {_FORMAT_VERSION}'
+            )
+        paths = []
+        for _ in range(num_paths):
+            length, = _PATH_LENGTH.unpack(
+                _read_exactly(infile, _PATH_LENGTH.size)
+            )
+            paths.append(_read_exactly(infile, length))
+        columns = []
+        for typecode in _COLUMN_TYPECODES:
+            column = array.array(typecode)
+            column.frombytes(_read_exactly(infile, column.itemsize * num_cmds))
+            if sys.byteorder == 'big':  # pragma: no cover
+                column.byteswap()
+            columns.append(column)
+        offsets, cmd_types, path_ids, other_path_ids = columns
+        return cls(
+            version=version,
+            stream_size=stream_size,
+            stream_hash=stream_hash,
+            paths=tuple(paths),
+            offsets=offsets,
+            cmd_types=cmd_types,
+            path_ids=path_ids,
+            other_path_ids=other_path_ids,
+        )
+
+    def _get_path_to_cmd_idxs(self) -> Dict[bytes, List[int]]:
+        if self._path_to_cmd_idxs is None:
+            path_id_to_cmd_idxs = defaultdict(list)
+            for cmd_idx, (path_id, other_path_id) in enumerate(
+                zip(self.path_ids, self.other_path_ids),
+            ):
+                path_id_to_cmd_idxs[path_id].append(cmd_idx)
+                if other_path_id not in (_NO_PATH, path_id):
+                    path_id_to_cmd_idxs[other_path_id].append(cmd_idx)
+            self._path_to_cmd_idxs = {
+                self.paths[path_id]: cmd_idxs
+                    for path_id, cmd_idxs in path_id_to_cmd_idxs.items()
+            }
+        return self._path_to_cmd_idxs
+
+    def offsets_for_path(
+        self, path: bytes, kinds: Optional[Iterable[CommandKind]] = None,
+    ) -> List[int]:
+        '''
+        The offsets of the commands touching `path`, in stream order.  If
+        `kinds` is set, only commands of those kinds are included.
+        '''
+        cmd_idxs = self._get_path_to_cmd_idxs().get(os.path.normpath(path), ())
+        if kinds is not None:
+            cmd_types = {k.value for k in kinds}
+            cmd_idxs = [i for i in cmd_idxs if self.cmd_types[i] in cmd_types]
+        return [self.offsets[i] for i in cmd_idxs]
+
+    def items_for_path(
+        self, infile, path: bytes,
+        kinds: Optional[Iterable[CommandKind]] = None,
+        *, lazy_data: bool = False,
+    ) -> Iterable[SendStreamItem]:
+        '''
+        Seeks to, and decodes, each command from `offsets_for_path`.
+        `infile` is the indexed send-stream, which starts at position 0.
+        '''
+        for offset in self.offsets_for_path(path, kinds):
+            yield read_command_at(
+                infile, offset, version=self.version, lazy_data=lazy_data,
+            )
+
+
+def load_or_build_index(stream_path: bytes) -> SendStreamIndex:
+    '''
+    Loads the sidecar index of the send-stream at `stream_path`.  If it is
+    missing, unreadable, or stale, builds & saves a new one.  An index is
+    stale unless it has the SHA-256 of the send-stream, since a rewritten
+    stream may keep its size, and even its mtime.
+    '''
+    index_path = stream_path + _SIDECAR_SUFFIX
+    with open(stream_path, 'rb') as f:
+        stream_hash = bytes.fromhex(content_hash(f))
+    try:
+        with open(index_path, 'rb') as f:
+            idx = SendStreamIndex.load(f)
+        if idx.stream_hash == stream_hash:
+            return idx
+    except (OSError, RuntimeError, struct.error):
+        pass  # Rebuild below
+    with open(stream_path, 'rb') as f:
+        idx = SendStreamIndex.build(f)
+    # Write-and-rename, so that concurrent readers never see partial files.
+    tmp_path = index_path + b'.tmp' + str(os.getpid()).encode()
+    try:
+        with open(tmp_path, 'wb') as f:
+            idx.dump(f)
+        os.rename(tmp_path, index_path)
+    finally:
+        # Only left behind if `dump` or `rename` failed.
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    return idx
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+'''
+Renders a `Subvolume` to JSON piece by piece, so that big subvolumes can
+be written out without first building their `RenderedTree`.
+
+`gen_rendered_json` yields the text of
+`json.dumps(emit_non_unique_traversal_ids(subvol.render()),
+sort_keys=True, indent=indent)`, and `gen_rendered_ndjson` yields one line
+per inode instead.  Both traverse the subvolume top-down, holding just the
+unvisited siblings of the current path, and a `TraversalIDMaker` entry
+per hardlinked inode.
+
+This works because of how `emit_non_unique_traversal_ids` numbers inodes:
+ - Only inodes with several paths get IDs, and their number of paths is
+   known from the `InodeIDMap` before the traversal starts.
+ - Directories cannot be hardlinked, so IDs only go on files.  Files are
+   leaves, and the top-down and bottom-up traversals visit the leaves in
+   the same order, so the IDs come out the same.  So do the IDs that
+   `extent_id_maker` gives to shared extents.
+
+Caveat: `sort_keys` orders the names of the children as `str`s, while we
+visit them in `bytes` order.  These agree unless some names are not valid
+UTF-8, in which case our output has the same content, but in a different
+key order.
+'''
+import json
+import os
+
+from typing import Any, Iterator, Mapping, NamedTuple, Optional
+
+from .inode import Inode
+from .inode_id import InodeID
+from .rendered_tree import TraversalIDMaker
+
+
+class _RenderedEntry(NamedTuple):
+    depth: int  # 0 for `top_path`
+    name: Optional[bytes]  # None for `top_path`
+    path: bytes
+    # Like the inodes of `emit_non_unique_traversal_ids`: `repr`, or
+    # `[repr, ID]` for hardlinked files.
+    value: Any
+    is_dir: bool
+
+
+def _path_counts(subvol: 'Subvolume', top_path: bytes) -> Mapping[int, int]:
+    'For each hardlinked inode, the number of its paths under `top_path`.'
+    top = os.path.normpath(top_path)
+    prefix = top + b'/'
+    inner = subvol.id_map.inner
+    path_counts = {}
+    for int_id, rev_entries in inner.id_to_reverse_entries.items():
+        if len(rev_entries) < 2:
+            continue  # Most inodes have one path, `gen_paths` is slower
+        path_counts[int_id] = sum(
+            top == b'.' or path == top or path.startswith(prefix)
+                for path in inner.gen_paths(
+                    InodeID(id=int_id, inner_id_map=inner)
+                )
+        )
+    return path_counts
+
+
+def _gen_entries(
+    subvol: 'Subvolume',
+    top_path: bytes,
+    extent_id_maker: Optional[TraversalIDMaker],
+) -> Iterator[_RenderedEntry]:
+    'Yields the inodes in pre-order, with the children in sorted order.'
+    if extent_id_maker is None:
+        extent_id_maker = TraversalIDMaker()
+    id_maker = TraversalIDMaker()
+    path_counts = _path_counts(subvol, top_path)
+    id_to_children = subvol.id_map.id_to_children
+
+    def render_extent_id(extent_id):
+        return extent_id_maker.next_with_nonce(extent_id).id
+
+    def render(int_id):
+        ino = subvol.id_to_inode[int_id]
+        value = ino.repr_with_extent_ids(render_extent_id) \
+            if isinstance(ino, Inode) else repr(ino)
+        if path_counts.get(int_id, 1) < 2:
+            return value
+        return [value, id_maker.next_with_nonce(int_id).id]
+
+    top = os.path.normpath(top_path)
+    stack = [(0, None, top, subvol.id_map.get_id(top_path).id)]
+    while stack:
+        depth, name, path, int_id = stack.pop()
+        name_to_child = id_to_children.get(int_id)
+        yield _RenderedEntry(
+            depth=depth,
+            name=name,
+            path=path,
+            value=render(int_id),
+            is_dir=name_to_child is not None,
+        )
+        if name_to_child is not None:
+            stack.extend(
+                (
+                    depth + 1,
+                    child_name,
+                    child_name if path == b'.' else path + b'/' + child_name,
+                    child_id,
+                ) for child_name, child_id in sorted(
+                    name_to_child.items(), reverse=True,
+                )
+            )
+
+
+def _decode(b: bytes) -> str:
+    return b.decode(errors='surrogateescape')
+
+
+def gen_rendered_json(
+    subvol: 'Subvolume', top_path: bytes=b'.', *,
+    extent_id_maker: Optional[TraversalIDMaker]=None,
+    indent: Optional[int]=None,
+    level: int=0,
+) -> Iterator[str]:
+    '''
+    Yields pieces of the JSON of the rendered `subvol`, see the docblock.
+    `extent_id_maker` and `indent` are as in `Subvolume.render` and
+    `json.dumps`.  With `indent`, the output is indented as if it were
+    nested `level` levels deep in a bigger JSON document.
+    '''
+    item_sep = ', ' if indent is None else ','
+
+    def newline(lvl):
+        return '' if indent is None else '\n' + ' ' * (indent * lvl)
+
+    def dumps(value, lvl):
+        return json.dumps(value, indent=indent).replace('\n', newline(lvl))
+
+    # For each open directory: whether we already wrote one of its children
+    open_dirs = []
+
+    def close_dir():
+        lvl = level + 2 * (len(open_dirs) - 1)
+        return (newline(lvl + 1) if open_dirs.pop() else '') + '}' + \
+            newline(lvl) + ']'
+
+    for entry in _gen_entries(subvol, top_path, extent_id_maker):
+        while len(open_dirs) > entry.depth:
+            yield close_dir()
+        lvl = level + 2 * entry.depth
+        if entry.name is not None:
+            yield (item_sep if open_dirs[-1] else '') + newline(lvl) + \
+                json.dumps(_decode(entry.name)) + ': '
+            open_dirs[-1] = True
+        yield '[' + newline(lvl + 1) + dumps(entry.value, lvl + 1)
+        if entry.is_dir:
+            yield item_sep + newline(lvl + 1) + '{'
+            open_dirs.append(False)
+        else:
+            yield newline(lvl) + ']'
+    while open_dirs:
+        yield close_dir()
+
+
+def gen_rendered_ndjson(
+    subvol: 'Subvolume', top_path: bytes=b'.', *,
+    extent_id_maker: Optional[TraversalIDMaker]=None,
+) -> Iterator[str]:
+    '''
+    Yields one line of JSON per inode of the rendered `subvol`, of the form
+    `[path, inode]`, where `inode` is as in `gen_rendered_json`.
+    Directories come before their children, and siblings are sorted.
+    '''
+    for entry in _gen_entries(subvol, top_path, extent_id_maker):
+        yield json.dumps([_decode(entry.path), entry.value]) + '\n'
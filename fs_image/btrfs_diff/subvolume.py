@@ -21,6 +21,20 @@ mutate its state.
   specified by the standard.
 
 - Maximum path lengths are not checked.
+
+## Placeholders
+
+An incremental send-stream only makes sense on top of its parent
+subvolume, which normally means applying every ancestor stream first.  A
+`Subvolume` with `placeholders=True` instead models the unknown parent
+lazily: whenever an item refers to a path that does not exist, we first
+make it, along with any missing ancestor directories.  Items that reveal
+the type of the path (e.g. `rmdir`, `write`) make an `IncompleteDir` or
+an `IncompleteFile`, the rest make an `IncompletePlaceholder`, whose
+type stays `Unknown` until a later item reveals it.  Placeholders have no
+metadata until the stream sets it, and files start out empty, so data
+that the stream does not write reads as holes.  Clones from subvolumes
+that we lack are modeled as writes of unknown data.
 '''
 import os
 
@@ -33,10 +47,12 @@ from typing import (
 from .coroutine_utils import while_not_exited
 from .extents_to_chunks import extents_to_chunks_with_clones
 from .freeze import freeze
+from .inode import Inode
 from .inode_id import InodeID, InodeIDMap
 from .incomplete_inode import (
     IncompleteDevice, IncompleteDir, IncompleteFifo, IncompleteFile,
-    IncompleteInode, IncompleteSocket, IncompleteSymlink,
+    IncompleteInode, IncompleteInodeMap, IncompletePlaceholder,
+    IncompleteSocket, IncompleteSymlink,
 )
 from .send_stream import SendStreamItem, SendStreamItems
 from .rendered_tree import RenderedTree, TraversalIDMaker
@@ -50,6 +66,16 @@ _DUMP_ITEM_TO_INCOMPLETE_INODE = {
     SendStreamItems.symlink: IncompleteSymlink,
 }
 
+# In `placeholders` mode, the target paths of these must be files.
+_FILE_DATA_ITEMS = (
+    SendStreamItems.clone,
+    SendStreamItems.encoded_write,
+    SendStreamItems.fallocate,
+    SendStreamItems.truncate,
+    SendStreamItems.update_extent,
+    SendStreamItems.write,
+)
+
 
 # Future: `deepfrozen` would let us lose the `new` methods on NamedTuples,
 # and avoid `deepcopy`.
@@ -58,14 +84,17 @@ class Subvolume(NamedTuple):
     Models a btrfs subvolume, knows how to apply SendStreamItem mutations
     to itself.
 
-    IMPORTANT: Keep this object correctly `deepcopy`able, we need that
-    for snapshotting. Notes:
+    `snapshot()` is O(1), since `id_map` and `id_to_inode` are built of
+    copy-on-write maps from `cow_map.py`.  Each snapshot copies a chunk
+    of inodes only when it first mutates one of them, which mutating an
+    `IncompleteInode` from `id_to_inode` takes care of.
+
+    IMPORTANT: Keep this object correctly `deepcopy`able for the sake of
+    tests. Notes:
 
       - `InodeIDMap` opaquely holds a `description`, which in practice
         is a `SubvolumeDescription` that is **NOT** safely `deepcopy`able
-        unless the whole `Volume` is being copied in one call.  For
-        single-volume snapshots, `SubvolumeSetMutator` has an icky
-        workaround :)
+        unless the whole `Volume` is being copied in one call.
 
       - The tests for `InodeIDMap` try to ensure that it is safely
         `deepcopy`able.  Changes to its members should be validated there.
@@ -87,21 +116,36 @@ class Subvolume(NamedTuple):
     # where a subvolume is mounted within a volume, but this does not
     # require us to share inodes across subvolumes.
     id_map: InodeIDMap
-    id_to_inode: Mapping[InodeID, Union[IncompleteInode, 'Inode']]
+    # Keyed by `InodeID.id`, since snapshots share this with their parent,
+    # whose `InodeID`s differ from ours.  Inode numbers are dense, so an
+    # `IncompleteInodeMap` stores them compactly.
+    id_to_inode: Mapping[int, Union[IncompleteInode, 'Inode']]
+    # Set when the parent of our send-stream is unknown, so that items make
+    # placeholders for the paths they refer to.  Snapshots inherit it, since
+    # their parent is incomplete, too.  See the module docblock.
+    placeholders: bool = False
 
     @classmethod
     def new(cls, *, id_map, **kwargs) -> 'Subvolume':
-        kwargs.setdefault('id_to_inode', {})
-        kwargs['id_to_inode'][id_map.get_id(b'.')] = IncompleteDir(
+        kwargs.setdefault('id_to_inode', IncompleteInodeMap())
+        kwargs['id_to_inode'][id_map.get_id(b'.').id] = IncompleteDir(
             item=SendStreamItems.mkdir(path=b'.'),
         )
         return cls(id_map=id_map, **kwargs)
 
+    def snapshot(self, *, description: Any='') -> 'Subvolume':
+        'Returns an independent copy of `self` in O(1).'
+        return type(self)(
+            id_map=self.id_map.snapshot(description=description),
+            id_to_inode=self.id_to_inode.copy(),
+            placeholders=self.placeholders,
+        )
+
     def inode_at_path(self, path: bytes) -> Optional[IncompleteInode]:
         id = self.id_map.get_id(path)
         # Using `[]` instead of `.get()` to assert that `id_to_inode`
         # remains a superset of `id_map`.  The converse is harder to check.
-        return None if id is None else self.id_to_inode[id]
+        return None if id is None else self.id_to_inode[id.id]
 
     def _require_inode_at_path(
         self, item: SendStreamItem, path: bytes,
@@ -113,10 +157,101 @@ class Subvolume(NamedTuple):
 
     def _delete(self, path):
         ino_id = self.id_map.remove_path(path)
-        if not self.id_map.get_paths(ino_id):
-            del self.id_to_inode[ino_id]
+        if not self.id_map.has_paths(ino_id):
+            del self.id_to_inode[ino_id.id]
+
+    def _add_placeholder(
+        self, item: SendStreamItem, path: bytes, inode_class: Optional[type],
+    ) -> None:
+        '''
+        Makes sure that the ancestor directories of `path` exist, and
+        unless `inode_class` is None, `path` itself.  A new path, or an
+        `IncompletePlaceholder`, becomes an `inode_class`.  Otherwise,
+        `apply_item` checks its type as usual.
+        '''
+        parts = os.path.normpath(path).split(b'/')
+        if parts == [b'.']:
+            return  # The root always exists
+        # Ancestors first, since `get_id` fails if one of them is a file.
+        for i in range(1, len(parts)):
+            self._add_placeholder_inode(
+                item, b'/'.join(parts[:i]), IncompleteDir,
+            )
+        if inode_class is not None:
+            self._add_placeholder_inode(item, path, inode_class)
+
+    def _add_placeholder_inode(
+        self, item: SendStreamItem, path: bytes, inode_class: type,
+    ) -> None:
+        ino_id = self.id_map.get_id(path)
+        old_ino = None if ino_id is None else self.id_to_inode[ino_id.id]
+        if old_ino is not None and (
+            inode_class is IncompletePlaceholder
+            or not isinstance(old_ino, IncompletePlaceholder)
+        ):
+            return
+        ino = inode_class(
+            item=item if inode_class is IncompletePlaceholder
+                else inode_class.INITIAL_ITEM(path=path),
+        )
+        if old_ino is None:
+            ino_id = self.id_map.next()
+            if inode_class is IncompleteDir:
+                self.id_map.add_dir(ino_id, path)
+            else:
+                self.id_map.add_file(ino_id, path)
+        else:  # `item` revealed the type of the placeholder
+            ino.mode = old_ino.mode
+            ino.owner = old_ino.owner
+            ino.utimes = old_ino.utimes
+            ino._xattrs = old_ino._xattrs  # Never mutated, so share it
+            if inode_class is IncompleteDir:
+                if len(self.id_map.get_paths(ino_id)) > 1:
+                    raise RuntimeError(
+                        f'Cannot apply {item}, {path} is hardlinked, so it '
+                        'is not a directory'
+                    )
+                # The ID map only lets a path without children change type.
+                self.id_map.remove_path(path)
+                self.id_map.add_dir(ino_id, path)
+        self.id_to_inode[ino_id.id] = ino
+
+    def _add_placeholders(self, item: SendStreamItem) -> None:
+        'In `placeholders` mode, adds the paths that `item` expects.'
+        if isinstance(item, tuple(_DUMP_ITEM_TO_INCOMPLETE_INODE)):
+            self._add_placeholder(item, item.path, None)
+        elif isinstance(item, SendStreamItems.rename):
+            self._add_placeholder(item, item.path, IncompletePlaceholder)
+            self._add_placeholder(item, item.dest, None)
+            # Only a directory may replace a directory.
+            dest_ino = self.inode_at_path(item.dest)
+            if dest_ino is not None:
+                if isinstance(dest_ino, IncompleteDir):
+                    self._add_placeholder(item, item.path, IncompleteDir)
+                elif isinstance(self.inode_at_path(item.path), IncompleteDir):
+                    self._add_placeholder(item, item.dest, IncompleteDir)
+        elif isinstance(item, SendStreamItems.link):
+            self._add_placeholder(item, item.dest, IncompletePlaceholder)
+            self._add_placeholder(item, item.path, None)
+        elif isinstance(item, SendStreamItems.rmdir):
+            self._add_placeholder(item, item.path, IncompleteDir)
+        elif isinstance(item, _FILE_DATA_ITEMS):
+            self._add_placeholder(item, item.path, IncompleteFile)
+        else:
+            self._add_placeholder(item, item.path, IncompletePlaceholder)
+            if isinstance(item, SendStreamItems.remove_xattr) and (
+                item.name not in self.inode_at_path(item.path).xattrs
+            ):
+                # The parent had it, we just did not know its value.
+                self._require_inode_at_path(item, item.path).apply_item(
+                    SendStreamItems.set_xattr(
+                        path=item.path, name=item.name, data=b'',
+                    ),
+                )
 
     def apply_item(self, item: SendStreamItem) -> None:
+        if self.placeholders:
+            self._add_placeholders(item)
         for item_type, inode_class in _DUMP_ITEM_TO_INCOMPLETE_INODE.items():
             if isinstance(item, item_type):
                 ino_id = self.id_map.next()
@@ -124,8 +259,8 @@ class Subvolume(NamedTuple):
                     self.id_map.add_dir(ino_id, item.path)
                 else:
                     self.id_map.add_file(ino_id, item.path)
-                assert ino_id not in self.id_to_inode
-                self.id_to_inode[ino_id] = inode_class(item=item)
+                assert ino_id.id not in self.id_to_inode
+                self.id_to_inode[ino_id.id] = inode_class(item=item)
                 return  # Done applying item
 
         if isinstance(item, SendStreamItems.rename):
@@ -147,15 +282,15 @@ class Subvolume(NamedTuple):
                 return
 
             # Overwrite an existing path.
-            if isinstance(self.id_to_inode[old_id], IncompleteDir):
-                new_ino = self.id_to_inode[new_id]
+            if isinstance(self.id_to_inode[old_id.id], IncompleteDir):
+                new_ino = self.id_to_inode[new_id.id]
                 # _delete() below will ensure that the destination is empty
                 if not isinstance(new_ino, IncompleteDir):
                     raise RuntimeError(
                         f'{item} cannot overwrite {new_ino}, since a '
                         'directory may only overwrite an empty directory'
                     )
-            elif isinstance(self.id_to_inode[new_id], IncompleteDir):
+            elif isinstance(self.id_to_inode[new_id.id], IncompleteDir):
                 raise RuntimeError(
                     f'{item} cannot overwrite a directory with a non-directory'
                 )
@@ -177,7 +312,7 @@ class Subvolume(NamedTuple):
             old_id = self.id_map.get_id(item.dest)
             if old_id is None:
                 raise RuntimeError(f'{item} source does not exist')
-            if isinstance(self.id_to_inode[old_id], IncompleteDir):
+            if isinstance(self.id_to_inode[old_id.id], IncompleteDir):
                 raise RuntimeError(f'Cannot {item} a directory')
             self.id_map.add_file(old_id, item.path)
         else:  # Any other operation must be handled at inode scope.
@@ -190,28 +325,43 @@ class Subvolume(NamedTuple):
         self, item: SendStreamItems.clone, from_subvol: 'Subvolume',
     ):
         assert isinstance(item, SendStreamItems.clone)
+        if self.placeholders:
+            self._add_placeholders(item)
+        if from_subvol.placeholders:
+            from_subvol._add_placeholder(item, item.from_path, IncompleteFile)
+            from_ino = from_subvol._require_inode_at_path(item, item.from_path)
+            # The parent's file was at least long enough for the clone.
+            end = item.clone_offset + item.len
+            if isinstance(from_ino, IncompleteFile) and (
+                from_ino.extent.length < end
+            ):
+                from_ino.extent = from_ino.extent.truncate(length=end)
         return self._require_inode_at_path(item, item.path).apply_clone(
             item, from_subvol._require_inode_at_path(item, item.from_path),
         )
 
     # Exposed as a method for the benefit of `SubvolumeSet`.
     def _inode_ids_and_extents(self):
+        inner = self.id_map.inner
         for id, ino in self.id_to_inode.items():
             if hasattr(ino, 'extent'):
-                yield (id, ino.extent)
+                yield (InodeID(id=id, inner_id_map=inner), ino.extent)
 
     def freeze(
         self,
         *,
         _memo,
         id_to_chunks: Optional[Mapping[InodeID, Sequence['Chunk']]]=None,
+        shared_extents: bool=False,
     ):
         '''
         Returns a recursively immutable copy of `self`, replacing
         `IncompleteInode`s by `Inode`s, using the provided `id_to_chunks` to
         populate them with `Chunk`s instead of `Extent`s.
 
-        If `id_to_chunks` is omitted, we'll detect clones only within `self`.
+        If `id_to_chunks` is omitted, we'll detect clones only within `self`,
+        representing them as per `shared_extents`, which has the meaning
+        documented in `extents_to_chunks_with_clones`.
 
         IMPORTANT: Our lookups assume that the `id_to_chunks` has the
         pre-`freeze` variants of the `InodeID`s.
@@ -219,14 +369,16 @@ class Subvolume(NamedTuple):
         if id_to_chunks is None:
             id_to_chunks = dict(extents_to_chunks_with_clones(
                 list(self._inode_ids_and_extents()),
+                shared_extents=shared_extents,
             ))
         return type(self)(
             id_map=freeze(self.id_map, _memo=_memo),
             id_to_inode=MappingProxyType({
-                freeze(id, _memo=_memo):
-                        freeze(ino, _memo=_memo, chunks=id_to_chunks.get(id))
-                    for id, ino in self.id_to_inode.items()
+                id: freeze(ino, _memo=_memo, chunks=id_to_chunks.get(
+                    InodeID(id=id, inner_id_map=self.id_map.inner),
+                )) for id, ino in self.id_to_inode.items()
             }),
+            placeholders=self.placeholders,
         )
 
     def inodes(self) -> Iterator[Union['Inode', 'IncompleteInode']]:
@@ -251,8 +403,9 @@ class Subvolume(NamedTuple):
         Works on both frozen and unfrozen `Subvolume`s, you will
         correspondingly get the `Inode` or the `IncompleteInode`.
 
-        Hardlinked files will get visited multiple times. The client can
-        alway keep a map keyed on `id(ino)` to handle this.  We purposely do
+        Hardlinked files will get visited multiple times, as the same
+        object. The client can alway keep a map keyed on `id(ino)` to
+        handle this.  We purposely do
         not expose `InodeID`.  A big reason to hide it is that `InodeID`s
         depend on the sequence of send-stream items that constructed the
         filesystem.  This is a problem, because one would expect a
@@ -285,22 +438,51 @@ class Subvolume(NamedTuple):
 
         See also: `rendered_tree.gather_bottom_up()`
         '''
-        ino_id = self.id_map.get_id(top_path)
-        child_paths = self.id_map.get_children(ino_id)
-        # While I'd love the next code to be a single expression using a
-        # dictionary comprehension, Python does not allow `yield` inside
-        # comprehensions.  See https://stackoverflow.com/questions/32139885
-        if child_paths is None:
-            child_results = None
-        else:
-            child_results = {}
-            for child_path in sorted(child_paths):
-                child_results[os.path.relpath(child_path, top_path)] = (
-                    yield from self.gather_bottom_up(child_path)
-                )
-        return (  # noqa: B901
-            yield (top_path, self.id_to_inode[ino_id], child_results)
-        )
+        # This is iterative, since a recursive coroutine would hit the stack
+        # limit on deep trees, and since each `yield` would have to pass
+        # through every `yield from` between it and the root.
+        #
+        # Stack frames are `[name, path, int_id, children, child_results]`,
+        # where `children` iterates over the sorted `(name, int_id)` pairs
+        # that remain to be visited, and is None for files.
+        id_to_children = self.id_map.id_to_children
+        # `id_to_inode` makes a new view per lookup, so keep the ones we
+        # yielded, to give hardlinks the same object, with a stable `id()`.
+        id_to_ino = {}
+
+        def make_frame(name, path, int_id):
+            name_to_child = id_to_children.get(int_id)
+            if name_to_child is None:
+                return [name, path, int_id, None, None]
+            # Sorting by name is the same as sorting by path.
+            children = iter(sorted(name_to_child.items()))
+            return [name, path, int_id, children, {}]
+
+        stack = [make_frame(None, top_path, self.id_map.get_id(top_path).id)]
+        top_prefix = os.path.normpath(top_path)
+        while True:
+            name, path, int_id, children, child_results = stack[-1]
+            if children is not None:
+                child = next(children, None)
+                if child is not None:
+                    child_name, child_id = child
+                    if len(stack) == 1:  # `top_path` may be unnormalized
+                        path = top_prefix
+                    stack.append(make_frame(
+                        child_name,
+                        child_name if path == b'.'
+                            else path + b'/' + child_name,
+                        child_id,
+                    ))
+                    continue
+            stack.pop()
+            ino = id_to_ino.get(int_id)
+            if ino is None:
+                ino = id_to_ino[int_id] = self.id_to_inode[int_id]
+            result = yield (path, ino, child_results)
+            if not stack:
+                return result  # noqa: B901
+            stack[-1][4][name] = result
 
     def map_bottom_up(self, fn, top_path=b'.') -> RenderedTree:
         '''
@@ -321,15 +503,32 @@ class Subvolume(NamedTuple):
                 }]
         return ctx.result
 
-    def render(self, top_path=b'.') -> RenderedTree:
+    def render(
+        self, top_path=b'.', *,
+        extent_id_maker: Optional[TraversalIDMaker]=None,
+    ) -> RenderedTree:
         '''
         Produces a JSON-friendly plain-old-data view of the Subvolume.
         Before this is actually JSON-ready, you will need to call one of the
         `emit_*_traversal_ids` functions.  Read the docblock of
         `rendered_tree.py` for more details.
+
+        Shared extents (see `extents_to_chunks.py`) are numbered in
+        traversal order by `extent_id_maker`.  To get consistent numbers
+        across the subvolumes of a `SubvolumeSet`, render all of them with
+        the same maker.
         '''
         id_maker = TraversalIDMaker()
+        if extent_id_maker is None:
+            extent_id_maker = TraversalIDMaker()
+
+        def render_extent_id(extent_id):
+            return extent_id_maker.next_with_nonce(extent_id).id
+
         return self.map_bottom_up(
-            lambda ino: id_maker.next_with_nonce(id(ino)).wrap(repr(ino)),
+            lambda ino: id_maker.next_with_nonce(id(ino)).wrap(
+                ino.repr_with_extent_ids(render_extent_id)
+                    if isinstance(ino, Inode) else repr(ino)
+            ),
             top_path=top_path,
         )
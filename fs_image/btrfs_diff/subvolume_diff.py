@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+'''
+Compares two frozen `Subvolume`s, such as consecutive layers of an image,
+and reports which paths were added, removed, or modified.
+
+`subtree_digests` hashes a subvolume bottom-up, so that the digest of a
+directory covers its whole subtree.  `diff_subvolumes` walks both trees
+from the root, and skips each directory whose digests match without
+looking inside it.  Computing digests is O(N), but you can reuse them:
+to compare a chain of N layers, digest each layer once, not twice.
+
+We compare paths, not `InodeID`s, since subvolumes that were built
+independently number their inodes differently.  A hardlinked inode is
+compared once per path.
+
+Our model does not record the bytes of files, only how they are laid out
+into `Chunk`s.  So, "data changes" are changes in the sequence of chunks:
+their kinds, lengths, and clones.  Clone sources are compared by their
+paths.  Shared extents (see `extents_to_chunks.py`) are compared by their
+offsets and lengths, since their IDs only make sense within one `freeze`.
+'''
+import enum
+import hashlib
+
+from typing import Any, Iterator, Mapping, NamedTuple, Optional, Tuple
+
+from .coroutine_utils import while_not_exited
+from .inode import Chunk, Clone, Inode
+
+
+class SubtreeDigest(NamedTuple):
+    digest: bytes  # Covers the inode, and the subtree of a directory
+    inode: Inode
+    # None for files. For directories, maps the names of the children to
+    # their digests, in sorted order.
+    children: Optional[Mapping[bytes, 'SubtreeDigest']]
+
+
+class InodeDiff(NamedTuple):
+    class Kind(enum.Enum):
+        ADDED = 'added'
+        REMOVED = 'removed'
+        MODIFIED = 'modified'
+
+        def __repr__(self):
+            return self.name
+
+    kind: 'InodeDiff.Kind'
+    path: bytes
+    old: Optional[Inode]  # None if ADDED
+    new: Optional[Inode]  # None if REMOVED
+    # For MODIFIED: the `Inode` fields that differ, in declaration order.
+    changed_fields: Tuple[str, ...] = ()
+    # For MODIFIED files whose `chunks` differ: the sorted, disjoint
+    # `(offset, length)` byte ranges where the chunks of `old` and `new`
+    # differ, covering the data of both.
+    changed_ranges: Tuple[Tuple[int, int], ...] = ()
+
+
+def _clone_key(clone: Clone) -> Tuple[Any, ...]:
+    return (
+        tuple(sorted(clone.inode_id.inner_id_map.gen_paths(clone.inode_id))),
+        clone.offset,
+        clone.length,
+    )
+
+
+def _chunk_key(chunk: Chunk) -> Tuple[Any, ...]:
+    return (
+        chunk.kind.name,
+        chunk.length,
+        tuple(sorted(
+            (cc.offset, _clone_key(cc.clone)) for cc in chunk.chunk_clones
+        )),
+        tuple(
+            (se.offset, se.length, se.extent_offset)
+                for se in chunk.shared_extents
+        ),
+    )
+
+
+def _field_keys(ino: Inode) -> Tuple[Any, ...]:
+    '''
+    Comparable, plain-data versions of the fields of `ino`, which also
+    have a lossless `repr` -- unlike, say, `InodeUtimes`.
+    '''
+    if not isinstance(ino, Inode):
+        raise TypeError(f'Can only diff frozen subvolumes, got {ino}')
+    return (
+        ino.file_type,
+        ino.mode,
+        None if ino.owner is None else tuple(ino.owner),
+        None if ino.utimes is None else tuple(ino.utimes),
+        tuple(sorted(ino.xattrs.items())),
+        None if ino.chunks is None
+            else tuple(_chunk_key(c) for c in ino.chunks),
+        ino.dev,
+        ino.dest,
+    )
+
+
+def subtree_digests(subvol: 'Subvolume', top_path=b'.') -> SubtreeDigest:
+    '''
+    Hashes the frozen `subvol` from `top_path` down.  Pass the result to
+    `diff_subvolumes` to reuse it across comparisons.
+    '''
+    ino_to_digest = {}  # Hash hardlinked files just once
+    with while_not_exited(subvol.gather_bottom_up(top_path)) as ctx:
+        result = None
+        while True:
+            _path, ino, child_results = ctx.send(result)
+            if child_results is None:
+                digest = ino_to_digest.get(id(ino))
+                if digest is None:
+                    digest = ino_to_digest[id(ino)] = hashlib.blake2b(
+                        repr(_field_keys(ino)).encode(), digest_size=16,
+                    ).digest()
+            else:
+                h = hashlib.blake2b(
+                    repr(_field_keys(ino)).encode(), digest_size=16,
+                )
+                # `gather_bottom_up` visits the children in sorted order.
+                for name, child in child_results.items():
+                    h.update(repr((name, child.digest)).encode())
+                digest = h.digest()
+            result = SubtreeDigest(
+                digest=digest, inode=ino, children=child_results,
+            )
+    return ctx.result
+
+
+def _child_path(path: bytes, name: bytes) -> bytes:
+    return name if path == b'.' else path + b'/' + name
+
+
+def _gen_subtree(
+    kind: InodeDiff.Kind, path: bytes, top: SubtreeDigest,
+) -> Iterator[InodeDiff]:
+    'Every inode under `top` was added or removed, parents come first.'
+    stack = [(path, top)]
+    while stack:
+        path, node = stack.pop()
+        yield InodeDiff(
+            kind=kind,
+            path=path,
+            old=node.inode if kind == InodeDiff.Kind.REMOVED else None,
+            new=node.inode if kind == InodeDiff.Kind.ADDED else None,
+        )
+        if node.children:
+            stack.extend(
+                (_child_path(path, name), child) for name, child in sorted(
+                    node.children.items(), reverse=True,
+                )
+            )
+
+
+def _changed_ranges(old_chunks, new_chunks) -> Tuple[Tuple[int, int], ...]:
+    def offset_keys(chunks):
+        offset = 0
+        for chunk in chunks:
+            yield offset, chunk.length, _chunk_key(chunk)
+            offset += chunk.length
+
+    old_set = set(offset_keys(old_chunks or ()))
+    new_set = set(offset_keys(new_chunks or ()))
+    ranges = []
+    for offset, length, _key in sorted(old_set ^ new_set):
+        if ranges and offset <= ranges[-1][0] + ranges[-1][1]:
+            prev_offset, prev_length = ranges[-1]
+            ranges[-1] = (
+                prev_offset,
+                max(prev_length, offset + length - prev_offset),
+            )
+        else:
+            ranges.append((offset, length))
+    return tuple(ranges)
+
+
+def _modified(path: bytes, old: Inode, new: Inode) -> Optional[InodeDiff]:
+    changed_fields = tuple(
+        field for field, old_key, new_key in zip(
+            Inode._fields, _field_keys(old), _field_keys(new),
+        ) if old_key != new_key
+    )
+    if not changed_fields:
+        return None
+    return InodeDiff(
+        kind=InodeDiff.Kind.MODIFIED,
+        path=path,
+        old=old,
+        new=new,
+        changed_fields=changed_fields,
+        changed_ranges=_changed_ranges(old.chunks, new.chunks)
+            if 'chunks' in changed_fields else (),
+    )
+
+
+def diff_subvolumes(
+    old: 'Subvolume',
+    new: 'Subvolume',
+    *,
+    old_digests: Optional[SubtreeDigest]=None,
+    new_digests: Optional[SubtreeDigest]=None,
+) -> Iterator[InodeDiff]:
+    '''
+    Yields the differences from the frozen `old` to the frozen `new`, with
+    paths in pre-order, and siblings sorted by name.  So, `a/b` comes
+    before `a-c`, even though bytewise, `a-c` sorts first.
+
+    Added and removed directories yield an entry for each inode in their
+    subtree.  A path that changes from a directory to a non-directory, or
+    vice-versa, is first REMOVED and then ADDED.  Any other change to the
+    inode at a path is MODIFIED.
+
+    Pass `old_digests` or `new_digests` to reuse the result of a prior
+    `subtree_digests` call on that subvolume.
+    '''
+    if old_digests is None:
+        old_digests = subtree_digests(old)
+    if new_digests is None:
+        new_digests = subtree_digests(new)
+    stack = [(b'.', old_digests, new_digests)]
+    while stack:
+        path, old_node, new_node = stack.pop()
+        if old_node is None:
+            yield from _gen_subtree(InodeDiff.Kind.ADDED, path, new_node)
+            continue
+        if new_node is None:
+            yield from _gen_subtree(InodeDiff.Kind.REMOVED, path, old_node)
+            continue
+        if old_node.digest == new_node.digest:
+            continue  # The entire subtree is the same
+        if (old_node.children is None) != (new_node.children is None):
+            yield from _gen_subtree(InodeDiff.Kind.REMOVED, path, old_node)
+            yield from _gen_subtree(InodeDiff.Kind.ADDED, path, new_node)
+            continue
+        modified = _modified(path, old_node.inode, new_node.inode)
+        if modified is not None:
+            yield modified
+        if old_node.children is not None:
+            stack.extend(
+                (
+                    _child_path(path, name),
+                    old_node.children.get(name),
+                    new_node.children.get(name),
+                ) for name in sorted(
+                    old_node.children.keys() | new_node.children.keys(),
+                    reverse=True,
+                )
+            )
@@ -9,7 +9,6 @@ directory tree the way they would be in a real btrfs filesystem.  This is
 not done here simply because we don't have a need to model it, but you can
 easily imagine a path-aware `Volume` abstraction on top of this.
 '''
-import copy
 import itertools
 
 from collections import Counter
@@ -18,7 +17,7 @@ from types import MappingProxyType
 # and avoid `deepcopy`.
 from typing import Iterator, Mapping, NamedTuple, Optional, Union
 
-from .extents_to_chunks import extents_to_chunks_with_clones
+from .extents_to_chunks import CloneIndex, extents_to_chunks_with_clones
 from .freeze import freeze
 from .inode_id import InodeIDMap
 from .send_stream import SendStreamItem, SendStreamItems
@@ -61,10 +60,9 @@ class SubvolumeDescription(NamedTuple):
 
     IMPORTANT: Because of our `.name_uuid_prefix_counts` member, which is
     owned by a `SubvolumeSet`, this object would ONLY be safely
-    `deepcopy`able if we were to copy the `SubvolumeSet` in one call -- but
-    we never do that.  When we make snapshots in `SubvolumeSetMutator`, we
-    have to work around this problem, since a naive implementation would
-    `deepcopy` this object via `Subvolume.id_map.description`.
+    `deepcopy`able if we were to copy the `SubvolumeSet` in one call.  This
+    is not a problem for snapshots in `SubvolumeSetMutator`, since
+    `Subvolume.snapshot` takes a new description instead of copying it.
     '''
     name: bytes
     id: SubvolumeID
@@ -95,11 +93,15 @@ class SubvolumeSet(NamedTuple):
     # each possible length of prefix (from 0 to `len(uuid)`).  When the name
     # is unique, `@uuid_prefix` is omitted (aka prefix length 0).
     name_uuid_prefix_counts: Mapping[str, int]
+    # Lets `freeze` recompute `Chunk`s only for the files that changed
+    # since the previous `freeze`.  `None` in frozen `SubvolumeSet`s.
+    clone_index: Optional[CloneIndex] = None
 
     @classmethod
     def new(cls, **kwargs) -> 'SubvolumeSet':
         kwargs.setdefault('uuid_to_subvolume', {})
         kwargs.setdefault('name_uuid_prefix_counts', Counter())
+        kwargs.setdefault('clone_index', CloneIndex())
         return cls(**kwargs)
 
     def get_by_rendered_id(self, rendered_id: str) -> Subvolume:
@@ -108,19 +110,34 @@ class SubvolumeSet(NamedTuple):
                 return subvol
         return None
 
-    def freeze(self, *, _memo) -> 'SubvolumeSet':
+    def freeze(
+        self, *, _memo, shared_extents: bool=False,
+    ) -> 'SubvolumeSet':
         '''
         Return a recursively immutable copy of `self`, replacing all
         `IncompleteInode`s by `Inode`s, and checking that all inode metadata
         are populated.  Correctly resolving cloned extents has to happen at
-        the level of the `SubvolumeSet`.
+        the level of the `SubvolumeSet`.  For `shared_extents`, see
+        `extents_to_chunks_with_clones`.
+
+        The `clone_index` makes repeated `freeze`s cheap, since only the
+        changed files get new `Chunk`s, and only those get frozen again.
+        Unchanged inodes and `InodeIDMap`s also reuse their previous frozen
+        copies, see `IncompleteInode.freeze` and `InodeIDMap.freeze`.  The
+        linear `shared_extents` form is cheap to compute from scratch, so
+        it does not use the index.
         '''
-        id_to_chunks = dict(extents_to_chunks_with_clones(
-            list(itertools.chain.from_iterable(
-                subvol._inode_ids_and_extents()
-                    for subvol in self.uuid_to_subvolume.values()
+        ids_and_extents = itertools.chain.from_iterable(
+            subvol._inode_ids_and_extents()
+                for subvol in self.uuid_to_subvolume.values()
+        )
+        if self.clone_index is None or shared_extents:
+            id_to_chunks = dict(extents_to_chunks_with_clones(
+                list(ids_and_extents), shared_extents=shared_extents,
             ))
-        ))
+        else:
+            id_to_chunks = self.clone_index.update(ids_and_extents)
+            self.clone_index.freeze_chunks(_memo=_memo)
         return type(self)(
             uuid_to_subvolume=MappingProxyType({
                 uuid: freeze(subvol, _memo=_memo, id_to_chunks=id_to_chunks)
@@ -129,6 +146,7 @@ class SubvolumeSet(NamedTuple):
             name_uuid_prefix_counts=freeze(
                 self.name_uuid_prefix_counts, _memo=_memo,
             ),
+            clone_index=None,
         )
 
     def inodes(self) -> Iterator[Union['Inode', 'IncompleteInode']]:
@@ -161,13 +179,20 @@ class SubvolumeSetMutator(NamedTuple):
     The reason we don't just return `Subvolume` to the caller after
     the first item is that we need some logic as the `SubvolumeSet` and
     `Subvolume` layers to resolve `clone` commands.
+
+    With `allow_unknown_parent`, an incremental send-stream can be applied
+    without first applying those of its ancestors.  If its parent is not in
+    the `SubvolumeSet`, the new `Subvolume` models it with placeholders, as
+    explained in `subvolume.py`.  Then, clones from unknown subvolumes
+    become writes of unknown data.
     '''
     subvolume: Subvolume
     subvolume_set: SubvolumeSet
 
     @classmethod
     def new(
-        cls, subvol_set: SubvolumeSet, subvol_item: SendStreamItem,
+        cls, subvol_set: SubvolumeSet, subvol_item: SendStreamItem, *,
+        allow_unknown_parent: bool=False,
     ) -> 'SubvolumeSetMutator':
         if not isinstance(subvol_item, (
             SendStreamItems.subvol, SendStreamItems.snapshot,
@@ -185,20 +210,18 @@ class SubvolumeSetMutator(NamedTuple):
             name=subvol_item.path, id=my_id, parent_id=parent_id,
             name_uuid_prefix_counts=subvol_set.name_uuid_prefix_counts,
         )
-        if isinstance(subvol_item, SendStreamItems.snapshot):
-            parent_subvol = subvol_set.uuid_to_subvolume[parent_id.uuid]
-            # `SubvolumeDescription` references a part `SubvolumeSet`, so it
-            # is not correctly `deepcopy`able as part of a `Subvolume`.  And
-            # we want to modify the `InodeIDMap`'s `description` in any
-            # case, so let's just bulk-replace the old description instance.
-            # This would not be sane if the old instance were of a type that
-            # may be interned by the runtime, like `int`, hence the assert.
-            assert isinstance(
-                parent_subvol.id_map.inner.description, SubvolumeDescription
+        if parent_id is not None and allow_unknown_parent and (
+            parent_id.uuid not in subvol_set.uuid_to_subvolume
+        ):
+            subvol = Subvolume.new(
+                id_map=InodeIDMap.new(description=description),
+                placeholders=True,
             )
-            subvol = copy.deepcopy(parent_subvol, memo={
-                id(parent_subvol.id_map.inner.description): description,
-            })
+        elif parent_id is not None:
+            parent_subvol = subvol_set.uuid_to_subvolume[parent_id.uuid]
+            # O(1), the snapshot shares inodes & paths with its parent until
+            # either one mutates them.
+            subvol = parent_subvol.snapshot(description=description)
         else:
             subvol = Subvolume.new(
                 id_map=InodeIDMap.new(description=description),
@@ -222,6 +245,12 @@ class SubvolumeSetMutator(NamedTuple):
                 item.from_uuid.decode()
             )
             if not from_subvol:
-                raise RuntimeError(f'Unknown from_uuid for {item}')
+                if not self.subvolume.placeholders:
+                    raise RuntimeError(f'Unknown from_uuid for {item}')
+                return self.subvolume.apply_item(
+                    SendStreamItems.update_extent(
+                        path=item.path, offset=item.offset, len=item.len,
+                    ),
+                )
             return self.subvolume.apply_clone(item, from_subvol)
         return self.subvolume.apply_item(item)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+import io
+import unittest
+
+from .demo_sendstreams import gold_demo_sendstreams
+
+from ..compact_send_stream import compact_send_stream
+from ..freeze import freeze
+from ..parse_send_stream import parse_send_stream
+from ..rendered_tree import emit_non_unique_traversal_ids
+from ..send_stream import SendStreamItems, WriteDataRef
+from ..subvolume_set import SubvolumeSet, SubvolumeSetMutator
+from ..write_send_stream import write_send_stream
+
+
+def _round_trip(items):
+    out = io.BytesIO()
+    write_send_stream(items, out)
+    return list(parse_send_stream(io.BytesIO(out.getvalue()), verify_crc=True))
+
+
+def _render(items):
+    subvols = SubvolumeSet.new()
+    items = iter(items)
+    mutator = SubvolumeSetMutator.new(subvols, next(items))
+    for item in items:
+        mutator.apply_item(item)
+    return freeze(subvols).map(
+        lambda sv: emit_non_unique_traversal_ids(sv.render())
+    )
+
+
+_SUBVOL = SendStreamItems.subvol(path=b'x', uuid=b'ux', transid=7)
+
+
+class CompactSendStreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.maxDiff = 12345
+
+    def test_gold(self):
+        items = list(parse_send_stream(io.BytesIO(
+            gold_demo_sendstreams()['create_ops']['sendstream'],
+        )))
+        compacted = _round_trip(compact_send_stream(items))
+        self.assertEqual(_render(items), _render(compacted))
+        # Compaction is idempotent.
+        self.assertEqual(
+            compacted, _round_trip(compact_send_stream(compacted)),
+        )
+
+        self.assertLess(len(compacted), len(items))
+        self.assertFalse(any(
+            isinstance(i, SendStreamItems.rename) for i in compacted
+        ))
+        # Each inode's times are set once, after all other changes.
+        utimes = [
+            i.path for i in compacted if isinstance(i, SendStreamItems.utimes)
+        ]
+        self.assertEqual(len(set(utimes)), len(utimes))
+        self.assertTrue(all(
+            isinstance(i, SendStreamItems.utimes)
+                for i in compacted[-len(utimes):]
+        ))
+        # The 48K + 8K clone becomes a single clone.
+        clone, = (
+            i for i in compacted if isinstance(i, SendStreamItems.clone)
+        )
+        self.assertEqual(
+            (b'56KB_nuls_clone', 0, 56 * 1024, b'56KB_nuls', 0),
+            (clone.path, clone.offset, clone.len, clone.from_path,
+                clone.clone_offset),
+        )
+        self.assertIn(
+            SendStreamItems.link(path=b'hello/world', dest=b'goodbye'),
+            compacted,
+        )
+
+    def test_data(self):
+        si = SendStreamItems
+        items = [
+            _SUBVOL,
+            si.mkfile(path=b'o257-7-0'),
+            si.write(path=b'o257-7-0', offset=0, data=b'abcdef'),
+            si.write(path=b'o257-7-0', offset=6, data=b'gh'),
+            si.write(path=b'o257-7-0', offset=2, data=b'XY'),
+            si.rename(path=b'o257-7-0', dest=b'f'),
+            si.truncate(path=b'f', size=20),
+            si.write(path=b'f', offset=12, data=b'ij'),
+            si.mkfile(path=b'g'),
+            # Unaligned, so this is written out.
+            si.clone(
+                path=b'g', offset=0, len=3, from_uuid=b'ux', from_transid=7,
+                from_path=b'f', clone_offset=1,
+            ),
+            si.mkfile(path=b'h'),
+            si.update_extent(path=b'h', offset=0, len=5),
+            si.update_extent(path=b'h', offset=5, len=5),
+        ]
+        compacted = list(compact_send_stream(items))
+        self.assertEqual([
+            _SUBVOL,
+            si.mkfile(path=b'f'),
+            si.write(path=b'f', offset=0, data=b'abXYefgh'),
+            si.write(path=b'f', offset=12, data=b'ij'),
+            si.truncate(path=b'f', size=20),
+            si.mkfile(path=b'g'),
+            si.write(path=b'g', offset=0, data=b'bXY'),
+            si.mkfile(path=b'h'),
+            si.update_extent(path=b'h', offset=0, len=10),
+        ], compacted)
+        # Same data, but `f` and `g` no longer share an extent.
+        self.assertEqual({'x': ['(Dir)', {
+            'f': ['(File d8h4d2h6)'], 'g': ['(File d3)'], 'h': ['(File d10)'],
+        }]}, _render(compacted))
+
+    def test_aligned_clone(self):
+        si = SendStreamItems
+        data = bytes(range(256)) * 64  # 16KiB
+        items = [
+            _SUBVOL,
+            si.mkfile(path=b'a'),
+            si.write(path=b'a', offset=0, data=data),
+            si.mkfile(path=b'b'),
+            si.clone(
+                path=b'b', offset=8192, len=4096, from_uuid=b'ux',
+                from_transid=7, from_path=b'a', clone_offset=4096,
+            ),
+            si.write(path=b'b', offset=0, data=b'x'),
+            # Unaligned, and not to the end of `a`, so this is written out.
+            si.mkfile(path=b'c'),
+            si.clone(
+                path=b'c', offset=0, len=100, from_uuid=b'ux',
+                from_transid=7, from_path=b'a', clone_offset=0,
+            ),
+        ]
+        compacted = list(compact_send_stream(items))
+        self.assertEqual([
+            _SUBVOL,
+            si.mkfile(path=b'a'),
+            si.write(path=b'a', offset=0, data=data),
+            si.mkfile(path=b'b'),
+            si.write(path=b'b', offset=0, data=b'x'),
+            si.clone(
+                path=b'b', offset=8192, len=4096, from_uuid=b'ux',
+                from_transid=7, from_path=b'a', clone_offset=4096,
+            ),
+            si.mkfile(path=b'c'),
+            si.write(path=b'c', offset=0, data=data[:100]),
+        ], compacted)
+        # Without `c`, which no longer shares an extent with `a`.
+        self.assertEqual(_render(items[:-2]), _render(compacted[:-2]))
+
+    def test_errors(self):
+        si = SendStreamItems
+        with self.assertRaisesRegex(RuntimeError, 'only compact full send-'):
+            list(compact_send_stream([si.snapshot(
+                path=b'x', uuid=b'ux', transid=7, parent_uuid=b'up',
+                parent_transid=5,
+            )]))
+        with self.assertRaisesRegex(RuntimeError, 'from another subvol'):
+            list(compact_send_stream([
+                _SUBVOL,
+                si.mkfile(path=b'f'),
+                si.clone(
+                    path=b'f', offset=0, len=3, from_uuid=b'up',
+                    from_transid=5, from_path=b'f', clone_offset=0,
+                ),
+            ]))
+        with self.assertRaisesRegex(RuntimeError, 'without lazy_data'):
+            list(compact_send_stream([
+                _SUBVOL,
+                si.mkfile(path=b'f'),
+                si.write(
+                    path=b'f', offset=0,
+                    data=WriteDataRef(offset=100, length=3),
+                ),
+            ]))
+        with self.assertRaisesRegex(RuntimeError, 'needs decoding'):
+            list(compact_send_stream([
+                _SUBVOL,
+                si.mkfile(path=b'f'),
+                si.encoded_write(
+                    path=b'f', offset=0, unencoded_file_len=3,
+                    unencoded_len=3, unencoded_offset=0, compression=1,
+                    encryption=0, data=b'abc',
+                ),
+            ]))
+
+
+if __name__ == '__main__':
+    unittest.main()
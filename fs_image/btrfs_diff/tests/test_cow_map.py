@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+import copy
+import random
+import unittest
+
+from types import MappingProxyType
+
+from ..cow_map import CowIntMap, CowIntTable, CowMap
+from ..freeze import freeze
+
+
+class Collider:
+    'Instances with equal `h` have equal hashes, but are distinct keys.'
+
+    def __init__(self, h, name):
+        self.h = h
+        self.name = name
+
+    def __hash__(self):
+        return self.h
+
+    def __eq__(self, other):
+        return (self.h, self.name) == (other.h, other.name)
+
+    def __repr__(self):
+        return f'Collider({self.h}, {self.name})'
+
+
+class CowMapTestCase(unittest.TestCase):
+
+    def _check(self, expected, m):
+        self.assertEqual(expected, dict(m.items()))
+        self.assertEqual(len(expected), len(m))
+        self.assertEqual(set(expected), set(m))
+        self.assertEqual(
+            sorted(expected.values(), key=repr), sorted(m.values(), key=repr),
+        )
+        for k, v in expected.items():
+            self.assertIn(k, m)
+            self.assertIs(v, m[k])
+
+    def test_basics(self):
+        m = CowMap({1: 'a', 2: 'b'})
+        self.assertEqual({1: 'a', 2: 'b'}, m)
+        self.assertEqual("CowMap({1: 'a', 2: 'b'})", repr(CowMap(m)))
+        self.assertEqual(2, len(m))
+        self.assertNotIn(3, m)
+        self.assertIsNone(m.get(3))
+        with self.assertRaises(KeyError):
+            m[3]
+        with self.assertRaises(KeyError):
+            del m[3]
+        with self.assertRaises(KeyError):
+            del CowMap()[3]
+        del m[1]
+        m[2] = 'c'
+        self._check({2: 'c'}, m)
+        del m[2]
+        self._check({}, m)
+        self.assertEqual(CowMap(), {})
+
+    def test_copies_are_independent(self):
+        rand = random.Random(7)
+        maps = [CowMap()]
+        dicts = [{}]
+        for _ in range(5000):
+            i = rand.randrange(len(maps))
+            m, d = maps[i], dicts[i]
+            op = rand.random()
+            # Negative keys and huge keys exercise all the hash bits.
+            key = rand.choice([
+                rand.randrange(300), -rand.randrange(300),
+                rand.randrange(2 ** 70),
+            ])
+            if op < 0.05 and len(maps) < 30:
+                maps.append(m.copy())
+                dicts.append(dict(d))
+            elif op < 0.3 and d:
+                key = rand.choice(list(d))
+                del m[key]
+                del d[key]
+            else:
+                m[key] = d[key] = object()
+        for m, d in zip(maps, dicts):
+            self._check(d, m)
+
+    def test_hash_collisions(self):
+        a1, a2, a3, b = (
+            Collider(5, 1), Collider(5, 2), Collider(5, 3), Collider(37, 1),
+        )
+        m = CowMap({a1: 1, b: 2})
+        c = m.copy()
+        m[a2] = 3
+        m[a3] = 4
+        m[a3] = 5
+        self._check({a1: 1, a2: 3, a3: 5, b: 2}, m)
+        self._check({a1: 1, b: 2}, c)
+        self.assertNotIn(Collider(5, 4), m)
+        with self.assertRaises(KeyError):
+            del m[Collider(5, 4)]
+
+        c2 = m.copy()
+        del m[a2]
+        del m[a1]
+        self._check({a3: 5, b: 2}, m)
+        self._check({a1: 1, a2: 3, a3: 5, b: 2}, c2)
+        del m[a3]
+        self._check({b: 2}, m)
+
+    def test_collapse_on_delete(self):
+        # Keys 1, 33, and 65 share their lowest 5 hash bits, so they end up
+        # in a deeper node, which must collapse as they get deleted.
+        m = CowMap({1: 'a', 33: 'b', 65: 'c', 2: 'd'})
+        c = m.copy()
+        for k in [33, 1]:
+            del m[k]
+        self._check({65: 'c', 2: 'd'}, m)
+        del m[2]
+        self._check({65: 'c'}, m)
+        self._check({1: 'a', 33: 'b', 65: 'c', 2: 'd'}, c)
+        for k in [1, 33, 65, 2]:
+            del c[k]
+        self._check({}, c)
+
+    def test_get_mut(self):
+        m = CowMap({1: [1]})
+        v = m[1]
+        self.assertIs(v, m.get_mut(1, list))  # Owned values are not copied
+
+        c = m.copy()
+        v_m = m.get_mut(1, list)
+        v_c = c.get_mut(1, list)
+        self.assertIsNot(v, v_m)
+        self.assertIsNot(v, v_c)
+        self.assertIsNot(v_m, v_c)
+        self.assertIs(v_m, m.get_mut(1, list))  # Now it is owned
+        v_m.append(2)
+        self.assertEqual({1: [1, 2]}, m)
+        self.assertEqual({1: [1]}, c)
+        self.assertEqual([1], v)
+        with self.assertRaises(KeyError):
+            m.get_mut(2, list)
+
+    def test_deepcopy_and_freeze(self):
+        m = CowMap({1: [1], 2: {3: 4}})
+        c = m.copy()
+        m_copy, c_copy = copy.deepcopy((m, c))
+        m_copy.get_mut(1, list).append(5)
+        c_copy[1].append(6)  # The copies share the value, just like `m, c`
+        self.assertEqual({1: [1], 2: {3: 4}}, m)
+        self.assertEqual({1: [1, 5], 2: {3: 4}}, m_copy)
+        self.assertEqual({1: [1, 6], 2: {3: 4}}, c_copy)
+
+        frozen = freeze(m)
+        self.assertIsInstance(frozen, MappingProxyType)
+        self.assertEqual({1: (1,), 2: {3: 4}}, frozen)
+        self.assertIsInstance(frozen[2], MappingProxyType)
+
+
+class CowIntMapTestCase(unittest.TestCase):
+
+    def _check(self, expected, m):
+        # Unlike `CowMap`, the keys come out in order.
+        self.assertEqual(sorted(expected.items()), list(m.items()))
+        self.assertEqual(len(expected), len(m))
+        for k, v in expected.items():
+            self.assertIn(k, m)
+            self.assertIs(v, m[k])
+
+    def test_basics(self):
+        m = CowIntMap()
+        self.assertEqual({}, m)
+        self.assertNotIn(0, m)
+        m[5] = 'a'
+        m[3] = 'b'
+        self.assertEqual("CowIntMap({3: 'b', 5: 'a'})", repr(m))
+        self.assertEqual([3, 5], list(m))
+        self.assertEqual(['b', 'a'], list(m.values()))
+        for bad_key in [-1, 2 ** 100, 'a', None, 1.0]:
+            self.assertNotIn(bad_key, m)
+            self.assertEqual('x', m.get(bad_key, 'x'))
+            with self.assertRaises(KeyError):
+                del m[bad_key]
+        for bad_key in [-1, 'a', None, 1.0, True]:
+            with self.assertRaisesRegex(TypeError, 'CowIntMap keys are'):
+                m[bad_key] = 'c'
+        with self.assertRaises(KeyError):
+            m[4]
+        m[2 ** 40] = 'c'  # Grows the trie, leaving the old keys intact
+        self._check({3: 'b', 5: 'a', 2 ** 40: 'c'}, m)
+        with self.assertRaises(KeyError):
+            m[2 ** 40 + 1]
+        with self.assertRaises(KeyError):
+            m[2 ** 39]
+        self.assertIsNone(m.get(2 ** 39))
+        self.assertEqual('c', m.get(2 ** 40))
+        del m[3]
+        del m[2 ** 40]
+        self._check({5: 'a'}, m)
+
+    def test_copies_are_independent(self):
+        rand = random.Random(7)
+        maps = [CowIntMap()]
+        dicts = [{}]
+        for _ in range(5000):
+            i = rand.randrange(len(maps))
+            m, d = maps[i], dicts[i]
+            op = rand.random()
+            key = rand.choice([rand.randrange(100), rand.randrange(5000)])
+            if op < 0.05 and len(maps) < 30:
+                maps.append(m.copy())
+                dicts.append(dict(d))
+            elif op < 0.3 and d:
+                key = rand.choice(list(d))
+                del m[key]
+                del d[key]
+            elif op < 0.4 and d:
+                key = rand.choice(list(d))
+                self.assertEqual(d[key], m.get_mut(key, list))
+                d[key] = m[key]
+            else:
+                m[key] = d[key] = [key]
+        for m, d in zip(maps, dicts):
+            self._check(d, m)
+
+    def test_get_mut(self):
+        m = CowIntMap({1: [1], 40: [40]})
+        v = m[1]
+        self.assertIs(v, m.get_mut(1, list))  # Owned values are not copied
+
+        c = m.copy()
+        c[2] = [2]  # Copies the bottom node, but `1` stays shared
+        v_c = c.get_mut(1, list)
+        self.assertIsNot(v, v_c)
+        self.assertIs(v_c, c.get_mut(1, list))  # Now it is owned
+        v_c.append(3)
+        self.assertEqual({1: [1], 40: [40]}, m)
+        self.assertEqual({1: [1, 3], 2: [2], 40: [40]}, c)
+        # `copy()` took ownership from both maps, as with `CowMap`.
+        self.assertIsNot(v, m.get_mut(1, list))
+        with self.assertRaises(KeyError):
+            m.get_mut(2, list)
+
+    def test_deepcopy_and_freeze(self):
+        m = CowIntMap({1: [1], 2: {3: 4}})
+        c = m.copy()
+        m_copy, c_copy = copy.deepcopy((m, c))
+        m_copy.get_mut(1, list).append(5)
+        c_copy[1].append(6)  # The copies share the value, just like `m, c`
+        self.assertEqual({1: [1], 2: {3: 4}}, m)
+        self.assertEqual({1: [1, 5], 2: {3: 4}}, m_copy)
+        self.assertEqual({1: [1, 6], 2: {3: 4}}, c_copy)
+
+        frozen = freeze(m)
+        self.assertIsInstance(frozen, MappingProxyType)
+        self.assertEqual({1: (1,), 2: {3: 4}}, frozen)
+
+
+class CowIntTableTestCase(unittest.TestCase):
+
+    def _check(self, expected, t):
+        self.assertEqual(sorted(expected), list(t))
+        self.assertEqual(len(expected), len(t))
+        for k, row in expected.items():
+            self.assertIn(k, t)
+            self.assertEqual(list(row), t.get_row(k))
+            for field, v in enumerate(row):
+                self.assertEqual(v, t.get(k, field))
+
+    def test_basics(self):
+        t = CowIntTable('bqOC')
+        self.assertEqual(0, len(t))
+        self.assertNotIn(0, t)
+        t.set_row(40, (1, 2, 'a', 'c'))
+        t.set_row(3, (None, None, None, None))
+        self._check({3: (None,) * 4, 40: (1, 2, 'a', 'c')}, t)
+        # Values that do not pack into their field are still stored.
+        for value in [-128, 128, -129, 'x', 1.5, True, 2 ** 70, None, 127]:
+            t.set(3, 0, value)
+            self.assertEqual(value, t.get(3, 0))
+            self.assertIs(type(value), type(t.get(3, 0)))
+        t.set(3, 1, 2 ** 70)
+        t.set_cache(3, 3, 'cached')
+        self._check({
+            3: (127, 2 ** 70, None, 'cached'), 40: (1, 2, 'a', 'c'),
+        }, t)
+        t.set_row(3, (5, 6, 7, 8))  # Replaces, clearing the overflow
+        self._check({3: (5, 6, 7, 8), 40: (1, 2, 'a', 'c')}, t)
+        del t[40]
+        self._check({3: (5, 6, 7, 8)}, t)
+        t.set_row(40, (None,) * 4)  # Deleting cleared the row
+        self._check({3: (5, 6, 7, 8), 40: (None,) * 4}, t)
+
+        for bad_key in [-1, 2 ** 100, 'a', None, 1.0, 4]:
+            self.assertNotIn(bad_key, t)
+            with self.assertRaises(KeyError):
+                t.get(bad_key, 0)
+            with self.assertRaises(KeyError):
+                t.set(bad_key, 0, 1)
+            with self.assertRaises(KeyError):
+                del t[bad_key]
+        for bad_key in [-1, 'a', None, 1.0, True]:
+            with self.assertRaisesRegex(TypeError, 'CowIntTable keys are'):
+                t.set_row(bad_key, (None,) * 4)
+        with self.assertRaisesRegex(ValueError, '4 fields'):
+            t.set_row(5, (1, 2))
+        with self.assertRaisesRegex(ValueError, 'Bad CowIntTable field'):
+            CowIntTable('bx')
+
+    def test_copies_are_independent(self):
+        rand = random.Random(7)
+        tables = [CowIntTable('ihO')]
+        dicts = [{}]
+        for _ in range(5000):
+            i = rand.randrange(len(tables))
+            t, d = tables[i], dicts[i]
+            op = rand.random()
+            key = rand.choice([rand.randrange(100), rand.randrange(5000)])
+            if op < 0.05 and len(tables) < 30:
+                tables.append(t.copy())
+                dicts.append(dict(d))
+            elif op < 0.3 and d:
+                key = rand.choice(list(d))
+                del t[key]
+                del d[key]
+            elif op < 0.6 and d:
+                key = rand.choice(list(d))
+                field = rand.randrange(3)
+                value = rand.choice([None, key, -key, 2 ** 40, str(key)])
+                t.set(key, field, value)
+                d[key] = d[key][:field] + (value,) + d[key][field + 1:]
+            else:
+                d[key] = (key, None, [key])
+                t.set_row(key, d[key])
+        for t, d in zip(tables, dicts):
+            self._check(d, t)
+
+    def test_caches_and_deepcopy(self):
+        t = CowIntTable('iC')
+        t.set_row(1, (1, None))
+        c = t.copy()
+        c.set_cache(1, 1, 'x')  # Shared, like the rest of the row
+        self.assertEqual('x', t.get(1, 1))
+        c.set(1, 0, 2)  # Now `c` has a row of its own
+        c.set_cache(1, 1, 'y')
+        self.assertEqual([1, 'x'], t.get_row(1))
+        self.assertEqual([2, 'y'], c.get_row(1))
+        with self.assertRaises(AssertionError):
+            t.set_cache(1, 0, 'z')
+
+        t.set_row(2, (3, 'z'))
+        t_copy, c_copy = copy.deepcopy((t, c))
+        self._check({1: (1, None), 2: (3, None)}, t_copy)  # No caches
+        self._check({1: (2, None)}, c_copy)
+        t_copy.set(1, 0, 4)
+        self.assertEqual(1, t.get(1, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+import struct
+import unittest
+
+from .demo_sendstreams import gold_demo_sendstreams
+
+from ..crc32c import crc32c
+from ..parse_send_stream import BTRFS_SEND_STREAM_MAGIC
+
+
+def _slow_crc32c(data: bytes, crc: int) -> int:
+    for b in data:
+        crc ^= b
+        for _ in range(8):
+            crc = (crc >> 1) ^ (0x82F63B78 if crc & 1 else 0)
+    return crc
+
+
+class Crc32cTestCase(unittest.TestCase):
+
+    def test_standard_check_value(self):
+        # The usual CRC32C is the raw one, pre- and post-inverted.
+        self.assertEqual(
+            0xE3069283, crc32c(b'123456789', 0xffffffff) ^ 0xffffffff,
+        )
+
+    def test_matches_bitwise_crc(self):
+        data = bytes(range(256)) * 3
+        # Cover every remainder modulo 8, as well as memoryview input.
+        for end in [0, 1, 7, 8, 9, 15, 16, 17, 100, len(data)]:
+            for seed in [0, 0xffffffff, 0x12345678]:
+                self.assertEqual(
+                    _slow_crc32c(data[:end], seed),
+                    crc32c(memoryview(data)[:end], seed),
+                )
+
+    def test_gold_send_stream_crcs(self):
+        num_cmds = 0
+        for d in gold_demo_sendstreams().values():
+            s = d['sendstream']
+            pos = len(BTRFS_SEND_STREAM_MAGIC) + 4  # skip the version
+            while pos < len(s):
+                length, cmd_type, crc = struct.unpack_from('<IHI', s, pos)
+                zeroed_header = struct.pack('<IHI', length, cmd_type, 0)
+                body = s[pos + 10:pos + 10 + length]
+                self.assertEqual(crc, crc32c(zeroed_header + body))
+                pos += 10 + length
+                num_cmds += 1
+        self.assertGreater(num_cmds, 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
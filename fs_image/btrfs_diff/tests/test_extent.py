@@ -3,6 +3,7 @@ import copy
 import functools
 import itertools
 import math
+import random
 import unittest
 
 from types import SimpleNamespace
@@ -13,6 +14,26 @@ from ..extent import Extent
 unittest.util._MAX_LENGTH = 12345
 
 
+def _check_tree(e: Extent) -> int:
+    '''
+    Asserts that the nodes of `e` form an AVL tree with correct lengths and
+    heights, and no empty pieces.  Returns the number of trimmed leaves.
+    '''
+    if e.height == 0:
+        assert e == Extent.empty(), e
+        return 0
+    if isinstance(e.content, Extent.Kind):
+        assert (e.offset, e.height) == (0, 1), e
+        return 1
+    left, leaf, right = e.content
+    assert isinstance(leaf.content, Extent.Kind), leaf
+    piece_length = e.length - left.length - right.length
+    assert piece_length > 0 and e.offset + piece_length <= leaf.length, e
+    assert e.height == 1 + max(left.height, right.height), e
+    assert abs(left.height - right.height) <= 1, e
+    return _check_tree(left) + 1 + _check_tree(right)
+
+
 class ExtentTestCase(unittest.TestCase):
     def setUp(self):
         self.maxDiff = 12345
@@ -24,12 +45,12 @@ class ExtentTestCase(unittest.TestCase):
             Extent.empty().write(offset=0, length=3),
         )
         # Writing at offset 5 creates a hole.
-        self.assertEqual(
-            Extent((
-                Extent(Extent.Kind.HOLE, 0, 5), Extent(Extent.Kind.DATA, 0, 6),
-            ), 0, 11),
-            Extent.empty().write(offset=5, length=6),
-        )
+        e = Extent.empty().write(offset=5, length=6)
+        self.assertEqual([
+            (0, 5, Extent(Extent.Kind.HOLE, 0, 5)),
+            (0, 6, Extent(Extent.Kind.DATA, 0, 6)),
+        ], list(e.gen_trimmed_leaves()))
+        self.assertEqual(2, _check_tree(e))
 
     def test_write_and_clone(self):
         # 3-byte hole, 4-byte data, 5-byte hole, 6-byte data
@@ -80,50 +101,36 @@ class ExtentTestCase(unittest.TestCase):
                 msg='Write into `four` at offset 0, partly replacing `a`',
                 into=four,
                 action=lambda e: e.write(offset=0, length=2),
-                result=Extent((
-                    Extent(Extent.Kind.DATA, 0, 2), Extent((four,), 2, 16)
-                ), 0, 18),
                 leaves=[Extent(Extent.Kind.DATA, 0, 2), (2, 1, a), b, c, d],
             ),
             SimpleNamespace(
                 msg='Write into `four` at offset 0, replacing all of `a`',
                 into=four,
                 action=lambda e: e.write(offset=0, length=3),
-                result=Extent((
-                    Extent(Extent.Kind.DATA, 0, 3), Extent((four,), 3, 15)
-                ), 0, 18),
                 leaves=[Extent(Extent.Kind.DATA, 0, 3), b, c, d],
             ),
             SimpleNamespace(
                 msg='Write into `four` at offset 0, over `a` and some of `b`',
                 into=four,
                 action=lambda e: e.write(offset=0, length=5),
-                result=Extent((
-                    Extent(Extent.Kind.DATA, 0, 5), Extent((four,), 5, 13)
-                ), 0, 18),
                 leaves=[Extent(Extent.Kind.DATA, 0, 5), (2, 2, b), c, d],
             ),
             SimpleNamespace(
                 msg='Write into `four` at offset 0, leaving just part of `d`',
                 into=four,
                 action=lambda e: e.write(offset=0, length=15),
-                result=Extent((
-                    Extent(Extent.Kind.DATA, 0, 15), Extent((four,), 15, 3)
-                ), 0, 18),
                 leaves=[Extent(Extent.Kind.DATA, 0, 15), (3, 3, d)],
             ),
             SimpleNamespace(
                 msg='Write into `four` at offset 0, replacing all of `four`',
                 into=four,
                 action=lambda e: e.write(offset=0, length=18),
-                result=Extent(Extent.Kind.DATA, 0, 18),
                 leaves=[Extent(Extent.Kind.DATA, 0, 18)],
             ),
             SimpleNamespace(
                 msg='Write into `four` at offset 0, go 10 bytes past its end',
                 into=four,
                 action=lambda e: e.write(offset=0, length=28),
-                result=Extent(Extent.Kind.DATA, 0, 28),
                 leaves=[Extent(Extent.Kind.DATA, 0, 28)],
             ),
 
@@ -132,22 +139,12 @@ class ExtentTestCase(unittest.TestCase):
                 msg='Write 7 bytes into `four` at offset 5',
                 into=four,
                 action=lambda e: e.write(offset=5, length=7),
-                result=Extent((
-                    Extent((four,), 0, 5),
-                    Extent(Extent.Kind.DATA, 0, 7),
-                    Extent((four,), 12, 6),
-                ), 0, 18),
                 leaves=[a, (0, 2, b), Extent(Extent.Kind.DATA, 0, 7), d],
             ),
             SimpleNamespace(
                 msg='Write 7 bytes into `four` at offset 7',
                 into=four,
                 action=lambda e: e.write(offset=7, length=7),
-                result=Extent((
-                    Extent((four,), 0, 7),
-                    Extent(Extent.Kind.DATA, 0, 7),
-                    Extent((four,), 14, 4),
-                ), 0, 18),
                 leaves=[a, b, Extent(Extent.Kind.DATA, 0, 7), (2, 4, d)],
             ),
 
@@ -156,10 +153,6 @@ class ExtentTestCase(unittest.TestCase):
                 msg='Write 10 bytes into `four` at offset 8',
                 into=four,
                 action=lambda e: e.write(offset=8, length=10),
-                result=Extent((
-                    Extent((four,), 0, 8),
-                    Extent(Extent.Kind.DATA, 0, 10),
-                ), 0, 18),
                 leaves=[a, b, (0, 1, c), Extent(Extent.Kind.DATA, 0, 10)],
             ),
 
@@ -168,10 +161,6 @@ class ExtentTestCase(unittest.TestCase):
                 msg='Write 10 bytes into `four` at offset 12',
                 into=four,
                 action=lambda e: e.write(offset=12, length=10),
-                result=Extent((
-                    Extent((four,), 0, 12),
-                    Extent(Extent.Kind.DATA, 0, 10),
-                ), 0, 22),
                 leaves=[a, b, c, Extent(Extent.Kind.DATA, 0, 10)],
             ),
 
@@ -180,21 +169,12 @@ class ExtentTestCase(unittest.TestCase):
                 msg='Write 2 bytes into `four` at offset 18',
                 into=four,
                 action=lambda e: e.write(offset=18, length=2),
-                result=Extent((
-                    four,
-                    Extent(Extent.Kind.DATA, 0, 2),
-                ), 0, 20),
                 leaves=[a, b, c, d, Extent(Extent.Kind.DATA, 0, 2)],
             ),
             SimpleNamespace(
                 msg='Write 1 bytes into `four` at offset 19',
                 into=four,
                 action=lambda e: e.write(offset=19, length=1),
-                result=Extent((
-                    four,
-                    Extent(Extent.Kind.HOLE, 0, 1),
-                    Extent(Extent.Kind.DATA, 0, 1),
-                ), 0, 20),
                 leaves=[
                     a, b, c, d,
                     Extent(Extent.Kind.HOLE, 0, 1),
@@ -220,28 +200,18 @@ class ExtentTestCase(unittest.TestCase):
                 msg='Write 2 bytes into `one` at offset 0',
                 into=one,
                 action=lambda e: e.write(offset=0, length=2),
-                result=Extent((
-                    Extent(Extent.Kind.DATA, 0, 2),
-                    Extent((one,), 2, 5),
-                ), 0, 7),
                 leaves=[Extent(Extent.Kind.DATA, 0, 2), (2, 5, one)],
             ),
             SimpleNamespace(
                 msg='Write 7 bytes into `one` at offset 0',
                 into=one,
                 action=lambda e: e.write(offset=0, length=7),
-                result=Extent(Extent.Kind.DATA, 0, 7),
                 leaves=[Extent(Extent.Kind.DATA, 0, 7)],
             ),
             SimpleNamespace(
                 msg='Write 3 bytes into `one` at offset 2',
                 into=one,
                 action=lambda e: e.write(offset=2, length=3),
-                result=Extent((
-                    Extent((one,), 0, 2),
-                    Extent(Extent.Kind.DATA, 0, 3),
-                    Extent((one,), 5, 2),
-                ), 0, 7),
                 leaves=[
                     (0, 2, one), Extent(Extent.Kind.DATA, 0, 3), (5, 2, one),
                 ],
@@ -250,41 +220,24 @@ class ExtentTestCase(unittest.TestCase):
                 msg='Write 4 bytes into `one` at offset 3',
                 into=one,
                 action=lambda e: e.write(offset=3, length=4),
-                result=Extent((
-                    Extent((one,), 0, 3),
-                    Extent(Extent.Kind.DATA, 0, 4),
-                ), 0, 7),
                 leaves=[(0, 3, one), Extent(Extent.Kind.DATA, 0, 4)],
             ),
             SimpleNamespace(
                 msg='Write 4 bytes into `one` at offset 5',
                 into=one,
                 action=lambda e: e.write(offset=5, length=4),
-                result=Extent((
-                    Extent((one,), 0, 5),
-                    Extent(Extent.Kind.DATA, 0, 4),
-                ), 0, 9),
                 leaves=[(0, 5, one), Extent(Extent.Kind.DATA, 0, 4)],
             ),
             SimpleNamespace(
                 msg='Write 3 bytes into `one` at offset 7',
                 into=one,
                 action=lambda e: e.write(offset=7, length=3),
-                result=Extent((
-                    one,
-                    Extent(Extent.Kind.DATA, 0, 3),
-                ), 0, 10),
                 leaves=[one, Extent(Extent.Kind.DATA, 0, 3)],
             ),
             SimpleNamespace(
                 msg='Write 2 bytes into `one` at offset 11',
                 into=one,
                 action=lambda e: e.write(offset=11, length=2),
-                result=Extent((
-                    one,
-                    Extent(Extent.Kind.HOLE, 0, 4),
-                    Extent(Extent.Kind.DATA, 0, 2),
-                ), 0, 13),
                 leaves=[
                     one,
                     Extent(Extent.Kind.HOLE, 0, 4),
@@ -319,10 +272,6 @@ class ExtentTestCase(unittest.TestCase):
                     to_offset=3,
                     from_extent=clone, from_offset=0, length=clone.length,
                 ),
-                result=Extent((
-                    Extent((one,), 0, 3),
-                    clone,
-                ), 0, clone.length + 3),
                 leaves=[(0, 3, one), *clone_leaves],
             ),
             SimpleNamespace(
@@ -331,11 +280,6 @@ class ExtentTestCase(unittest.TestCase):
                 action=lambda e: e.clone(
                     to_offset=2, from_extent=clone, from_offset=2, length=4,
                 ),
-                result=Extent((
-                    Extent((one,), 0, 2),
-                    Extent((clone,), 2, 4),
-                    Extent((one,), 6, 1),
-                ), 0, 7),
                 leaves=[(0, 2, one), (2, 3, ca), (0, 1, cb), (6, 1, one)],
             ),
             SimpleNamespace(
@@ -345,19 +289,15 @@ class ExtentTestCase(unittest.TestCase):
                     to_offset=5,
                     from_extent=clone, from_offset=3, length=7,
                 ),
-                result=Extent((
-                    Extent((four,), 0, 5),
-                    Extent((clone,), 3, 7),
-                    Extent((four,), 12, 6),
-                ), 0, 18),
-                # `cc` starts at offset 2 because `clone` already trimmed it
                 leaves=[a, (0, 2, b), (3, 2, ca), cb, (2, 1, cc), d],
             ),
         ]:
             with self.subTest(ns.msg):
                 _, _, orig_leaves = zip(*ns.into.gen_trimmed_leaves())
                 result = ns.action(ns.into)
-                self.assertEqual(ns.result, result)
+                if hasattr(ns, 'result'):
+                    self.assertIs(ns.result, result)
+                self.assertEqual(len(ns.leaves), _check_tree(result))
                 for expected_leaf, leaf in itertools.zip_longest(
                     ns.leaves, result.gen_trimmed_leaves(),
                 ):
@@ -372,15 +312,28 @@ class ExtentTestCase(unittest.TestCase):
     # `test_leaf_commutativity` also tests `truncate`.
     def test_truncate(self):
         e = Extent.empty().write(offset=3, length=7)
+        (_, _, hole), (_, _, data) = e.gen_trimmed_leaves()
         for i in range(1, 10):
-            self.assertEqual(Extent((e,), 0, i), e.truncate(length=i))
-        self.assertEqual(
-            Extent((e, Extent(Extent.Kind.HOLE, 0, 1)), 0, 11),
-            e.truncate(length=11),
-        )
+            self.assertEqual(
+                [(0, min(i, 3), hole)] + ([(0, i - 3, data)] if i > 3 else []),
+                list(e.truncate(length=i).gen_trimmed_leaves()),
+            )
+        self.assertIs(e, e.truncate(length=10))
+        self.assertEqual([
+            (0, 3, hole), (0, 7, data), (0, 1, Extent(Extent.Kind.HOLE, 0, 1)),
+        ], list(e.truncate(length=11).gen_trimmed_leaves()))
+        self.assertIs(Extent.empty(), e.truncate(length=0))
+
+    def test_punch_hole(self):
+        e = Extent.empty().write(offset=0, length=10)
+        self.assertEqual('d3h4d3', repr(e.punch_hole(offset=3, length=4)))
+        self.assertEqual('d10h5', repr(e.punch_hole(offset=8, length=2)
+            .truncate(length=15).write(offset=8, length=2)
+            .punch_hole(offset=10, length=5)))
+        self.assertEqual('d10h7', repr(e.punch_hole(offset=12, length=5)))
 
-    # A cute demonstration that while different orders of operations produce
-    # different nestings, `gen_trimmed_leaves` restores commutativity.
+    # A cute demonstration that while different orders of operations can
+    # produce different trees, `gen_trimmed_leaves` restores commutativity.
     #
     # While it does not replace `test_write_and_clone`, the main benefit of
     # this test is scalability: it gives us a cheap-to-implement, but
@@ -412,9 +365,11 @@ class ExtentTestCase(unittest.TestCase):
                 lambda extent, op: op(extent), ops_it, Extent.empty(),
             )
 
-        # All permutations make distinct nestings with the same leaf structure
+        # Trees are normalized, so many, but not all, of the permutations
+        # make equal trees.  All have the same leaf structure.
         all_extents = {compose_ops(p) for p in itertools.permutations(ops)}
-        self.assertEqual(math.factorial(len(ops)), len(all_extents))
+        self.assertLess(1, len(all_extents))
+        self.assertGreater(math.factorial(len(ops)), len(all_extents))
         self.assertEqual(
             {(
                 1,
@@ -447,7 +402,115 @@ class ExtentTestCase(unittest.TestCase):
         result = (Extent.empty()
             .write(offset=0, length=30)
             .clone(to_offset=10, from_extent=clone, from_offset=1, length=3))
-        self.assertIs(clone, result.content[1].content[0])
+        self.assertEqual('d10h3d17', repr(result))
+        (_, _, hole), = clone.gen_trimmed_leaves()
+        self.assertIs(hole, list(result.gen_trimmed_leaves())[1][2])
+
+    def test_random_ops_against_leaf_lists(self):
+        # A naive model of a file: its list of trimmed leaves.
+        def model_slice(leaves, offset, length):
+            pos = 0
+            for leaf_offset, leaf_length, leaf in leaves:
+                start = max(offset, pos)
+                end = min(offset + length, pos + leaf_length)
+                if start < end:
+                    yield (leaf_offset + start - pos, end - start, leaf)
+                pos += leaf_length
+
+        def model_put(leaves, offset, what_leaves):
+            length = sum(l for _, l, _ in leaves)
+            what_length = sum(l for _, l, _ in what_leaves)
+            return [
+                *model_slice(leaves, 0, offset),
+                *([(0, offset - length, None)] if offset > length else []),
+                *what_leaves,
+                *model_slice(leaves, offset + what_length, length),
+            ]
+
+        def leaves_with_holes_as_none(e):
+            return [
+                (o, l, None if leaf.content == Extent.Kind.HOLE else leaf)
+                    for o, l, leaf in e.gen_trimmed_leaves()
+            ]
+
+        def model_without_holes(leaves):
+            return [
+                (o, l, None if leaf is None or (
+                    leaf.content == Extent.Kind.HOLE
+                ) else leaf) for o, l, leaf in leaves
+            ]
+
+        rand = random.Random(7)
+        files = [(Extent.empty(), [])] * 4
+        for step in range(1000):
+            i = rand.randrange(len(files))
+            e, leaves = files[i]
+            op = rand.randrange(4)
+            offset = rand.randrange(60)
+            if op == 0:
+                length = rand.randrange(1, 20)
+                e = e.write(offset=offset, length=length)
+                leaves = model_put(
+                    leaves, offset, [list(e.gen_trimmed_leaves(
+                        offset=offset, length=length,
+                    ))[0]],
+                )
+            elif op == 1:
+                leaves = list(model_slice(leaves, 0, offset)) + (
+                    [(0, offset - e.length, None)] if offset > e.length else []
+                )
+                e = e.truncate(length=offset)
+            elif op == 2:
+                from_e, from_leaves = rand.choice(files)
+                if from_e.length:
+                    from_offset = rand.randrange(from_e.length)
+                    length = rand.randrange(1, from_e.length - from_offset + 1)
+                    e = e.clone(
+                        to_offset=offset, from_extent=from_e,
+                        from_offset=from_offset, length=length,
+                    )
+                    leaves = model_put(leaves, offset, list(model_slice(
+                        from_leaves, from_offset, length,
+                    )))
+            else:
+                length = rand.randrange(1, 20)
+                e = e.punch_hole(offset=offset, length=length)
+                leaves = model_put(leaves, offset, [(0, length, None)])
+            with self.subTest(step=step):
+                self.assertEqual(
+                    model_without_holes(leaves), leaves_with_holes_as_none(e),
+                )
+                self.assertEqual(len(leaves), _check_tree(e))
+                offset = rand.randrange(e.length + 1)
+                length = rand.randrange(e.length - offset + 1)
+                self.assertEqual(
+                    model_without_holes(model_slice(leaves, offset, length)),
+                    model_without_holes(e.gen_trimmed_leaves(
+                        offset=offset, length=length,
+                    )),
+                )
+            # Keep the real hole leaves in the model, for use by clones.
+            files[i] = (e, [
+                (o, l, m if m is not None else leaf) for (o, l, m), (
+                    _, _, leaf
+                ) in zip(leaves, e.gen_trimmed_leaves())
+            ])
+
+    def test_balanced(self):
+        for name, offsets in [
+            ('sequential', [4 * i for i in range(2000)]),
+            ('random', random.Random(3).sample(range(4 * 2000), 2000)),
+        ]:
+            with self.subTest(name):
+                e = Extent.empty()
+                for offset in offsets:
+                    e = e.write(offset=offset, length=4)
+                num_leaves = _check_tree(e)
+                # The AVL height bound
+                self.assertLess(e.height, 1.45 * math.log2(num_leaves + 2))
+                self.assertEqual(
+                    num_leaves, sum(1 for _ in e.gen_trimmed_leaves()),
+                )
 
     def test_repr_kind(self):
         self.assertEqual('Extent.Kind.DATA', repr(Extent.Kind.DATA))
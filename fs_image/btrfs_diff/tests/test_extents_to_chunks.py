@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import itertools
 import math
+import random
 import re
 import textwrap
 import unittest
@@ -9,7 +10,7 @@ from typing import Iterable, Tuple
 
 from ..extent import Extent
 from ..inode_id import InodeIDMap
-from ..extents_to_chunks import extents_to_chunks_with_clones
+from ..extents_to_chunks import CloneIndex, extents_to_chunks_with_clones
 
 # `unittest`'s output shortening makes tests much harder to debug.
 unittest.util._MAX_LENGTH = 12345
@@ -44,6 +45,56 @@ def _repr_ids_and_chunks(ids_and_chunks: Iterable[Tuple['InodeID', 'Chunk']]):
     }
 
 
+def _repr_clones_from_shared_extents(
+    ids_and_chunks: Iterable[Tuple['InodeID', 'Chunk']],
+):
+    '''
+    Computes the `ChunkClone`s implied by the `shared_extents` of `Chunk`s,
+    in the format of `_repr_ids_and_chunks`.  This lets us check the linear
+    representation against the quadratic one.
+    '''
+    ids_and_chunks = list(ids_and_chunks)
+    # (extent ID) -> [(InodeID, chunk index, chunk file offset, shared)]
+    extent_id_to_refs = {}
+    for id, chunks in ids_and_chunks:
+        chunk_offset = 0
+        for chunk_idx, c in enumerate(chunks):
+            assert not c.chunk_clones
+            for se in c.shared_extents:
+                extent_id_to_refs.setdefault(se.extent_id, []).append(
+                    (id, chunk_idx, chunk_offset, se),
+                )
+            chunk_offset += c.length
+
+    id_to_chunk_clones = {
+        id: [set() for _ in chunks] for id, chunks in ids_and_chunks
+    }
+    for refs in extent_id_to_refs.values():
+        # This is the quadratic part :)
+        for ref, other in itertools.permutations(refs, 2):
+            id, chunk_idx, _, se = ref
+            other_id, _, other_chunk_offset, other_se = other
+            start = max(se.extent_offset, other_se.extent_offset)
+            end = min(
+                se.extent_offset + se.length,
+                other_se.extent_offset + other_se.length,
+            )
+            if start < end:
+                other_offset = other_chunk_offset + other_se.offset + (
+                    start - other_se.extent_offset
+                )
+                id_to_chunk_clones[id][chunk_idx].add(
+                    f'{repr(other_id)}:{other_offset}+{end - start}'
+                    f'@{se.offset + start - se.extent_offset}'
+                )
+    return {
+        repr(id): [
+            (f'{c.kind.name}/{c.length}', chunk_clones)
+                for c, chunk_clones in zip(chunks, id_to_chunk_clones[id])
+        ] for id, chunks in ids_and_chunks
+    }
+
+
 class ExtentsToChunksTestCase(unittest.TestCase):
     '''
     This test has one main focus, plus a few additional checks.
@@ -172,9 +223,19 @@ class ExtentsToChunksTestCase(unittest.TestCase):
             )
 
     def _repr_chunks_from_figure(self, s, **kwargs):
-        return _repr_ids_and_chunks(extents_to_chunks_with_clones(list(
+        ids_and_extents = list(
             self._gen_ids_and_extents_from_figure(s, **kwargs)
-        )))
+        )
+        result = _repr_ids_and_chunks(
+            extents_to_chunks_with_clones(ids_and_extents)
+        )
+        # Every figure test also checks the linear representation.
+        self.assertEqual(result, _repr_clones_from_shared_extents(
+            extents_to_chunks_with_clones(
+                ids_and_extents, shared_extents=True,
+            ),
+        ))
+        return result
 
     def test_gen_ranges_from_figure(self):
         self.assertEqual(
@@ -456,14 +517,15 @@ class ExtentsToChunksTestCase(unittest.TestCase):
         # files, let's make sure the clone detection does the right thing.
         # Also add an empty file to make sure that corner case works.
 
-        ids_and_chunks = list(extents_to_chunks_with_clones([
+        ids_and_extents = [
             (self.id_map.add_file(self.id_map.next(), p), e) for p, e in [
                 (b'a', a),
                 (b'b', b),
                 (b'c', c),
                 (b'e', Extent.empty()),
             ]
-        ]))
+        ]
+        ids_and_chunks = list(extents_to_chunks_with_clones(ids_and_extents))
 
         # I iteratively built this up from the "trimmed leaves" data above,
         # and checked against the real output, one file at a time.  So, this
@@ -563,6 +625,128 @@ class ExtentsToChunksTestCase(unittest.TestCase):
             'e': [],
         }, _repr_ids_and_chunks(ids_and_chunks))
 
+        self.assertEqual(
+            _repr_ids_and_chunks(ids_and_chunks),
+            _repr_clones_from_shared_extents(extents_to_chunks_with_clones(
+                ids_and_extents, shared_extents=True,
+            )),
+        )
+
+    def test_shared_extents(self):
+        # The example from the `extents_to_chunks.py` docblock
+        self.assertEqual({
+            'A': [('DATA/6', ['e0:0+3@0', 'e0:6+3@3'])],
+            'B': [('DATA/5', ['e0:1+5@0'])],
+            'C': [('DATA/5', ['e0:3+5@0'])],
+        }, {
+            repr(id): [
+                (f'{c.kind.name}/{c.length}', [repr(se) for se in ses])
+                    for c in chunks
+                        for ses in [c.shared_extents]
+            ] for id, chunks in extents_to_chunks_with_clones(
+                list(self._gen_ids_and_extents_from_figure('''
+                     BBBBBAAA
+                    AAACCCCC
+                    0123456789
+                ''')),
+                shared_extents=True,
+            )
+        })
+
+        # Unlike `ChunkClone`s, the representation is linear in the number
+        # of clones.
+        source = Extent.empty().write(offset=0, length=32)
+        ids_and_extents = [
+            (
+                self.id_map.add_file(self.id_map.next(), f'f{i}'.encode()),
+                Extent.empty().clone(
+                    to_offset=0, from_extent=source, from_offset=0, length=32,
+                ),
+            ) for i in range(100)
+        ]
+        for shared_extents, expected in [
+            (False, (0, 99)),
+            (True, (1, 0)),
+        ]:
+            self.assertEqual([[expected]] * 100, [
+                [(len(c.shared_extents), len(c.chunk_clones)) for c in chunks]
+                    for _, chunks in extents_to_chunks_with_clones(
+                        ids_and_extents, shared_extents=shared_extents,
+                    )
+            ])
+
+    def test_clone_index(self):
+        rand = random.Random(42)  # Deterministic, but varied
+        ids = [
+            self.id_map.add_file(self.id_map.next(), f'f{i}'.encode())
+                for i in range(6)
+        ]
+        id_to_extent = {}
+        idx = CloneIndex()
+        for step in range(300):
+            ino_id = rand.choice(ids)
+            extent = id_to_extent.get(ino_id, Extent.empty())
+            op = rand.randrange(5)
+            if op == 0:
+                extent = extent.write(
+                    offset=rand.randrange(20), length=rand.randrange(1, 8),
+                )
+            elif op == 1:
+                extent = extent.truncate(length=rand.randrange(20))
+            elif op == 2:
+                from_extent = rand.choice(list(id_to_extent.values()) or [
+                    Extent.empty().write(offset=0, length=10),
+                ])
+                length = rand.randrange(from_extent.length + 1)
+                if length:
+                    extent = extent.clone(
+                        to_offset=rand.randrange(20),
+                        from_extent=from_extent,
+                        from_offset=rand.randrange(
+                            from_extent.length - length + 1
+                        ),
+                        length=length,
+                    )
+            elif op == 3:
+                id_to_extent.pop(ino_id, None)  # The file was deleted
+                extent = None
+            # else: The file is unchanged
+            if extent is not None:
+                id_to_extent[ino_id] = extent
+
+            with self.subTest(step=step):
+                id_to_chunks = idx.update(id_to_extent.items())
+                self.assertEqual(
+                    dict(extents_to_chunks_with_clones(
+                        list(id_to_extent.items()),
+                    )),
+                    dict(id_to_chunks),
+                )
+
+        # Only the changed inodes, and those sharing their leaf extents,
+        # get new `Chunk`s.
+        a, b, c = ids[:3]
+        shared = Extent.empty().write(offset=0, length=5)
+        id_to_extent = {
+            a: shared,
+            b: Extent.empty().clone(
+                to_offset=0, from_extent=shared, from_offset=0, length=5,
+            ),
+            c: Extent.empty().write(offset=0, length=5),
+        }
+        prev_id_to_chunks = dict(idx.update(id_to_extent.items()))
+        self.assertEqual(
+            {a, b, c}, set(prev_id_to_chunks),  # The old inodes were dropped
+        )
+        id_to_extent[a] = id_to_extent[a].truncate(length=3)
+        id_to_chunks = idx.update(id_to_extent.items())
+        self.assertIs(prev_id_to_chunks[c], id_to_chunks[c])
+        self.assertIsNot(prev_id_to_chunks[b], id_to_chunks[b])
+        self.assertEqual(
+            dict(extents_to_chunks_with_clones(list(id_to_extent.items()))),
+            dict(id_to_chunks),
+        )
+
 
 if __name__ == '__main__':
     unittest.main()
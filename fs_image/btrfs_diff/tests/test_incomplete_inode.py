@@ -1,13 +1,18 @@
 #!/usr/bin/env python3
+import copy
 import stat
 import unittest
 
-from ..inode import InodeOwner, InodeUtimes
+from ..extent import Extent
+from ..freeze import freeze
+from ..inode import Chunk, InodeOwner, InodeUtimes
 from ..incomplete_inode import (
     IncompleteDevice, IncompleteDir, IncompleteFifo, IncompleteFile,
-    IncompleteSocket, IncompleteSymlink,
+    IncompleteInodeMap, IncompletePlaceholder, IncompleteSocket,
+    IncompleteSymlink,
 )
 from ..parse_dump import SendStreamItem, SendStreamItems as SSI
+from ..send_stream import WriteDataRef
 
 
 class IncompleteInodeTestCase(unittest.TestCase):
@@ -71,6 +76,58 @@ class IncompleteInodeTestCase(unittest.TestCase):
         with self.assertRaisesRegex(RuntimeError, 'cannot apply FakeItem'):
             ino.apply_item(FakeItem(path=b'a'))
 
+    def test_compact_representation(self):
+        ino = IncompleteFile(item=SSI.mkfile(path=b'a'))
+        ino2 = IncompleteDevice(item=SSI.mknod(
+            path=b'b', mode=stat.S_IFCHR | 0o644, dev=0x1234,
+        ))
+        for i in [ino, ino2]:
+            self.assertFalse(hasattr(i, '__dict__'))
+        self.assertIs(ino.xattrs, ino2.xattrs)  # Empty & shared
+        with self.assertRaises(TypeError):
+            ino.xattrs[b'cat'] = b'nip'
+        with self.assertRaisesRegex(KeyError, 'cat'):
+            ino.apply_item(SSI.remove_xattr(path=b'a', name=b'cat'))
+        for i in [ino, ino2]:
+            i.apply_item(SSI.chown(path=b'a', uid=10, gid=20))
+        self.assertIs(ino.owner, ino2.owner)
+
+    def test_incomplete_file_lazy_write(self):
+        ino = IncompleteFile(item=SSI.mkfile(path=b'a'))
+        # A lazily-parsed `write` only needs the length of its data.
+        ino.apply_item(SSI.write(
+            path=b'a', offset=2, data=WriteDataRef(offset=1234, length=3),
+        ))
+        self.assertEqual('(File h2d3)', repr(ino))
+
+    def test_incomplete_file_v2_items(self):
+        ino = IncompleteFile(item=SSI.mkfile(path=b'a'))
+        # The logical length is what counts, not the compressed size.
+        ino.apply_item(SSI.encoded_write(
+            path=b'a', offset=0, unencoded_file_len=10, unencoded_len=4096,
+            unencoded_offset=0, compression=1, encryption=0, data=b'x' * 3,
+        ))
+        self.assertEqual('(File d10)', repr(ino))
+
+        def fallocate(mode, offset, length):
+            ino.apply_item(SSI.fallocate(
+                path=b'a', mode=mode, offset=offset, len=length,
+            ))
+            return repr(ino)
+
+        self.assertEqual('(File d10)', fallocate(1, 5, 20))  # KEEP_SIZE
+        self.assertEqual('(File d10h5)', fallocate(0, 5, 10))
+        self.assertEqual('(File d2h4d4h5)', fallocate(3, 2, 4))  # PUNCH_HOLE
+        self.assertEqual('(File d2h4d4h5)', fallocate(3, 20, 4))
+        self.assertEqual('(File h15)', fallocate(0x11, 0, 20))  # ZERO_RANGE
+        self.assertEqual('(File h20)', fallocate(0x10, 10, 10))
+        for bad_mode in [2, 0x8]:  # PUNCH_HOLE needs KEEP_SIZE, COLLAPSE
+            with self.assertRaisesRegex(RuntimeError, 'bad mode'):
+                fallocate(bad_mode, 0, 1)
+
+        ino.apply_item(SSI.fileattr(path=b'a', attr=0x10))  # Ignored
+        self.assertEqual('(File h20)', repr(ino))
+
     # These have no special logic, so this exercise is mildly redundant,
     # but hey, unexecuted Python is a dead, smelly, broken Python.
     def test_simple_file_types(self):
@@ -121,6 +178,49 @@ class IncompleteInodeTestCase(unittest.TestCase):
 
         self.assertEqual('(Symlink o1:2 cat)', repr(ino))
 
+    def test_freeze_reuse(self):
+        d = IncompleteDir(item=SSI.mkdir(path=b'd'))
+        d.apply_item(SSI.chmod(path=b'd', mode=0o755))
+        dev = IncompleteDevice(item=SSI.mknod(
+            path=b'dev', mode=stat.S_IFCHR | 0o644, dev=0x12,
+        ))
+        sym = IncompleteSymlink(item=SSI.symlink(path=b's', dest=b'cat'))
+        for ino, mutate, ino_repr in [
+            (d, lambda: d.apply_item(SSI.set_xattr(
+                path=b'd', name=b'user.a', data=b'b',
+            )), "(Dir m755 x'user.a'='b')"),
+            # Direct edits, as in `inode_utils.py`, count as changes, too.
+            (d, lambda: setattr(d, 'mode', None), "(Dir x'user.a'='b')"),
+            (dev, lambda: setattr(dev, 'dev', 0x34), '(Char m644 34)'),
+            (sym, lambda: setattr(sym, 'dest', b'dog'), '(Symlink dog)'),
+        ]:
+            frozen = freeze(ino, chunks=None)
+            self.assertIs(frozen, freeze(ino, chunks=None))
+            mutate()
+            self.assertEqual(ino_repr, repr(freeze(ino, chunks=None)))
+            self.assertIsNot(frozen, freeze(ino, chunks=None))
+
+        # Copies start without the cache, but freeze the same.
+        frozen = freeze(d, chunks=None)
+        d_copy = copy.deepcopy(d)
+        self.assertIsNot(frozen, freeze(d_copy, chunks=None))
+        self.assertEqual(frozen, freeze(d_copy, chunks=None))
+        d_copy.apply_item(SSI.set_xattr(path=b'd', name=b'user.a', data=b''))
+        self.assertEqual({b'user.a': b'b'}, d.xattrs)
+
+        # Files with new `Chunk`s share the rest of the frozen `Inode`.
+        f = IncompleteFile(item=SSI.mkfile(path=b'f'))
+        f.apply_item(SSI.set_xattr(path=b'f', name=b'user.a', data=b'b'))
+        chunks = (Chunk(kind=Extent.Kind.DATA, length=5, chunk_clones=()),)
+        frozen = freeze(f, chunks=chunks)
+        self.assertIs(frozen, freeze(f, _memo={
+            id(chunks): frozen.chunks,
+        }, chunks=chunks))
+        self.assertEqual("(File x'user.a'='b' d5)", repr(frozen))
+        frozen2 = freeze(f, chunks=chunks[:0])
+        self.assertEqual("(File x'user.a'='b')", repr(frozen2))
+        self.assertIs(frozen.xattrs, frozen2.xattrs)
+
     def test_apply_clone(self):
         f1 = IncompleteFile(item=SSI.mkfile(path=b'unused'))
         f1.apply_item(SSI.write(path=b'unused', offset=10, data=b'a' * 10))
@@ -153,6 +253,58 @@ class IncompleteInodeTestCase(unittest.TestCase):
         self.assertEqual('(File h10d10)', repr(f1))
         self.assertEqual('(File d3h7d5)', repr(f2))
 
+    def test_inode_map(self):
+        m = IncompleteInodeMap()
+        f = IncompleteFile(item=SSI.mkfile(path=b'f'))
+        f.apply_item(SSI.write(path=b'f', offset=0, data=b'abc'))
+        m[5] = f
+        m[7] = IncompleteDevice(item=SSI.mknod(
+            path=b'b', mode=stat.S_IFBLK | 0o600, dev=0x12,
+        ))
+        m[9] = IncompleteSymlink(item=SSI.symlink(path=b's', dest=b'cat'))
+        m[11] = IncompletePlaceholder(item=SSI.chmod(path=b'p', mode=0o1))
+        self.assertEqual([5, 7, 9, 11], list(m))
+        self.assertEqual(4, len(m))
+        self.assertEqual(
+            ['(File d3)', '(Block m600 12)', '(Symlink cat)', '(Unknown)'],
+            [repr(ino) for ino in m.values()],
+        )
+        self.assertIsInstance(m[11], IncompletePlaceholder)
+        self.assertNotIn(6, m)
+        self.assertIsNone(m.get(6))
+        with self.assertRaises(KeyError):
+            m[6]
+
+        # The map stored a copy, and mutating its inode mutates the map.
+        f.apply_item(SSI.chmod(path=b'f', mode=0o644))
+        self.assertEqual('(File d3)', repr(m[5]))
+        m[5].apply_item(SSI.chown(path=b'f', uid=1, gid=2))
+        self.assertEqual(InodeOwner(uid=1, gid=2), m[5].owner)
+        self.assertIs(f.extent, m[5].extent)
+
+        # Copies are independent, including their xattrs.
+        c = m.copy()
+        c[5].apply_item(SSI.set_xattr(path=b'f', name=b'user.a', data=b'b'))
+        c[7].apply_item(SSI.utimes(
+            path=b'b', ctime=(1, 2), mtime=(3, 4), atime=(5, 6),
+        ))
+        del c[9]
+        self.assertEqual({}, m[5].xattrs)
+        self.assertIsNone(m[7].utimes)
+        self.assertIn(9, m)
+        self.assertEqual({b'user.a': b'b'}, c[5].xattrs)
+        self.assertEqual(
+            InodeUtimes(ctime=(1, 2), mtime=(3, 4), atime=(5, 6)),
+            c[7].utimes,
+        )
+        self.assertEqual([5, 7, 11], list(c))
+
+        # `deepcopy` of a view makes a standalone inode.
+        d = copy.deepcopy(c[7])
+        d.apply_item(SSI.chmod(path=b'b', mode=0o644))
+        self.assertEqual(0o600, c[7].mode)
+        self.assertEqual('(Block m644 t70/01/01.00:00:01+2+2 12)', repr(d))
+
 
 if __name__ == '__main__':
     unittest.main()
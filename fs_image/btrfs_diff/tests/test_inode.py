@@ -6,7 +6,8 @@ from ..extent import Extent
 from ..extents_to_chunks import extents_to_chunks_with_clones
 from ..inode import (
     _time_delta, _repr_time, _repr_time_delta,
-    Chunk, ChunkClone, Clone, Inode, InodeOwner, InodeUtimes,
+    Chunk, ChunkClone, ChunkSharedExtent, Clone, Inode, InodeOwner,
+    InodeUtimes,
 )
 from ..inode_id import InodeIDMap
 
@@ -142,6 +143,29 @@ class InodeTestCase(unittest.TestCase):
             ('(DATA/12: a:7+2@3, a:5+6@4)', '(DATA/12: a:5+6@4, a:7+2@3)'),
         )
 
+    def test_chunk_shared_extent(self):
+        se = ChunkSharedExtent(offset=3, length=2, extent_offset=7, extent_id=5)
+        self.assertEqual('e5:7+2@3', repr(se))
+        self.assertEqual('e9:7+2@3', se.repr_with_extent_id(9))
+        chunk = Chunk(
+            kind=Extent.Kind.DATA, length=12, chunk_clones=(),
+            shared_extents=(se, se._replace(offset=5, extent_id=0)),
+        )
+        self.assertEqual('(DATA/12; e5:7+2@3, e0:7+2@5)', repr(chunk))
+
+        ino = self._complete_inode(stat.S_IFREG, chunks=(
+            chunk,
+            Chunk(kind=Extent.Kind.HOLE, length=3, chunk_clones=()),
+        ))
+        self.assertEqual(
+            '(File m644 o3:5 t70/01/01.00:00:02+5+2 d12[e5:7+2@3/e0:7+2@5]h3)',
+            repr(ino),
+        )
+        self.assertEqual(
+            '(File m644 o3:5 t70/01/01.00:00:02+5+2 d12[e2:7+2@3/e7:7+2@5]h3)',
+            ino.repr_with_extent_ids({5: 2, 0: 7}.__getitem__),
+        )
+
     def test_repr_owner(self):
         self.assertEqual('12:345', repr(InodeOwner(uid=12, gid=345)))
 
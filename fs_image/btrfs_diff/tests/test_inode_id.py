@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import copy
 import random
 import unittest
 
@@ -6,7 +7,7 @@ from types import SimpleNamespace
 
 from ..freeze import freeze
 from ..inode_id import (
-    InodeID, InodeIDMap, _PathEntry, _ReversePathEntry, _ROOT_REVERSE_ENTRY,
+    InodeID, InodeIDMap, _ReversePathEntry, _ROOT_REVERSE_ENTRY,
 )
 
 from .deepcopy_test import DeepCopyTestCase
@@ -109,7 +110,7 @@ class InodeIDTestCase(DeepCopyTestCase):
             TypeError, 'mappingproxy.* does not support item deletion',
         ):
             freeze(id_map).remove_path(b'a/c')
-        self.assertIs(mut_ns.ino2, id_map.remove_path(b'a/c'))
+        self.assertEqual(mut_ns.ino2, id_map.remove_path(b'a/c'))
         saved_frozen_map = freeze(id_map)  # We'll check this later
         id_map = yield from maybe_replace_map(id_map, 'removed a/c name')
         for im, ns in unfrozen_and_frozen(id_map, mut_ns):
@@ -119,15 +120,11 @@ class InodeIDTestCase(DeepCopyTestCase):
 
             self.assertEqual({b'a'}, im.get_children(ns.ino_root))
 
-        # Look-up by ID
-        for (im, ns), check_same in zip(
-            unfrozen_and_frozen(id_map, mut_ns),
-            # `is` comparison would be harder to implement for the frozen
-            # variant, and meaningless because we just constructed it.
-            [self.assertIs, self.assertEqual],
-        ):
-            check_same(ns.ino1, im.get_id(b'a'))
-            check_same(ns.ino2, im.get_id(b'a/d'))
+        # Look-up by ID.  The map stores integers, so the `InodeID`s it
+        # returns are equal to, but not the same objects as, ours.
+        for im, ns in unfrozen_and_frozen(id_map, mut_ns):
+            self.assertEqual(ns.ino1, im.get_id(b'a'))
+            self.assertEqual(ns.ino2, im.get_id(b'a/d'))
 
         # Cannot remove non-empty directories
         with self.assertRaisesRegex(RuntimeError, "remove b'a'.*has children"):
@@ -141,7 +138,7 @@ class InodeIDTestCase(DeepCopyTestCase):
         # Check that we clean up empty path sets
         for im, ns in unfrozen_and_frozen(id_map, mut_ns):
             self.assertIn(ns.ino2.id, im.inner.id_to_reverse_entries)
-        self.assertIs(mut_ns.ino2, id_map.remove_path(b'a/d'))
+        self.assertEqual(mut_ns.ino2, id_map.remove_path(b'a/d'))
         id_map = yield from maybe_replace_map(id_map, 'removed a/d name')
         for im, _ns in unfrozen_and_frozen(id_map, mut_ns):
             self.assertNotIn(INO2_ID, im.inner.id_to_reverse_entries)
@@ -182,11 +179,9 @@ class InodeIDTestCase(DeepCopyTestCase):
         id_map = yield from maybe_replace_map(id_map, 'removed a')
         for im, _ns in unfrozen_and_frozen(id_map, mut_ns):
             self.assertEqual(
-                {0: {_ROOT_REVERSE_ENTRY}}, im.inner.id_to_reverse_entries,
+                {0: (_ROOT_REVERSE_ENTRY,)}, im.inner.id_to_reverse_entries,
             )
-            self.assertEqual(_PathEntry(
-                id=InodeID(id=0, inner_id_map=im.inner), name_to_child={},
-            ), im.root)
+            self.assertEqual({0: {}}, im.id_to_children)
 
         # Test renaming directories
         id_map.add_dir(id_map.next(), b'x')
@@ -214,16 +209,14 @@ class InodeIDTestCase(DeepCopyTestCase):
             # `get_children` promises to return None for files.
             self.assertIsNone(im.get_children(im.get_id(b'x1/y/z')))
 
-        # Tests for `_reverse_entry_matches_path_parts`: Given an InodeID,
-        # look up the `ReversePathEntry` that corresponds to a given path.
+        # Removing a hardlink must drop just its `ReversePathEntry`.
         #
-        # (1) Let us specifically aims to cover the cases when, of the path
-        # and the `ReversePathEntry`, one is a suffix of the other.  For
+        # (1) Let us specifically cover the cases when, of the removed path
+        # and another hardlink, one is a suffix of the other.  For
         # example: `e/d/c/b/a` and `c/b/a`.
         mut_ns.ino_id = id_map.next()
-        # To see such suffixes we must get lucky with iteration order of the
-        # reverse entries `set`.  The solution is to have many entries,
-        # randomly inserted into the `set`, ensuring that we hit both cases.
+        # Insert the hardlinks in random order, so that the removed entry
+        # is found at varying positions among the reverse entries.
         depths = list(range(20))  # Raise this until our coverage isn't flaky.
         random.shuffle(depths)
         for depth in depths:
@@ -235,9 +228,7 @@ class InodeIDTestCase(DeepCopyTestCase):
                 id_map.add_dir(id_map.next(), path)
             id_map.add_file(mut_ns.ino_id, path + b'/0')
         id_map = yield from maybe_replace_map(id_map, 'made suffixy hardlinks')
-        # Each `remove` has a chance of hitting either "suffix" relationship
-        # before finding the right `reverse_entry`.  Randomize the order to
-        # make sure our odds are "as expected", untained by systematic bias.
+        # Randomize the order of removals, too.
         random.shuffle(depths)
         for depth in depths:
             id_map.remove_path(
@@ -246,8 +237,7 @@ class InodeIDTestCase(DeepCopyTestCase):
         id_map = yield from maybe_replace_map(id_map, 'removed hardlinks')
         mut_ns.ino_id = InodeID(id=mut_ns.ino_id.id, inner_id_map=id_map.inner)
         self.assertEqual(set(), id_map.get_paths(mut_ns.ino_id))
-        # (2) Let's try a few hardlinks, neither a suffix of the other, to
-        # make sure we hit the "different paths" branch.
+        # (2) Let's try a few hardlinks, neither a suffix of the other.
         num_diff_paths = 20  # Raise this until our coverage isn't flaky.
         for i in range(num_diff_paths):
             id_map.add_file(mut_ns.ino_id, f'lala{i}'.encode())
@@ -279,23 +269,15 @@ class InodeIDTestCase(DeepCopyTestCase):
         # Even though we changed `id_map` a lot, `saved_frozen` is still
         # in the same state where we took the snapshot.
         self.assertIsNone(saved_frozen_map.inode_id_counter)
-        self.assertEqual(_PathEntry(
-            id=InodeID(id=0, inner_id_map=saved_frozen_map.inner),
-            name_to_child={
-                b'a': _PathEntry(id=InodeID(
-                    id=INO1_ID, inner_id_map=saved_frozen_map.inner,
-                ), name_to_child={
-                    b'd': _PathEntry(id=InodeID(
-                        id=INO2_ID, inner_id_map=saved_frozen_map.inner,
-                    ), name_to_child=None)
-                }),
-            },
-        ), saved_frozen_map.root)
+        self.assertEqual({
+            0: {b'a': INO1_ID},
+            INO1_ID: {b'd': INO2_ID},
+        }, saved_frozen_map.id_to_children)
         self.assertEqual('', saved_frozen_map.inner.description)
         self.assertEqual({
-            0: {_ROOT_REVERSE_ENTRY},
-            INO1_ID: {_ReversePathEntry(name=b'a', parent_int_id=0)},
-            INO2_ID: {_ReversePathEntry(name=b'd', parent_int_id=INO1_ID)},
+            0: (_ROOT_REVERSE_ENTRY,),
+            INO1_ID: (_ReversePathEntry(name=b'a', parent_int_id=0),),
+            INO2_ID: (_ReversePathEntry(name=b'd', parent_int_id=INO1_ID),),
         }, saved_frozen_map.inner.id_to_reverse_entries)
 
     def test_inode_id_and_map(self):
@@ -307,6 +289,124 @@ class InodeIDTestCase(DeepCopyTestCase):
             'cat@food', repr(cat_map.add_file(cat_map.next(), b'food')),
         )
 
+    def test_snapshot(self):
+        cat = InodeIDMap.new(description='cat')
+        cat.add_dir(cat.next(), b'a')
+        cat.add_dir(cat.next(), b'a/b')
+        cat_file = cat.add_file(cat.next(), b'a/b/c')
+        cat.add_file(cat_file, b'a/c')
+
+        def paths(im):
+            return {
+                p: sorted(im.get_paths(im.get_id(p)))
+                    for p in [b'.', b'a', b'a/b', b'a/b/c', b'a/c']
+                        if im.get_id(p) is not None
+            }
+
+        cat_paths = paths(cat)
+        tiger = cat.snapshot(description='tiger')
+        self.assertEqual(cat_paths, paths(tiger))
+        self.assertEqual('tiger@a/b/c,a/c', repr(tiger.get_id(b'a/b/c')))
+        # Unchanged directories are shared until one side mutates them.
+        b_id = cat.get_id(b'a/b').id
+        self.assertIs(cat.id_to_children[b_id], tiger.id_to_children[b_id])
+        # The counters are independent, but start at the same place.
+        self.assertEqual(cat.next().id, tiger.next().id)
+
+        tiger.rename_path(b'a/b', b'b')
+        tiger.remove_path(b'a/c')
+        tiger.add_file(tiger.next(), b'b/d')
+        self.assertEqual(cat_paths, paths(cat))
+        self.assertEqual({
+            b'.': [b'.'], b'a': [b'a'], b'a/b': [b'a/b'],
+            b'a/b/c': [b'a/b/c', b'a/c'], b'a/c': [b'a/b/c', b'a/c'],
+        }, cat_paths)
+        self.assertEqual({b'b/c'}, tiger.get_paths(tiger.get_id(b'b/c')))
+        self.assertEqual({b'b/c', b'b/d'}, tiger.get_children(
+            tiger.get_id(b'b'),
+        ))
+        self.assertEqual({b'a/b/c'}, cat.get_children(cat.get_id(b'a/b')))
+        self.assertEqual(cat_file.id, tiger.remove_path(b'b/c').id)
+        self.assertIsNone(tiger.get_id(b'a/b'))
+
+        # Mutating the parent after a snapshot does not affect the child.
+        lion = cat.snapshot(description='lion')
+        cat.remove_path(b'a/b/c')
+        self.assertEqual({b'a/c'}, cat.get_paths(cat_file))
+        self.assertEqual(
+            {b'a/b/c', b'a/c'}, lion.get_paths(lion.get_id(b'a/c')),
+        )
+
+    def test_dir_path_cache(self):
+        id_map = InodeIDMap.new()
+        id_map.add_dir(id_map.next(), b'a')
+        id_map.add_dir(id_map.next(), b'a/b')
+        ino = id_map.add_file(id_map.next(), b'a/b/c')
+        self.assertEqual({b'a/b/c'}, id_map.get_paths(ino))
+        self.assertEqual(
+            {1: b'a', 2: b'a/b'}, id_map.inner.dir_paths,
+        )
+        frozen = freeze(id_map)
+        # Renaming or removing a directory invalidates the cache.
+        self.assertEqual({b'a': 1, b'a/b': 2}, id_map.inner.path_to_dir_id)
+        self.assertEqual(ino, id_map.get_id(b'a/b/c'))
+        id_map.rename_path(b'a', b'x')
+        self.assertEqual({}, id_map.inner.dir_paths)
+        self.assertEqual({b'x': 1}, id_map.inner.path_to_dir_id)
+        self.assertIsNone(id_map.get_id(b'a/b/c'))
+        self.assertEqual({b'x/b/c'}, id_map.get_paths(ino))
+        id_map.add_file(ino, b'x/d')
+        self.assertEqual({b'x/b/c', b'x/d'}, id_map.get_paths(ino))
+        id_map.rename_path(b'x/b/c', b'x/b/e')  # Files don't invalidate it
+        self.assertEqual({1: b'x', 2: b'x/b'}, id_map.inner.dir_paths)
+        # Frozen maps compute the paths of all nonempty directories.
+        self.assertEqual({0: b'.', 1: b'a', 2: b'a/b'}, frozen.inner.dir_paths)
+        self.assertEqual({b'a': 1, b'a/b': 2}, frozen.inner.path_to_dir_id)
+        self.assertEqual(
+            {b'a/b/c'}, frozen.get_paths(frozen.get_id(b'a/b/c')),
+        )
+
+    def test_freeze_cache(self):
+        description = ['cat']
+        id_map = InodeIDMap.new(description=description)
+        ino = id_map.add_file(id_map.next(), b'f')
+        frozen = freeze(id_map)
+        # An unchanged map freezes to the same object, also via `InodeID`s.
+        self.assertIs(frozen, freeze(id_map))
+        self.assertIs(frozen.inner, freeze(ino).inner_id_map)
+        # Copies start without the cache.
+        self.assertIsNot(frozen, freeze(copy.deepcopy(id_map)))
+        for mutate in [
+            lambda: id_map.add_dir(id_map.next(), b'd'),
+            lambda: id_map.rename_path(b'f', b'd/g'),
+            lambda: id_map.remove_path(b'd/g'),
+            lambda: description.append('tiger'),
+        ]:
+            mutate()
+            new_frozen = freeze(id_map)
+            self.assertIsNot(frozen, new_frozen)
+            self.assertIs(new_frozen, freeze(id_map))
+            frozen = new_frozen
+        self.assertEqual({b'd'}, frozen.get_children(frozen.get_id(b'.')))
+        self.assertEqual(('cat', 'tiger'), frozen.inner.description)
+        # Snapshots have their own cache.
+        self.assertIsNot(frozen, freeze(id_map.snapshot(
+            description=description,
+        )))
+
+    def test_deep_paths(self):
+        id_map = InodeIDMap.new()
+        path = b'd'
+        for _ in range(1500):  # Deeper than the default recursion limit
+            id_map.add_dir(id_map.next(), path)
+            path += b'/d'
+        ino = id_map.add_file(id_map.next(), path)
+        self.assertEqual({path}, id_map.get_paths(ino))
+        frozen = freeze(id_map)
+        self.assertEqual({path}, frozen.get_paths(
+            InodeID(id=ino.id, inner_id_map=frozen.inner),
+        ))
+
     def test_hashing_and_equality(self):
         maps = [InodeIDMap.new() for i in range(100)]
         hashes = {hash(m.get_id(b'.')) for m in maps}
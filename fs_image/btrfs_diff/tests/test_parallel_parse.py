@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+import io
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+from .demo_sendstreams import gold_demo_sendstreams
+
+from .. import parallel_parse
+from ..parallel_parse import (
+    compact_to_items, items_to_compact, parse_btrfs_dump_parallel,
+    parse_send_stream_files,
+)
+from ..parse_dump import parse_btrfs_dump
+from ..parse_send_stream import parse_send_stream
+from ..send_stream import SendStreamItems, WriteDataRef
+
+
+class ParallelParseTestCase(unittest.TestCase):
+
+    def test_compact_round_trip(self):
+        items = [
+            i for d in gold_demo_sendstreams().values()
+                for i in parse_send_stream(io.BytesIO(d['sendstream']))
+        ] + [
+            SendStreamItems.fileattr(path=b'a', attr=3),
+            SendStreamItems.write(
+                path=b'a', offset=0, data=WriteDataRef(offset=5, length=7),
+            ),
+        ]
+        compact = items_to_compact(items)
+        self.assertTrue(all(type(c) is tuple for c in compact))
+        self.assertEqual(items, list(compact_to_items(compact)))
+
+    def test_parse_send_stream_files(self):
+        streams = gold_demo_sendstreams()
+        names = ['create_ops', 'mutate_ops', 'create_ops']
+        with tempfile.TemporaryDirectory() as td:
+            paths = []
+            for i, name in enumerate(names):
+                paths.append(os.path.join(td, f'{i}_{name}').encode())
+                with open(paths[-1], 'wb') as f:
+                    f.write(streams[name]['sendstream'])
+
+            expected = [
+                list(parse_send_stream(io.BytesIO(streams[n]['sendstream'])))
+                    for n in names
+            ]
+            self.assertEqual(expected, list(parse_send_stream_files(paths)))
+            self.assertEqual(expected, list(parse_send_stream_files(
+                paths, max_workers=1,
+            )))
+
+            for items, path in zip(
+                parse_send_stream_files(paths, lazy_data=True), paths,
+            ):
+                with open(path, 'rb') as f:
+                    for item in items:
+                        if isinstance(item, SendStreamItems.write):
+                            self.assertIsInstance(item.data, WriteDataRef)
+                            self.assertEqual(
+                                len(item.data), len(item.data.read(f)),
+                            )
+
+            # Files that cannot be `mmap`ed are read as streams.
+            empty_path = os.path.join(td, 'empty').encode()
+            with open(empty_path, 'wb'):
+                pass
+            with self.assertRaisesRegex(RuntimeError, "Magic b'', not"):
+                list(parse_send_stream_files([paths[0], empty_path]))
+
+    def test_parse_btrfs_dump_parallel(self):
+        for name, d in gold_demo_sendstreams().items():
+            dump = b''.join(l + b'\n' for l in d['dump'] if l)
+            expected = list(parse_btrfs_dump(io.BytesIO(dump)))
+            for max_workers, chunk_lines in [(None, 10000), (2, 7)]:
+                self.assertEqual(expected, list(parse_btrfs_dump_parallel(
+                    io.BytesIO(dump),
+                    max_workers=max_workers,
+                    chunk_lines=chunk_lines,
+                )), name)
+            # Errors in a chunk come after the items of the prior chunks.
+            bad_dump = dump + b'mkfile ./nope\n'
+            items = []
+            with self.assertRaisesRegex(RuntimeError, 'did not start with'):
+                for item in parse_btrfs_dump_parallel(
+                    io.BytesIO(bad_dump), max_workers=2, chunk_lines=7,
+                ):
+                    items.append(item)
+            self.assertEqual(expected, items)
+        self.assertEqual([], list(parse_btrfs_dump_parallel(io.BytesIO())))
+
+    def test_parse_btrfs_dump_parallel_worker_error(self):
+        dump = b''.join(
+            l + b'\n' for l in gold_demo_sendstreams()['create_ops']['dump']
+                if l
+        )
+        expected = list(parse_btrfs_dump(io.BytesIO(dump)))
+        items = []
+        # Fails in the worker with a `TypeError`, but not when re-parsed.
+        with unittest.mock.patch.object(
+            parallel_parse, '_parse_dump_lines_to_compact', os.strerror,
+        ), self.assertRaises(TypeError):
+            for item in parse_btrfs_dump_parallel(
+                io.BytesIO(dump), max_workers=2, chunk_lines=7,
+            ):
+                items.append(item)
+        # We got the first item, and the items of the failed chunk.
+        self.assertEqual(expected[:8], items)
+
+
+if __name__ == '__main__':
+    unittest.main()
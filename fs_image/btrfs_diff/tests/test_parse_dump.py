@@ -6,7 +6,8 @@ import unittest
 from typing import List, Sequence
 
 from ..parse_dump import (
-    NAME_TO_PARSER_TYPE, parse_btrfs_dump, unquote_btrfs_progs_path,
+    NAME_TO_PARSER_TYPE, parse_btrfs_dump, parse_btrfs_dump_lines,
+    unquote_btrfs_progs_path,
 )
 from ..send_stream import SendStreamItem, SendStreamItems
 
@@ -64,9 +65,12 @@ class ParseBtrfsDumpTestCase(unittest.TestCase):
             'utimes',
             # Omitted since `--dump` never prints data: 'write',
         }
+        # `demo_sendstreams.py` makes version 1 streams, so these are
+        # covered by `test_v2_items` instead.
+        v2_ops = {'encoded_write', 'fallocate', 'fileattr'}
         self.assertEqual(
             {n.decode() for n in NAME_TO_PARSER_TYPE.keys()},
-            expected_ops,
+            expected_ops | v2_ops,
         )
 
         # Now check that `demo_sendstream.py` also exercises those operations.
@@ -136,6 +140,49 @@ class ParseBtrfsDumpTestCase(unittest.TestCase):
         with self.assertRaisesRegex(RuntimeError, "s/t' contains /"):
             _parse_lines_to_list([subvol_line.replace(b'./s', b'./s/t')])
 
+    def test_line_splitting(self):
+        self.assertEqual([
+            # Escaped spaces are part of the path, the other spaces are not.
+            SendStreamItems.mkfile(path=b'a b\\'),
+            SendStreamItems.chmod(path=b'.', mode=0o755),
+            # Only `--dump` paths may contain newlines, not the details.
+            SendStreamItems.unlink(path=b'c\nd'),
+        ], list(parse_btrfs_dump_lines([
+            b'mkfile  ./s/a\\ b\\\n',
+            b'chmod ./s/    mode=755\n',
+            b'unlink ./s/c\nd\n',
+        ], b's')))
+        for bad_line in [
+            b'mkfile ./s/a',  # No newline
+            b'mkfile\n',  # No path
+            b'mkfile  \n',
+            b'chmod ./s/a mode=7\n55\n',
+            b'chmod ./s/a mode=8\n',
+        ]:
+            with self.assertRaisesRegex(RuntimeError, 'unexpected format'):
+                list(parse_btrfs_dump_lines([bad_line], b's'))
+        # The subvolume path itself, but without the `./` that `--dump`
+        # always prints.  The slow path still catches this.
+        with self.assertRaisesRegex(RuntimeError, 'did not start with'):
+            list(parse_btrfs_dump_lines([b'mkfile s\n'], b's'))
+
+    def test_v2_items(self):
+        uuid = '01234567-0123-0123-0123-012345678901'
+        self.assertEqual([
+            SendStreamItems.subvol(path=b's', uuid=uuid.encode(), transid=7),
+            # `--dump` omits the data, so this is like `write`.
+            SendStreamItems.update_extent(path=b'f', offset=4096, len=5000),
+            SendStreamItems.fallocate(path=b'f', mode=3, offset=5, len=10),
+            SendStreamItems.fileattr(path=b'f', attr=0x10),
+        ], _parse_lines_to_list([
+            f'subvol ./s uuid={uuid} transid=7'.encode(),
+            b'encoded_write ./s/f offset=4096 len=1234, '
+                b'unencoded_file_len=5000, unencoded_len=8192, '
+                b'unencoded_offset=0, compression=1, encryption=0',
+            b'fallocate ./s/f mode=3 offset=5 len=10',
+            b'fileattr ./s/f fileattr=0x10',
+        ]))
+
     def test_set_xattr_errors(self):
         uuid = '01234567-0123-0123-0123-012345678901'
 
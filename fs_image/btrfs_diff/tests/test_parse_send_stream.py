@@ -4,16 +4,22 @@ This test only validates the binary send-stream parser. We rely on the fact
 that `test_parse_dump.py` already sanity-checks the gold data.
 '''
 import io
+import mmap
 import struct
+import tempfile
 import unittest
 
 from .demo_sendstreams import gold_demo_sendstreams
 from .demo_sendstreams_expected import get_filtered_and_expected_items
 
+from ..crc32c import crc32c
 from ..parse_send_stream import (
-    AttributeKind, check_magic, check_version, CommandKind, file_unpack,
-    parse_send_stream, read_attribute, read_command,
+    _CrcVerifier, AttributeKind, BTRFS_SEND_STREAM_MAGIC, check_magic,
+    check_version, CommandKind, file_unpack, parse_send_stream,
+    parse_send_stream_buffer, read_attribute, read_command, read_command_at,
+    scan_send_stream, scan_send_stream_buffer, scan_send_stream_offsets,
 )
+from ..send_stream import SendStreamItems, WriteDataRef
 
 # `unittest`'s output shortening makes tests much harder to debug.
 unittest.util._MAX_LENGTH = 12345
@@ -23,6 +29,22 @@ def _parse_stream_bytes(s: bytes) -> io.BytesIO:
     return parse_send_stream(io.BytesIO(s))
 
 
+def _attr(kind: AttributeKind, fmt: str, *values) -> bytes:
+    data = struct.pack('<' + fmt, *values)
+    return struct.pack('<HH', kind.value, len(data)) + data
+
+
+def _cmd(kind: CommandKind, *attrs: bytes) -> bytes:
+    body = b''.join(attrs)
+    crc = crc32c(struct.pack('<IHI', len(body), kind.value, 0) + body)
+    return struct.pack('<IHI', len(body), kind.value, crc) + body
+
+
+def _v2_data(data: bytes) -> bytes:
+    'Version 2 DATA attributes have no length, and end their command.'
+    return struct.pack('<H', AttributeKind.DATA.value) + data
+
+
 class ParseSendStreamTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -41,6 +63,349 @@ class ParseSendStreamTestCase(unittest.TestCase):
         )
         self.assertEqual(filtered_items, expected_items)
 
+    def test_buffer_parse_matches_file_parse(self):
+        for name, d in gold_demo_sendstreams().items():
+            with self.subTest(name):
+                expected = list(_parse_stream_bytes(d['sendstream']))
+                self.assertEqual(
+                    expected, list(parse_send_stream_buffer(d['sendstream'])),
+                )
+                with tempfile.TemporaryFile() as f:
+                    f.write(d['sendstream'])
+                    f.flush()
+                    with mmap.mmap(
+                        f.fileno(), 0, access=mmap.ACCESS_READ,
+                    ) as m:
+                        actual = list(parse_send_stream_buffer(m))
+                self.assertEqual(expected, actual)
+                # Equality alone would not catch `memoryview` leaking out.
+                self.assertEqual(
+                    [repr(i) for i in expected], [repr(i) for i in actual],
+                )
+
+    def test_lazy_data(self):
+        num_writes = 0
+        for name, d in gold_demo_sendstreams().items():
+            with self.subTest(name):
+                stream = d['sendstream']
+                expected = list(_parse_stream_bytes(stream))
+                lazy = list(parse_send_stream(
+                    io.BytesIO(stream), lazy_data=True,
+                ))
+                self.assertEqual(
+                    lazy,
+                    list(parse_send_stream_buffer(stream, lazy_data=True)),
+                )
+                self.assertEqual(len(expected), len(lazy))
+                for eager_item, lazy_item in zip(expected, lazy):
+                    if not isinstance(eager_item, SendStreamItems.write):
+                        self.assertEqual(eager_item, lazy_item)
+                        continue
+                    num_writes += 1
+                    ref = lazy_item.data
+                    self.assertIsInstance(ref, WriteDataRef)
+                    self.assertEqual(len(eager_item.data), len(ref))
+                    self.assertEqual(
+                        eager_item.data, ref.read(io.BytesIO(stream)),
+                    )
+                    self.assertEqual(
+                        eager_item.data,
+                        stream[ref.offset:ref.offset + ref.length],
+                    )
+                    self.assertEqual(
+                        eager_item._replace(data=ref), lazy_item,
+                    )
+        self.assertGreater(num_writes, 0)
+
+        with self.assertRaisesRegex(RuntimeError, 'WriteDataRef.* got 2 b'):
+            WriteDataRef(offset=1, length=5).read(io.BytesIO(b'abc'))
+
+    def test_verify_crc(self):
+        for name, d in gold_demo_sendstreams().items():
+            with self.subTest(name):
+                stream = d['sendstream']
+                expected = list(_parse_stream_bytes(stream))
+                self.assertEqual(expected, list(parse_send_stream(
+                    io.BytesIO(stream), verify_crc=True,
+                )))
+                self.assertEqual(expected, list(parse_send_stream_buffer(
+                    stream, verify_crc=True,
+                )))
+
+        # Corrupt the data of a write -- this still parses, but the CRC
+        # no longer matches.
+        stream = gold_demo_sendstreams()['create_ops']['sendstream']
+        ref = next(
+            i.data for i in parse_send_stream_buffer(stream, lazy_data=True)
+                if isinstance(i, SendStreamItems.write)
+        )
+        bad_stream = bytearray(stream)
+        bad_stream[ref.offset] ^= 0xff
+        bad_stream = bytes(bad_stream)
+        # Without verification, the corruption passes silently.
+        self.assertEqual(
+            len(list(_parse_stream_bytes(stream))),
+            len(list(_parse_stream_bytes(bad_stream))),
+        )
+        for parse in [
+            lambda: parse_send_stream(io.BytesIO(bad_stream), verify_crc=True),
+            lambda: parse_send_stream_buffer(bad_stream, verify_crc=True),
+        ]:
+            with self.assertRaisesRegex(
+                RuntimeError, 'CommandKind.WRITE.* at offset .* has CRC32C',
+            ):
+                list(parse())
+
+    def test_crc_verifier_pool(self):
+        # Exercise the process pool by making every command its own batch.
+        stream = gold_demo_sendstreams()['create_ops']['sendstream']
+        bad_pos = next(
+            i.data.offset
+                for i in parse_send_stream_buffer(stream, lazy_data=True)
+                    if isinstance(i, SendStreamItems.write)
+        )
+
+        def verify(corrupt):
+            verifier = _CrcVerifier(batch_bytes=1, max_workers=2)
+            try:
+                pos = 17  # magic & version
+                while pos < len(stream):
+                    length, cmd_type, crc = struct.unpack_from(
+                        '<IHI', stream, pos,
+                    )
+                    body = bytearray(stream[pos + 10:pos + 10 + length])
+                    if corrupt and pos < bad_pos < pos + 10 + length:
+                        body[bad_pos - pos - 10] ^= 0xff
+                    # With few workers, this may raise before `finish()`.
+                    verifier.add(pos, length, cmd_type, crc, body)
+                    pos += 10 + length
+                verifier.finish()
+            finally:
+                verifier.close()
+
+        verify(corrupt=False)
+        with self.assertRaisesRegex(RuntimeError, 'WRITE.* has CRC32C'):
+            verify(corrupt=True)
+
+    def test_version_2(self):
+        path = _attr(AttributeKind.PATH, '1s', b'f')
+        offset = _attr(AttributeKind.FILE_OFFSET, 'Q', 4096)
+        stream = b''.join([
+            BTRFS_SEND_STREAM_MAGIC, struct.pack('<I', 2),
+            _cmd(
+                CommandKind.SUBVOL,
+                _attr(AttributeKind.PATH, '1s', b's'),
+                _attr(AttributeKind.UUID, '16s', b'\1' * 16),
+                _attr(AttributeKind.CTRANSID, 'Q', 7),
+            ),
+            _cmd(CommandKind.MKFILE, path),
+            _cmd(CommandKind.WRITE, path, offset, _v2_data(b'x')),
+            _cmd(
+                CommandKind.ENCODED_WRITE, path, offset,
+                _attr(AttributeKind.UNENCODED_FILE_LEN, 'Q', 5000),
+                _attr(AttributeKind.UNENCODED_LEN, 'Q', 8192),
+                _attr(AttributeKind.UNENCODED_OFFSET, 'Q', 0),
+                _attr(AttributeKind.COMPRESSION, 'I', 2),
+                _v2_data(b'compressed'),
+            ),
+            # Compression and encryption are optional.
+            _cmd(
+                CommandKind.ENCODED_WRITE, path, offset,
+                _attr(AttributeKind.UNENCODED_FILE_LEN, 'Q', 3),
+                _attr(AttributeKind.UNENCODED_LEN, 'Q', 3),
+                _attr(AttributeKind.UNENCODED_OFFSET, 'Q', 0),
+                _v2_data(b'raw'),
+            ),
+            _cmd(
+                CommandKind.FALLOCATE, path,
+                _attr(AttributeKind.FALLOCATE_MODE, 'I', 3), offset,
+                _attr(AttributeKind.SIZE, 'Q', 10),
+            ),
+            _cmd(
+                CommandKind.FILEATTR, path,
+                _attr(AttributeKind.FILEATTR, 'Q', 0x10),
+            ),
+            _cmd(CommandKind.END),
+        ])
+
+        def encoded_write(**kwargs):
+            return SendStreamItems.encoded_write(
+                path=b'f', offset=4096, unencoded_offset=0, encryption=0,
+                **kwargs,
+            )
+
+        expected = [
+            SendStreamItems.subvol(
+                path=b's', uuid=b'01010101-0101-0101-0101-010101010101',
+                transid=7,
+            ),
+            SendStreamItems.mkfile(path=b'f'),
+            SendStreamItems.write(path=b'f', offset=4096, data=b'x'),
+            encoded_write(
+                unencoded_file_len=5000, unencoded_len=8192, compression=2,
+                data=b'compressed',
+            ),
+            encoded_write(
+                unencoded_file_len=3, unencoded_len=3, compression=0,
+                data=b'raw',
+            ),
+            SendStreamItems.fallocate(path=b'f', mode=3, offset=4096, len=10),
+            SendStreamItems.fileattr(path=b'f', attr=0x10),
+        ]
+        self.assertEqual(expected, list(parse_send_stream(
+            io.BytesIO(stream), verify_crc=True,
+        )))
+        self.assertEqual(expected, list(parse_send_stream_buffer(
+            stream, verify_crc=True,
+        )))
+
+        lazy = list(parse_send_stream_buffer(stream, lazy_data=True))
+        self.assertEqual(
+            lazy, list(parse_send_stream(io.BytesIO(stream), lazy_data=True)),
+        )
+        for eager_item, lazy_item in zip(expected, lazy):
+            if hasattr(eager_item, 'data'):
+                ref = lazy_item.data
+                self.assertIsInstance(ref, WriteDataRef)
+                self.assertEqual(
+                    eager_item.data, stream[ref.offset:ref.offset + len(ref)],
+                )
+            else:
+                self.assertEqual(eager_item, lazy_item)
+
+        with self.assertRaisesRegex(RuntimeError, 'ENCODED_WRITE lacks .*UNE'):
+            read_command(io.BytesIO(
+                _cmd(CommandKind.ENCODED_WRITE, path, offset),
+            ), version=2)
+
+        # In version 1, DATA attributes have a length.
+        with self.assertRaisesRegex(RuntimeError, 'Not enough bytes'):
+            read_command(io.BytesIO(
+                _cmd(CommandKind.WRITE, path, offset, _v2_data(b'x')),
+            ))
+
+    def test_scan(self):
+
+        class Unseekable(io.BytesIO):
+            def seekable(self):
+                return False
+
+        for name, d in gold_demo_sendstreams().items():
+            stream = d['sendstream']
+            items = list(_parse_stream_bytes(stream))
+            for kinds, item_types in [
+                (set(), ()),
+                ({CommandKind.MKNOD}, (SendStreamItems.mknod,)),
+                (
+                    {CommandKind.WRITE, CommandKind.RENAME},
+                    (SendStreamItems.write, SendStreamItems.rename),
+                ),
+                ({CommandKind.SUBVOL, CommandKind.SNAPSHOT}, (
+                    SendStreamItems.subvol, SendStreamItems.snapshot,
+                )),
+            ]:
+                with self.subTest((name, kinds)):
+                    expected = [i for i in items if isinstance(i, item_types)]
+                    for scanned in [
+                        scan_send_stream(io.BytesIO(stream), kinds),
+                        scan_send_stream(Unseekable(stream), kinds),
+                        scan_send_stream_buffer(stream, kinds),
+                    ]:
+                        self.assertEqual(expected, list(scanned))
+
+        stream = gold_demo_sendstreams()['create_ops']['sendstream']
+        self.assertEqual(
+            [
+                i for i in parse_send_stream_buffer(stream, lazy_data=True)
+                    if isinstance(i, SendStreamItems.write)
+            ],
+            list(scan_send_stream(
+                io.BytesIO(stream), {CommandKind.WRITE}, lazy_data=True,
+            )),
+        )
+        self.assertEqual(
+            list(scan_send_stream(
+                io.BytesIO(stream), {CommandKind.WRITE}, lazy_data=True,
+            )),
+            list(scan_send_stream_buffer(
+                stream, {CommandKind.WRITE}, lazy_data=True,
+            )),
+        )
+
+        # Skipped commands are still checked for truncation.
+        for scan in [
+            lambda s: scan_send_stream(io.BytesIO(s), ()),
+            lambda s: scan_send_stream(Unseekable(s), ()),
+            lambda s: scan_send_stream_buffer(s, ()),
+        ]:
+            with self.assertRaisesRegex(RuntimeError, 'Not enough bytes|got'):
+                list(scan(stream[:-20]))
+
+        truncated = stream[:17] + _cmd(CommandKind.MKFILE, b'x' * 5)[:12]
+        with self.assertRaisesRegex(RuntimeError, 'got 2 bytes'):
+            list(scan_send_stream(Unseekable(truncated), ()))
+
+        bad_cmd = stream[:17] + struct.pack('<IHI', 0, 12345, 0)
+        for scan in [
+            lambda s: scan_send_stream(io.BytesIO(s), ()),
+            lambda s: scan_send_stream_buffer(s, ()),
+        ]:
+            with self.assertRaisesRegex(ValueError, '12345 is not a valid'):
+                list(scan(bad_cmd))
+
+    def test_scan_offsets(self):
+        stream = gold_demo_sendstreams()['create_ops']['sendstream']
+        offsets_and_items = list(scan_send_stream_offsets(
+            io.BytesIO(stream), CommandKind,
+        ))
+        self.assertEqual(
+            list(_parse_stream_bytes(stream)),
+            [i for _, i in offsets_and_items],
+        )
+        for offset, item in offsets_and_items:
+            self.assertEqual(
+                item, read_command_at(io.BytesIO(stream), offset, version=1),
+            )
+            lazy_item = read_command_at(
+                io.BytesIO(stream), offset, version=1, lazy_data=True,
+            )
+            if isinstance(item, SendStreamItems.write):
+                ref = lazy_item.data
+                self.assertEqual(
+                    item.data, stream[ref.offset:ref.offset + ref.length],
+                )
+            else:
+                self.assertEqual(item, lazy_item)
+
+    def test_buffer_errors(self):
+        def parse(s):
+            return list(parse_send_stream_buffer(s))
+
+        with self.assertRaisesRegex(RuntimeError, "Magic b'xxx', not "):
+            parse(b'xxx')
+        magic = b'btrfs-stream\0'
+        with self.assertRaisesRegex(RuntimeError, 'we require version 1'):
+            parse(magic + b'abcd')
+        with self.assertRaisesRegex(RuntimeError, 'Not enough bytes'):
+            parse(magic + b'ab')
+        with self.assertRaisesRegex(RuntimeError, 'Not enough bytes'):
+            parse(magic + struct.pack('<I', 1))
+
+        def cmd(*attrs):
+            return magic + struct.pack('<I', 1) + struct.pack(
+                '<IHI', len(b''.join(attrs)), CommandKind.MKFILE.value, 0,
+            ) + b''.join(attrs)
+
+        with self.assertRaisesRegex(RuntimeError, 'CommandHead.* got 0 bytes'):
+            parse(cmd(b'1234')[:-4])
+        with self.assertRaisesRegex(RuntimeError, 'Not enough bytes'):
+            parse(cmd(b'123'))
+        with self.assertRaisesRegex(RuntimeError, 'AttributeH.* got 0 bytes'):
+            parse(cmd(struct.pack('<HH', AttributeKind.PATH.value, 3)))
+        path_attr = struct.pack('<HH3s', AttributeKind.PATH.value, 3, b'cat')
+        with self.assertRaisesRegex(RuntimeError, '\\.PATH occurred twice'):
+            parse(cmd(path_attr, path_attr))
+
     def test_errors(self):
         with self.assertRaisesRegex(RuntimeError, "Magic b'xxx', not "):
             check_magic(io.BytesIO(b'xxx'))
@@ -79,6 +444,17 @@ class ParseSendStreamTestCase(unittest.TestCase):
                 b'dog',
             )))
 
+        with self.assertRaisesRegex(RuntimeError, 'MKFILE lacks .*PATH'):
+            read_command(io.BytesIO(struct.pack(
+                '<IHI' + 'HH3s',
+                7,  # length excluding this header
+                CommandKind.MKFILE.value,
+                0,  # crc32c
+                AttributeKind.PATH_LINK.value,  # not the PATH we need
+                3,  # length excluding this header
+                b'cat',
+            )))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+import io
+import os
+import struct
+import tempfile
+import unittest
+import unittest.mock
+
+from .demo_sendstreams import gold_demo_sendstreams
+
+from ..parse_dump import parse_btrfs_dump
+from ..parse_send_stream import parse_send_stream
+from ..send_stream import SendStreamItems, WriteDataRef
+from ..send_stream_cache import (
+    _MAGIC, content_hash, dump_items, load_items, load_or_parse_items,
+    parse_send_stream_cached,
+)
+from .. import send_stream_cache
+
+
+def _round_trip(items):
+    out = io.BytesIO()
+    dump_items(items, out)
+    return load_items(io.BytesIO(out.getvalue()))
+
+
+def _dumped(items):
+    out = io.BytesIO()
+    dump_items(items, out)
+    return out.getvalue()
+
+
+class SendStreamCacheTestCase(unittest.TestCase):
+
+    def test_round_trip_gold_streams(self):
+        for name, d in gold_demo_sendstreams().items():
+            with self.subTest(name):
+                for lazy_data in [False, True]:
+                    items = list(parse_send_stream(
+                        io.BytesIO(d['sendstream']), lazy_data=lazy_data,
+                    ))
+                    self.assertEqual(items, _round_trip(items))
+                # `parse_dump` puts a placeholder into `from_transid`.
+                items = list(parse_btrfs_dump(
+                    io.BytesIO(b'\n'.join(d['dump']) + b'\n'),
+                ))
+                self.assertEqual(items, _round_trip(items))
+
+    def test_round_trip_field_values(self):
+        si = SendStreamItems
+        items = [
+            si.encoded_write(
+                path=b'p', offset=0, unencoded_file_len=5, unencoded_len=5,
+                unencoded_offset=0, compression=None, encryption=0,
+                data=WriteDataRef(offset=7, length=3),
+            ),
+            si.fallocate(path=b'p', mode=-1, offset=2 ** 64 - 1, len=0),
+            si.utimes(path=b'p', atime=(-3, 0), mtime=(0, 9), ctime=(1, 2)),
+            si.write(path=b'p', offset=0, data=b''),
+        ]
+        self.assertEqual(items, _round_trip(items))
+        self.assertEqual([], _round_trip([]))
+
+    def test_dedupes_byte_strings(self):
+        data = b'x' * 10000
+        items = [
+            SendStreamItems.write(path=b'a', offset=i * len(data), data=data)
+                for i in range(100)
+        ]
+        self.assertEqual(items, _round_trip(items))
+        self.assertLess(len(_dumped(items)), 2 * len(data))
+
+    def test_errors(self):
+        for bad_value in [1.5, True, 'str', (1, 2, 3), (1, b'')]:
+            with self.assertRaisesRegex(RuntimeError, 'Cannot serialize'):
+                _dumped([SendStreamItems.chmod(path=b'p', mode=bad_value)])
+
+        good = _dumped([SendStreamItems.chmod(path=b'p', mode=0o644)])
+        version_pos = len(_MAGIC)
+        for regex, bad in [
+            ('^Magic', b'x' + good[1:]),
+            ('format version', good[:version_pos] + struct.pack('<I', 7) +
+                good[version_pos + 4:]),
+            ('truncated', good[:version_pos + 3]),
+            ('truncated', good[:-1]),
+            ('trailing bytes', good + b'x'),
+            ('Unknown item type', good.replace(b'chmod', b'chmox')),
+            ('has fields', good.replace(b'chmod', b'chown')),
+            ('corrupt', good.replace(b'bu', b'bb')),  # Byte string index
+            ('corrupt', good[:-10] + b'\xff' + good[-9:]),  # Signature
+            ('bad tags', good.replace(b'bu', b'bz')),
+        ]:
+            with self.assertRaisesRegex(RuntimeError, regex):
+                load_items(io.BytesIO(bad))
+
+        # The header claims one more byte string than there is.
+        bad = bytearray(good)
+        bad[version_pos + 4] += 1
+        with self.assertRaisesRegex(RuntimeError, 'truncated'):
+            load_items(io.BytesIO(bytes(bad)))
+
+    def test_content_hash(self):
+        self.assertEqual(
+            'e3b0c44298fc1c149afbf4c8996fb924'
+            '27ae41e4649b934ca495991b7852b855',
+            content_hash(io.BytesIO(b'')),
+        )
+        with unittest.mock.patch.object(
+            send_stream_cache, '_HASH_CHUNK_SIZE', 3,
+        ):
+            self.assertEqual(
+                content_hash(io.BytesIO(b'abcdefg')),
+                content_hash(io.BytesIO(b'abcdefg')),
+            )
+            self.assertNotEqual(
+                content_hash(io.BytesIO(b'abcdefg')),
+                content_hash(io.BytesIO(b'abcdefh')),
+            )
+
+    def test_cache(self):
+        streams = gold_demo_sendstreams()
+        with tempfile.TemporaryDirectory() as td:
+            stream_path = os.path.join(td.encode(), b'stream')
+            cache_dir = os.path.join(td.encode(), b'cache')
+            with open(stream_path, 'wb') as f:
+                f.write(streams['create_ops']['sendstream'])
+            with open(stream_path, 'rb') as f:
+                expected = list(parse_send_stream(f))
+                f.seek(0)
+                expected_lazy = list(parse_send_stream(f, lazy_data=True))
+            self.assertNotEqual(expected, expected_lazy)
+
+            # The first call populates the cache, the next ones use it.
+            self.assertEqual(
+                expected, parse_send_stream_cached(stream_path, cache_dir),
+            )
+            self.assertEqual(1, len(os.listdir(cache_dir)))
+            with unittest.mock.patch.object(
+                send_stream_cache, 'parse_send_stream',
+                side_effect=AssertionError,
+            ):
+                self.assertEqual(
+                    expected, parse_send_stream_cached(stream_path, cache_dir),
+                )
+            # `lazy_data` parses get their own cache entry.
+            for _ in range(2):
+                self.assertEqual(expected_lazy, parse_send_stream_cached(
+                    stream_path, cache_dir, lazy_data=True,
+                ))
+            self.assertEqual(2, len(os.listdir(cache_dir)))
+
+            # A changed stream has a new key.
+            with open(stream_path, 'wb') as f:
+                f.write(streams['mutate_ops']['sendstream'])
+            with open(stream_path, 'rb') as f:
+                expected = list(parse_send_stream(f))
+            self.assertEqual(
+                expected, parse_send_stream_cached(stream_path, cache_dir),
+            )
+            self.assertEqual(3, len(os.listdir(cache_dir)))
+
+            # Corrupt cache entries get replaced.
+            for name in os.listdir(cache_dir):
+                with open(os.path.join(cache_dir, name), 'wb') as f:
+                    f.write(b'garbage')
+            self.assertEqual(
+                expected, parse_send_stream_cached(stream_path, cache_dir),
+            )
+            self.assertEqual(3, len(os.listdir(cache_dir)))
+            self.assertEqual(expected, load_or_parse_items(
+                stream_path, cache_dir, unittest.mock.Mock(
+                    side_effect=AssertionError,
+                ), parser_id='parse_send_stream',
+            ))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+import hashlib
+import io
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+from .demo_sendstreams import gold_demo_sendstreams
+
+from ..parse_send_stream import CommandKind, parse_send_stream
+from ..send_stream import SendStreamItems
+from ..send_stream_index import load_or_build_index, SendStreamIndex
+from ..write_send_stream import write_send_stream
+
+
+def _touched_paths(item):
+    yield item.path
+    if isinstance(item, (SendStreamItems.rename, SendStreamItems.link)):
+        yield item.dest
+    elif isinstance(item, SendStreamItems.clone):
+        yield item.from_path
+
+
+class SendStreamIndexTestCase(unittest.TestCase):
+
+    def test_index_gold_streams(self):
+        for name, d in gold_demo_sendstreams().items():
+            with self.subTest(name):
+                stream = d['sendstream']
+                items = list(parse_send_stream(io.BytesIO(stream)))
+                idx = SendStreamIndex.build(io.BytesIO(stream))
+                self.assertEqual(1, idx.version)
+                self.assertEqual(len(stream), idx.stream_size)
+                self.assertEqual(
+                    hashlib.sha256(stream).digest(), idx.stream_hash,
+                )
+                self.assertEqual(len(items), len(idx.offsets))
+
+                paths = {p for i in items for p in _touched_paths(i)}
+                self.assertEqual(paths, set(idx.paths))
+                for path in paths:
+                    self.assertEqual(
+                        [i for i in items if path in _touched_paths(i)],
+                        list(idx.items_for_path(io.BytesIO(stream), path)),
+                    )
+                self.assertEqual([], idx.offsets_for_path(b'no such path'))
+
+                out = io.BytesIO()
+                idx.dump(out)
+                self.assertEqual(
+                    idx, SendStreamIndex.load(io.BytesIO(out.getvalue())),
+                )
+                self.assertNotEqual(idx, 'not an index')
+
+    def test_kinds_and_lazy_data(self):
+        stream = gold_demo_sendstreams()['create_ops']['sendstream']
+        idx = SendStreamIndex.build(io.BytesIO(stream))
+        written_path = next(
+            i.path for i in parse_send_stream(io.BytesIO(stream))
+                if isinstance(i, SendStreamItems.write)
+        )
+        writes = list(idx.items_for_path(
+            io.BytesIO(stream), written_path, {CommandKind.WRITE},
+            lazy_data=True,
+        ))
+        self.assertGreater(len(writes), 0)
+        self.assertLess(
+            len(writes), len(idx.offsets_for_path(written_path)),
+        )
+        for write in writes:
+            self.assertIsInstance(write, SendStreamItems.write)
+            self.assertEqual(written_path, write.path)
+            self.assertEqual(
+                stream[write.data.offset:write.data.offset + len(write.data)],
+                write.data.read(io.BytesIO(stream)),
+            )
+
+    def test_load_errors(self):
+        stream = gold_demo_sendstreams()['mutate_ops']['sendstream']
+        out = io.BytesIO()
+        SendStreamIndex.build(io.BytesIO(stream)).dump(out)
+        data = out.getvalue()
+        with self.assertRaisesRegex(RuntimeError, 'Magic '):
+            SendStreamIndex.load(io.BytesIO(b'x' + data))
+        with self.assertRaisesRegex(RuntimeError, 'format version 7 != 2'):
+            SendStreamIndex.load(io.BytesIO(
+                data[:17] + b'\7' + data[18:]
+            ))
+        for size in [20, 17 + 32 + 1, len(data) - 1]:
+            with self.assertRaisesRegex(RuntimeError, 'index truncated'):
+                SendStreamIndex.load(io.BytesIO(data[:size]))
+
+    def test_load_or_build_index(self):
+        streams = gold_demo_sendstreams()
+        with tempfile.TemporaryDirectory() as td:
+            stream_path = os.path.join(td, 'stream').encode()
+            with open(stream_path, 'wb') as f:
+                f.write(streams['create_ops']['sendstream'])
+            with open(stream_path, 'rb') as f:
+                expected = SendStreamIndex.build(f)
+
+            self.assertEqual(expected, load_or_build_index(stream_path))
+            self.assertTrue(os.path.exists(stream_path + b'.index'))
+            with unittest.mock.patch.object(
+                SendStreamIndex, 'build', side_effect=AssertionError,
+            ):
+                self.assertEqual(expected, load_or_build_index(stream_path))
+
+            # A stale index gets rebuilt.
+            with open(stream_path, 'wb') as f:
+                f.write(streams['mutate_ops']['sendstream'])
+            with open(stream_path, 'rb') as f:
+                expected = SendStreamIndex.build(f)
+            self.assertEqual(expected, load_or_build_index(stream_path))
+
+            # So does a corrupt one.
+            with open(stream_path + b'.index', 'wb') as f:
+                f.write(b'garbage')
+            # A failed save leaves no temporary files.
+            with unittest.mock.patch.object(
+                os, 'rename', side_effect=OSError('fail'),
+            ), self.assertRaisesRegex(OSError, 'fail'):
+                load_or_build_index(stream_path)
+            self.assertEqual(
+                {b'stream', b'stream.index'}, set(os.listdir(td.encode())),
+            )
+            self.assertEqual(expected, load_or_build_index(stream_path))
+            self.assertEqual(
+                {b'stream', b'stream.index'}, set(os.listdir(td.encode())),
+            )
+
+    def test_same_size_rewrite(self):
+        'Neither the size nor the mtime of a rewritten stream must matter.'
+        si = SendStreamItems
+        with tempfile.TemporaryDirectory() as td:
+            stream_path = os.path.join(td, 'stream').encode()
+            paths = []
+            for name in [b'aaaa', b'bbbb']:
+                with open(stream_path, 'wb') as f:
+                    write_send_stream([
+                        si.subvol(
+                            path=b'vol', transid=1,
+                            uuid=b'01234567-89ab-cdef-0123-456789abcdef',
+                        ),
+                        si.mkfile(path=name),
+                    ], f)
+                os.utime(stream_path, ns=(0, 0))
+                paths.append(load_or_build_index(stream_path).paths)
+            self.assertEqual([(b'vol', b'aaaa'), (b'vol', b'bbbb')], paths)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+import json
+import unittest
+
+from ..freeze import freeze
+from ..inode_id import InodeIDMap
+from ..rendered_tree import emit_non_unique_traversal_ids, TraversalIDMaker
+from ..send_stream import SendStreamItems
+from ..streaming_render import gen_rendered_json, gen_rendered_ndjson
+from ..subvolume import Subvolume
+
+
+def _new_subvol(items):
+    subvol = Subvolume.new(id_map=InodeIDMap.new())
+    for item in items:
+        if isinstance(item, SendStreamItems.clone):
+            subvol.apply_clone(item, subvol)
+        else:
+            subvol.apply_item(item)
+    return subvol
+
+
+class StreamingRenderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.maxDiff = 12345
+        si = SendStreamItems
+        self.subvol = _new_subvol([
+            si.mkdir(path=b'a'),
+            si.mkdir(path=b'a/b'),
+            si.mkfile(path=b'a/b/f'),
+            si.write(path=b'a/b/f', offset=0, data=b'x' * 10),
+            si.link(path=b'a/b/f2', dest=b'a/b/f'),
+            si.link(path=b'c', dest=b'a/b/f'),
+            si.mkfile(path=b'a/g'),
+            si.clone(
+                path=b'a/g', offset=0, len=4, from_uuid=b'', from_transid=0,
+                from_path=b'a/b/f', clone_offset=2,
+            ),
+            si.mkdir(path=b'a/empty'),
+            si.mkfile(path=b'a/h'),
+            si.link(path=b'a/h2', dest=b'a/h'),
+            si.symlink(path=b's', dest=b'a'),
+            si.mkfile(path='ü'.encode()),
+        ])
+
+    def _check(self, subvol, top_path=b'.'):
+        for indent in [None, 2]:
+            extent_id_maker = TraversalIDMaker()
+            self.assertEqual(
+                json.dumps(
+                    emit_non_unique_traversal_ids(subvol.render(
+                        top_path, extent_id_maker=extent_id_maker,
+                    )),
+                    sort_keys=True,
+                    indent=indent,
+                ),
+                ''.join(gen_rendered_json(subvol, top_path, indent=indent)),
+            )
+        # We number the extents in the same order as `render`.
+        stream_extent_id_maker = TraversalIDMaker()
+        for _ in gen_rendered_json(
+            subvol, top_path, extent_id_maker=stream_extent_id_maker,
+        ):
+            pass
+        self.assertEqual(*[
+            {nonce: tid.id for nonce, tid in maker.nonce_to_id.items()}
+                for maker in [extent_id_maker, stream_extent_id_maker]
+        ])
+
+    def test_same_as_render(self):
+        self._check(self.subvol)
+        for shared_extents in [False, True]:
+            frozen = freeze(self.subvol, shared_extents=shared_extents)
+            self._check(frozen)
+            # Hardlinks only get IDs if they occur more than once under
+            # `top_path`: `c` is outside of `a`.
+            self._check(frozen, b'a')
+            self._check(frozen, b'a/b/')
+            self._check(frozen, b'a/g')
+        self.assertIn(
+            '"c": [["(File d10(a/g:0+4@2))", 0]]',
+            ''.join(gen_rendered_json(freeze(self.subvol))),
+        )
+
+    def test_level(self):
+        subvol = freeze(self.subvol)
+        self.assertEqual(
+            json.dumps({
+                'x': emit_non_unique_traversal_ids(subvol.render(b'a/b')),
+            }, indent=2),
+            '{\n  "x": ' + ''.join(
+                gen_rendered_json(subvol, b'a/b', indent=2, level=1)
+            ) + '\n}',
+        )
+
+    def test_ndjson(self):
+        subvol = freeze(self.subvol, shared_extents=True)
+        self.assertEqual([
+            ['a', '(Dir)'],
+            ['a/b', '(Dir)'],
+            ['a/b/f', ['(File d10[e0:0+10@0])', 0]],
+            ['a/b/f2', ['(File d10[e0:0+10@0])', 0]],
+            ['a/empty', '(Dir)'],
+            ['a/g', '(File d4[e0:2+4@0])'],
+            ['a/h', ['(File)', 1]],
+            ['a/h2', ['(File)', 1]],
+        ], [json.loads(line) for line in gen_rendered_ndjson(subvol, b'a')])
+
+    def test_deep_tree(self):
+        si = SendStreamItems
+        paths = [b'd'] * 1500
+        for i in range(1, len(paths)):
+            paths[i] = paths[i - 1] + b'/d'
+        subvol = _new_subvol(
+            [si.mkdir(path=p) for p in paths]
+                + [si.mkfile(path=paths[-1] + b'/f')]
+        )
+        lines = list(gen_rendered_ndjson(subvol))
+        self.assertEqual(1502, len(lines))
+        self.assertEqual(
+            [(paths[-1] + b'/f').decode(), '(File)'], json.loads(lines[-1]),
+        )
+        self.assertEqual(
+            '["(Dir)", {"d": ' * 1500 + '["(Dir)", {"f": ["(File)"]'
+                + '}]' * 1501,
+            ''.join(gen_rendered_json(subvol)),
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,4 @@
 #!/usr/bin/env python3
-import copy
 import unittest
 
 from ..coroutine_utils import while_not_exited
@@ -112,10 +111,13 @@ class SubvolumeTestCase(DeepCopyTestCase):
         cat = yield 'cat after error testing', cat
         self._check_both_renders(cat_final_repr, cat)
 
-        # Make a snapshot using the hack from `SubvolumeSetMutator`
-        tiger = copy.deepcopy(cat, memo={
-            id(cat.id_map.inner.description): 'tiger',
-        })
+        # Make a snapshot, as `SubvolumeSetMutator` does
+        tiger = cat.snapshot(description='tiger')
+        # Inodes are shared until mutated
+        self.assertIs(
+            cat.inode_at_path(b'dog').extent,
+            tiger.inode_at_path(b'dog').extent,
+        )
         tiger = yield 'freshly copied tiger', tiger
         self._check_both_renders(cat_final_repr, tiger)
 
@@ -149,6 +151,10 @@ class SubvolumeTestCase(DeepCopyTestCase):
             'wolf': [wolf], 'tamaskan': [wolf],
         }]
         self._check_both_renders(tiger_penultimate_repr, tiger)
+        # Modifying `tiger`'s inodes copied them, `cat` is unchanged.
+        self.assertEqual(0o700, tiger.inode_at_path(b'wolf').mode)
+        self.assertEqual(0o744, cat.inode_at_path(b'dog').mode)
+        self._check_both_renders(cat_final_repr, cat)
 
         # Renaming the same inode is a no-op
         tiger.apply_item(si.rename(path=b'tamaskan', dest=b'wolf'))
@@ -339,6 +345,120 @@ class SubvolumeTestCase(DeepCopyTestCase):
     def test_subvolume(self):
         self.check_deepcopy_at_each_step(self._check_subvolume)
 
+    def test_traversal_order_and_paths(self):
+        si = SendStreamItems
+        subvol = Subvolume.new(id_map=InodeIDMap.new())
+        for item in [
+            si.mkdir(path=b'a'),
+            si.mkfile(path=b'a/y'),
+            si.mkdir(path=b'a/x'),
+            si.mkfile(path=b'a/x/z'),
+            si.mkfile(path=b'b'),
+        ]:
+            subvol.apply_item(item)
+        for sv in [subvol, freeze(subvol)]:
+            visited = []
+            with while_not_exited(sv.gather_bottom_up(b'./a/')) as ctx:
+                result = None
+                while True:
+                    path, _ino, child_results = ctx.send(result)
+                    visited.append((path, child_results))
+                    result = len(visited)
+            self.assertEqual([
+                (b'a/x/z', None),
+                (b'a/x', {b'z': 1}),
+                (b'a/y', None),
+                (b'./a/', {b'x': 2, b'y': 3}),
+            ], visited)
+            self.assertEqual(4, ctx.result)
+
+    def test_deep_tree(self):
+        si = SendStreamItems
+        subvol = Subvolume.new(id_map=InodeIDMap.new())
+        path = b'd'
+        depth = 1500  # Deeper than the default recursion limit
+        for _ in range(depth):
+            subvol.apply_item(si.mkdir(path=path))
+            path += b'/d'
+        subvol.apply_item(si.mkfile(path=path))
+        ser = emit_all_traversal_ids(freeze(subvol).render())
+        for i in range(depth + 1):
+            ino, children = ser
+            self.assertEqual(depth + 1 - i, ino[1])
+            ser = children['d']
+        self.assertEqual([['(File)', 0]], ser)
+
+    def test_placeholders(self):
+        si = SendStreamItems
+        subvol = Subvolume.new(
+            id_map=InodeIDMap.new(description='diff'), placeholders=True,
+        )
+        # Items make the paths they refer to, with their ancestors.
+        subvol.apply_item(si.chown(path=b'a/b', uid=1, gid=2))
+        subvol.apply_item(si.mkfile(path=b'c/d'))
+        subvol.apply_item(si.unlink(path=b'gone'))
+        subvol.apply_item(si.rmdir(path=b'e/gone_dir'))
+        self._check_both_renders(['(Dir)', {
+            'a': ['(Dir)', {'b': ['(Unknown o1:2)']}],
+            'c': ['(Dir)', {'d': ['(File)']}],
+            'e': ['(Dir)', {}],
+        }], subvol)
+
+        # Later items reveal the types of `Unknown` inodes, which keep
+        # their metadata.
+        subvol.apply_item(si.write(path=b'a/b', offset=2, data=b'xy'))
+        subvol.apply_item(si.chmod(path=b'f', mode=0o700))
+        subvol.apply_item(si.mkfifo(path=b'f/fifo'))
+        # Renames between directories make the source a directory, too.
+        subvol.apply_item(si.rename(path=b'g', dest=b'e'))
+        subvol.apply_item(si.rename(path=b'h', dest=b'i/h'))
+        subvol.apply_item(si.link(path=b'a/j', dest=b'h2'))
+        # The parent had the xattr, we just did not know its value.
+        subvol.apply_item(si.remove_xattr(path=b'h2', name=b'user.x'))
+        subvol.apply_item(si.set_xattr(path=b'h2', name=b'user.y', data=b'1'))
+        h2_repr = InodeRepr("(Unknown x'user.y'='1')")
+        expected = ['(Dir)', {
+            'a': ['(Dir)', {'b': ['(File o1:2 h2d2)'], 'j': [h2_repr]}],
+            'c': ['(Dir)', {'d': ['(File)']}],
+            'e': ['(Dir)', {}],
+            'f': ['(Dir m700)', {'fifo': ['(FIFO)']}],
+            'h2': [h2_repr],
+            'i': ['(Dir)', {'h': ['(Unknown)']}],
+        }]
+        self._check_both_renders(expected, subvol)
+
+        # Snapshots keep making placeholders, and do not affect `subvol`.
+        snap = subvol.snapshot(description='snap')
+        snap.apply_item(si.chown(path=b'a/j', uid=3, gid=4))
+        snap.apply_item(si.truncate(path=b'k', size=3))
+        self._check_render(['(Dir)', {
+            **expected[1],
+            'a': ['(Dir)', {
+                'b': ['(File o1:2 h2d2)'],
+                'j': [InodeRepr("(Unknown o3:4 x'user.y'='1')")],
+            }],
+            'h2': [InodeRepr("(Unknown o3:4 x'user.y'='1')")],
+            'k': ['(File h3)'],
+        }], snap)
+        self._check_render(expected, subvol)
+
+        with self.assertRaisesRegex(RuntimeError, 'is hardlinked, so it is '):
+            subvol.apply_item(si.mkfile(path=b'h2/file'))
+        with self.assertRaisesRegex(RuntimeError, 'parent of .* is a file'):
+            subvol.apply_item(si.mkfile(path=b'a/b/file'))
+        with self.assertRaisesRegex(RuntimeError, 'Can only .* a directory'):
+            subvol.apply_item(si.rmdir(path=b'c/d'))
+        self._check_render(expected, subvol)
+
+        # Even with all its metadata, an `Unknown` inode is not complete.
+        subvol.apply_item(si.chown(path=b'i/h', uid=0, gid=0))
+        subvol.apply_item(si.utimes(
+            path=b'i/h', atime=(0, 0), mtime=(0, 0), ctime=(0, 0),
+        ))
+        with self.assertRaisesRegex(RuntimeError, 'must have a known file_'):
+            freeze(subvol.inode_at_path(b'i/h'), chunks=None) \
+                .assert_valid_and_complete()
+
     def test_rendered_tree(self):
         'Miscellaneous coverage over `rendered_tree.py`.'
         with self.assertRaisesRegex(RuntimeError, 'Unknown type in rendered'):
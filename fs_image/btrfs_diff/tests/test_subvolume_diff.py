@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+import unittest
+
+from ..freeze import freeze
+from ..inode_id import InodeIDMap
+from ..send_stream import SendStreamItems
+from ..subvolume import Subvolume
+from ..subvolume_diff import diff_subvolumes, InodeDiff, subtree_digests
+
+ADDED = InodeDiff.Kind.ADDED
+REMOVED = InodeDiff.Kind.REMOVED
+MODIFIED = InodeDiff.Kind.MODIFIED
+
+
+def _new_subvol(items):
+    subvol = Subvolume.new(id_map=InodeIDMap.new())
+    _apply(subvol, items)
+    return subvol
+
+
+def _apply(subvol, items):
+    for item in items:
+        if isinstance(item, SendStreamItems.clone):
+            subvol.apply_clone(item, subvol)
+        else:
+            subvol.apply_item(item)
+
+
+def _summarize(diffs):
+    return [
+        (d.kind, d.path, d.changed_fields, d.changed_ranges) for d in diffs
+    ]
+
+
+class SubvolumeDiffTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.maxDiff = 12345
+        si = SendStreamItems
+        self.parent = _new_subvol([
+            si.mkdir(path=b'a'),
+            si.mkdir(path=b'a/b'),
+            si.mkfile(path=b'a/b/f'),
+            si.write(path=b'a/b/f', offset=0, data=b'x' * 10),
+            si.mkfile(path=b'a/g'),
+            si.mkdir(path=b'c'),
+            si.mkfile(path=b'c/h'),
+            si.link(path=b'c/h2', dest=b'c/h'),
+            si.symlink(path=b's', dest=b'a'),
+        ])
+
+    def _diff(self, items, **freeze_kwargs):
+        child = self.parent.snapshot()
+        _apply(child, items)
+        return _summarize(diff_subvolumes(
+            freeze(self.parent, **freeze_kwargs),
+            freeze(child, **freeze_kwargs),
+        ))
+
+    def test_unchanged(self):
+        frozen = freeze(self.parent)
+        self.assertEqual([], list(diff_subvolumes(frozen, frozen)))
+        self.assertEqual([], self._diff([]))
+        # Digests depend on content, not on how it was constructed.
+        self.assertEqual(
+            subtree_digests(frozen).digest,
+            subtree_digests(freeze(self.parent.snapshot())).digest,
+        )
+
+    def test_added_and_removed(self):
+        si = SendStreamItems
+        self.assertEqual([
+            (MODIFIED, b'.', ('utimes',), ()),
+            (REMOVED, b'c', (), ()),
+            (REMOVED, b'c/h', (), ()),
+            (REMOVED, b'c/h2', (), ()),
+            (ADDED, b'd', (), ()),
+            (ADDED, b'd/e', (), ()),
+        ], self._diff([
+            si.unlink(path=b'c/h'),
+            si.unlink(path=b'c/h2'),
+            si.rmdir(path=b'c'),
+            si.mkdir(path=b'd'),
+            si.mkfifo(path=b'd/e'),
+            si.utimes(path=b'.', atime=(1, 2), mtime=(3, 4), ctime=(5, 6)),
+        ]))
+
+    def test_order(self):
+        si = SendStreamItems
+        # Pre-order, with siblings sorted by name, so `a/...` precedes `a-c`.
+        self.assertEqual([
+            (ADDED, b'a/b/e', (), ()),
+            (ADDED, b'a-c', (), ()),
+        ], self._diff([
+            si.mkfile(path=b'a-c'),
+            si.mkfile(path=b'a/b/e'),
+        ]))
+
+    def test_modified(self):
+        si = SendStreamItems
+        diffs = self._diff([
+            si.chmod(path=b'a/g', mode=0o755),
+            si.chown(path=b'a/g', uid=1, gid=2),
+            si.set_xattr(path=b'c/h', name=b'user.k', data=b'v'),
+            si.truncate(path=b'a/b/f', size=20),
+        ])
+        self.assertEqual([
+            (MODIFIED, b'a/b/f', ('chunks',), ((10, 10),)),
+            (MODIFIED, b'a/g', ('mode', 'owner'), ()),
+            # Hardlinks are reported at each path.
+            (MODIFIED, b'c/h', ('xattrs',), ()),
+            (MODIFIED, b'c/h2', ('xattrs',), ()),
+        ], diffs)
+
+    def test_changed_ranges(self):
+        si = SendStreamItems
+        # We don't know the bytes of files, and overwrites don't change
+        # the chunks.
+        self.assertEqual([], self._diff([
+            si.write(path=b'a/b/f', offset=3, data=b'yy'),
+        ]))
+        self.assertEqual([
+            (MODIFIED, b'a/b/f', ('chunks',), ((0, 10),)),
+        ], self._diff([si.truncate(path=b'a/b/f', size=5)]))
+        # Clones are data changes, even if the chunk lengths are the same.
+        clone = si.clone(
+            path=b'a/g', offset=0, len=4, from_uuid=b'', from_transid=0,
+            from_path=b'a/b/f', clone_offset=2,
+        )
+        for shared_extents in [False, True]:
+            self.assertEqual([
+                (MODIFIED, b'a/b/f', ('chunks',), ((0, 10),)),
+                (MODIFIED, b'a/g', ('chunks',), ((0, 4),)),
+            ], self._diff([clone], shared_extents=shared_extents))
+
+    def test_replaced(self):
+        si = SendStreamItems
+        self.assertEqual([
+            (REMOVED, b'a', (), ()),
+            (REMOVED, b'a/b', (), ()),
+            (REMOVED, b'a/b/f', (), ()),
+            (REMOVED, b'a/g', (), ()),
+            (ADDED, b'a', (), ()),
+            # A symlink is a file that turned into a different file type.
+            (MODIFIED, b's', ('file_type', 'chunks', 'dest'), ()),
+        ], self._diff([
+            si.rename(path=b'a', dest=b'tmp'),
+            si.unlink(path=b's'),
+            si.mkfile(path=b's'),
+            si.mkfile(path=b'a'),
+            si.unlink(path=b'tmp/b/f'),
+            si.rmdir(path=b'tmp/b'),
+            si.unlink(path=b'tmp/g'),
+            si.rmdir(path=b'tmp'),
+        ]))
+
+    def test_reuse_digests(self):
+        si = SendStreamItems
+        child = self.parent.snapshot()
+        _apply(child, [si.mkfile(path=b'c/new')])
+        frozen_parent, frozen_child = freeze(self.parent), freeze(child)
+        parent_digests = subtree_digests(frozen_parent)
+        child_digests = subtree_digests(frozen_child)
+        # Unchanged subtrees have the same digests.
+        self.assertEqual(
+            parent_digests.children[b'a'].digest,
+            child_digests.children[b'a'].digest,
+        )
+        self.assertNotEqual(
+            parent_digests.children[b'c'].digest,
+            child_digests.children[b'c'].digest,
+        )
+        # The subvolumes are not even looked at if both digests are given.
+        self.assertEqual([
+            (ADDED, b'c/new', (), ()),
+        ], _summarize(diff_subvolumes(
+            None, None,
+            old_digests=parent_digests,
+            new_digests=child_digests,
+        )))
+        self.assertEqual([
+            (REMOVED, b'c/new', (), ()),
+        ], _summarize(diff_subvolumes(
+            frozen_child, frozen_parent, old_digests=child_digests,
+        )))
+
+    def test_kind_repr(self):
+        self.assertEqual('[ADDED]', repr([ADDED]))
+
+    def test_requires_frozen(self):
+        with self.assertRaisesRegex(TypeError, 'Can only diff frozen subv'):
+            subtree_digests(self.parent)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
+import copy
 import unittest
 
 from ..freeze import freeze
 from ..parse_dump import SendStreamItems
-from ..rendered_tree import emit_all_traversal_ids
+from ..rendered_tree import (
+    emit_all_traversal_ids, emit_non_unique_traversal_ids, TraversalIDMaker,
+)
 from ..subvolume_set import SubvolumeSet, SubvolumeSetMutator
 
 from .subvolume_utils import expected_subvol_add_traversal_ids
@@ -138,6 +141,24 @@ class SubvolumeSetTestCase(unittest.TestCase):
         }, freeze(subvols)))
         self._check_repr(*reprs_and_frozens[-1])
 
+        # The same clones in the linear representation.  Rendering all
+        # subvolumes with one maker makes their extent IDs agree.
+        extent_id_maker = TraversalIDMaker()
+        self.assertEqual({
+            'cat': ['(Dir)', {
+                'from': ['(File d2[e0:0+2@0])'],
+                'to': ['(File d2[e0:0+2@0])'],
+                'hole': ['(File h5[e1:0+5@0])'],
+            }],
+            'tiger': ['(Dir)', {
+                'to': ['(File d1[e0:0+1@0]h2[e1:2+2@0])'],
+            }],
+        }, freeze(subvols, shared_extents=True).map(
+            lambda sv: emit_non_unique_traversal_ids(
+                sv.render(extent_id_maker=extent_id_maker),
+            )
+        ))
+
         # Get `repr` to show some disambiguation
         cat2 = SubvolumeSetMutator.new(subvols, si.subvol(
             path=b'cat', uuid=b'app', transid=3,
@@ -178,11 +199,209 @@ class SubvolumeSetTestCase(unittest.TestCase):
         )
         self.assertEqual('tiger@eep', repr(tiger2.id_map.inner.description))
 
+        # The incremental `clone_index` agrees with a from-scratch freeze,
+        # also in a `deepcopy` that diverges from the original.
+        subvols_copy = copy.deepcopy(subvols)
+        tiger_copy = subvols_copy.uuid_to_subvolume['ee']
+        SubvolumeSetMutator(
+            subvolume=tiger_copy, subvolume_set=subvols_copy,
+        ).apply_item(si.truncate(path=b'to', size=1))
+        for ss in [subvols, subvols_copy]:
+            self.assertEqual(*[
+                freeze(s).map(
+                    lambda sv: emit_non_unique_traversal_ids(sv.render())
+                ) for s in [ss, ss._replace(clone_index=None)]
+            ])
+        self.assertEqual(['(File d1(cat@ab@from:0+1@0/cat@ab@to:0+1@0))'], [
+            repr(ino) for ino in freeze(subvols_copy).uuid_to_subvolume[
+                'ee'
+            ].inodes() if repr(ino).startswith('(File')
+        ])
+
         # This ensures that the frozen SubvolumeSets did not get changed
         # by mutations on the original.
         for expected, frozen in reprs_and_frozens:
             self._check_repr(expected, frozen)
 
+    def test_incremental_freeze(self):
+        si = SendStreamItems
+        subvols = SubvolumeSet.new()
+        cat_mutator = SubvolumeSetMutator.new(subvols, si.subvol(
+            path=b'cat', uuid=b'abe', transid=3,
+        ))
+        for item in [
+            si.mkdir(path=b'd'),
+            si.mkfile(path=b'a'),
+            si.write(path=b'a', offset=0, data=b'hello'),
+            si.mkfile(path=b'b'),
+            si.clone(
+                path=b'b', offset=0, from_uuid=b'abe', from_transid=3,
+                from_path=b'a', clone_offset=1, len=3,
+            ),
+            si.mkfile(path=b'c'),
+            si.write(path=b'c', offset=0, data=b'bye'),
+        ]:
+            cat_mutator.apply_item(item)
+        tiger = SubvolumeSetMutator.new(subvols, si.snapshot(
+            path=b'tiger', uuid=b'ee', transid=4,
+            parent_uuid=b'abe', parent_transid=3,
+        ))
+        tiger.apply_item(si.mkfile(path=b'e'))  # Not shared with `cat`
+
+        def render(frozen):
+            return frozen.map(
+                lambda sv: emit_non_unique_traversal_ids(sv.render())
+            )
+
+        def inode(frozen, uuid, path):
+            return frozen.uuid_to_subvolume[uuid].inode_at_path(path)
+
+        def check_freeze(reused, rechunked):
+            prev = frozen
+            new = freeze(subvols)
+            self.assertEqual(
+                render(freeze(subvols._replace(clone_index=None))),
+                render(new),
+            )
+            for uuid, path in reused:
+                prev_ino, new_ino = inode(prev, uuid, path), inode(
+                    new, uuid, path,
+                )
+                self.assertIs(prev_ino.chunks, new_ino.chunks)
+                self.assertIs(prev_ino.xattrs, new_ino.xattrs)
+                # Snapshots share `a`, `b` & `c`, but not their `Chunk`s.
+                if path not in [b'a', b'b', b'c']:
+                    self.assertIs(prev_ino, new_ino)
+            for uuid, path in rechunked:
+                self.assertIsNot(
+                    inode(prev, uuid, path).chunks,
+                    inode(new, uuid, path).chunks,
+                )
+            return new
+
+        first = frozen = freeze(subvols)
+        first_render = render(first)
+        all_paths = [
+            (uuid, path) for uuid in ['abe', 'ee']
+                for path in [b'.', b'd', b'a', b'b', b'c']
+        ] + [('ee', b'e')]
+        frozen = check_freeze(reused=all_paths, rechunked=[])
+        for uuid in ['abe', 'ee']:
+            self.assertIs(
+                frozen.uuid_to_subvolume[uuid].id_map,
+                freeze(subvols).uuid_to_subvolume[uuid].id_map,
+            )
+
+        # A write re-freezes just the files whose clones changed.
+        tiger.apply_item(si.write(path=b'c', offset=0, data=b'b'))
+        frozen = check_freeze(
+            reused=[p for p in all_paths if p[1] != b'c'],
+            rechunked=[('abe', b'c'), ('ee', b'c')],
+        )
+        self.assertEqual(
+            '(File d3(cat@c:1+2@1))', repr(inode(frozen, 'ee', b'c')),
+        )
+
+        # A rename changes the paths of the `Clone`s into `tiger`.
+        tiger.apply_item(si.rename(path=b'a', dest=b'd/a'))
+        frozen = check_freeze(
+            reused=[
+                ('abe', b'.'), ('abe', b'd'), ('ee', b'.'), ('ee', b'd'),
+                ('ee', b'c'), ('ee', b'e'),
+            ],
+            rechunked=[
+                ('abe', b'a'), ('abe', b'b'), ('abe', b'c'), ('ee', b'b'),
+            ],
+        )
+        self.assertEqual(
+            '(File d5(cat@b:0+3@1/tiger@b:0+3@1/tiger@d/a:0+5@0))',
+            repr(inode(frozen, 'abe', b'a')),
+        )
+        # Earlier frozen copies are unaffected.
+        self.assertNotEqual(first_render, render(frozen))
+        self.assertEqual(first_render, render(first))
+
+    def test_unknown_parent(self):
+        si = SendStreamItems
+        subvols = SubvolumeSet.new()
+        cat = SubvolumeSetMutator.new(subvols, si.snapshot(
+            path=b'cat', uuid=b'abe', transid=5,
+            parent_uuid=b'unknown', parent_transid=3,
+        ), allow_unknown_parent=True)
+        self.assertTrue(cat.subvolume.placeholders)
+        cat.apply_item(si.write(path=b'd/a', offset=1, data=b'x'))
+        # Clones from the unknown parent write unknown data.
+        cat.apply_item(si.clone(
+            path=b'd/a', offset=3, len=2, from_uuid=b'unknown',
+            from_transid=3, from_path=b'b', clone_offset=0,
+        ))
+        # Clone sources from the stream's own subvolume are made as needed.
+        cat.apply_item(si.clone(
+            path=b'c', offset=0, len=2, from_uuid=b'abe', from_transid=5,
+            from_path=b'e', clone_offset=1,
+        ))
+
+        # The known parent makes a plain snapshot, which still makes
+        # placeholders, since its parent is incomplete.
+        tiger = SubvolumeSetMutator.new(subvols, si.snapshot(
+            path=b'tiger', uuid=b'ee', transid=7,
+            parent_uuid=b'abe', parent_transid=5,
+        ), allow_unknown_parent=True)
+        self.assertTrue(tiger.subvolume.placeholders)
+        tiger.apply_item(si.clone(
+            path=b'c', offset=2, len=1, from_uuid=b'abe', from_transid=5,
+            from_path=b'd/a', clone_offset=1,
+        ))
+        tiger.apply_item(si.chown(path=b'f', uid=1, gid=2))
+
+        self._check_repr({
+            'cat': ['(Dir)', {
+                'c': ['(File h2)'],
+                'd': ['(Dir)', {'a': ['(File h1d1h1d2)']}],
+                'e': ['(File h3)'],
+            }],
+            'tiger': ['(Dir)', {
+                'c': ['(File h2d1)'],
+                'd': ['(Dir)', {'a': ['(File h1d1h1d2)']}],
+                'e': ['(File h3)'],
+                'f': ['(Unknown o1:2)'],
+            }],
+        }, subvols)
+        # `tiger` shares all the extents of `cat` that it did not change.
+        self._check_repr({
+            'cat': ['(Dir)', {
+                'c': ['(File h2(cat@e:1+2@0/tiger@c:0+2@0/tiger@e:1+2@0))'],
+                'd': ['(Dir)', {'a': [
+                    '(File h1(tiger@d/a:0+1@0)'
+                    'd1(tiger@c:2+1@0/tiger@d/a:1+1@0)'
+                    'h1(tiger@d/a:2+1@0)d2(tiger@d/a:3+2@0))'
+                ]}],
+                'e': ['(File h3(cat@c:0+2@1/tiger@c:0+2@1/tiger@e:0+3@0))'],
+            }],
+            'tiger': ['(Dir)', {
+                'c': [
+                    '(File h2(cat@c:0+2@0/cat@e:1+2@0/tiger@e:1+2@0)'
+                    'd1(cat@d/a:1+1@0/tiger@d/a:1+1@0))'
+                ],
+                'd': ['(Dir)', {'a': [
+                    '(File h1(cat@d/a:0+1@0)'
+                    'd1(cat@d/a:1+1@0/tiger@c:2+1@0)'
+                    'h1(cat@d/a:2+1@0)d2(cat@d/a:3+2@0))'
+                ]}],
+                'e': ['(File h3(cat@c:0+2@1/cat@e:0+3@0/tiger@c:0+2@1))'],
+                'f': ['(Unknown o1:2)'],
+            }],
+        }, freeze(subvols))
+
+        # Outside of placeholder subvolumes, unknown clone sources still fail.
+        with self.assertRaisesRegex(RuntimeError, 'Unknown from_uuid '):
+            SubvolumeSetMutator.new(subvols, si.subvol(
+                path=b'lion', uuid=b'f00', transid=3,
+            ), allow_unknown_parent=True).apply_item(si.clone(
+                path=b'c', offset=0, len=1, from_uuid=b'unknown',
+                from_transid=3, from_path=b'b', clone_offset=0,
+            ))
+
     def test_errors(self):
         si = SendStreamItems
         subvols = SubvolumeSet.new()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+import io
+import unittest
+
+from .demo_sendstreams import gold_demo_sendstreams
+
+from ..parse_send_stream import parse_send_stream
+from ..send_stream import SendStreamItems, WriteDataRef
+from ..write_send_stream import encode_item, MAX_WRITE_SIZE, write_send_stream
+
+
+def _round_trip(items):
+    out = io.BytesIO()
+    write_send_stream(items, out)
+    return list(parse_send_stream(io.BytesIO(out.getvalue()), verify_crc=True))
+
+
+class WriteSendStreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.maxDiff = 12345
+
+    def test_gold_round_trip(self):
+        for name, d in gold_demo_sendstreams().items():
+            items = list(parse_send_stream(io.BytesIO(d['sendstream'])))
+            self.assertEqual(items, _round_trip(items), name)
+
+    def test_split_writes(self):
+        si = SendStreamItems
+        data = bytes(range(256)) * (MAX_WRITE_SIZE // 128 + 1)
+        self.assertEqual(3, len(list(encode_item(
+            si.write(path=b'f', offset=5, data=data),
+        ))))
+        items = _round_trip([
+            si.subvol(
+                path=b'x', uuid=b'01234567-89ab-cdef-0123-456789abcdef',
+                transid=7,
+            ),
+            si.write(path=b'f', offset=5, data=data),
+        ])
+        self.assertEqual([
+            si.write(path=b'f', offset=5, data=data[:MAX_WRITE_SIZE]),
+            si.write(
+                path=b'f', offset=5 + MAX_WRITE_SIZE,
+                data=data[MAX_WRITE_SIZE:2 * MAX_WRITE_SIZE],
+            ),
+            si.write(
+                path=b'f', offset=5 + 2 * MAX_WRITE_SIZE,
+                data=data[2 * MAX_WRITE_SIZE:],
+            ),
+        ], items[1:])
+
+    def test_errors(self):
+        si = SendStreamItems
+        with self.assertRaisesRegex(RuntimeError, 'parse without lazy_data'):
+            list(encode_item(si.write(
+                path=b'f', offset=0, data=WriteDataRef(offset=0, length=1),
+            )))
+        with self.assertRaisesRegex(RuntimeError, 'to a version 1 send-s'):
+            list(encode_item(si.fileattr(path=b'f', attr=1)))
+        with self.assertRaisesRegex(RuntimeError, 'has 65536 bytes, but'):
+            list(encode_item(si.set_xattr(
+                path=b'f', name=b'user.big', data=b'x' * 2 ** 16,
+            )))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+'''
+Writes `SendStreamItems` as a version 1 btrfs send-stream, which
+`parse_send_stream` reads back as the same items, and which `btrfs
+receive` can apply.
+
+We encode exactly the attributes that the parser decodes, so streams from
+`btrfs send` do not round-trip byte-for-byte: e.g. we omit the unused INO
+attribute.  Version 2 commands, and `WriteDataRef`s from `lazy_data`
+parses, are not supported.
+
+In version 1, attribute lengths are 16-bit, so `write`s with more data
+than `btrfs send` puts in one command are split into several commands.
+'''
+import uuid
+
+from typing import Iterable, Iterator
+
+from .crc32c import crc32c
+# This module is part of the same library as the parser, so it shares the
+# parser's private tables, rather than duplicating them.
+from .parse_send_stream import (
+    _ATTRIBUTE_HEADER, _ATTRIBUTE_KIND_TO_CONV, _COMMAND_HEADER,
+    _COMMAND_KIND_TO_ITEM_FIELDS, _TIME, _UINT32, _UINT64, _VERSION,
+    AttributeKind, BTRFS_SEND_STREAM_MAGIC, CommandKind, conv_bytes,
+    conv_path, conv_time, conv_uint32, conv_uint64, conv_uuid,
+)
+from .send_stream import SendStreamItem, SendStreamItems
+
+# `BTRFS_SEND_READ_SIZE` from the kernel's `send.h`.
+MAX_WRITE_SIZE = 48 * 1024
+
+_V2_ONLY_COMMANDS = {
+    CommandKind.FALLOCATE, CommandKind.FILEATTR, CommandKind.ENCODED_WRITE,
+}
+
+_CONV_TO_ENCODER = {
+    conv_uuid: lambda s: uuid.UUID(s.decode()).bytes,
+    conv_uint32: _UINT32.pack,
+    conv_uint64: _UINT64.pack,
+    conv_time: lambda t: _TIME.pack(*t),
+    conv_bytes: bytes,
+    conv_path: bytes,
+}
+
+# The inverse of `_COMMAND_KIND_TO_ITEM_FIELDS`: for each item type, the
+# raw command type, and the attributes to encode from the item's fields.
+_ITEM_TYPE_TO_COMMAND = {
+    fields_spec[0]: (kind.value, [
+        (name, attr_kind.value, _CONV_TO_ENCODER[
+            _ATTRIBUTE_KIND_TO_CONV[attr_kind]
+        ]) for name, attr_kind, *_ in fields_spec[1]
+    ]) for kind, fields_spec in _COMMAND_KIND_TO_ITEM_FIELDS.items()
+        if fields_spec is not None and kind not in _V2_ONLY_COMMANDS
+}
+_END_TYPE = CommandKind.END.value
+_MAX_ATTRIBUTE_SIZE = 2 ** 16 - 1
+
+
+def _encode_command(cmd_type: int, attrs: Iterable[bytes]) -> bytes:
+    body = b''.join(attrs)
+    crc = crc32c(body, crc32c(_COMMAND_HEADER.pack(len(body), cmd_type, 0)))
+    return _COMMAND_HEADER.pack(len(body), cmd_type, crc) + body
+
+
+def _encode_attribute(attr_type: int, data: bytes) -> bytes:
+    if len(data) > _MAX_ATTRIBUTE_SIZE:
+        raise RuntimeError(
+            f'{AttributeKind(attr_type)} has {len(data)} bytes, but '
+            f'version 1 allows at most {_MAX_ATTRIBUTE_SIZE}'
+        )
+    return _ATTRIBUTE_HEADER.pack(attr_type, len(data)) + data
+
+
+def encode_item(item: SendStreamItem) -> Iterator[bytes]:
+    'Yields the encoded commands for `item`, usually just one.'
+    if isinstance(item, SendStreamItems.write):
+        if not isinstance(item.data, bytes):
+            raise RuntimeError(f'Cannot write {item}, parse without lazy_data')
+        if len(item.data) > MAX_WRITE_SIZE:
+            for pos in range(0, len(item.data), MAX_WRITE_SIZE):
+                yield from encode_item(item._replace(
+                    offset=item.offset + pos,
+                    data=item.data[pos:pos + MAX_WRITE_SIZE],
+                ))
+            return
+    try:
+        cmd_type, fields = _ITEM_TYPE_TO_COMMAND[type(item)]
+    except KeyError:
+        raise RuntimeError(f'Cannot write {item} to a version 1 send-stream')
+    yield _encode_command(cmd_type, (
+        _encode_attribute(attr_type, encode(getattr(item, name)))
+            for name, attr_type, encode in fields
+    ))
+
+
+def write_send_stream(items: Iterable[SendStreamItem], outfile) -> None:
+    '''
+    Writes a complete send-stream to the binary file `outfile`.  The first
+    item must be a `subvol` or `snapshot`, as with `btrfs send`.
+    '''
+    outfile.write(BTRFS_SEND_STREAM_MAGIC + _VERSION.pack(1))
+    for item in items:
+        for command in encode_item(item):
+            outfile.write(command)
+    outfile.write(_encode_command(_END_TYPE, ()))